@@ -27,6 +27,7 @@ from RunJobUtilities import dumpOutput          # ASCII dump
 from RunJobUtilities import getStdoutFilename   #
 from RunJobUtilities import findVmPeaks         #
 from RunJobUtilities import getSourceSetup      #
+import DiagnosticsScanner                       # Single pass scan of the payload stdout/stderr for all checks
 
 # Standard python modules
 import re
@@ -35,6 +36,14 @@ import time
 import commands
 from glob import glob
 
+# patterns looked for in the payload stdout/stderr, all found in the same pass over the file
+DiagnosticsScanner.registerPattern("events processed so far")
+DiagnosticsScanner.registerPattern("St9bad_alloc")
+DiagnosticsScanner.registerPattern("std::bad_alloc")
+DiagnosticsScanner.registerPattern("MemoryRescueSvc", "memory_rescue")
+DiagnosticsScanner.registerPattern("FATAL out of memory: taking the application down", "fatal_out_of_memory")
+DiagnosticsScanner.registerPattern("prepare 5 database is locked", "sqlite_locked")
+
 class ATLASExperiment(Experiment):
 
     # private data members
@@ -803,7 +812,12 @@ class ATLASExperiment(Experiment):
             N = 0
             if os.path.exists(filename):
                 tolog("Processing stdout file: %s" % (filename))
-                matched_lines = grep(["events processed so far"], filename)
+                try:
+                    # only the last line is needed
+                    matched_lines = DiagnosticsScanner.scan(filename).getLines("events processed so far", last=1)
+                except (IOError, OSError), e:
+                    tolog("!!WARNING!!2999!! %s" % (e))
+                    matched_lines = []
                 if len(matched_lines) > 0:
                     if "events read and" in matched_lines[-1]:
                         # event #415044, run #142189 2 events read and 0 events processed so far
@@ -966,10 +980,14 @@ class ATLASExperiment(Experiment):
                 tolog("Processing stderr file: %s" % (filename))
                 if os.path.getsize(filename) > 0:
                     tolog("WARNING: %s produced stderr, will dump to log" % (job.payload))
-                    stderr_output = dumpOutput(filename)
-                    if stderr_output.find("MemoryRescueSvc") >= 0 and \
-                           stderr_output.find("FATAL out of memory: taking the application down") > 0:
-                        out_of_memory = True
+                    dumpOutput(filename)
+                    try:
+                        result = DiagnosticsScanner.scan(filename)
+                    except (IOError, OSError), e:
+                        tolog("!!WARNING!!2999!! %s" % (e))
+                    else:
+                        if result.count("memory_rescue") > 0 and result.count("fatal_out_of_memory") > 0:
+                            out_of_memory = True
             else:
                 tolog("Warning: File %s does not exist" % (filename))
 
@@ -1425,9 +1443,13 @@ class ATLASExperiment(Experiment):
                 else:
                     # check for specific errors in athena stdout
                     if os.path.exists(filename):
-                        e1 = "prepare 5 database is locked"
                         e2 = "Error SQLiteStatement"
-                        _out = commands.getoutput('grep "%s" %s | grep "%s"' % (e1, filename, e2))
+                        try:
+                            _lines = DiagnosticsScanner.scan(filename).getLines("sqlite_locked")
+                            _out = "".join([line for line in _lines if e2 in line]).rstrip("\n")
+                        except (IOError, OSError), e:
+                            tolog("!!WARNING!!2999!! %s" % (e))
+                            _out = ""
                         if 'sqlite' in _out:
                             job.pilotErrorDiag = "NFS/SQLite locking problems: %s" % (_out)
                             job.result[2] = error.ERR_NFSSQLITE
@@ -1740,6 +1762,16 @@ class ATLASExperiment(Experiment):
         if limit == None:
             limit = 48
 
+        # read the remaining VOMS lifetime from the proxy file itself if possible, arcproxy and voms-proxy-info
+        # (which both need the full environment setup) are only used for proxies which can not be parsed
+        from ProxyInspector import getTimeLeft
+        timeleft = getTimeLeft()
+        if timeleft is not None:
+            ec, pilotErrorDiag = self.interpretProxyInfo(0, str(timeleft), limit)
+            if ec == 0:
+                tolog("Voms proxy verified using the proxy file")
+            return ec, pilotErrorDiag
+
         from SiteMover import SiteMover
         if envsetup == "":
             envsetup = SiteMover.getEnvsetup()
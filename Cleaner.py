@@ -1,11 +1,22 @@
 import os
+import stat
 import time
-import commands
-from dircache import listdir
-from glob import glob
+import errno
+import shutil
+import threading
+from fnmatch import fnmatch
 from pUtil import tolog
 from JobState import JobState
 
+# os.scandir is not available in python 2, use the scandir package if it is installed
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 class Cleaner:
     """
     This class is used to clean up lingering old/lost jobs.
@@ -29,13 +40,24 @@ class Cleaner:
     <limit> should be an integer > 0 [hours]
     <uflag> user flag needed to distinguish job type (an analysis pilot is not allowed
             to touch production job directories on some sites)
+    <time_budget> maximum time [s] the clean-up may take, directories which could not be
+            examined or removed in time are left for the next pilot (0: no limit)
+    <threads> number of threads removing directories
+    <dry_run> only report what would be removed
+
+    All Panda_Pilot_* directories are classified in a single pass over <path> (one directory
+    listing per pilot directory), and removed in-process by a small thread pool.
     """
 
-    def __init__(self, limit=12, path="/tmp", uflag=None):
+    def __init__(self, limit=12, path="/tmp", uflag=None, time_budget=0, threads=4, dry_run=False):
         """ Default init with verification """
 
         self.clean = True
         self.uflag = None
+        self.time_budget = time_budget
+        self.threads = max(threads, 1)
+        self.dry_run = dry_run
+        self.report = []
         # verify the clean-up limit
         _type = str(limit.__class__)
         if limit and _type.find('int') == -1:
@@ -75,255 +97,368 @@ class Cleaner:
         """ execute the clean-up """
 
         status = True
-        number_of_cleanups = 0
 
         if self.clean:
-            tolog("Executing empty dirs clean-up, stage 1/5")
-            Cleaner.purgeEmptyDirs(self.path)
+            t0 = time.time()
+            deadline = None
+            if self.time_budget > 0:
+                deadline = t0 + self.time_budget
+                tolog("Clean-up time budget: %d s" % (self.time_budget))
+
+            tolog("Scanning %s for lingering Panda_Pilot_* directories" % (self.path))
+            candidates = Cleaner.scan(self.path, deadline=deadline)
+            tolog("Scanned %d pilot directories in %.1f s%s" % (candidates['scanned'], time.time() - t0,
+                                                                  " (time budget exceeded)" if candidates['expired'] else ""))
+
+            removals = []
+            for kind, description in [('empty', 'empty dirs'), ('workdirs', 'work dirs'), ('maxedout', 'maxed-out dirs')]:
+                tolog("Found %d %s to purge" % (len(candidates[kind]), description))
+                removals += [(kind, _dir, reason) for _dir, reason in candidates[kind]]
+
+            tolog("Executing AthenaMP clean-up <SKIPPED>")
+            #files = ['AthenaMP_*', 'fifo_*', 'TokenExtractorChannel*', 'zmq_EventService*', 'asetup*', 'tmp*.pkl']
+            #for f in files:
+            #    removals += [('files', _file, reason) for _file, reason in Cleaner.scanFiles(self.path, f, limit=48*3600)]
 
-            tolog("Executing work dir clean-up, stage 2/5")
-            Cleaner.purgeWorkDirs(self.path)
+            tolog("Examining job state files of %d pilot directories" % (len(candidates['jobstates'])))
+            removals += self.examineJobStates(candidates['jobstates'], deadline)
 
-            tolog("Executing maxed-out dirs clean-up, stage 3/5")
-            Cleaner.purgeMaxedoutDirs(self.path)
+            # work dirs inside of removed pilot dirs need no removal of their own
+            dirs = set([_dir for kind, _dir, reason in removals if kind != 'workdirs'])
+            removals = [(kind, _dir, reason) for kind, _dir, reason in removals
+                        if kind != 'workdirs' or os.path.dirname(_dir) not in dirs]
 
-            tolog("Executing AthenaMP clean-up, stage 4/5 <SKIPPED>")
-            #files = ['AthenaMP_*', 'fifo_*', 'TokenExtractorChannel*', 'zmq_EventService*', 'asetup*', 'tmp*.pkl']
-            #for f in files:
-            #    Cleaner.purgeFiles(self.path, f, limit=48*3600)
-
-            tolog("Executing PanDA Pilot dir clean-up, stage 5/5")
-            JS = JobState()
-
-            # grab all job state files in all work directories
-            job_state_files = glob(self.path + "/Panda_Pilot_*/jobState-*.pickle")
-            number_of_files = len(job_state_files)
-            file_number = 0
-            max_cleanups = 30
-            tolog("Number of found job state files: %d" % (number_of_files))
-            if job_state_files:
-                # loop over all found job state files
-                for file_path in job_state_files:
-                    file_number += 1
-                    if file_number > max_cleanups:
-                        tolog("Maximum number of job recoveries exceeded for this pilot: %d" % (max_cleanups))
-                        break
-                    tolog("Processing job state file %d/%d: %s" % (file_number, number_of_files, file_path))
-                    current_time = int(time.time())
-
-                    # when was file last modified?
-                    try:
-                        file_modification_time = os.path.getmtime(file_path)
-                    except:
-                        # skip this file since it was not possible to read the modification time
-                        pass
-                    else:
-                        # was the job state file updated longer than the time limit? (convert to seconds)
-                        mod_time = current_time - file_modification_time
-                        if mod_time > self.limit*3600:
-                            tolog("File was last modified %d seconds ago (proceed)" % (mod_time))
-                            cmd = "whoami; ls -lF %s; ls -lF %s" % (file_path, os.path.dirname(file_path))
-                            tolog("Executing command: %s" % (cmd))
-                            ec, rs = commands.getstatusoutput(cmd)
-                            if ec == 0:
-                                tolog("%s" % (rs))
-                            else:
-                                tolog("!!WARNING!!2999!! %d, %s" % (ec, rs))
-
-                            # open the job state file
-                            if JS.get(file_path):
-                                # decode the job state info
-                                _job, _site, _node, _recoveryAttempt = JS.decode()
-
-                                # add member if it doesn't exist (new Job version)
-                                try:
-                                    _tmp = _job.prodSourceLabel
-                                except:
-                                    _job.prodSourceLabel = ''
-
-                                if _job and _site and _node:
-                                    # query the job state file for job information
-                                    if _job.result[0] == 'running' or _job.result[0] == 'starting' or (_job.result[0] == 'holding' and mod_time > 7*24*3600):
-                                        if _job.result[0] == 'holding':
-                                            tolog("Job %s was found in %s state but has not been modified for a long time - will be cleaned up" % (_job.jobId, _job.result[0]))
-                                        else:
-                                            tolog("Job %s was found in %s state - will be cleaned up" % (_job.jobId, _job.result[0]))
-                                        tolog("Erasing directory: %s" % (_site.workdir))
-                                        cmd = "rm -rf %s" % (_site.workdir)
-                                        try:
-                                            ec, rs = commands.getstatusoutput(cmd)
-                                        except:
-                                            tolog("!!WARNING!!5500!! Could not erase lost job workdir: %d, %s" % (ec, rs))
-                                            status = False
-                                            break
-                                        else:
-                                            tolog("Lost job workdir removed")
-                                    else:
-                                        tolog("Job found in state: %s" % (_job.result[0]))
-                        else:
-                            tolog("File was last modified %d seconds ago (skip)" % (mod_time))
+            self.report = removals
+            if self.dry_run:
+                for kind, _dir, reason in removals:
+                    tolog("Dry run, would remove %s: %s (%s)" % (kind, _dir, reason))
+                tolog("Dry run, would remove %d directories/files in %s" % (len(removals), self.path))
             else:
-                tolog("No job state files were found, aborting clean-up")
+                removed, failed, skipped = Cleaner.remove([_dir for kind, _dir, reason in removals],
+                                                          threads=self.threads, deadline=deadline)
+                tolog("Removed %d directories/files, %d failed, %d left for the next pilot (%.1f s)" %\
+                      (removed, failed, skipped, time.time() - t0))
+                if failed:
+                    status = False
         else:
             tolog("Clean-up turned off")
             status = False
 
         return status
 
-    def purgeEmptyDirs(path):
-        """ locate and remove empty lingering dirs """
+    def examineJobStates(self, job_state_files, deadline=None):
+        """ decide which pilot directories with job state files older than the limit can be removed """
 
-        all_dirs = glob("%s/Panda_Pilot_*" % (path))
-        max_dirs = 50
-        purged_nr = 0
-        dir_nr = 0
+        removals = []
+        max_cleanups = 30
+        current_time = int(time.time())
+        JS = JobState()
 
-        for _dir in all_dirs:
-            if dir_nr >= max_dirs:
+        for file_number, (file_path, file_modification_time) in enumerate(job_state_files):
+            if file_number >= max_cleanups:
+                tolog("Maximum number of job recoveries exceeded for this pilot: %d" % (max_cleanups))
+                break
+            if deadline and time.time() > deadline:
+                tolog("Clean-up time budget exceeded, leaving %d job state files for the next pilot" %\
+                      (len(job_state_files) - file_number))
                 break
-            # when was the dir last modified?
-            current_time = int(time.time())
+
+            # was the job state file updated longer than the time limit? (convert to seconds)
+            mod_time = current_time - file_modification_time
+            if mod_time <= self.limit*3600:
+                continue
+
+            tolog("Processing job state file %d/%d: %s (last modified %d seconds ago)" %\
+                  (file_number + 1, len(job_state_files), file_path, mod_time))
             try:
-                file_modification_time = os.path.getmtime(_dir)
-            except:
-                # skip this dir since it was not possible to read the modification time
-                pass
+                st = os.stat(file_path)
+                tolog("Job state file owner: %d, pilot is run by user %d, mode: %o" % (st.st_uid, os.getuid(), stat.S_IMODE(st.st_mode)))
+            except OSError, e:
+                tolog("!!WARNING!!2999!! %s" % (e))
+
+            # open the job state file
+            if not JS.get(file_path):
+                continue
+
+            # decode the job state info
+            _job, _site, _node, _recoveryAttempt = JS.decode()
+            if not (_job and _site and _node):
+                continue
+
+            # query the job state file for job information
+            if _job.result[0] == 'running' or _job.result[0] == 'starting' or (_job.result[0] == 'holding' and mod_time > 7*24*3600):
+                if _job.result[0] == 'holding':
+                    reason = "job %s was found in %s state but has not been modified for a long time" % (_job.jobId, _job.result[0])
+                else:
+                    reason = "job %s was found in %s state" % (_job.jobId, _job.result[0])
+                tolog("%s - will be cleaned up" % (reason.capitalize()))
+                removals.append(('jobstates', _site.workdir, reason))
             else:
-                mod_time = current_time - file_modification_time
-                if mod_time > 12*3600:
-                    try:
-                        ls = listdir(_dir)
-                    except Exception, e:
-                        tolog("!!WARNING!!2999!! Exception caught: %s" % str(e))
-                    else:
-                        if len(ls) == 0 or len(ls) == 1:
-                            if len(ls) == 0:
-                                tolog("Found empty dir: %s (last modified %d s ago, will now purge it)" % (_dir, mod_time))
-                            else:
-                                tolog("Found empty dir: %s (last modified %d s ago, will now purge it, 1 sub dir: %s)" % (_dir, mod_time, ls[0]))
-
-                            ec, rs = commands.getstatusoutput("rm -rf %s" % (_dir))
-                            if ec != 0:
-                                tolog("Failed to remove dir: %d, %s (belonging to user %d, pilot is run by user %d)" %\
-                                      (ec, rs, os.stat(_dir)[4], os.getuid()))
-                            else:
-                                purged_nr += 1
-            dir_nr += 1
-        tolog("Purged %d empty directories" % (purged_nr))
-            
-    purgeEmptyDirs = staticmethod(purgeEmptyDirs)    
+                tolog("Job found in state: %s" % (_job.result[0]))
 
-    def purgeWorkDirs(path):
-        """ locate and remove lingering athena workDirs """
+        return removals
 
-        all_dirs = glob("%s/Panda_Pilot_*/PandaJob*" % (path))
-        max_dirs = 50
-        purged_nr = 0
-        dir_nr = 0
+    def listdir(path):
+        """ return [(name, lstat result or None)] for all entries of a directory """
 
-        for _dir in all_dirs:
-            if dir_nr >= max_dirs:
+        entries = []
+        if scandir:
+            for entry in scandir(path):
+                try:
+                    entries.append((entry.name, entry.stat(follow_symlinks=False)))
+                except OSError:
+                    entries.append((entry.name, None))
+        else:
+            for name in os.listdir(path):
+                try:
+                    entries.append((name, os.lstat(os.path.join(path, name))))
+                except OSError:
+                    entries.append((name, None))
+        return entries
+
+    listdir = staticmethod(listdir)
+
+    def scan(path, deadline=None, min_age=12*3600):
+        """
+        classify all Panda_Pilot_* directories in path in a single pass, returns a dictionary with
+        'empty', 'maxedout', 'workdirs': [(path, reason)] of directories to be purged
+        'jobstates': [(job state file, mtime)] of pilot directories to be examined
+        """
+
+        candidates = {'empty': [], 'maxedout': [], 'workdirs': [], 'jobstates': [], 'scanned': 0, 'expired': False}
+        current_time = int(time.time())
+
+        try:
+            pilot_dirs = [(name, st) for name, st in Cleaner.listdir(path) if fnmatch(name, "Panda_Pilot_*")]
+        except OSError, e:
+            tolog("!!WARNING!!2999!! Exception caught: %s" % str(e))
+            return candidates
+
+        for name, st in pilot_dirs:
+            if deadline and time.time() > deadline:
+                candidates['expired'] = True
                 break
-            # when was the dir last modified?
-            current_time = int(time.time())
+
+            # skip this dir if it was not possible to read the modification time
+            if st is None or not stat.S_ISDIR(st.st_mode):
+                continue
+            _dir = os.path.join(path, name)
+            candidates['scanned'] += 1
+
             try:
-                file_modification_time = os.path.getmtime(_dir)
-            except:
-                # skip this dir since it was not possible to read the modification time
-                pass
-            else:
-                mod_time = current_time - file_modification_time
-                if mod_time > 12*3600:
-                    try:
-                        ls = listdir(_dir)
-                    except Exception, e:
-                        tolog("!!WARNING!!2999!! Exception caught: %s" % str(e))
+                entries = Cleaner.listdir(_dir)
+            except OSError, e:
+                tolog("!!WARNING!!2999!! Exception caught: %s" % str(e))
+                continue
+
+            mod_time = current_time - st.st_mtime
+            if mod_time > min_age:
+                if len(entries) <= 1:
+                    if entries:
+                        reason = "empty dir, last modified %d s ago, 1 sub dir: %s" % (mod_time, entries[0][0])
                     else:
-                        if len(ls) == 1:
-                            if "workDir" in ls:
-                                ec, rs = commands.getstatusoutput("ls -lF %s" % (_dir))
-                                tolog("ls: %s" % str(rs))
-                                tolog("Found single workDir: %s (will now purge it)" % (_dir))
-                                ec, rs = commands.getstatusoutput("rm -rf %s" % (_dir))
-                                if ec != 0:
-                                    tolog("Failed to remove dir: %s" % (rs))
-                                else:
-                                    purged_nr += 1
-            dir_nr += 1
-        tolog("Purged %d single workDirs directories" % (purged_nr))
-
-    purgeWorkDirs = staticmethod(purgeWorkDirs)    
+                        reason = "empty dir, last modified %d s ago" % (mod_time)
+                    candidates['empty'].append((_dir, reason))
+                    continue
+
+                maxedout = [entry for entry, entry_st in entries if ".MAXEDOUT" in entry]
+                if maxedout:
+                    candidates['maxedout'].append((_dir, "found MAXEDOUT job state file: %s" % (maxedout[0])))
+                    continue
+
+            # job state files are examined regardless of the age of the dir
+            for entry, entry_st in entries:
+                if fnmatch(entry, "jobState-*.pickle") and entry_st is not None:
+                    candidates['jobstates'].append((os.path.join(_dir, entry), entry_st.st_mtime))
+
+            # lingering athena work dirs
+            for entry, entry_st in entries:
+                if not fnmatch(entry, "PandaJob*") or entry_st is None or not stat.S_ISDIR(entry_st.st_mode):
+                    continue
+                if current_time - entry_st.st_mtime <= min_age:
+                    continue
+                try:
+                    ls = os.listdir(os.path.join(_dir, entry))
+                except OSError, e:
+                    tolog("!!WARNING!!2999!! Exception caught: %s" % str(e))
+                else:
+                    if ls == ["workDir"]:
+                        candidates['workdirs'].append((os.path.join(_dir, entry), "single workDir"))
+
+        return candidates
+
+    scan = staticmethod(scan)
+
+    def scanFiles(path, filename, limit=12*3600):
+        """ locate lingering directories/files matching filename, returns [(path, reason)] """
+
+        files = []
+        current_time = int(time.time())
+        try:
+            entries = Cleaner.listdir(path)
+        except OSError, e:
+            tolog("!!WARNING!!2999!! Exception caught: %s" % str(e))
+            return files
+
+        for name, st in entries:
+            if st is None or not fnmatch(name, filename):
+                continue
+            mod_time = current_time - st.st_mtime
+            if mod_time > limit:
+                files.append((os.path.join(path, name), "last modified %d s ago" % (mod_time)))
+        return files
+
+    scanFiles = staticmethod(scanFiles)
+
+    def removePath(path):
+        """ remove a directory tree or file in-process, returns a list of errors """
+
+        errors = []
+
+        def onerror(func, _path, exc_info):
+            # a read-only directory can not be emptied, try to make it writable once
+            parent = os.path.dirname(_path)
+            if exc_info[1].errno == errno.EACCES and not os.access(parent, os.W_OK):
+                try:
+                    os.chmod(parent, stat.S_IRWXU)
+                    func(_path)
+                    return
+                except OSError:
+                    pass
+            if exc_info[1].errno != errno.ENOENT:
+                errors.append("%s: %s" % (_path, exc_info[1]))
+
+        try:
+            st = os.lstat(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                errors.append("%s: %s" % (path, e))
+            return errors
+
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(path, onerror=onerror)
+        else:
+            try:
+                os.remove(path)
+            except OSError, e:
+                onerror(os.remove, path, (OSError, e, None))
 
-    def purgeFiles(path, filename, limit=12*3600):
-        """ locate and remove lingering directories/files """
+        if errors:
+            try:
+                owner = os.lstat(path).st_uid
+            except OSError:
+                owner = -1
+            errors.append("(belonging to user %d, pilot is run by user %d)" % (owner, os.getuid()))
+        return errors
 
-        all_files = glob("%s/%s" % (path, filename))
-        max_files = 50
-        file_nr = 0
+    removePath = staticmethod(removePath)
 
-        for _file in all_files:
-            if file_nr >= max_files:
-                break
+    def remove(paths, threads=4, deadline=None):
+        """ remove directories/files with a thread pool, returns (removed, failed, skipped) """
 
-            # when was the dir last modified?
-            current_time = int(time.time())
-            try:
-                file_modification_time = os.path.getmtime(_file)
-            except:
-                # skip this dir since it was not possible to read the modification time
-                pass
+        from ThreadPool import ThreadPool
+
+        counts = {'removed': 0, 'failed': 0, 'skipped': 0}
+        lock = threading.Lock()
+        expired = threading.Event()
+
+        def _remove(path):
+            if expired.isSet():
+                result = 'skipped'
             else:
-                mod_time = current_time - file_modification_time
-                if mod_time > limit:
-                    tolog("Found file %s last modified %d s ago (will now try to purge it)" % (_file, mod_time))
-                    ec, rs = commands.getstatusoutput("rm -f %s" % (_file))
-                    if ec != 0:
-                        tolog("Failed to remove dir: %s" % (rs))
-            file_nr += 1
+                errors = Cleaner.removePath(path)
+                if errors:
+                    tolog("Failed to remove %s: %s" % (path, "; ".join(errors)))
+                    result = 'failed'
+                else:
+                    result = 'removed'
+            lock.acquire()
+            counts[result] += 1
+            lock.release()
+
+        if not paths:
+            return 0, 0, 0
+        if deadline and time.time() > deadline:
+            tolog("Clean-up time budget exceeded, all removals are left for the next pilot")
+            return 0, 0, len(paths)
+
+        pool = ThreadPool(min(threads, len(paths)), poll_timeout=0.1)
+        for path in paths:
+            pool.add_task(_remove, path)
+
+        while not pool.is_empty():
+            if deadline and time.time() > deadline and not expired.isSet():
+                # do not start new removals, the ones in progress are completed in the background
+                tolog("Clean-up time budget exceeded, remaining removals are left for the next pilot")
+                expired.set()
+                break
+            time.sleep(0.1)
+
+        # idle workers are joined, busy ones finish their current removal in the background
+        pool.dismissWorkers(len(pool.workers), do_join=not expired.isSet())
+
+        lock.acquire()
+        removed, failed, skipped = counts['removed'], counts['failed'], counts['skipped']
+        lock.release()
+        skipped += len(paths) - removed - failed - skipped
+        return removed, failed, skipped
+
+    remove = staticmethod(remove)
+
+    def purgeEmptyDirs(path):
+        """ locate and remove empty lingering dirs """
+
+        dirs = Cleaner.scan(path)['empty']
+        removed, failed, skipped = Cleaner.remove([_dir for _dir, reason in dirs])
+        tolog("Purged %d empty directories" % (removed))
+
+    purgeEmptyDirs = staticmethod(purgeEmptyDirs)
+
+    def purgeWorkDirs(path):
+        """ locate and remove lingering athena workDirs """
+
+        dirs = Cleaner.scan(path)['workdirs']
+        removed, failed, skipped = Cleaner.remove([_dir for _dir, reason in dirs])
+        tolog("Purged %d single workDirs directories" % (removed))
+
+    purgeWorkDirs = staticmethod(purgeWorkDirs)
+
+    def purgeFiles(path, filename, limit=12*3600):
+        """ locate and remove lingering directories/files """
+
+        files = Cleaner.scanFiles(path, filename, limit=limit)
+        for _file, reason in files:
+            tolog("Found file %s %s (will now try to purge it)" % (_file, reason))
+        Cleaner.remove([_file for _file, reason in files])
 
     purgeFiles = staticmethod(purgeFiles)
 
     def purgeMaxedoutDirs(path):
         """ locate and remove maxedout lingering dirs """
 
-        all_dirs = glob("%s/Panda_Pilot_*" % (path))
-        max_dirs = 50
-        purged_nr = 0
-        dir_nr = 0
+        dirs = Cleaner.scan(path)['maxedout']
+        removed, failed, skipped = Cleaner.remove([_dir for _dir, reason in dirs])
+        tolog("Purged %d maxed-out directories" % (removed))
 
-        for _dir in all_dirs:
-            if dir_nr >= max_dirs:
-                break
-            # when was the dir last modified?
-            current_time = int(time.time())
-            try:
-                file_modification_time = os.path.getmtime(_dir)
-            except:
-                # skip this dir since it was not possible to read the modification time
-                pass
-            else:
-                mod_time = current_time - file_modification_time
-                if mod_time > 12*3600:
-                    try:
-                        ls = listdir(_dir)
-                    except Exception, e:
-                        tolog("!!WARNING!!2999!! Exception caught: %s" % str(e))
-                    else:
-                        if len(ls) > 0:
-                            purge = False
-                            for f in ls:
-                                if ".MAXEDOUT" in f:
-                                    tolog("Found MAXEDOUT job state file: %s (will now purge the work dir: %s)" % (f, _dir))
-                                    purge = True
-                                    break
-                            if purge:
-                                ec, rs = commands.getstatusoutput("rm -rf %s" % (_dir))
-                                if ec != 0:
-                                    tolog("Failed to remove dir: %d, (belonging to user %d, pilot is run by user %d)" %\
-                                          (ec, os.stat(_dir)[4], os.getuid()))
-                                else:
-                                    purged_nr += 1
-            dir_nr += 1
-        tolog("Purged %d empty directories" % (purged_nr))
-            
-    purgeMaxedoutDirs = staticmethod(purgeMaxedoutDirs)    
+    purgeMaxedoutDirs = staticmethod(purgeMaxedoutDirs)
+
+
+if __name__ == "__main__":
+    # clean-up report for a directory, nothing is removed unless --remove is given:
+    # python Cleaner.py <path> [--remove] [--limit=<hours>] [--time-budget=<s>]
+    import sys
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    opts = dict([(arg[2:].split("=") + [None])[:2] for arg in sys.argv[1:] if arg.startswith("--")])
+    if not args:
+        print "usage: python Cleaner.py <path> [--remove] [--limit=<hours>] [--time-budget=<s>]"
+        sys.exit(1)
+
+    cleaner = Cleaner(limit=int(opts.get('limit') or 12), path=args[0], time_budget=int(opts.get('time-budget') or 0),
+                      dry_run='remove' not in opts)
+    t0 = time.time()
+    cleaner.cleanup()
+    for kind, _dir, reason in cleaner.report:
+        print "%-9s %s (%s)" % (kind, _dir, reason)
+    print "%d directories/files %s in %.2f s" % (len(cleaner.report), "removed" if 'remove' in opts else "to be removed",
+                                                 time.time() - t0)
@@ -0,0 +1,231 @@
+# CopytoolSetupCache.py
+#
+# Process-wide cache of copytool setup probes.
+# Site movers verify their setup by sourcing the (ALRB/CVMFS) setup string and running 'which <copyCommand>'
+# for every new mover instance, and prefix every copy command with the same setup string. Sourcing such a setup
+# can take seconds. This module probes a setup once per (setup string, copy command, X509 proxy), captures the
+# resulting environment with 'env -0', and runs later copytool commands directly in that environment.
+# A probe is redone when the proxy file or one of the sourced setup files changes.
+
+import os
+import time
+import threading
+import subprocess
+
+from pUtil import tolog, extractFilePaths
+
+# proxy checks are only trusted for this long, as the remaining proxy lifetime shrinks
+PROXY_CHECK_TTL = 600
+
+_MARKER = "__COPYTOOL_SETUP_ENV__"
+
+_probes = {}
+_proxyChecks = {}
+_lock = threading.Lock()
+
+
+def getProxyPath():
+    """ Return the X509 proxy path used by the copytools """
+
+    return os.environ.get('X509_USER_PROXY', '')
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+
+def getSignature(setupStr):
+    """ Return the state of all files the setup depends on (sourced files and the proxy) """
+
+    paths = extractFilePaths(setupStr.replace("'", "")) or []
+    proxy = getProxyPath()
+    if proxy:
+        paths.append(proxy)
+    return [(path, _stamp(path)) for path in paths]
+
+
+def getKey(setupStr, copyCommand):
+    return (setupStr.strip(), copyCommand, getProxyPath())
+
+
+def parseEnv(data):
+    """ Parse 'env -0' output into a dictionary """
+
+    env = {}
+    for entry in data.split('\0'):
+        if '=' not in entry:
+            continue
+        name, value = entry.split('=', 1)
+        # skip exported shell functions and shell internals
+        if name.startswith('BASH_FUNC_') or name in ('_', 'SHLVL', 'PWD', 'OLDPWD'):
+            continue
+        env[name] = value
+    return env
+
+
+def usableSetup(setupStr):
+    """ Can the environment of this setup be captured? Aliases (and functions) are not exported """
+
+    return "alias" not in setupStr
+
+
+def _runProbe(setupStr, copyCommand):
+    """ Source the setup, locate the copy command and dump the environment, all in one shell """
+
+    command = setupStr.strip()
+    if command != "" and not command.endswith(';'):
+        command += ";"
+    command += " which %s; _ec=$?; printf '\\n%s\\n'; env -0; exit $_ec" % (copyCommand, _MARKER)
+
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    data, _ = process.communicate()
+    status = process.returncode
+
+    env = None
+    output = data
+    if ("\n%s\n" % _MARKER) in data:
+        output, envData = data.split("\n%s\n" % _MARKER, 1)
+        env = parseEnv(envData)
+        if not env.get('PATH'):
+            # 'env -0' not supported
+            env = None
+
+    # same status and output conventions as commands.getstatusoutput()
+    if status < 0:
+        status = -status
+    else:
+        status = status << 8
+    if output.endswith('\n'):
+        output = output[:-1]
+
+    return status, output, env
+
+
+def probeSetup(setupStr, copyCommand):
+    """
+    Verify that copyCommand is found after sourcing setupStr, return (status, output) like the
+    'which' call in the site movers did. The probe (and the captured environment) is cached.
+    """
+
+    key = getKey(setupStr, copyCommand)
+    signature = getSignature(setupStr)
+
+    _lock.acquire()
+    try:
+        entry = _probes.get(key)
+        if entry and entry['signature'] == signature:
+            tolog("Using cached setup probe for %s (%d s old)" % (copyCommand, time.time() - entry['time']))
+            return entry['status'], entry['output']
+    finally:
+        _lock.release()
+
+    t0 = time.time()
+    status, output, env = _runProbe(setupStr, copyCommand)
+    tolog("Probed setup for %s in %.1f s (status=%s, environment captured: %s)" % (copyCommand, time.time() - t0, status, env is not None))
+
+    if not usableSetup(setupStr):
+        env = None
+
+    # only remember successful probes, a failed probe (e.g. cvmfs hiccup) should be redone on the next attempt
+    if status == 0:
+        _lock.acquire()
+        try:
+            _probes[key] = {'signature': signature, 'status': status, 'output': output, 'env': env, 'time': time.time()}
+        finally:
+            _lock.release()
+
+    return status, output
+
+
+def getEnv(setupStr, copyCommand):
+    """ Return the captured environment of a successful and still valid probe, or None """
+
+    _lock.acquire()
+    try:
+        entry = _probes.get(getKey(setupStr, copyCommand))
+    finally:
+        _lock.release()
+
+    if not entry or entry['env'] is None:
+        return None
+    if entry['signature'] != getSignature(setupStr):
+        return None
+    return entry['env']
+
+
+def splitCommand(cmd, setupStr, copyCommand):
+    """
+    Return (command, env) to run a mover command which is prefixed with setupStr.
+    If a valid environment was captured for the setup, the prefix is dropped and the environment returned,
+    otherwise the command is returned unchanged with env=None (i.e. the setup is sourced again).
+    """
+
+    setupStr = setupStr.strip()
+    stripped = cmd.lstrip()
+    if not setupStr or not stripped.startswith(setupStr):
+        return cmd, None
+
+    env = getEnv(setupStr, copyCommand)
+    if env is None:
+        return cmd, None
+
+    return stripped[len(setupStr):].lstrip(), env
+
+
+def getstatusoutput(cmd, setupStr, copyCommand):
+    """ commands.getstatusoutput() for mover commands, using the captured setup environment if possible """
+
+    cmd, env = splitCommand(cmd, setupStr, copyCommand)
+
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    output, _ = process.communicate()
+    status = process.returncode
+    if status < 0:
+        status = -status
+    else:
+        status = status << 8
+    if output.endswith('\n'):
+        output = output[:-1]
+    return status, output
+
+
+def verifyProxy(thisExperiment, setupStr, limit=None):
+    """ Cached thisExperiment.verifyProxy(envsetup=setupStr, limit=limit), trusted for PROXY_CHECK_TTL seconds """
+
+    key = (thisExperiment.__class__.__name__, setupStr.strip(), getProxyPath(), limit)
+    signature = getSignature(setupStr)
+
+    _lock.acquire()
+    try:
+        entry = _proxyChecks.get(key)
+        if entry and entry['signature'] == signature and time.time() - entry['time'] < PROXY_CHECK_TTL:
+            return entry['status'], entry['output']
+    finally:
+        _lock.release()
+
+    status, output = thisExperiment.verifyProxy(envsetup=setupStr, limit=limit)
+
+    # only remember successful checks, a failed check should be redone on the next attempt
+    if status == 0:
+        _lock.acquire()
+        try:
+            _proxyChecks[key] = {'signature': signature, 'status': status, 'output': output, 'time': time.time()}
+        finally:
+            _lock.release()
+
+    return status, output
+
+
+def clear():
+    """ Forget all probes, e.g. after the proxy was replaced in place """
+
+    _lock.acquire()
+    try:
+        _probes.clear()
+        _proxyChecks.clear()
+    finally:
+        _lock.release()
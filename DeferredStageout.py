@@ -11,6 +11,13 @@ Also I had too much time to spend it on writing all of these comments
 from glob import glob
 
 import os, sys
+import errno
+import re
+import fcntl
+import shutil
+import tempfile
+import multiprocessing
+from Queue import Empty
 import pUtil
 import time
 from JobState import JobState
@@ -94,19 +101,30 @@ class LockFileWrapper(object):
 
     def __init__(self, file_path):
         self.__name = os.path.join(os.path.dirname(file_path), "ATOMIC_LOCKFILE")
+        self.__fd = None
 
     def __enter__(self):
         # acquire the lock
-        self.__fd = os.open(self.__name, os.O_EXCL|os.O_CREAT)
+        try:
+            self.__fd = os.open(self.__name, os.O_EXCL|os.O_CREAT)
+        except OSError:
+            # work dir is locked by another pilot (or worker)
+            log("Found lock file: %s (skip this dir)" % (self.__name))
+            return False
 
         return True
 
     def __exit__(self, *args):
+        if self.__fd is None:
+            return
         try:
             os.close(self.__fd)
             os.unlink(self.__name)
         except Exception, e:
-            if "Bad file descriptor" in e:
+            if isinstance(e, OSError) and e.errno == errno.ENOENT:
+                # a finished job's dir is removed by cleanup() while it is locked
+                log("Lock file was removed with the job directory: %s" % (self.__name))
+            elif "Bad file descriptor" in e:
                 log("Lock file already released")
             else:
                 log("WARNING: Could not release lock file: %s" % (e))
@@ -144,8 +162,11 @@ def DeferredStageout(deferred_stageout_dirs, max_stageout_jobs=0,
                                     mandatory parameter
     :param max_stageout_jobs:   (integer)   maximum stageout jobs to be finished, if zero, every job will be processed
                                 defaults to zero
+    :param deferredStageoutWorkers: (integer)   number of job directories processed concurrently, if it is less than 2,
+                                                jobs are processed one by one
+                                    defaults to env['deferredStageoutWorkers']
 
-    Other parameters are passed into DeferredStageoutDir
+    Other parameters are passed into DeferredStageoutDir (or DeferredStageoutConcurrent)
 
     :return: (integer) number of staged out jobs
     """
@@ -157,6 +178,9 @@ def DeferredStageout(deferred_stageout_dirs, max_stageout_jobs=0,
     # reduce duplicates
     dirs_set = set(map(os.path.abspath, deferred_stageout_dirs))
 
+    if DorE(kwargs, 'deferredStageoutWorkers') > 1:
+        return DeferredStageoutConcurrent(sorted(dirs_set), max_stageout_jobs, **kwargs)
+
     for deferred_stageout_dir in dirs_set:
         # increment in two steps, because maybe I'll send some other params
         d.update({'max_stageout_jobs': max_stageout_jobs-stageout_jobs if max_stageout_jobs > 0 else 0})
@@ -171,6 +195,263 @@ def DeferredStageout(deferred_stageout_dirs, max_stageout_jobs=0,
     return stageout_jobs
 
 
+def FindDeferredStageoutJobs(deferred_stageout_dir, **kwargs):
+    """
+    Finds the jobs in a deferred stageout directory.
+
+    :param deferred_stageout_dir:   (string) directory to scan for deferred stageout jobs
+    :param job_state_mode:  ("default"|"test")  Mode of job state file
+                            defaults to "default"
+
+    :return: (list, list) HPC job directories, job state files of the other jobs
+    """
+    job_state_files = glob(deferred_stageout_dir + "/*/" + jobState_file_wildcart)
+    job_state_files = pUtil.removeTestFiles(job_state_files, mode=kwargs.get("job_state_mode", "default"))
+
+    hpc_job_state_dirs = map(os.path.dirname, glob(deferred_stageout_dir + "/*/" + hpc_jobState_file_wildcart))
+
+    job_state_files = filter(lambda jsf: os.path.dirname(jsf) not in hpc_job_state_dirs, job_state_files)
+
+    return hpc_job_state_dirs, job_state_files
+
+
+def RemoveEmptyDeferredStageoutDir(deferred_stageout_dir):
+    """
+    Removes a processed deferred stageout directory, if it has no subdirs left.
+    """
+    log("Directory \"%s\" is to be removed." % deferred_stageout_dir)
+    log("Contents:")
+    o, e = commands.getstatusoutput("ls -la "+deferred_stageout_dir)
+    log("%s" % o)
+    dirs = filter(os.path.isdir, glob(deferred_stageout_dir + "/*"))
+
+    if len(dirs) < 1:
+        log("It is OK to remove it, proceeding." % deferred_stageout_dir)
+        o, e = commands.getstatusoutput("rm -rf "+deferred_stageout_dir)
+    else:
+        log("There are subdirs in this dir, can not remove.")
+        log("Remaining subdirs: %s" % dirs)
+
+
+class EndpointSlots(object):
+    """
+    Limits the number of concurrent transfers per destination endpoint across processes.
+    Every endpoint has `limit` slot files in `lock_dir`, a transfer holds an flock on one of them.
+    """
+
+    def __init__(self, lock_dir, limit, poll_interval=0.2):
+        self.lock_dir = lock_dir
+        self.limit = limit
+        self.poll_interval = poll_interval
+
+    def acquire(self, endpoint):
+        name = re.sub(r'[^\w.-]', '_', endpoint) or "default"
+        waiting = False
+        while True:
+            for i in range(self.limit):
+                fd = os.open(os.path.join(self.lock_dir, "%s.%d" % (name, i)), os.O_CREAT | os.O_RDWR)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    os.close(fd)
+                else:
+                    return fd
+            if not waiting:
+                log("All %d transfer slots for endpoint %s are busy, waiting" % (self.limit, endpoint))
+                waiting = True
+            time.sleep(self.poll_interval)
+
+    def release(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+class EndpointSlot(object):
+
+    def __init__(self, slots, endpoint):
+        self.__slots = slots
+        self.__endpoint = endpoint
+        self.__fd = None
+
+    def __enter__(self):
+        if self.__slots:
+            self.__fd = self.__slots.acquire(self.__endpoint)
+        return self
+
+    def __exit__(self, *args):
+        if self.__fd is not None:
+            self.__slots.release(self.__fd)
+
+
+def GetDestinationEndpoint(job):
+    """ The endpoint used to limit concurrent transfers of a job """
+
+    if job.ddmEndPointOut:
+        return job.ddmEndPointOut[0]
+    if job.destinationSE:
+        return job.destinationSE
+    return "default"
+
+
+def _DeferredStageoutWorker(task, queue, kwargs):
+    """ Processes one job directory in a worker process and reports (task, was_stageout, finalize) to the parent """
+
+    kind, job_dir, job_state_file, _ = task
+    finalize = []
+    was_stageout = False
+    try:
+        if kind == "hpc":
+            was_stageout = DeferredStageoutHPCJob(job_dir, **kwargs)
+        else:
+            was_stageout = DeferredStageoutJob(job_dir, job_state_file=job_state_file, locked=True,
+                                               finalize=finalize, **kwargs)
+    except:
+        log("Deferred stageout failed for job directory %s: %s" % (job_dir, traceback.format_exc()))
+
+    try:
+        queue.put((task, was_stageout, finalize))
+    except:
+        # e.g. the job state can not be pickled, the parent will treat the job as not staged out
+        log("Could not report deferred stageout of %s: %s" % (job_dir, traceback.format_exc()))
+        queue.put((task, False, []))
+
+
+def DeferredStageoutConcurrent(deferred_stageout_dirs, max_stageout_jobs=0, remove_empty_dir=False, **kwargs):
+    """
+    Performs deferred stageout of the jobs in all provided dirs with a bounded pool of worker processes.
+    Job directories are independent, so every job directory is processed in its own process (the stageout code
+    changes the working dir and the log file of the process).
+
+    The atomic lock file of a job directory is held by this process from dispatching the job until its server update
+    is done. The workers only perform the transfers, the final server updates and post-job actions are performed
+    here, one job after the other with a single server client.
+
+    :param deferred_stageout_dirs:  (array of strings)  list of directories to search for jobs.
+    :param max_stageout_jobs:   (integer)   maximum stageout jobs to be finished, if zero, every job will be processed
+    :param remove_empty_dir:  (bool)    Remove the processed directories, if they are empty
+    :param deferredStageoutWorkers: (integer)   maximum number of concurrent worker processes
+                                    defaults to env['deferredStageoutWorkers']
+    :param maxEndpointTransfers:    (integer)   maximum number of concurrent transfers to the same destination
+                                                endpoint, if zero, transfers are not limited
+                                    defaults to env['maxEndpointTransfers']
+
+    Other parameters are passed into DeferredStageoutJob and DeferredStageoutHPCJob
+
+    :return: (integer) number of staged out jobs
+    """
+    max_workers = DorE(kwargs, 'deferredStageoutWorkers')
+    max_endpoint_transfers = DorE(kwargs, 'maxEndpointTransfers')
+
+    tasks = []
+    for deferred_stageout_dir in deferred_stageout_dirs:
+        log("Scanning directory \"%s\" for deferred stageout jobs." % deferred_stageout_dir)
+        hpc_job_state_dirs, job_state_files = FindDeferredStageoutJobs(deferred_stageout_dir, **kwargs)
+        tasks += [("hpc", job_dir, "", deferred_stageout_dir) for job_dir in hpc_job_state_dirs]
+        tasks += [("job", os.path.dirname(jsf), jsf, deferred_stageout_dir) for jsf in job_state_files]
+
+    if not tasks:
+        log("No deferred stageout jobs found")
+
+    lock_dir = None
+    d = dict(kwargs)
+    if max_endpoint_transfers > 0:
+        lock_dir = tempfile.mkdtemp(prefix="deferred-stageout-slots-")
+        d['endpoint_slots'] = EndpointSlots(lock_dir, max_endpoint_transfers)
+
+    from PandaServerClient import PandaServerClient
+    d['panda_client'] = PandaServerClient(pilot_version=DorE(kwargs, 'version'),
+                                          pilot_version_tag=DorE(kwargs, 'pilot_version_tag'),
+                                          pilot_initdir=DorE(kwargs, 'pilot_initdir'),
+                                          jobSchedulerId=DorE(kwargs, 'jobSchedulerId'),
+                                          pilotId=DorE(kwargs, 'pilotId'),
+                                          updateServer=DorE(kwargs, 'updateServerFlag'),
+                                          jobrec=DorE(kwargs, 'jobrec'),
+                                          pshttpurl=DorE(kwargs, 'pshttpurl'))
+
+    log("Processing %d deferred stageout jobs with up to %d workers (%s concurrent transfers per endpoint)" %
+        (len(tasks), max_workers, max_endpoint_transfers if max_endpoint_transfers > 0 else "unlimited"))
+
+    queue = multiprocessing.Queue()
+    active = {}  # task -> (process, lock)
+    stageout_jobs = 0
+    complete_dirs = set(deferred_stageout_dirs)
+
+    try:
+        while tasks or active:
+            # start new workers, never more than the remaining number of jobs to be staged out
+            while tasks and len(active) < max_workers and \
+                    (max_stageout_jobs <= 0 or stageout_jobs + len(active) < max_stageout_jobs):
+                task = tasks.pop(0)
+                kind, job_dir, job_state_file, _ = task
+
+                lock = None
+                if kind == "job":
+                    lock = LockFileWrapper(job_state_file)
+                    if not lock.__enter__():
+                        continue
+
+                process = multiprocessing.Process(target=_DeferredStageoutWorker, args=(task, queue, d))
+                process.start()
+                active[task] = (process, lock)
+
+            if not active:
+                break
+
+            try:
+                result = queue.get(timeout=5)
+            except Empty:
+                # workers which died without reporting
+                for task, (process, lock) in active.items():
+                    if not process.is_alive():
+                        log("!!WARNING!!1999!! Deferred stageout worker for %s died (exit code %s)" %
+                            (task[1], process.exitcode))
+                        del active[task]
+                        if lock:
+                            lock.__exit__()
+                continue
+
+            task, was_stageout, finalize = result
+            process, lock = active.pop(task)
+            process.join()
+
+            try:
+                # final server updates, one job after the other
+                for job_state, XMLStr, rc in finalize:
+                    with LogWrapper(d.get('deferred_stageout_logfile', False), job_state.job.jobId):
+                        FinalizeDeferredStageoutJob(job_state, XMLStr, rc, **d)
+            except:
+                log("!!WARNING!!1999!! Failed to finalize deferred stageout of %s: %s" %
+                    (task[1], traceback.format_exc()))
+            finally:
+                if lock:
+                    lock.__exit__()
+
+            if was_stageout:
+                stageout_jobs += 1
+
+        if tasks:
+            # stopped at max_stageout_jobs
+            complete_dirs -= set(task[3] for task in tasks)
+    finally:
+        for task, (process, lock) in active.items():
+            process.terminate()
+            process.join()
+            if lock:
+                lock.__exit__()
+        if lock_dir:
+            shutil.rmtree(lock_dir, ignore_errors=True)
+
+    log("Deferred stageout finished: %d jobs staged out" % stageout_jobs)
+
+    if remove_empty_dir:
+        for deferred_stageout_dir in sorted(complete_dirs):
+            RemoveEmptyDeferredStageoutDir(deferred_stageout_dir)
+
+    return stageout_jobs
+
+
 def DeferredStageoutLocal(**kwargs):
     """
     This is a simple alias to
@@ -210,12 +491,7 @@ def DeferredStageoutDir(deferred_stageout_dir, max_stageout_jobs=0, remove_empty
     stageout_jobs = 0
     d = dict(kwargs)
 
-    job_state_files = glob(deferred_stageout_dir + "/*/" + jobState_file_wildcart)
-    job_state_files = pUtil.removeTestFiles(job_state_files, mode=kwargs.get("job_state_mode", "default"))
-
-    hpc_job_state_dirs = map(os.path.dirname, glob(deferred_stageout_dir + "/*/" + hpc_jobState_file_wildcart))
-
-    job_state_files = filter(lambda jsf: os.path.dirname(jsf) not in hpc_job_state_dirs, job_state_files)
+    hpc_job_state_dirs, job_state_files = FindDeferredStageoutJobs(deferred_stageout_dir, **kwargs)
 
     for hpc_job_state_dir in hpc_job_state_dirs:
         # increment in two steps, because maybe I'll return some other params
@@ -245,18 +521,7 @@ def DeferredStageoutDir(deferred_stageout_dir, max_stageout_jobs=0, remove_empty
     log("Finished processing directory \"%s\"." % deferred_stageout_dir)
 
     if remove_empty_dir:
-        log("Directory \"%s\" is to be removed." % deferred_stageout_dir)
-        log("Contents:")
-        o, e = commands.getstatusoutput("ls -la "+deferred_stageout_dir)
-        log("%s" % o)
-        dirs = filter(os.path.isdir, glob(deferred_stageout_dir + "/*"))
-
-        if len(dirs) < 1:
-            log("It is OK to remove it, proceeding." % deferred_stageout_dir)
-            o, e = commands.getstatusoutput("rm -rf "+deferred_stageout_dir)
-        else:
-            log("There are subdirs in this dir, can not remove.")
-            log("Remaining subdirs: %s" % dirs)
+        RemoveEmptyDeferredStageoutDir(deferred_stageout_dir)
 
     return stageout_jobs
 
@@ -342,7 +607,7 @@ def DeferredStageoutHPCJob(job_dir, deferred_stageout_logfile=False, **kwargs):
         return False
 
 
-def DeferredStageoutJob(job_dir, job_state_file="", deferred_stageout_logfile=False,
+def DeferredStageoutJob(job_dir, job_state_file="", deferred_stageout_logfile=False, locked=False, finalize=None,
                         **kwargs):
     """
     Performs stageing out preparation and stages out the job in specified directory.
@@ -357,6 +622,11 @@ def DeferredStageoutJob(job_dir, job_state_file="", deferred_stageout_logfile=Fa
                                                         Replaces "{job_id}" with current job id like
                                                         "log-{job_id}.txt" -> "log-124124.txt"
                                         Default False
+    :param locked:  (bool)  the atomic lock file of the job directory is already held by the caller
+                    defaults to False
+    :param finalize:    (list|None) if a list is given, the server update and post-job actions are not performed, but
+                                    (job_state, XMLStr, rc) is appended to it for FinalizeDeferredStageoutJob
+                        defaults to None
 
     Other parameters are passed into other functions
 
@@ -377,7 +647,10 @@ def DeferredStageoutJob(job_dir, job_state_file="", deferred_stageout_logfile=Fa
 
     # lockfd, lockfn = createAtomicLockFile(job_dir)
 
-    with LockFileWrapper(job_dir):
+    with LockFileWrapper(job_state_file) as is_locked:
+        if not is_locked and not locked:
+            return False
+
         if not TestJobDirForDeferredStageoutNecessity(job_dir, job_state_file, **kwargs):
             log("Job \"%s\" does not need deferred stageout procedure (yet)" % job_dir)
             # releaseAtomicLockFile(lockfd, lockfn)
@@ -444,67 +717,92 @@ def DeferredStageoutJob(job_dir, job_state_file="", deferred_stageout_logfile=Fa
             if logfile != "" and not pUtil.isLogfileCopied(job_state.site.workdir):
                 log("Stageout will now transfer the log")
                 _log = JobLog()
-                ret, _ = _log.transferLogFile(job_state.job, job_state.site, DorE(kwargs, 'experiment'), dest=None,
-                                              jr=True)
+                with EndpointSlot(kwargs.get('endpoint_slots'), GetDestinationEndpoint(job_state.job)):
+                    ret, _ = _log.transferLogFile(job_state.job, job_state.site, DorE(kwargs, 'experiment'), dest=None,
+                                                  jr=True)
 
             if not ret:
                 rc = ReturnCode.Holding  # We need to transfer log file regardless the files
 
-            if rc == ReturnCode.OK:
-                if pUtil.verifyTransfer(job_state.site.workdir):
-                    job_state.job.result[0] = "finished"
-                else:
-                    job_state.job.result[0] = "failed"
-                job_state.job.setState(job_state.job.result)
+            pUtil.chdir(currentdir)
+
+            if finalize is not None:
+                finalize.append((job_state, XMLStr, rc))
+                return True
 
-            if job_state.job.result[0] in finalJobStates:
-                job_state.job.final_state = job_state.job.result[0]
+            return FinalizeDeferredStageoutJob(job_state, XMLStr, rc, **kwargs)
 
-            log("Stageout will now update the server with new status")
 
-            rt, retNode = updatePandaServer(job_state, xmlstr=XMLStr, **kwargs)
+def FinalizeDeferredStageoutJob(job_state, XMLStr, rc, **kwargs):
+    """
+    Sets the final state of a staged out job, updates the server and performs post-job actions.
 
-            if rt == 0:
-                log("Job %s updated (exit code %d)" % (job_state.job.jobId, job_state.job.result[2]))
+    :param job_state:   (JobState) job state after the transfers
+    :param XMLStr:  (string) job metadata
+    :param rc:  (integer) ReturnCode of the transfers
 
-                # did the server send back a command?
-                if "tobekilled" in job_state.job.action:
-                    log("!!WARNING!!1120!! Panda server returned a \'tobekilled\' command")
-                    job_state.job.result[0] = "failed"
+    Other parameters are passed into other functions
 
-                # further recovery attempt unnecessary, but keep the work dir for debugging
-                if job_state.job.result[0] == "failed":
-                    log("Further recovery attempts will be prevented for failed job (will leave work dir)")
-                    if not job_state.rename(job_state.site, job_state.job):
-                        log("(Fate of job state file left for next pilot)")
+    :return: (bool) True
+    """
+    currentdir = os.getcwd()
+    pUtil.chdir(job_state.site.workdir)
 
-            else:
-                log("!!WARNING!!1120!! Panda server returned a %d" % (rt))
+    if rc == ReturnCode.OK:
+        if pUtil.verifyTransfer(job_state.site.workdir):
+            job_state.job.result[0] = "finished"
+        else:
+            job_state.job.result[0] = "failed"
+        job_state.job.setState(job_state.job.result)
 
-                # store the final state so that the next pilot will know
+    if job_state.job.result[0] in finalJobStates:
+        job_state.job.final_state = job_state.job.result[0]
 
-                # store the metadata xml
-                retNode['xml'] = XMLStr
+    log("Stageout will now update the server with new status")
 
-                # update the job state file with the new state information
-                _retjs = pUtil.updateJobState(job_state.job, job_state.site, retNode, job_state.recoveryAttempt)
+    rt, retNode = updatePandaServer(job_state, xmlstr=XMLStr, **kwargs)
 
-            log("Stageout will now proceed to post-job actions")
+    if rt == 0:
+        log("Job %s updated (exit code %d)" % (job_state.job.jobId, job_state.job.result[2]))
 
-            if job_state.job.result[0] in finalJobStates:
-                pUtil.postJobTask(job_state.job, job_state.site,
-                                  DorE(kwargs, 'workerNode'), DorE(kwargs, 'experiment'), jr=True,
-                                  ra=job_state.recoveryAttempt)
+        # did the server send back a command?
+        if "tobekilled" in job_state.job.action:
+            log("!!WARNING!!1120!! Panda server returned a \'tobekilled\' command")
+            job_state.job.result[0] = "failed"
 
-            pUtil.chdir(currentdir)
+        # further recovery attempt unnecessary, but keep the work dir for debugging
+        if job_state.job.result[0] == "failed":
+            log("Further recovery attempts will be prevented for failed job (will leave work dir)")
+            if not job_state.rename(job_state.site, job_state.job):
+                log("(Fate of job state file left for next pilot)")
 
-            # releaseAtomicLockFile(lockfd, lockfn)
+    else:
+        log("!!WARNING!!1120!! Panda server returned a %d" % (rt))
+
+        # store the final state so that the next pilot will know
+
+        # store the metadata xml
+        retNode['xml'] = XMLStr
 
-            if job_state.job.result[0] == "finished":
-                log("Stageout will now remove the job, it is in finished state and can be removed")
-                cleanup(job_state)
+        # update the job state file with the new state information
+        _retjs = pUtil.updateJobState(job_state.job, job_state.site, retNode, job_state.recoveryAttempt)
 
-            return True
+    log("Stageout will now proceed to post-job actions")
+
+    if job_state.job.result[0] in finalJobStates:
+        pUtil.postJobTask(job_state.job, job_state.site,
+                          DorE(kwargs, 'workerNode'), DorE(kwargs, 'experiment'), jr=True,
+                          ra=job_state.recoveryAttempt)
+
+    pUtil.chdir(currentdir)
+
+    # releaseAtomicLockFile(lockfd, lockfn)
+
+    if job_state.job.result[0] == "finished":
+        log("Stageout will now remove the job, it is in finished state and can be removed")
+        cleanup(job_state)
+
+    return True
 
 
 def TestJobDirForDeferredStageoutNecessity(job_dir, job_state_file,
@@ -865,15 +1163,16 @@ def TransferFiles(job_state, datadir, files, **kwargs):
     ec = -1
     try:
         # Note: alt stage-out numbers are not saved in recovery mode (job object not returned from this function)
-        rc, pilotErrorDiag, rf, rs, job.filesNormalStageOut, job.filesAltStageOut, os_bucket_id = Mover.mover_put_data(
-            "xmlcatalog_file:%s" % outPFC, dsname,
-            thisSite.sitename, thisSite.computingElement, analysisJob=pUtil.isAnalysisJob(job.trf.split(",")[0]),
-            proxycheck=DorE(kwargs, 'proxycheckFlag'),
-            pinitdir=DorE(kwargs, 'pilot_initdir'),
-            datasetDict=datasetDict,
-            stageoutTries=DorE(kwargs, 'stageoutretry'), 
-            cmtconfig=cmtconfig, recoveryWorkDir=thisSite.workdir,
-            job=job)
+        with EndpointSlot(kwargs.get('endpoint_slots'), GetDestinationEndpoint(job)):
+            rc, pilotErrorDiag, rf, rs, job.filesNormalStageOut, job.filesAltStageOut, os_bucket_id = Mover.mover_put_data(
+                "xmlcatalog_file:%s" % outPFC, dsname,
+                thisSite.sitename, thisSite.computingElement, analysisJob=pUtil.isAnalysisJob(job.trf.split(",")[0]),
+                proxycheck=DorE(kwargs, 'proxycheckFlag'),
+                pinitdir=DorE(kwargs, 'pilot_initdir'),
+                datasetDict=datasetDict,
+                stageoutTries=DorE(kwargs, 'stageoutretry'),
+                cmtconfig=cmtconfig, recoveryWorkDir=thisSite.workdir,
+                job=job)
     except Exception, e:
         pilotErrorDiag = "Put function can not be called for staging out: %s" % str(e)
         log("!!%s!!1105!! %s" % (env['errorLabel'], pilotErrorDiag))
@@ -960,6 +1259,14 @@ def updatePandaServer(job_state, xmlstr=None, spaceReport=False,
                       log=None, jr=False, stdout_tail="", **kwargs):
     """ Update the panda server with the latest job info """
 
+    client = kwargs.get('panda_client')
+    if client is not None:
+        return client.updatePandaServer(job_state.job, job_state.site, DorE(kwargs, 'workerNode'),
+                                        DorE(kwargs, 'psport'), xmlstr=xmlstr,
+                                        spaceReport=spaceReport, log=log, ra=job_state.recoveryAttempt,
+                                        jr=jr, useCoPilot=DorE(kwargs, 'useCoPilot'),
+                                        stdout_tail=stdout_tail)
+
     from PandaServerClient import PandaServerClient
     client = PandaServerClient(pilot_version=DorE(kwargs, 'version'),
                                pilot_version_tag=DorE(kwargs, 'pilot_version_tag'),
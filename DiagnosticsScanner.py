@@ -0,0 +1,403 @@
+# DiagnosticsScanner.py
+#
+# Single pass scanner for payload output files (athena_stdout.txt etc).
+# Error diagnosis used to reopen and rescan the same (possibly multi-GB) payload stdout/stderr files for every
+# check. Diagnosis code now registers its patterns here, and the first check that needs a file streams it once in
+# large blocks for all registered patterns. The hits (byte offset and line number of every matching line) are
+# cached per file, so that all later checks (grep(), getJobReport(), isOutOfMemory(), ..) are answered from memory.
+# Only the results of the MAX_CACHED_FILES most recently scanned files are kept.
+#
+# Python's regex engine tries every alternative at every position, which makes one big alternation slower than
+# a plain substring search. Each pattern is therefore reduced to the literal(s) that every match must contain;
+# these are located with str.find() and only the candidate lines are checked with the real pattern. Patterns
+# without such a literal are matched with one combined regex over the block.
+# A line matches a pattern like in grep(), i.e. re.search(pattern, line) for every line of the file.
+
+import os
+import re
+import sre_parse
+import threading
+from array import array
+from collections import OrderedDict
+
+from pUtil import tolog
+
+# read size, a partial last line is carried over to the next block
+BLOCK_SIZE = 16*1024*1024
+
+# the text of this many first and last hits is kept in memory per pattern, other lines are read back on demand
+KEEP_LINES = 100
+
+# shortest literal that is worth a prefilter pass
+MIN_LITERAL = 3
+
+# scan results of this many files are kept, the least recently used ones are dropped
+MAX_CACHED_FILES = 16
+
+_patterns = {}
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def registerPattern(pattern, name=None):
+    """ Register a pattern for all later scans, return its name (default: the pattern itself) """
+
+    if name is None:
+        name = pattern
+    _lock.acquire()
+    try:
+        if _patterns.get(name, pattern) != pattern:
+            # the hits of the old pattern are no longer valid
+            for result in _cache.values():
+                result.forget(name)
+        _patterns[name] = pattern
+    finally:
+        _lock.release()
+    return name
+
+
+def getPatterns():
+    """ Return a copy of the {name: pattern} registry """
+
+    _lock.acquire()
+    try:
+        return dict(_patterns)
+    finally:
+        _lock.release()
+
+
+def _literalRuns(items):
+    """ Return the literals of which at least one occurs in every match of the parsed pattern, or None """
+
+    items = list(items)
+    if len(items) == 1:
+        op, av = items[0]
+        if op == sre_parse.SUBPATTERN:
+            return _literalRuns(av[-1])
+        if op == sre_parse.BRANCH:
+            # one literal per alternative
+            literals = []
+            for branch in av[1]:
+                branch_literals = _literalRuns(branch)
+                if not branch_literals:
+                    return None
+                literals += branch_literals
+            return literals
+
+    # the longest run of plain characters
+    best = ""
+    run = ""
+    for op, av in items:
+        if op == sre_parse.LITERAL and av < 256:
+            run += chr(av)
+        else:
+            if len(run) > len(best):
+                best = run
+            run = ""
+    if len(run) > len(best):
+        best = run
+
+    if len(best) >= MIN_LITERAL:
+        return [best]
+    return None
+
+
+def requiredLiterals(pattern):
+    """ Return a list of literals, one of which is contained in every match of pattern, or None """
+
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return None
+    if parsed.pattern.flags & (sre_parse.SRE_FLAG_IGNORECASE | sre_parse.SRE_FLAG_VERBOSE):
+        return None
+    return _literalRuns(parsed)
+
+
+class CombinedMatcher:
+    """ Matches a set of named patterns against the lines of a block in one pass """
+
+    def __init__(self, patterns):
+        """ patterns: {name: pattern} """
+
+        self.compiled = {}
+        self.literals = {}
+        regex_names = []
+        for name, pattern in patterns.items():
+            self.compiled[name] = re.compile(pattern)
+            literals = requiredLiterals(pattern)
+            if literals:
+                for literal in literals:
+                    self.literals.setdefault(literal, set()).add(name)
+            else:
+                regex_names.append(name)
+
+        self.regex_names = regex_names
+        self.combined = None
+        if regex_names:
+            self.combined = re.compile("|".join(["(?:%s)" % patterns[name] for name in regex_names]), re.MULTILINE)
+
+    def candidates(self, block):
+        """ Return {line start: set of names} for all lines of the block which may match """
+
+        found = {}
+        for literal, names in self.literals.items():
+            find = block.find
+            rfind = block.rfind
+            pos = find(literal)
+            while pos >= 0:
+                start = rfind('\n', 0, pos) + 1
+                if start in found:
+                    found[start].update(names)
+                else:
+                    found[start] = set(names)
+                end = find('\n', pos)
+                if end < 0:
+                    break
+                pos = find(literal, end + 1)
+
+        if self.combined:
+            regex_names = set(self.regex_names)
+            search = self.combined.search
+            match = search(block)
+            while match:
+                start = block.rfind('\n', 0, match.start()) + 1
+                if start in found:
+                    found[start].update(regex_names)
+                else:
+                    found[start] = set(regex_names)
+                end = block.find('\n', match.start())
+                if end < 0:
+                    break
+                match = search(block, end + 1)
+
+        return found
+
+    def match(self, block):
+        """ Return a sorted list of (line start, line, names) for the lines of the block that match """
+
+        hits = []
+        found = self.candidates(block)
+        for start in sorted(found):
+            if start >= len(block):
+                # a zero-length match after the last line of the block: the next block starts there
+                continue
+            end = block.find('\n', start)
+            if end < 0:
+                line = block[start:]
+            else:
+                line = block[start:end + 1]
+            names = [name for name in found[start] if self.compiled[name].search(line)]
+            if names:
+                hits.append((start, line, names))
+        return hits
+
+
+class ScanResult:
+    """ The hits of the registered patterns in one file """
+
+    def __init__(self, filename, signature):
+
+        self.filename = filename
+        self.signature = signature
+        self.patterns = {}
+        self.offsets = {}
+        self.linenumbers = {}
+        self.text = {}
+        self.size = 0
+        self.numberOfLines = 0
+
+    def forget(self, name):
+        """ Drop the hits of a pattern, it will be scanned for again """
+
+        for d in (self.patterns, self.offsets, self.linenumbers, self.text):
+            if name in d:
+                del d[name]
+
+    def scanned(self, name):
+        return name in self.patterns
+
+    def count(self, name):
+        """ Number of lines matching the pattern """
+
+        return len(self.offsets.get(name, []))
+
+    def getOffsets(self, name):
+        """ Byte offsets of the lines matching the pattern """
+
+        return list(self.offsets.get(name, []))
+
+    def getLineNumbers(self, name):
+        """ Line numbers (starting at 1) of the lines matching the pattern """
+
+        return list(self.linenumbers.get(name, []))
+
+    def readLines(self, offsets):
+        """ Return the lines starting at the given byte offsets (kept in memory or read back from the file) """
+
+        lines = [None]*len(offsets)
+        missing = []
+        for i, offset in enumerate(offsets):
+            for text in self.text.values():
+                if offset in text:
+                    lines[i] = text[offset]
+                    break
+            else:
+                missing.append(i)
+
+        if missing:
+            f = open(self.filename, "r")
+            try:
+                for i in missing:
+                    f.seek(offsets[i])
+                    lines[i] = f.readline()
+            finally:
+                f.close()
+
+        return lines
+
+    def getLines(self, name, first=None, last=None):
+        """ Return the lines matching the pattern, or only the first/last N of them """
+
+        offsets = self.offsets.get(name, [])
+        if first is not None:
+            offsets = offsets[:first]
+        elif last is not None:
+            offsets = offsets[len(offsets) - min(last, len(offsets)):]
+        return self.readLines(list(offsets))
+
+    def add(self, names, patterns):
+        """ Prepare the result for new hits of the named patterns """
+
+        for name in names:
+            self.patterns[name] = patterns[name]
+            self.offsets[name] = array('l')
+            self.linenumbers[name] = array('l')
+            self.text[name] = {}
+
+    def record(self, name, offset, linenumber, line):
+        """ Record a hit, keep the text of the first and last KEEP_LINES hits """
+
+        offsets = self.offsets[name]
+        offsets.append(offset)
+        self.linenumbers[name].append(linenumber)
+        text = self.text[name]
+        text[offset] = line
+        n = len(offsets)
+        if n > 2*KEEP_LINES:
+            # forget the hit that is no longer among the last ones
+            del text[offsets[n - KEEP_LINES - 1]]
+
+
+def getSignature(filename):
+    """ Identify the current version of a file (a growing or replaced file must be rescanned) """
+
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+def scanFile(filename, patterns, result):
+    """ Stream the file once and record the hits of all patterns in result """
+
+    matcher = CombinedMatcher(patterns)
+    result.add(patterns.keys(), patterns)
+
+    f = open(filename, "r")
+    try:
+        offset = 0
+        linenumber = 1
+        carry = ""
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                block = carry
+                carry = ""
+            else:
+                # only scan complete lines, the remainder is carried over to the next block
+                end = data.rfind('\n')
+                if end < 0:
+                    carry += data
+                    continue
+                block = carry + data[:end + 1]
+                carry = data[end + 1:]
+            if not block:
+                break
+
+            position = 0
+            for start, line, names in matcher.match(block):
+                linenumber += block.count('\n', position, start)
+                position = start
+                for name in names:
+                    result.record(name, offset + start, linenumber, line)
+
+            linenumber += block.count('\n', position)
+            offset += len(block)
+            if not data:
+                break
+
+        result.size = offset
+        result.numberOfLines = linenumber - 1
+    finally:
+        f.close()
+
+
+def scan(filename, names=None):
+    """
+    Return the ScanResult of the file for the registered patterns (or the named ones).
+    The file is only read if it changed, or for patterns that were registered after the last scan.
+    """
+
+    filename = os.path.abspath(filename)
+    signature = getSignature(filename)
+    patterns = getPatterns()
+    if names is not None:
+        patterns = dict([(name, patterns[name]) for name in names])
+
+    _lock.acquire()
+    try:
+        result = _cache.pop(filename, None)
+        if not result or result.signature != signature:
+            result = ScanResult(filename, signature)
+        _cache[filename] = result
+        while len(_cache) > MAX_CACHED_FILES:
+            _cache.popitem(last=False)
+        missing = dict([(name, pattern) for name, pattern in patterns.items() if not result.scanned(name)])
+        if missing:
+            scanFile(filename, missing, result)
+            tolog("Scanned %s for %d pattern(s): %d bytes, %d lines, %d hits" % \
+                  (filename, len(missing), result.size, result.numberOfLines, sum([result.count(name) for name in missing])))
+    finally:
+        _lock.release()
+
+    return result
+
+
+def grep(patterns, filename):
+    """ Return the lines of the file that match the patterns, like pUtil.grep() """
+
+    names = [registerPattern(pattern) for pattern in patterns]
+    result = scan(filename)
+
+    # in file order, a line matching several patterns is listed once per pattern
+    hits = []
+    for i, name in enumerate(names):
+        hits += [(offset, i) for offset in result.offsets[name]]
+    hits.sort()
+    return result.readLines([offset for offset, i in hits])
+
+
+def clear(filename=None):
+    """ Forget the hits of one or all files """
+
+    _lock.acquire()
+    try:
+        if filename is None:
+            _cache.clear()
+        else:
+            _cache.pop(os.path.abspath(filename), None)
+    finally:
+        _lock.release()
+
+
+# generic patterns, the experiments register their own ones
+registerPattern("Job Report produced by", "job_report")
@@ -4,29 +4,22 @@
 #   Based the on Factory Design Pattern
 #   Note: not compatible with Singleton Design Pattern due to the subclassing
 
-from types import TypeType
-from Experiment import Experiment
-from ATLASExperiment import ATLASExperiment
-from CMSExperiment import CMSExperiment
-from OtherExperiment import OtherExperiment
-from AMSTaiwanExperiment import AMSTaiwanExperiment
-from NordugridATLASExperiment import NordugridATLASExperiment
+# experiment name: name of the module and class, imported on first use
+experimentModules = {"generic": "Experiment",
+                     "ATLAS": "ATLASExperiment",
+                     "CMS": "CMSExperiment",
+                     "Other": "OtherExperiment",
+                     "AMSTaiwan": "AMSTaiwanExperiment",
+                     "Nordugrid-ATLAS": "NordugridATLASExperiment"}
 
 class ExperimentFactory(object):
 
     def newExperiment(self, experiment):
         """ Generate a new site information object """
 
-        # get all classes
-        experimentClasses = [j for (i,j) in globals().iteritems() if isinstance(j, TypeType) and issubclass(j, Experiment)]
-
-        # loop over all subclasses
-        for experimentClass in experimentClasses:
-            si = experimentClass()
-
-            # return the matching experiment class
-            if si.getExperiment() == experiment:
-                return experimentClass
+        name = experimentModules.get(experiment)
+        if name:
+            return getattr(__import__(name), name)
 
         # if no class was found, raise an error
         raise ValueError('ExperimentFactory: No such class: "%s"' % (experiment))
@@ -23,6 +23,7 @@ from PilotErrors import PilotErrors
 from pUtil import tolog, readpar, getSiteInformation, extractFilePaths, getExperiment, extractPattern
 from FileStateClient import updateFileState
 from SiteInformation import SiteInformation
+import CopytoolSetupCache
 from FAXTools import getFAXRedirectors, updateRedirector
 
 # placing the import lfc here breaks compilation on non-lcg sites
@@ -124,7 +125,7 @@ class FAXSiteMover(xrdcpSiteMover.xrdcpSiteMover):
         # get the experiment object
         thisExperiment = getExperiment(experiment)
 
-        status, output = thisExperiment.verifyProxy(envsetup=_setupStr)
+        status, output = CopytoolSetupCache.verifyProxy(thisExperiment, _setupStr)
         return status, output
 
     def verifySetup(self, _setupStr, experiment, proxycheck=False):
@@ -138,11 +139,12 @@ class FAXSiteMover(xrdcpSiteMover.xrdcpSiteMover):
         if command != "" and not command.endswith(';'):
             command = command + ";"
         command += " which "+ self.realCopyCommand
-        status, output = commands.getstatusoutput(command)
+        # probed once per process for a given setup, copy command and proxy
+        status, output = CopytoolSetupCache.probeSetup(_setupStr, self.realCopyCommand)
         self.log("Execute command:  %s" % command)
         self.log("Status: %s, Output: %s" % (status, output))
         if status != 0:
-            self.log(self.copyCommand +" is not found in envsetup: " + _setupStr)
+            self.log(self.realCopyCommand +" is not found in envsetup: " + _setupStr)
             #self.prepareReport('RFCP_FAIL', self._variables['report'])
             outputRet["report"]["clientState"] = "RFCP_FAIL"
             outputRet["errorLog"] = output
@@ -287,7 +289,8 @@ class FAXSiteMover(xrdcpSiteMover.xrdcpSiteMover):
             timeout = self.getTimeOut(fsize)
         self.log("Using time-out %d s for file size %s" % (timeout, sourceSize))
         try:
-            timerCommand = TimerCommand(_cmd_str)
+            _cmd, _env = CopytoolSetupCache.splitCommand(_cmd_str, self._setup, self.realCopyCommand)
+            timerCommand = TimerCommand(_cmd, env=_env)
             s, o = timerCommand.run(timeout=timeout)
         except Exception, e:
             tolog("!!WARNING!!2990!! Exception caught by stageInFile(): %s" % (str(e)))
@@ -546,7 +549,7 @@ class FAXSiteMover(xrdcpSiteMover.xrdcpSiteMover):
 
 
         command = "%s xrdcp -h" % (self._setup)
-        status_local, output_local = commands.getstatusoutput(command)
+        status_local, output_local = CopytoolSetupCache.getstatusoutput(command, self._setup, self.realCopyCommand)
         tolog("Execute command(%s) to decide whether -adler or --cksum adler32 to be used." % command)
         tolog("status: %s, output: %s" % (status_local, output_local))
         checksum_option = ""
@@ -571,7 +574,8 @@ class FAXSiteMover(xrdcpSiteMover.xrdcpSiteMover):
         outputRet["report"]['relativeStart'] = time()
         outputRet["report"]['transferStart'] =  time()
         try:
-            timerCommand = TimerCommand(_cmd_str)
+            _cmd, _env = CopytoolSetupCache.splitCommand(_cmd_str, self._setup, self.realCopyCommand)
+            timerCommand = TimerCommand(_cmd, env=_env)
             ec, o = timerCommand.run(timeout=self.timeout)
         except Exception, e:
             tolog("!!WARNING!!2999!! xrdcp threw an exception: %s" % (o))
@@ -609,7 +613,7 @@ class FAXSiteMover(xrdcpSiteMover.xrdcpSiteMover):
         cmd = "%s xrdadler32 %s" % (self._setup, full_surl)
         tolog("Executing command: %s" % (cmd))
         try:
-            ec, output = commands.getstatusoutput(cmd)
+            ec, output = CopytoolSetupCache.getstatusoutput(cmd, self._setup, self.realCopyCommand)
         except Exception, e:
             tolog("Warning: (Exception caught) xrdadler32 failed: %s" % (e))
             output = None
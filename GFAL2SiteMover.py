@@ -20,6 +20,7 @@ from PilotErrors import PilotErrors
 from pUtil import tolog, readpar, getSiteInformation, extractFilePaths, getExperiment
 from FileStateClient import updateFileState
 from SiteInformation import SiteInformation
+import CopytoolSetupCache
 
 # placing the import lfc here breaks compilation on non-lcg sites
 # import lfc
@@ -118,7 +119,7 @@ class GFAL2SiteMover(SiteMover.SiteMover):
         # get the experiment object
         thisExperiment = getExperiment(experiment)
 
-        status, output = thisExperiment.verifyProxy(envsetup=_setupStr, limit=2)
+        status, output = CopytoolSetupCache.verifyProxy(thisExperiment, _setupStr, limit=2)
         return status, output
 
     def verifySetup(self, _setupStr, experiment, proxycheck=True):
@@ -132,7 +133,8 @@ class GFAL2SiteMover(SiteMover.SiteMover):
         if command != "" and not command.endswith(';'):
             command = command + ";"
         command += " which " + self.copyCommand
-        status, output = commands.getstatusoutput(command)
+        # probed once per process for a given setup, copy command and proxy
+        status, output = CopytoolSetupCache.probeSetup(_setupStr, self.copyCommand)
         self.log("Execute command:  %s" % command)
         self.log("Status: %s, Output: %s" % (status, output))
         if status != 0:
@@ -274,7 +276,7 @@ class GFAL2SiteMover(SiteMover.SiteMover):
         outputRet["report"]['relativeStart'] = time()
         outputRet["report"]['transferStart'] = time()
         try:
-            s, o = commands.getstatusoutput(_cmd_str)
+            s, o = CopytoolSetupCache.getstatusoutput(_cmd_str, self._setup, self.copyCommand)
         except Exception, e:
             tolog("!!WARNING!!2990!! Exception caught by stageInFile(): %s" % (str(e)))
             o = str(e)
@@ -493,7 +495,7 @@ class GFAL2SiteMover(SiteMover.SiteMover):
         #mkdir
         _cmd_str = '%s gfal-mkdir --verbose %s -p %s' % (self._setup, timeout_option, os.path.dirname(destination))
         self.log("Executing command: %s" % (_cmd_str))
-        status, output = commands.getstatusoutput(_cmd_str)
+        status, output = CopytoolSetupCache.getstatusoutput(_cmd_str, self._setup, self.copyCommand)
         self.log("status: %s, output: %s" % (status, output.replace("\n"," ")))
         if status != 0:
             outputRet["errorLog"] = output
@@ -556,7 +558,7 @@ class GFAL2SiteMover(SiteMover.SiteMover):
             outputRet["report"]['relativeStart'] = time()
             outputRet["report"]['transferStart'] =  time()
             try:
-                ec, o = commands.getstatusoutput(_cmd_str)
+                ec, o = CopytoolSetupCache.getstatusoutput(_cmd_str, self._setup, self.copyCommand)
             except Exception, e:
                 tolog("!!WARNING!!2999!! gfal-copy threw an exception: %s" % (o))
                 o = str(e)
@@ -591,7 +593,7 @@ class GFAL2SiteMover(SiteMover.SiteMover):
         cmd = "%s gfal-sum -t %s %s %s" % (self._setup, self.timeout, full_surl, checksumType)
         tolog("Executing command: %s" % (cmd))
         try:
-            ec, output = commands.getstatusoutput(cmd)
+            ec, output = CopytoolSetupCache.getstatusoutput(cmd, self._setup, self.copyCommand)
         except Exception, e:
             tolog("Warning: (Exception caught) gfal-sum failed: %s" % (e))
             output = None
@@ -618,7 +620,7 @@ class GFAL2SiteMover(SiteMover.SiteMover):
         cmd = "%s gfal-ls -l -t %s %s " % (self._setup, self.timeout, full_surl)
         tolog("Executing command: %s" % (cmd))
         try:
-            ec, output = commands.getstatusoutput(cmd)
+            ec, output = CopytoolSetupCache.getstatusoutput(cmd, self._setup, self.copyCommand)
         except Exception, e:
             tolog("Warning: (Exception caught) gfal-ls failed: %s" % (e))
             remote_fsize = None
@@ -704,7 +706,7 @@ class GFAL2SiteMover(SiteMover.SiteMover):
         cmd = '%s gfal-rm --verbose  -t %d  %s' % (self._setup, self.timeout,  full_surl)
         tolog("Executing command: %s" % (cmd))
         try:
-            ec, rs = commands.getstatusoutput(cmd)
+            ec, rs = CopytoolSetupCache.getstatusoutput(cmd, self._setup, self.copyCommand)
         except Exception, e:
             tolog("Warning: Exception caught in removeFile: %s" % (e))
         else:
@@ -1,5 +1,6 @@
 import inspect
 import commands
+import fcntl
 import os
 import re
 import signal
@@ -24,13 +25,23 @@ from FileHandling import getCPUTimes
 
 from signal_block.signal_block import block_sig, unblock_sig
 
+MESSAGE_POLL_MIN = 0.0001  # seconds, first yampl poll interval after a message
+MESSAGE_POLL_MAX = 0.01    # seconds, yampl poll interval when AthenaMP is idle
+CHILD_POLL_INTERVAL = 1    # seconds, how often the child checks AthenaMP while no message is sent to it
+
+
+def setCloseOnExec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
 class EventServerJobManager():
     class MessageThread(threading.Thread):
-        def __init__(self, messageQ, socketname, context, **kwds):
+        def __init__(self, messagePipe, socketname, context, **kwds):
             threading.Thread.__init__(self, **kwds)
             self.__log = Logger.Logger(filename='EventServiceManager.log')
-            self.__messageQ = messageQ
+            self.__messagePipe = messagePipe
             self._stop = threading.Event()
+            self.__idleTime = 0
             try:
                 self.__messageSrv = yampl.ServerSocket(socketname, context)
             except:
@@ -39,6 +50,8 @@ class EventServerJobManager():
         def send(self, message):
             try:
                 self.__messageSrv.send_raw(message)
+                # AthenaMP answers soon, poll at the highest rate again
+                self.__idleTime = 0
             except:
                 self.__log.debug("Exception: failed to send yampl message: %s" % traceback.format_exc())
 
@@ -54,6 +67,8 @@ class EventServerJobManager():
                 self.__messageSrv = None
 
         def run(self):
+            # yampl has no descriptor to wait on: drain all pending messages, then back off exponentially
+            # from MESSAGE_POLL_MIN to MESSAGE_POLL_MAX while AthenaMP is quiet
             try:
                 while True:
                     if self.stopped():
@@ -63,9 +78,11 @@ class EventServerJobManager():
                         break
                     size, buf = self.__messageSrv.try_recv_raw()
                     if size == -1:
-                        time.sleep(0.00001)
+                        time.sleep(self.__idleTime)
+                        self.__idleTime = min(max(self.__idleTime * 2, MESSAGE_POLL_MIN), MESSAGE_POLL_MAX)
                     else:
-                        self.__messageQ.put(buf)
+                        self.__idleTime = 0
+                        self.__messagePipe.send_bytes(buf)
             except:
                 self.__log.debug("Exception: Message Thread failed: %s" % traceback.format_exc())
                 if self.__messageSrv:
@@ -107,7 +124,11 @@ class EventServerJobManager():
         self.__eventRanges = []
         self.__eventRangesStatus = {}
         self.__outputMessage = []
-        self.__messageQueue = multiprocessing.Queue()
+        # AthenaMP messages: the message thread writes to the pipe, the main program waits on getMessageFileno()
+        # (the pipe is also at EOF when the child process exited)
+        self.__messageReader, self.__messageWriter = multiprocessing.Pipe(False)
+        setCloseOnExec(self.__messageReader.fileno())
+        setCloseOnExec(self.__messageWriter.fileno())
         self.__messageInQueue = multiprocessing.Queue()
         self.__messageThread = None
         self.__TokenExtractorCmd = None
@@ -289,7 +310,7 @@ class EventServerJobManager():
     def initMessageThread(self, socketname='EventService_EventRanges', context='local'):
         self.__log.debug("Rank %s: initMessageThread: socketname: %s, context: %s, workdir: %s" %(self.__rank, socketname, context, os.getcwd()))
         try:
-            self.__messageThread = EventServerJobManager.MessageThread(self.__messageQueue, socketname, context)
+            self.__messageThread = EventServerJobManager.MessageThread(self.__messageWriter, socketname, context)
             self.__messageThread.start()
         except:
             self.__log.warning("Rank %s: Failed to initMessageThread: %s" % (self.__rank, str(traceback.format_exc())))
@@ -330,6 +351,7 @@ class EventServerJobManager():
         child_pid = os.fork()
         if child_pid == 0:
             # child process
+            self.__messageReader.close()
             self.initEventRangeChannel()
             self.initMessageThread(socketname=self.getEventRangeChannelName(), context=context)
             self.initTokenExtractorProcess(tokenExtractorCmd)
@@ -341,7 +363,7 @@ class EventServerJobManager():
                    self.terminateChild()
                    break
                 try:
-                    message = self.__messageInQueue.get(False)
+                    message = self.__messageInQueue.get(True, CHILD_POLL_INTERVAL)
                     self.__log.debug("Rank %s: Child get message: %s" % (self.__rank, message))
                     if "Stop_Message_Process" in message:
                         self.__log.debug("Rank %s: Child stop" % (self.__rank))
@@ -361,6 +383,7 @@ class EventServerJobManager():
             os._exit(0)
         else:
             self.__child_pid = child_pid
+            self.__messageWriter.close()
             self.__log.debug("Rank %s: Initialize helper thread" % (self.__rank))
             self.__helperThread = EventServerJobManager.HelperThread(self.__log, self.helperFunc)
             self.__helperThread.start()
@@ -410,7 +433,12 @@ class EventServerJobManager():
 
     def sendEventRangeToAthenaMP(self, eventRanges):
         block_sig(signal.SIGTERM)
+        try:
+            self.__sendEventRangeToAthenaMP(eventRanges)
+        finally:
+            unblock_sig(signal.SIGTERM)
 
+    def __sendEventRangeToAthenaMP(self, eventRanges):
         if "No more events" in eventRanges:
             self.__log.debug("Rank %s: sendEventRangeToAthenaMP: %s" % (self.__rank, eventRanges))
             self.__messageInQueue.put(eventRanges)
@@ -432,8 +460,6 @@ class EventServerJobManager():
 
         self.__athenaMP_isReady = False
 
-        unblock_sig(signal.SIGTERM)
-
     def getOutput(self):
         if len(self.__outputMessage) > 0:
             output = self.__outputMessage.pop(0)
@@ -591,54 +617,81 @@ class EventServerJobManager():
 
         return error_acronym, event_range_id, error_diagnostics
 
-    def handleMessage(self):
+    def getMessageFileno(self):
+        """ Descriptor which is readable when AthenaMP messages are pending or the child process exited (None if closed) """
+        if self.__messageReader is None:
+            return None
+        return self.__messageReader.fileno()
+
+    def receiveMessages(self):
+        """ Read all pending AthenaMP messages without blocking """
+        messages = []
+        if self.__messageReader is None:
+            return messages
+        try:
+            while self.__messageReader.poll():
+                messages.append(self.__messageReader.recv_bytes())
+        except (EOFError, IOError):
+            # all writers are gone: the child process exited, isDead() will notice
+            self.__log.debug("Rank %s: Message pipe closed" % (self.__rank))
+            self.__messageReader.close()
+            self.__messageReader = None
+        return messages
+
+    def handleMessages(self):
+        """ Handle all pending AthenaMP messages under one SIGTERM mask, return the number of messages """
         block_sig(signal.SIGTERM)
         try:
-            #message = self.__messageQueue.get(True, self.__pollTimeout)
-            message = self.__messageQueue.get(False)
-            #self.__messageQueue.task_done()
-        except Queue.Empty:
+            return self.__handleMessages()
+        finally:
             unblock_sig(signal.SIGTERM)
-            return False
-        else:
-            if self.__readyForEventTime is None:
-                self.__readyForEventTime = time.time()
-            self.__log.debug("Rank %s: Received message: %s" % (self.__rank, message))
-            if "Ready for events" in message:
-                self.__athenaMP_isReady = True
-                self.__athenaMP_needEvents += 1
-            elif message.startswith("/"):
-                self.__totalProcessedEvents += 1
-                self.__numOutputs += 1
-                # self.__outputMessage.append(message)
+
+    def __handleMessages(self):
+        messages = self.receiveMessages()
+        for message in messages:
+            self.__handleMessage(message)
+        return len(messages)
+
+    def handleMessage(self):
+        return self.handleMessages() > 0
+
+    def __handleMessage(self, message):
+        if self.__readyForEventTime is None:
+            self.__readyForEventTime = time.time()
+        self.__log.debug("Rank %s: Received message: %s" % (self.__rank, message))
+        if "Ready for events" in message:
+            self.__athenaMP_isReady = True
+            self.__athenaMP_needEvents += 1
+        elif message.startswith("/"):
+            self.__totalProcessedEvents += 1
+            self.__numOutputs += 1
+            # self.__outputMessage.append(message)
+            try:
+                # eventRangeID = message.split(',')[0].split('.')[-1]
+                eventRangeID = message.split(',')[-3].replace("ID:", "").replace("ID: ", "")
+                self.__eventRangesStatus[eventRangeID]['status'] = 'finished'
+                self.__eventRangesStatus[eventRangeID]['output'] = message
+                self.__outputMessage.append((eventRangeID, 'finished', message))
+            except Exception, e:
+                self.__log.warning("Rank %s: output message format is not recognized: %s " % (self.__rank, message))
+                self.__log.warning("Rank %s: %s" % (self.__rank, str(e)))
+        elif message.startswith('ERR'):
+            self.__log.error("Rank %s: Received an error message: %s" % (self.__rank, message))
+            error_acronym, eventRangeID, error_diagnostics = self.extractErrorMessage(message)
+            if eventRangeID != "":
                 try:
-                    # eventRangeID = message.split(',')[0].split('.')[-1]
-                    eventRangeID = message.split(',')[-3].replace("ID:", "").replace("ID: ", "")
-                    self.__eventRangesStatus[eventRangeID]['status'] = 'finished'
+                    self.__log.error("Rank %s: !!WARNING!!2144!! Extracted error acronym %s and error diagnostics \'%s\' for event range %s" % (self.__rank, error_acronym, error_diagnostics, eventRangeID))
+                    self.__eventRangesStatus[eventRangeID]['status'] = 'failed'
                     self.__eventRangesStatus[eventRangeID]['output'] = message
-                    self.__outputMessage.append((eventRangeID, 'finished', message))
+                    self.__outputMessage.append((eventRangeID, error_acronym, message))
                 except Exception, e:
                     self.__log.warning("Rank %s: output message format is not recognized: %s " % (self.__rank, message))
                     self.__log.warning("Rank %s: %s" % (self.__rank, str(e)))
-            elif message.startswith('ERR'):
-                self.__log.error("Rank %s: Received an error message: %s" % (self.__rank, message))
-                error_acronym, eventRangeID, error_diagnostics = self.extractErrorMessage(message)
-                if eventRangeID != "":
-                    try:
-                        self.__log.error("Rank %s: !!WARNING!!2144!! Extracted error acronym %s and error diagnostics \'%s\' for event range %s" % (self.__rank, error_acronym, error_diagnostics, eventRangeID))
-                        self.__eventRangesStatus[eventRangeID]['status'] = 'failed'
-                        self.__eventRangesStatus[eventRangeID]['output'] = message
-                        self.__outputMessage.append((eventRangeID, error_acronym, message))
-                    except Exception, e:
-                        self.__log.warning("Rank %s: output message format is not recognized: %s " % (self.__rank, message))
-                        self.__log.warning("Rank %s: %s" % (self.__rank, str(e)))
-                if "FATAL" in error_acronym:
-                    self.__log.error("Rank %s: !!WARNING!!2146!! A FATAL error was encountered, prepare to finish" % (self.__rank))
-                    self.terminate()
-            else:
-                self.__log.error("Rank %s: Received an unknown message: %s" % (self.__rank, message))
-            unblock_sig(signal.SIGTERM)
-            return True
+            if "FATAL" in error_acronym:
+                self.__log.error("Rank %s: !!WARNING!!2146!! A FATAL error was encountered, prepare to finish" % (self.__rank))
+                self.terminate()
+        else:
+            self.__log.error("Rank %s: Received an unknown message: %s" % (self.__rank, message))
 
     def findChildProcesses(self,pid):
         command = "/bin/ps -e --no-headers -o pid -o ppid -o fname"
@@ -765,25 +818,28 @@ class EventServerJobManager():
                 self.terminate()
                 return -1
 
-            while self.handleMessage():
-                pass
-            if self.__waitTerminate:
-                self.finish()
-            else:
-                while self.isReady():
-                    self.__log.info("Rank %s: AthenMP is ready." % self.__rank)
-                    eventRanges = self.getEventRanges()
-                    if eventRanges is None:
-                        return -1
-                    else:
-                        self.__log.info("Rank %s: Process Event: %s" % (self.__rank, eventRanges))
-                        self.sendEventRangeToAthenaMP(eventRanges)
-                        if "No more events" in eventRanges:
-                            self.__log.info("Rank %s: ESJobManager is finishing" % self.__rank)
-                            self.__log.info("Rank %s: wait AthenaMP to finish" % self.__rank)
-                            self.__startTerminateTime = time.time()
-                            self.__waitTerminate = True
-                            return 0
+            block_sig(signal.SIGTERM)
+            try:
+                self.__handleMessages()
+                if self.__waitTerminate:
+                    self.finish()
+                else:
+                    while self.isReady():
+                        self.__log.info("Rank %s: AthenMP is ready." % self.__rank)
+                        eventRanges = self.getEventRanges()
+                        if eventRanges is None:
+                            return -1
+                        else:
+                            self.__log.info("Rank %s: Process Event: %s" % (self.__rank, eventRanges))
+                            self.__sendEventRangeToAthenaMP(eventRanges)
+                            if "No more events" in eventRanges:
+                                self.__log.info("Rank %s: ESJobManager is finishing" % self.__rank)
+                                self.__log.info("Rank %s: wait AthenaMP to finish" % self.__rank)
+                                self.__startTerminateTime = time.time()
+                                self.__waitTerminate = True
+                                return 0
+            finally:
+                unblock_sig(signal.SIGTERM)
         except:
             self.__log.warning("Rank %s: Exception happened when polling: %s" % (self.__rank, str(traceback.format_exc())))
 
@@ -794,8 +850,8 @@ class EventServerJobManager():
         self.__log.info("Rank %s: ESJobManager flush messages" % self.__rank)
         while self.isReady():
             self.__log.info("Rank %s: AthenaMP is ready, send 'No more events' to it." % self.__rank)
-            self.sendEventRangeToAthenaMP("No more events")
-        while self.handleMessage():
+            self.__sendEventRangeToAthenaMP("No more events")
+        while self.__handleMessages():
             pass
 
         unblock_sig(signal.SIGTERM)
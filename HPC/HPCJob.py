@@ -7,7 +7,8 @@ import time
 import traceback
 logger = logging.getLogger(__name__)
 
-def main(globalWorkDir, localWorkDir, nonMPIMode=False, outputDir=None, dumpEventOutputs=True):
+def main(globalWorkDir, localWorkDir, nonMPIMode=False, outputDir=None, dumpEventOutputs=True, walltime=None, metricsInterval=60, metricsTimeSeries=False,
+         updateInterval=30, updateSize=1000, checkpointInterval=60, jobScheduler='packing', pandaServerURL=None):
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
     if nonMPIMode:
@@ -41,7 +42,9 @@ def main(globalWorkDir, localWorkDir, nonMPIMode=False, outputDir=None, dumpEven
     if mpirank==0:
         try:
             from pandayoda.yodacore import Yoda
-            yoda = Yoda.Yoda(globalWorkDir, localWorkDir, rank=0, nonMPIMode=nonMPIMode, outputDir=outputDir, dumpEventOutputs=dumpEventOutputs)
+            yoda = Yoda.Yoda(globalWorkDir, localWorkDir, rank=0, nonMPIMode=nonMPIMode, outputDir=outputDir, dumpEventOutputs=dumpEventOutputs, walltime=walltime,
+                             metricsInterval=metricsInterval, metricsTimeSeries=metricsTimeSeries, checkpointInterval=checkpointInterval,
+                             jobScheduler=jobScheduler, pandaServerURL=pandaServerURL)
             yoda.start()
 
             from pandayoda.yodaexe import Droid
@@ -49,7 +52,8 @@ def main(globalWorkDir, localWorkDir, nonMPIMode=False, outputDir=None, dumpEven
                 reserveCores = 0
             else:
                 reserveCores = 1
-            droid = Droid.Droid(globalWorkDir, localWorkDir, rank=0, nonMPIMode=True, reserveCores=reserveCores, outputDir=outputDir)
+            droid = Droid.Droid(globalWorkDir, localWorkDir, rank=0, nonMPIMode=True, reserveCores=reserveCores, outputDir=outputDir,
+                                updateInterval=updateInterval, updateSize=updateSize)
             droid.start()
 
             i = 30
@@ -70,7 +74,8 @@ def main(globalWorkDir, localWorkDir, nonMPIMode=False, outputDir=None, dumpEven
         try:
             status = 0
             from pandayoda.yodaexe import Droid
-            droid = Droid.Droid(globalWorkDir, localWorkDir, rank=mpirank, nonMPIMode=nonMPIMode, outputDir=outputDir)
+            droid = Droid.Droid(globalWorkDir, localWorkDir, rank=mpirank, nonMPIMode=nonMPIMode, outputDir=outputDir,
+                                updateInterval=updateInterval, updateSize=updateSize)
             droid.start()
             while (droid and droid.isAlive()):
                 droid.join(timeout=1)
@@ -98,6 +103,14 @@ Commands:
     oparser.add_argument('--nonMPIMode', default=False, action='store_true', help="Run Yoda in non-MPI mode")
     oparser.add_argument('--outputDir', dest="outputDir", default=None, help="Copy output files to this directory")
     oparser.add_argument('--dumpEventOutputs', default=False, action='store_true', help="Dump event output info to xml")
+    oparser.add_argument('--walltime', dest="walltime", default=None, help="Walltime of the allocation (hh:mm:ss or minutes), to schedule the event ranges")
+    oparser.add_argument('--metricsInterval', dest="metricsInterval", default=60, type=int, help="Seconds between the dumps of the job metrics")
+    oparser.add_argument('--metricsTimeSeries', default=False, action='store_true', help="Write the heartbeats of all ranks to jobMetrics-ranks.csv")
+    oparser.add_argument('--updateInterval', dest="updateInterval", default=30, type=int, help="Seconds a Droid collects event range updates before sending them to Yoda")
+    oparser.add_argument('--updateSize', dest="updateSize", default=1000, type=int, help="Maximum number of event range updates a Droid sends to Yoda at once")
+    oparser.add_argument('--checkpointInterval', dest="checkpointInterval", default=60, type=int, help="Seconds between the checkpoints of the event range state Yoda resumes from in a new allocation")
+    oparser.add_argument('--jobScheduler', dest="jobScheduler", default='packing', choices=['packing', 'ranks'], help="How Yoda assigns jobs to ranks: by the estimated cost of the jobs (packing) or by the needed ranks of HPCManager (ranks)")
+    oparser.add_argument('--pandaServerURL', dest="pandaServerURL", default=None, help="PanDA server URL for the event range updates of Yoda (default: the PanDA server of the pilot settings)")
     oparser.add_argument('--verbose', '-v', default=False, action='store_true', help="Print more verbose output.")
 
     if len(sys.argv) == 1:
@@ -112,10 +125,24 @@ Commands:
     if args.localWorkingDir is None:
         args.localWorkingDir = args.globalWorkingDir
 
+    walltime = None
+    if args.walltime:
+        try:
+            walltime = 0
+            for field in args.walltime.split(':'):
+                walltime = walltime * 60 + int(field)
+            if ':' not in args.walltime:
+                walltime *= 60
+        except ValueError:
+            logger.warning("Cannot parse walltime %s, ignore it" % args.walltime)
+            walltime = None
+
     rank = None
     try:
         logger.info("Start HPCJob")
-        rank = main(args.globalWorkingDir, args.localWorkingDir, args.nonMPIMode, args.outputDir, args.dumpEventOutputs)
+        rank = main(args.globalWorkingDir, args.localWorkingDir, args.nonMPIMode, args.outputDir, args.dumpEventOutputs, walltime,
+                    args.metricsInterval, args.metricsTimeSeries, args.updateInterval, args.updateSize, args.checkpointInterval, args.jobScheduler,
+                    args.pandaServerURL)
         logger.info( "Rank %s: HPCJob-Yoda success" % rank )
         if rank == 0:
             if not args.nonMPIMode:
@@ -8,6 +8,9 @@ import json
 import pickle
 
 from Logger import Logger
+from pandayoda.yodacore.EventRangeStore import writeEventRanges
+from pandayoda.yodacore.JobTracker import JobTracker, Backoff
+from pandayoda.yodacore import Checkpoint
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -108,6 +111,8 @@ class HPCManager:
         self.__localSetup = None
 
         self.__firstJobWorkDir = None
+        # state of the HPC job and new output dumps, from the Yoda directory (the batch system as a fallback)
+        self.__tracker = None
 
     def setPandaJobStateFile(self, file):
         self.__pandaJobStateFile = file
@@ -170,10 +175,13 @@ class HPCManager:
         res = None
         if mode == 'backfill':
             res = {}
-            while not res:
-                self.__log.info("Run in backfill mode, waiting to get resources.")
-                time.sleep(60)
+            backoff = Backoff(initial=15, maximum=120)
+            while True:
                 res = self.getHPCResources(defaultResources['partition'], int(defaultResources['max_nodes']), int(defaultResources['min_nodes']), int(defaultResources['min_walltime_m']))
+                if res:
+                    break
+                self.__log.info("Run in backfill mode, waiting to get resources.")
+                time.sleep(backoff.next())
 
         self.__log.info("Get resources: %s" % res)
         nodes = int(defaultResources['min_nodes'])
@@ -297,10 +305,9 @@ class HPCManager:
         with open(self.__jobsFile, 'w') as outputFile:
            json.dump(self.__jobs, outputFile)
 
+        # line-delimited shards and an index, Yoda reads the shards on demand
         self.__eventRanges = eventRanges
-        self.__eventRangesFile = os.path.join(self.__globalYodaDir, "JobsEventRanges.json")
-        with open(self.__eventRangesFile, 'w') as outputFile:
-           json.dump(self.__eventRanges, outputFile)
+        self.__eventRangesFile = writeEventRanges(self.__globalYodaDir, self.__eventRanges)
 
     def getJobsRanks(self):
         jobRanks = {}
@@ -338,14 +345,17 @@ class HPCManager:
         if not self.__jobs:
             self.__log.info("No prepared jobs available. will not submit any jobs.")
             return
+        self.getTracker().reset()
+        backoff = Backoff(initial=15, maximum=120)
         for i in range(5):
             if self.__plugin.getName() == 'arc12233' and self.__firstJobWorkDir is not None:
                 status, jobid = self.__plugin.submitJob(self.__globalWorkingDir, self.__firstJobWorkDir, self.__firstJobWorkDir, self.__queue, self.__repo, self.__mppwidth, self.__mppnppn, self.__walltime, self.__nodes, localSetup=self.__localSetup, cpuPerNode=self.__cpuPerNode, dumpEventOutputs=self.__dumpEventOutputs)
             else:
                 status, jobid = self.__plugin.submitJob(self.__globalWorkingDir, self.__globalYodaDir, self.__localWorkingDir, self.__queue, self.__repo, self.__mppwidth, self.__mppnppn, self.__walltime, self.__nodes, localSetup=self.__localSetup, cpuPerNode=self.__cpuPerNode, dumpEventOutputs=self.__dumpEventOutputs)
             if status != 0:
-                self.__log.info("Failed to submit this job to HPC. will sleep one minute and retry")
-                time.sleep(60)
+                interval = backoff.next()
+                self.__log.info("Failed to submit this job to HPC. will sleep %s seconds and retry" % interval)
+                time.sleep(interval)
             else:
                 self.__jobid = jobid
                 break
@@ -367,6 +377,15 @@ class HPCManager:
             self.__pluginName = hpcState['Plugin']
             self.__stageout_threads = hpcState['StageoutThreads']
             self.setupPlugin(self.__pluginName)
+            # the event ranges of the jobs are not restored here: a Yoda started in this dir resumes from its checkpoint
+            checkpointFile = os.path.join(self.__globalYodaDir, Checkpoint.STATE_FILE)
+            if os.path.exists(checkpointFile):
+                self.__log.info("Yoda checkpoint %s from %s" % (checkpointFile, time.ctime(os.path.getmtime(checkpointFile))))
+
+    def getTracker(self):
+        if self.__tracker is None:
+            self.__tracker = JobTracker(self.__globalYodaDir, lambda: self.__plugin.poll(self.__jobid), logger=self.__log)
+        return self.__tracker
 
     def poll(self):
         if self.__plugin.isLocalProcess():
@@ -376,21 +395,22 @@ class HPCManager:
             self.__log.info("HPC job id is None, will return failed.")
             self.__isFinished = True
             return 'Failed'
-        counter = 120
-        while counter > 0:
-           counter = counter - 1
-           state = self.__plugin.poll(self.__jobid)
-           if self.__lastState is None or self.__lastState != state or time.time() > self.__lastTime + 60*5:
-               self.__log.info("HPC job state is: %s" %(state))
-               self.__lastState = state
-               self.__lastTime = time.time()
-           if state in ['Complete', 'Failed']:
-               self.__isFinished = True
-               break
-           if state != 'Unknown': break
-           else: time.sleep(60)
+        state = self.getTracker().poll()
+        if self.__lastState is None or self.__lastState != state or time.time() > self.__lastTime + 60*5:
+            self.__log.info("HPC job state is: %s" %(state))
+            self.__lastState = state
+            self.__lastTime = time.time()
+        if state in ['Complete', 'Failed']:
+            self.__isFinished = True
         return state
 
+    def waitForChange(self, timeout):
+        """ Sleep until the HPC job changes its state or has new outputs, at most timeout seconds """
+        if self.__plugin.isLocalProcess() or self.__jobid is None:
+            time.sleep(timeout)
+            return False
+        return self.getTracker().wait(timeout)
+
     def checkHPCJobLog(self):
         logFile = os.path.join(self.__globalYodaDir, "athena_stdout.txt")
         command = "grep 'HPCJob-Yoda failed' " + logFile
@@ -401,21 +421,19 @@ class HPCManager:
 
     def getOutputs(self):
         outputs = []
-        all_files = os.listdir(self.__globalYodaDir)
-        for file in all_files:
-            if file.endswith(".dump"):
-                filename = os.path.join(self.__globalYodaDir, file)
-                handle = open(filename)
-                for line in handle:
-                    line = line.replace("  ", " ")
-                    eventRange, status, output = line.split(" ")
-                    if status == 'finished':
-                        outputFileName = output.split(",")[0]
-                        outputs.append((eventRange, status, outputFileName))
-                    else:
-                        outputs.append((eventRange, status, output))
-                handle.close()
-                os.rename(filename, filename + ".BAK")
+        # the dumps which appeared since the last call
+        for filename in self.getTracker().getOutputFiles():
+            handle = open(filename)
+            for line in handle:
+                line = line.replace("  ", " ")
+                eventRange, status, output = line.split(" ")
+                if status == 'finished':
+                    outputFileName = output.split(",")[0]
+                    outputs.append((eventRange, status, outputFileName))
+                else:
+                    outputs.append((eventRange, status, output))
+            handle.close()
+            os.rename(filename, filename + ".BAK")
         return outputs
 
     def isFinished(self):
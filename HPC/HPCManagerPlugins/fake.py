@@ -0,0 +1,46 @@
+
+from HPC.Logger import Logger
+from HPC.HPCManagerPlugins.plugin import Plugin
+
+class fake(Plugin):
+    """
+    Plugin for tests: submitJob() returns a job id without submitting anything, poll() returns the states of
+    fake.script one after the other (the last one repeated) and counts the calls in fake.queries
+    """
+    script = ['Queue']
+    queries = 0
+    submitted = []
+    deleted = []
+
+    def __init__(self, logFileName):
+        self.__log= Logger(logFileName)
+
+    @classmethod
+    def reset(cls):
+        cls.script = ['Queue']
+        cls.queries = 0
+        cls.submitted = []
+        cls.deleted = []
+
+    def getName(self):
+        return 'fake'
+
+    def getHPCResources(self, partition, max_nodes=None, min_nodes=2, min_walltime_m=30):
+        return None
+
+    def submitJob(self, globalWorkingDir, globalYodaDir, localWorkingDir, queue, repo, mppwidth, mppnppn, walltime, nodes, localSetup=None, cpuPerNode=None, dumpEventOutputs=False):
+        fake.submitted.append(globalYodaDir)
+        self.__log.info("fake HPC job submitted: 1234")
+        return 0, '1234'
+
+    def poll(self, jobid):
+        fake.queries += 1
+        if len(fake.script) > 1:
+            state = fake.script.pop(0)
+        else:
+            state = fake.script[0]
+        self.__log.info("fake HPC job %s state: %s" % (jobid, state))
+        return state
+
+    def delete(self, jobid):
+        fake.deleted.append(jobid)
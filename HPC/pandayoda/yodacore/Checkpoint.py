@@ -0,0 +1,181 @@
+"""
+Checkpoint of the event range state of Yoda, to resume in a new allocation after the old one ended or was preempted.
+
+The ranges of a job are identified by their position in the ready queue built at startup (the sharded input, see
+EventRangeStore, or JobsEventRanges.json). Ranges are handed out from the front of the queue, so the state of a job is
+  cursor     number of ranges taken from the queue
+  finished   bitmap of the positions < cursor which were reported finished or failed
+  stagedOut  bitmap of the positions < cursor which were staged out by the Droids
+  inFlight   {rank: [positions]} handed out and not reported yet (informational, they are not done)
+written atomically to YodaCheckpoint.json in the global working dir, the bitmaps as base64 of zlib. A resumed Yoda drops
+the first cursor ranges of each queue without reading their shards and requeues the ranges which are not done at the
+front of the queue. Ranges reported after the last checkpoint are processed again.
+"""
+
+import base64
+import collections
+import json
+import os
+import threading
+import time
+import zlib
+
+STATE_FILE = "YodaCheckpoint.json"
+CHECKPOINT_INTERVAL = 60
+VERSION = 1
+
+
+def encodeBitmap(bitmap):
+    return base64.b64encode(zlib.compress(str(bitmap)))
+
+
+def decodeBitmap(data):
+    return bytearray(zlib.decompress(base64.b64decode(data)))
+
+
+class JobRanges(object):
+    """ Positions of the ranges of one job """
+
+    def __init__(self, count):
+        self.count = count
+        self.cursor = 0
+        self.finished = bytearray()
+        self.stagedOut = bytearray()
+        # positions of the requeued ranges, at the front of the ready queue
+        self.requeued = collections.deque()
+        # eventRangeID: (position, rank)
+        self.inFlight = {}
+
+    def handOut(self, rank, eventRanges):
+        for eventRange in eventRanges:
+            if self.requeued:
+                position = self.requeued.popleft()
+            else:
+                position = self.cursor
+                self.cursor += 1
+            self.inFlight[eventRange['eventRangeID']] = (position, rank)
+        size = (self.cursor + 7) / 8
+        if len(self.finished) < size:
+            # grow by at least an eighth, not for every request
+            grow = max(size - len(self.finished), len(self.finished) / 8)
+            self.finished.extend('\0' * grow)
+            self.stagedOut.extend('\0' * grow)
+
+    def done(self, eventRangeID, stagedOut=False):
+        position = self.inFlight.pop(eventRangeID, (None, None))[0]
+        if position is None:
+            return False
+        bitmap = self.stagedOut if stagedOut else self.finished
+        bitmap[position >> 3] |= 1 << (position & 7)
+        return True
+
+    def isDone(self, position):
+        return bool((self.finished[position >> 3] | self.stagedOut[position >> 3]) & (1 << (position & 7)))
+
+    def getNotDone(self):
+        """ Positions < cursor which are neither finished nor staged out """
+        positions = []
+        finished, stagedOut = self.finished, self.stagedOut
+        for index in xrange((self.cursor + 7) / 8):
+            byte = finished[index] | stagedOut[index]
+            if byte != 0xff:
+                positions.extend([index * 8 + bit for bit in range(8) if not byte & (1 << bit)])
+        return [position for position in positions if position < self.cursor]
+
+    def getState(self):
+        inFlight = {}
+        for position, rank in self.inFlight.itervalues():
+            inFlight.setdefault(str(rank), []).append(position)
+        size = (self.cursor + 7) / 8
+        return {'count': self.count, 'cursor': self.cursor, 'inFlight': inFlight,
+                'finished': self.finished[:size], 'stagedOut': self.stagedOut[:size]}
+
+
+class Checkpoint(object):
+    """ Event range state of the jobs of Yoda; the methods can be called from the main loop and a helper thread """
+
+    def __init__(self, directory, logger=None):
+        self.path = os.path.join(directory, STATE_FILE)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.__log = logger
+
+    def debug(self, message):
+        if self.__log:
+            self.__log.debug(message)
+
+    def addJob(self, jobId, count):
+        """ count: number of ranges in the ready queue of the job at startup """
+        with self.lock:
+            self.jobs[jobId] = JobRanges(count)
+
+    def handOut(self, jobId, rank, eventRanges):
+        """ The ranges were taken from the front of the ready queue of the job for the rank """
+        if jobId in self.jobs:
+            with self.lock:
+                self.jobs[jobId].handOut(rank, eventRanges)
+
+    def done(self, jobId, eventRangeID, stagedOut=False):
+        if jobId in self.jobs:
+            with self.lock:
+                return self.jobs[jobId].done(eventRangeID, stagedOut)
+        return False
+
+    def getState(self):
+        """ Snapshot of the state of all jobs """
+        with self.lock:
+            jobs = dict((jobId, self.jobs[jobId].getState()) for jobId in self.jobs)
+        for jobState in jobs.values():
+            jobState['finished'] = encodeBitmap(jobState['finished'])
+            jobState['stagedOut'] = encodeBitmap(jobState['stagedOut'])
+        return {'version': VERSION, 'time': time.time(), 'jobs': jobs}
+
+    def write(self, state=None):
+        """ Write the checkpoint (of a snapshot taken before) atomically, return its size """
+        if state is None:
+            state = self.getState()
+        data = json.dumps(state)
+        tmpFile = open(self.path + ".new", 'w')
+        try:
+            tmpFile.write(data)
+        finally:
+            tmpFile.close()
+        os.rename(self.path + ".new", self.path)
+        return len(data)
+
+    def load(self):
+        """ The last checkpoint, None if there is none """
+        if not os.path.exists(self.path):
+            return None
+        tmpFile = open(self.path)
+        try:
+            state = json.load(tmpFile)
+        finally:
+            tmpFile.close()
+        if state.get('version') != VERSION:
+            self.debug("Ignore checkpoint %s of version %s" % (self.path, state.get('version')))
+            return None
+        return state
+
+    def resume(self, jobId, queue, jobState):
+        """
+        Restore the state of a job from its checkpoint: drop the ranges handed out already from the ready queue and
+        requeue those which are not done at its front. Return the number of requeued ranges, None if the queue does
+        not match the checkpoint.
+        """
+        jobRanges = self.jobs[jobId]
+        if jobState['count'] != jobRanges.count or jobState['cursor'] > len(queue):
+            self.debug("Job %s: checkpoint of %s ranges does not match the %s ready ranges, start over" % (jobId, jobState['count'], len(queue)))
+            return None
+        with self.lock:
+            jobRanges.cursor = jobState['cursor']
+            jobRanges.finished = decodeBitmap(jobState['finished'])
+            jobRanges.stagedOut = decodeBitmap(jobState['stagedOut'])
+            requeued = jobRanges.getNotDone()
+            eventRanges = queue.skip(jobRanges.cursor, keep=requeued)
+            queue.extendleft(reversed(eventRanges))
+            jobRanges.requeued = collections.deque(requeued)
+        inFlight = sum([len(positions) for positions in jobState['inFlight'].values()])
+        self.debug("Job %s: resumed at %s of %s ranges, requeued %s ranges (%s in flight on %s ranks)" %
+                   (jobId, jobRanges.cursor, jobRanges.count, len(requeued), inFlight, len(jobState['inFlight'])))
+        return len(requeued)
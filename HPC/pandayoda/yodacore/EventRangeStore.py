@@ -0,0 +1,187 @@
+"""
+Sharded event-range input of Yoda.
+
+HPCManager writes the event ranges of the jobs as line-delimited shards and an index:
+  JobsEventRanges.index.json    {"version": 1, "jobs": {jobId: {"count": N, "shards": [[file, count, fields], ...]}}}
+  JobsEventRanges.shards/       <jobId>.<n>.ranges, one JSON list of the values of 'fields' per line
+Additional ranges can be written with another prefix (<prefix>.index.json, <prefix>.shards).
+Yoda reads only the index at startup. The shards of a job are read when its queue drains, and the lines are decoded
+to event range dicts only when they are handed out to a Droid.
+"""
+
+import collections
+import itertools
+import json
+import os
+
+PREFIX = "JobsEventRanges"
+INDEX_SUFFIX = ".index.json"
+SHARDS_SUFFIX = ".shards"
+INDEX_FILE = PREFIX + INDEX_SUFFIX
+SHARD_SIZE = 100000
+
+
+class EventRangeQueue(collections.deque):
+    """
+    Ready event ranges of a job. The items are event range dicts, or lines of the current shard (decoded with
+    self.fields when they are popped). len() includes the ranges of the shards which were not read yet.
+    """
+
+    def __init__(self, iterable=(), shards=()):
+        collections.deque.__init__(self, iterable)
+        self.fields = None
+        self.shards = collections.deque()
+        self.unread = 0
+        self.addShards(shards)
+
+    def __len__(self):
+        return collections.deque.__len__(self) + self.unread
+
+    def addShards(self, shards):
+        """ shards: list of (path, number of ranges, fields) """
+        for path, count, fields in shards:
+            self.shards.append((path, count, fields))
+            self.unread += count
+
+    def loadShard(self):
+        """ Read the next shard, return False if there is none """
+        if not self.shards:
+            return False
+        path, count, fields = self.shards.popleft()
+        self.unread -= count
+        tmpFile = open(path)
+        try:
+            lines = tmpFile.read().splitlines()
+        finally:
+            tmpFile.close()
+        # the ranges of the previous shard were handed out already, only one set of fields is in the queue
+        self.fields = fields
+        self.extend(lines)
+        return True
+
+    def popleft(self):
+        if not collections.deque.__len__(self):
+            self.loadShard()
+        return collections.deque.popleft(self)
+
+    def decode(self, eventRange):
+        if isinstance(eventRange, basestring):
+            return dict((key, value) for key, value in zip(self.fields, json.loads(eventRange)) if value is not None)
+        return eventRange
+
+    def popEventRanges(self, nRanges):
+        """ Pop up to nRanges ranges, as dicts """
+        eventRanges = []
+        popleft = collections.deque.popleft
+        size = collections.deque.__len__
+        while len(eventRanges) < nRanges:
+            if not size(self) and not self.loadShard():
+                break
+            items = [popleft(self) for i in xrange(min(nRanges - len(eventRanges), size(self)))]
+            eventRanges.extend(self.decodeItems(items))
+        return eventRanges
+
+    def decodeItems(self, items):
+        """ Decode items of the queue to event range dicts """
+        if not all([isinstance(item, basestring) for item in items]):
+            return [self.decode(item) for item in items]
+        # decode the lines at once
+        eventRanges = []
+        fields = self.fields
+        for values in json.loads("[" + ",".join(items) + "]"):
+            if None in values:
+                eventRanges.append(dict((key, value) for key, value in zip(fields, values) if value is not None))
+            else:
+                eventRanges.append(dict(zip(fields, values)))
+        return eventRanges
+
+    def skip(self, nRanges, keep=()):
+        """
+        Drop the first nRanges ranges, return the ranges at the positions in keep (relative to the front) as dicts.
+        Shards without a kept position are dropped without being read.
+        """
+        keep = collections.deque(sorted(keep))
+        kept = []
+        position = 0
+        size = collections.deque.__len__
+        while position < nRanges:
+            if not size(self):
+                if not self.shards:
+                    break
+                path, count, fields = self.shards[0]
+                if position + count <= nRanges and not (keep and keep[0] < position + count):
+                    self.shards.popleft()
+                    self.unread -= count
+                    position += count
+                else:
+                    self.loadShard()
+                continue
+            n = min(nRanges - position, size(self))
+            items = list(collections.deque.__iter__(self))
+            collections.deque.clear(self)
+            collections.deque.extend(self, items[n:])
+            keptItems = []
+            while keep and keep[0] < position + n:
+                keptItems.append(items[keep.popleft() - position])
+            kept.extend(self.decodeItems(keptItems))
+            position += n
+        return kept
+
+
+def writeEventRanges(directory, jobsEventRanges, shardSize=SHARD_SIZE, prefix=PREFIX):
+    """
+    Write the event ranges of the jobs ({jobId: iterable of event range dicts}) as shards and an index
+    to the directory, return the path of the index
+    """
+    shardsDir = os.path.join(directory, prefix + SHARDS_SUFFIX)
+    if not os.path.exists(shardsDir):
+        os.makedirs(shardsDir)
+    index = {'version': 1, 'jobs': {}}
+    for jobId in jobsEventRanges:
+        jobIndex = {'count': 0, 'shards': []}
+        eventRanges = iter(jobsEventRanges[jobId])
+        for n in itertools.count():
+            shard = list(itertools.islice(eventRanges, shardSize))
+            if not shard:
+                break
+            # the keys of all ranges of the shard, missing values are written as null
+            fields = list(shard[0].keys())
+            known = set(fields)
+            for eventRange in shard:
+                if len(eventRange) != len(fields) or not known.issuperset(eventRange):
+                    for key in eventRange:
+                        if key not in known:
+                            fields.append(key)
+                            known.add(key)
+            fileName = "%s.%d.ranges" % (jobId, n)
+            outputFile = open(os.path.join(shardsDir, fileName), 'w')
+            try:
+                outputFile.write("\n".join([json.dumps([eventRange.get(key) for key in fields]) for eventRange in shard]))
+                outputFile.write("\n")
+            finally:
+                outputFile.close()
+            jobIndex['shards'].append([fileName, len(shard), fields])
+            jobIndex['count'] += len(shard)
+        index['jobs'][jobId] = jobIndex
+
+    indexFile = os.path.join(directory, prefix + INDEX_SUFFIX)
+    outputFile = open(indexFile + ".new", 'w')
+    json.dump(index, outputFile)
+    outputFile.close()
+    os.rename(indexFile + ".new", indexFile)
+    return indexFile
+
+
+def loadEventRanges(indexFile):
+    """ Read an index, return {jobId: EventRangeQueue}; the shards are read on demand """
+    tmpFile = open(indexFile)
+    try:
+        index = json.load(tmpFile)
+    finally:
+        tmpFile.close()
+    shardsDir = indexFile[:-len(INDEX_SUFFIX)] + SHARDS_SUFFIX
+    jobsEventRanges = {}
+    for jobId, jobIndex in index['jobs'].iteritems():
+        jobsEventRanges[jobId] = EventRangeQueue(shards=[(os.path.join(shardsDir, fileName), count, fields)
+                                                         for fileName, count, fields in jobIndex['shards']])
+    return jobsEventRanges
@@ -0,0 +1,86 @@
+"""
+Batched event range updates from the Droids to Yoda.
+
+A Droid collects the updates of its event ranges ({"jobId", "eventRangeID", "eventStatus", "output"[, "objstoreID"]})
+in an UpdateBatcher and sends them to Yoda in one updateEventRanges request when the oldest one waited flushInterval
+seconds or flushSize of them are pending. The request is encoded with encodeUpdates():
+  {"format": FORMAT, "count": N, "data": base64(zlib([[jobId, eventStatus, objstoreID, [eventRangeID, ...], [output, ...]], ...]))}
+the event ranges with the same job, status and object store are sent as two columns, which zlib compresses well
+(the outputs of a rank share their path). decodeUpdates() also accepts the plain list of updates sent by old Droids.
+"""
+
+import base64
+import json
+import time
+import zlib
+
+FORMAT = "zlib-columns-1"
+# seconds an update may wait in the Droid, and number of updates sent at once at the latest
+FLUSH_INTERVAL = 30
+FLUSH_SIZE = 1000
+
+
+def encodeUpdates(updates):
+    """ Encode a list of event range updates for the updateEventRanges request """
+    groups = {}
+    keys = []
+    for update in updates:
+        key = (update['jobId'], update['eventStatus'], update.get('objstoreID'))
+        if key not in groups:
+            groups[key] = ([], [])
+            keys.append(key)
+        eventRangeIDs, outputs = groups[key]
+        eventRangeIDs.append(update['eventRangeID'])
+        outputs.append(update['output'])
+    data = json.dumps([list(key) + list(groups[key]) for key in keys], separators=(',', ':'))
+    return {'format': FORMAT, 'count': len(updates), 'data': base64.b64encode(zlib.compress(data))}
+
+
+def decodeUpdates(params):
+    """ The list of event range updates of an updateEventRanges request """
+    if isinstance(params, dict) and params.get('format') == FORMAT:
+        updates = []
+        for jobId, eventStatus, objstoreID, eventRangeIDs, outputs in json.loads(zlib.decompress(base64.b64decode(params['data']))):
+            for eventRangeID, output in zip(eventRangeIDs, outputs):
+                update = {'jobId': jobId, 'eventRangeID': eventRangeID, 'eventStatus': eventStatus, 'output': output}
+                if objstoreID is not None:
+                    update['objstoreID'] = objstoreID
+                updates.append(update)
+        return updates
+    return params
+
+
+class UpdateBatcher(object):
+    """ Event range updates of a Droid waiting to be sent to Yoda """
+
+    def __init__(self, flushInterval=FLUSH_INTERVAL, flushSize=FLUSH_SIZE, clock=time.time):
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.clock = clock
+        self.updates = []
+        self.firstTime = None
+
+    def __len__(self):
+        return len(self.updates)
+
+    def add(self, update):
+        if not self.updates:
+            self.firstTime = self.clock()
+        self.updates.append(update)
+
+    def isDue(self):
+        return len(self.updates) >= self.flushSize or \
+            (self.updates and self.clock() - self.firstTime >= self.flushInterval)
+
+    def getTimeout(self):
+        """ Seconds until the pending updates are due, None if there are none """
+        if not self.updates:
+            return None
+        return max(self.firstTime + self.flushInterval - self.clock(), 0)
+
+    def flush(self):
+        """ Return the pending updates and forget them """
+        updates = self.updates
+        self.updates = []
+        self.firstTime = None
+        return updates
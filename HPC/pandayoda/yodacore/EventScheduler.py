@@ -0,0 +1,123 @@
+import collections
+import time
+
+from EventRangeStore import EventRangeQueue
+
+
+class EventScheduler(object):
+    """
+    Event range scheduler of Yoda. Ready event ranges are kept in one deque per job (EventRangeQueue, which reads
+    sharded event ranges on demand).
+
+    A Droid asks for as many ranges as it has idle workers. Once the processing rate of a rank is known (from its
+    heartbeats) it gets enough ranges for requestInterval seconds of work instead, which saves most of the MPI round
+    trips to rank 0. The chunks shrink towards the end of a job (at most 1/tailFactor of the fair share of the
+    remaining ranges of the job) and of the allocation (no more ranges than the rank can process in the remaining
+    walltime), so that no rank is left with a long list of ranges when the others are idle or the allocation ends.
+    Ranks whose job ran out of ranges can steal the job with the most remaining work per rank (stealJob).
+    """
+
+    def __init__(self, walltime=None, startTime=None, requestInterval=600, tailFactor=2, maxChunk=None, clock=time.time):
+        """
+        walltime: seconds of the allocation left at startTime (None if unknown)
+        requestInterval: seconds of work handed to a rank at once
+        clock: function returning the current time
+        """
+        self.readyJobsEventRanges = {}
+        self.walltime = walltime
+        self.clock = clock
+        if startTime is None:
+            startTime = clock()
+        self.endTime = startTime + walltime if walltime else None
+        self.requestInterval = requestInterval
+        self.tailFactor = tailFactor
+        self.maxChunk = maxChunk
+
+        self.jobsRanks = {}   # jobId: ranks running the job
+        self.rankJobs = {}    # rank: jobId
+        self.rankRates = {}   # rank: processed events per second of the current job
+
+    def addEventRanges(self, jobId, eventRanges):
+        """ eventRanges: list of event range dicts, or an EventRangeQueue of sharded ranges """
+        if jobId not in self.readyJobsEventRanges:
+            self.readyJobsEventRanges[jobId] = EventRangeQueue()
+            self.jobsRanks[jobId] = set()
+        if isinstance(eventRanges, EventRangeQueue):
+            queue = self.readyJobsEventRanges[jobId]
+            queue.extend([eventRanges.decode(eventRange) for eventRange in collections.deque.__iter__(eventRanges)])
+            queue.addShards(eventRanges.shards)
+        else:
+            self.readyJobsEventRanges[jobId].extend(eventRanges)
+
+    def getNumberOfReadyEventRanges(self, jobId=None):
+        if jobId is not None:
+            return len(self.readyJobsEventRanges.get(jobId, ()))
+        return sum([len(eventRanges) for eventRanges in self.readyJobsEventRanges.values()])
+
+    def addRank(self, jobId, rank):
+        """ The rank starts to run the job """
+        self.removeRank(self.rankJobs.get(rank), rank)
+        self.rankJobs[rank] = jobId
+        self.jobsRanks.setdefault(jobId, set()).add(rank)
+
+    def removeRank(self, jobId, rank):
+        """ The rank finished the job """
+        if jobId in self.jobsRanks:
+            self.jobsRanks[jobId].discard(rank)
+        if rank in self.rankJobs and self.rankJobs[rank] == jobId:
+            del self.rankJobs[rank]
+            if rank in self.rankRates:
+                del self.rankRates[rank]
+
+    def updateRate(self, jobId, rank, processedEvents, runningTime, setupTime=None):
+        """ Record the processing rate of a rank, from the heartbeat metrics of its current job (setupTime: see JobPacker) """
+        if self.rankJobs.get(rank) != jobId:
+            return
+        try:
+            if processedEvents > 0 and runningTime > 0:
+                self.rankRates[rank] = float(processedEvents) / runningTime
+        except TypeError:
+            pass
+
+    def getRemainingTime(self):
+        if self.endTime is None:
+            return None
+        return max(self.endTime - self.clock(), 0)
+
+    def getChunkSize(self, jobId, rank, nRanges):
+        """ Number of ranges to hand to a rank which asks for nRanges (never less than nRanges) """
+        chunk = nRanges
+        rate = self.rankRates.get(rank)
+        if rate:
+            chunk = max(chunk, int(rate * self.requestInterval))
+            # tail of the job: at most a fraction of the fair share of what is left
+            ranks = max(len(self.jobsRanks.get(jobId, ())), 1)
+            chunk = min(chunk, max(nRanges, self.getNumberOfReadyEventRanges(jobId) / (self.tailFactor * ranks)))
+            # tail of the allocation: no more than the rank can process before the end
+            remainingTime = self.getRemainingTime()
+            if remainingTime is not None:
+                chunk = min(chunk, max(nRanges, int(rate * remainingTime)))
+        if self.maxChunk:
+            chunk = min(chunk, max(nRanges, self.maxChunk))
+        return chunk
+
+    def getEventRanges(self, jobId, rank, nRanges):
+        """ Hand out the next ranges of a job to a rank, return the list of ranges """
+        eventRanges = self.readyJobsEventRanges.get(jobId)
+        if not eventRanges or nRanges < 1:
+            return []
+        return eventRanges.popEventRanges(self.getChunkSize(jobId, rank, nRanges))
+
+    def stealJob(self, rank, exclude=(), minRanges=1):
+        """
+        Job with the most ready ranges per running rank, for a rank whose job finished early
+        (None if no job has minRanges ready ranges left, a smaller rest is not worth the setup of the job)
+        """
+        best, bestShare = None, 0
+        for jobId, eventRanges in self.readyJobsEventRanges.iteritems():
+            if len(eventRanges) < minRanges or jobId in exclude:
+                continue
+            share = float(len(eventRanges)) / (len(self.jobsRanks.get(jobId, ())) + 1)
+            if share > bestShare:
+                best, bestShare = jobId, share
+        return best
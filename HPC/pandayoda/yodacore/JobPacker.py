@@ -0,0 +1,193 @@
+import heapq
+import time
+
+from EventScheduler import EventScheduler
+
+# processed events worth the prior time per event of a job: a job's own measurement outweighs the prior after so many
+PRIOR_EVENTS = 10
+# rank seconds per event before any job was measured (only the ratios between the jobs matter then)
+DEFAULT_EVENT_TIME = 1.0
+
+
+class EventTimeModel(object):
+    """
+    Rank seconds per event of every job, from the heartbeats of its ranks. A job starts from a prior, the mean of
+    the jobs measured so far, which its own heartbeats refine:
+        (priorEvents * prior + running time of its ranks) / (priorEvents + events processed by its ranks)
+    The heartbeats are cumulative per rank and job, so only the latest one of a rank counts.
+    """
+
+    def __init__(self, priorEvents=PRIOR_EVENTS, defaultEventTime=DEFAULT_EVENT_TIME):
+        self.priorEvents = priorEvents
+        self.defaultEventTime = defaultEventTime
+        self.ranks = {}     # jobId: {rank: (processedEvents, runningTime, setupTime)}
+        self.sums = {}      # jobId: [processedEvents, runningTime, setupTime, ranks with a setup time]
+        self.total = [0, 0.0]
+
+    def update(self, jobId, rank, processedEvents, runningTime, setupTime=None):
+        """ Record the latest heartbeat of a rank, return True if the model changed """
+        try:
+            processedEvents, runningTime = int(processedEvents), float(runningTime)
+            setupTime = float(setupTime) if setupTime else 0.0
+        except (TypeError, ValueError):
+            return False
+        if processedEvents <= 0 or runningTime <= 0:
+            return False
+        ranks = self.ranks.setdefault(jobId, {})
+        sums = self.sums.setdefault(jobId, [0, 0.0, 0.0, 0])
+        old = ranks.get(rank)
+        if old == (processedEvents, runningTime, setupTime):
+            return False
+        if old is not None:
+            sums[0] -= old[0]
+            sums[1] -= old[1]
+            self.total[0] -= old[0]
+            self.total[1] -= old[1]
+            if old[2]:
+                sums[2] -= old[2]
+                sums[3] -= 1
+        ranks[rank] = (processedEvents, runningTime, setupTime)
+        sums[0] += processedEvents
+        sums[1] += runningTime
+        self.total[0] += processedEvents
+        self.total[1] += runningTime
+        if setupTime:
+            sums[2] += setupTime
+            sums[3] += 1
+        return True
+
+    def isMeasured(self, jobId):
+        return jobId in self.sums and self.sums[jobId][0] > 0
+
+    def getPrior(self):
+        if self.total[0] > 0:
+            return self.total[1] / self.total[0]
+        return self.defaultEventTime
+
+    def getEventTime(self, jobId):
+        """ Rank seconds per event of the job """
+        processedEvents, runningTime = self.sums.get(jobId, (0, 0.0))[:2]
+        return (self.priorEvents * self.getPrior() + runningTime) / (self.priorEvents + processedEvents)
+
+    def getSetupTime(self, jobId=None):
+        """ Mean setup time of the ranks of the job (of all jobs if it has none yet), 0 if unknown """
+        sums = self.sums.get(jobId)
+        if sums and sums[3]:
+            return sums[2] / sums[3]
+        setupTime = sum([s[2] for s in self.sums.values()])
+        ranks = sum([s[3] for s in self.sums.values()])
+        return setupTime / ranks if ranks else 0.0
+
+
+class JobPacker(EventScheduler):
+    """
+    Event scheduler which also decides the job of every rank, to minimize the makespan of the allocation.
+
+    The cost of a job is its ready event ranges times its time per event (EventTimeModel, refined by the
+    heartbeats). A rank asking for a job gets the job which would finish last: first the jobs without any rank
+    (the most expensive first), then the job with the highest cost per running rank. Ranks whose job ran out of
+    ranges come back the same way, so ranks move to the slow jobs during the allocation. A rank is only added to a
+    job if its share of the job is worth it: at least minRanges ranges, and (once measured) more work than the setup
+    of AthenaMP. No job is started when the allocation ends before the setup is done.
+
+    The jobs are kept in a heap ordered by that priority. Handing out ranges and adding ranks only lower the priority
+    of a job, so the heap is updated lazily: a popped job whose priority dropped is pushed back with the new one.
+    A rank leaving a job or new ranges push the job again (older entries are dropped by their version), a new
+    measurement changes the costs of all jobs and rebuilds the heap at the next request.
+    """
+
+    def __init__(self, walltime=None, startTime=None, minRanges=1, clock=time.time, **kwds):
+        EventScheduler.__init__(self, walltime=walltime, startTime=startTime, clock=clock, **kwds)
+        self.model = EventTimeModel()
+        self.minRanges = minRanges
+        self.heap = []
+        self.versions = {}
+        self.rebuild = False
+
+    def addEventRanges(self, jobId, eventRanges):
+        EventScheduler.addEventRanges(self, jobId, eventRanges)
+        self.push(jobId)
+
+    def addRank(self, jobId, rank):
+        oldJobId = self.rankJobs.get(rank)
+        EventScheduler.addRank(self, jobId, rank)
+        if oldJobId is not None and oldJobId != jobId:
+            self.push(oldJobId)
+
+    def removeRank(self, jobId, rank):
+        EventScheduler.removeRank(self, jobId, rank)
+        if jobId in self.readyJobsEventRanges:
+            self.push(jobId)
+
+    def updateRate(self, jobId, rank, processedEvents, runningTime, setupTime=None):
+        EventScheduler.updateRate(self, jobId, rank, processedEvents, runningTime, setupTime)
+        if self.model.update(jobId, rank, processedEvents, runningTime, setupTime):
+            self.rebuild = True
+
+    def getCost(self, jobId):
+        """ Rank seconds of the ready ranges of the job """
+        return self.getNumberOfReadyEventRanges(jobId) * self.model.getEventTime(jobId)
+
+    def getPriority(self, jobId):
+        """ Heap key: jobs without ranks first, then the highest cost per rank """
+        ranks = len(self.jobsRanks.get(jobId, ()))
+        if ranks == 0:
+            return (0, -self.getCost(jobId))
+        return (1, -self.getCost(jobId) / ranks)
+
+    def push(self, jobId):
+        version = self.versions.get(jobId, 0) + 1
+        self.versions[jobId] = version
+        heapq.heappush(self.heap, (self.getPriority(jobId), version, jobId))
+
+    def rebuildHeap(self):
+        self.heap = []
+        for jobId in self.readyJobsEventRanges:
+            if self.getNumberOfReadyEventRanges(jobId):
+                self.versions[jobId] = self.versions.get(jobId, 0) + 1
+                self.heap.append((self.getPriority(jobId), self.versions[jobId], jobId))
+        heapq.heapify(self.heap)
+        self.rebuild = False
+
+    def isWorthRank(self, jobId):
+        """ Whether one more rank on the job pays off """
+        nRanges = self.getNumberOfReadyEventRanges(jobId)
+        ranks = len(self.jobsRanks.get(jobId, ()))
+        if nRanges == 0:
+            return False
+        if ranks == 0:
+            return True
+        share = nRanges / (ranks + 1)
+        if share < self.minRanges:
+            return False
+        if self.model.isMeasured(jobId) and share * self.model.getEventTime(jobId) < self.model.getSetupTime(jobId):
+            return False
+        return True
+
+    def getJob(self, rank, exclude=()):
+        """ Job for a rank (None if no job is worth a new rank), exclude: the jobs the rank already ran """
+        remainingTime = self.getRemainingTime()
+        if remainingTime is not None and remainingTime <= self.model.getSetupTime():
+            return None
+        if self.rebuild:
+            self.rebuildHeap()
+        skipped = []
+        jobId = None
+        while self.heap:
+            priority, version, candidate = heapq.heappop(self.heap)
+            if version != self.versions.get(candidate):
+                continue
+            if not self.getNumberOfReadyEventRanges(candidate):
+                # pushed again by new ranges
+                continue
+            current = self.getPriority(candidate)
+            if current != priority:
+                heapq.heappush(self.heap, (current, version, candidate))
+                continue
+            skipped.append((priority, version, candidate))
+            if candidate not in exclude and self.isWorthRank(candidate):
+                jobId = candidate
+                break
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return jobId
@@ -0,0 +1,211 @@
+"""
+Completion tracking of the HPC job running Yoda, for HPCManager.
+
+Yoda writes its state to YodaState.json in its working directory when it changes (starting, running, stopped,
+finished, failed), and the event status dumps (*.dump) when it has new outputs. The tracker watches both with
+os.stat() (inotify does not see the writes of other nodes on the shared file systems of HPCs): the directory is
+listed only when its mtime changed. The batch system (the poll() of the HPCManager plugin, which forks qstat,
+squeue, scontrol...) is only queried as a fallback, for a job which ends without Yoda writing its final state,
+with an interval growing from minQueryInterval to maxQueryInterval while the state does not change. The state file
+has no heartbeat, so maxQueryInterval is the delay until a job killed or preempted before Yoda wrote its final state
+is noticed: it is kept at a few minutes.
+"""
+
+import errno
+import json
+import os
+import time
+
+STATE_FILE = "YodaState.json"
+OUTPUT_SUFFIX = ".dump"
+# final states of Yoda and the corresponding state of the HPC job
+FINAL_STATES = {'finished': 'Complete', 'failed': 'Failed'}
+
+
+def writeState(directory, state):
+    """ Write the state of Yoda to STATE_FILE in directory, replacing the old file atomically """
+    path = os.path.join(directory, STATE_FILE)
+    tmpFile = open(path + ".new", 'w')
+    try:
+        json.dump({'state': state, 'time': time.time(), 'pid': os.getpid()}, tmpFile)
+    finally:
+        tmpFile.close()
+    os.rename(path + ".new", path)
+
+
+class Backoff(object):
+    """ Intervals between retries, growing by factor from initial to maximum """
+
+    def __init__(self, initial=60, maximum=300, factor=2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.interval = initial
+
+    def reset(self):
+        self.interval = self.initial
+
+    def next(self):
+        """ Return the current interval and increase it """
+        interval = self.interval
+        self.interval = min(self.interval * self.factor, self.maximum)
+        return interval
+
+
+class JobTracker(object):
+    """
+    State and new output dumps of a HPC job. queryState() returns the state of the job in the batch system
+    ('Queue', 'Running', 'Complete', 'Failed' or 'Unknown', see the HPCManager plugins)
+    """
+
+    def __init__(self, directory, queryState, logger=None, minQueryInterval=60, maxQueryInterval=300,
+                 checkInterval=1, settleTime=1, clock=time.time, sleep=time.sleep):
+        self.directory = directory
+        self.queryState = queryState
+        self.__log = logger
+        self.backoff = Backoff(minQueryInterval, maxQueryInterval)
+        self.checkInterval = checkInterval
+        # files written in place (Database.dumpUpdates) are complete when they were not modified for settleTime
+        self.settleTime = settleTime
+        self.clock = clock
+        self.sleep = sleep
+
+        self.yodaState = None
+        self.schedulerState = None
+        self.nextQueryTime = 0
+        self.queries = 0
+        self.__stateStat = None
+        self.__dirMtime = None
+        self.__scanTime = None
+        # output dumps: reported (name -> stat key), to be checked (names), new (paths)
+        self.__outputs = {}
+        self.__unsettled = set()
+        self.__newOutputs = []
+
+    def debug(self, message):
+        if self.__log:
+            self.__log.debug(message)
+
+    def reset(self):
+        """ Forget the state of a previous HPC job in the directory (before a new submission) """
+        try:
+            os.remove(os.path.join(self.directory, STATE_FILE))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.yodaState = None
+        self.schedulerState = None
+        self.__stateStat = None
+        self.nextQueryTime = 0
+        self.backoff.reset()
+
+    def checkState(self):
+        """ Read STATE_FILE if it changed, return True if the state of Yoda changed """
+        path = os.path.join(self.directory, STATE_FILE)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        key = (st.st_mtime, st.st_ino, st.st_size)
+        if key == self.__stateStat:
+            return False
+        self.__stateStat = key
+        try:
+            tmpFile = open(path)
+            try:
+                state = json.load(tmpFile)['state']
+            finally:
+                tmpFile.close()
+        except (IOError, OSError, ValueError, KeyError):
+            # replaced in the meantime
+            self.__stateStat = None
+            return False
+        if state == self.yodaState:
+            return False
+        self.debug("Yoda state: %s" % state)
+        self.yodaState = state
+        # the batch system is queried soon after a change, e.g. when Yoda was stopped by a signal
+        self.backoff.reset()
+        self.nextQueryTime = self.clock() + self.backoff.next()
+        return True
+
+    def checkOutputs(self):
+        """ Look for new or modified output dumps, return True if there are some """
+        now = self.clock()
+        found = False
+        try:
+            dirMtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return False
+        # the mtime of some file systems has a resolution of a second: rescan while a change could be missed
+        if dirMtime != self.__dirMtime or self.__scanTime - dirMtime < 2:
+            self.__dirMtime = dirMtime
+            self.__scanTime = now
+            names = set([name for name in os.listdir(self.directory) if name.endswith(OUTPUT_SUFFIX)])
+            for name in self.__outputs.keys():
+                if name not in names:
+                    del self.__outputs[name]
+            self.__unsettled.update(names)
+        for name in list(self.__unsettled):
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                self.__unsettled.discard(name)
+                continue
+            key = (st.st_mtime, st.st_ino, st.st_size)
+            if self.__outputs.get(name) == key:
+                # reported already
+                self.__unsettled.discard(name)
+            elif now - st.st_mtime >= self.settleTime:
+                self.__outputs[name] = key
+                self.__newOutputs.append(os.path.join(self.directory, name))
+                self.__unsettled.discard(name)
+                found = True
+        return found
+
+    def getOutputFiles(self):
+        """ The output dumps which appeared or changed since the last call """
+        self.checkOutputs()
+        outputs = self.__newOutputs
+        self.__newOutputs = []
+        return sorted(outputs)
+
+    def poll(self):
+        """ State of the HPC job """
+        self.checkState()
+        if self.yodaState in FINAL_STATES:
+            return FINAL_STATES[self.yodaState]
+        if self.clock() >= self.nextQueryTime:
+            try:
+                state = self.queryState()
+            except:
+                state = 'Unknown'
+            self.queries += 1
+            if state != self.schedulerState:
+                self.backoff.reset()
+            self.schedulerState = state
+            self.nextQueryTime = self.clock() + self.backoff.next()
+        if self.schedulerState in ['Complete', 'Failed']:
+            # ended without Yoda writing its final state (killed, node failure...)
+            return self.schedulerState
+        if self.yodaState is not None:
+            return 'Running'
+        return self.schedulerState or 'Unknown'
+
+    def wait(self, timeout):
+        """
+        Sleep until the state of Yoda changes, new output dumps appear, the batch system is to be queried or timeout
+        seconds passed; return True if the state or the outputs changed
+        """
+        end = self.clock() + timeout
+        while True:
+            changed = self.checkState()
+            if self.checkOutputs() or changed:
+                return True
+            now = self.clock()
+            if now >= end or (self.yodaState not in FINAL_STATES and now >= self.nextQueryTime):
+                return False
+            sleepTime = min(self.checkInterval, end - now)
+            if self.yodaState not in FINAL_STATES:
+                sleepTime = min(sleepTime, self.nextQueryTime - now)
+            self.sleep(sleepTime)
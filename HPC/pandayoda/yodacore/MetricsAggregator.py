@@ -0,0 +1,134 @@
+import heapq
+import threading
+import time
+
+# heartbeat values summed over the ranks of a job
+SUM_KEYS = ["setupTime", "runningTime", "totalTime", "cores", "queuedEvents", "processedEvents", "cpuConsumptionTime", "avgTimePerEvent"]
+# heartbeat values (and the stage-out time) with a min and max over the ranks
+EXTREMA_KEYS = ["setupTime", "runningTime", "totalTime", "stageoutTime"]
+# columns of the per-rank time series
+TIME_SERIES_KEYS = ["time", "jobId", "rank"] + SUM_KEYS
+
+
+class RankExtrema(object):
+    """
+    Min and max of a value over the ranks. Every update pushes the new value on both heaps, replaced values are
+    dropped when they reach the top (and the heaps are rebuilt when they hold too many of them)
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.minHeap = []
+        self.maxHeap = []
+
+    def update(self, rank, value):
+        self.values[rank] = value
+        heapq.heappush(self.minHeap, (value, rank))
+        heapq.heappush(self.maxHeap, (-value, rank))
+        if len(self.minHeap) > 2 * len(self.values) + 64:
+            self.minHeap = [(v, r) for r, v in self.values.iteritems()]
+            self.maxHeap = [(-v, r) for r, v in self.values.iteritems()]
+            heapq.heapify(self.minHeap)
+            heapq.heapify(self.maxHeap)
+
+    def getMin(self):
+        heap = self.minHeap
+        while heap and self.values[heap[0][1]] != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else 0
+
+    def getMax(self):
+        heap = self.maxHeap
+        while heap and self.values[heap[0][1]] != -heap[0][0]:
+            heapq.heappop(heap)
+        return -heap[0][0] if heap else 0
+
+
+class JobMetrics(object):
+    """ Latest heartbeat of every rank of a job, with running sums and extrema """
+
+    def __init__(self):
+        self.ranks = {}
+        self.sums = dict((key, 0) for key in SUM_KEYS)
+        self.extrema = dict((key, RankExtrema()) for key in EXTREMA_KEYS)
+
+    def update(self, rank, params):
+        values = dict((key, params.get(key, 0) or 0) for key in SUM_KEYS)
+        old = self.ranks.get(rank)
+        if old is not None:
+            for key in SUM_KEYS:
+                self.sums[key] -= old.get(key, 0) or 0
+        for key in SUM_KEYS:
+            self.sums[key] += values[key]
+        self.ranks[rank] = params
+
+        values['stageoutTime'] = values['totalTime'] - values['setupTime'] - values['runningTime']
+        for key in EXTREMA_KEYS:
+            self.extrema[key].update(rank, values[key])
+
+    def getReport(self):
+        """ The metrics of the job, as reported to the pilot (see RunJobHpcEvent.checkJobMetrics) """
+        sums = self.sums
+        num_ranks = max(len(self.ranks), 1)
+        report = {'avgYodaSetupTime': sums['setupTime'] / num_ranks,
+                  'avgYodaRunningTime': sums['runningTime'] / num_ranks,
+                  'avgYodaStageoutTime': (sums['totalTime'] - sums['setupTime'] - sums['runningTime']) / num_ranks,
+                  'avgYodaTotalTime': sums['totalTime'] / num_ranks,
+                  'cores': sums['cores'],
+                  'cpuConsumptionTime': sums['cpuConsumptionTime'],
+                  'totalQueuedEvents': sums['queuedEvents'],
+                  'totalProcessedEvents': sums['processedEvents'],
+                  'avgTimePerEvent': sums['avgTimePerEvent'] / num_ranks}
+        for key, name in [('setupTime', 'SetupTime'), ('runningTime', 'RunningTime'), ('stageoutTime', 'StageoutTime'), ('totalTime', 'TotalTime')]:
+            report['maxYoda' + name] = self.extrema[key].getMax()
+            report['minYoda' + name] = self.extrema[key].getMin()
+        for key in report:
+            report[key] = int(report[key])
+        return report
+
+
+class MetricsAggregator(object):
+    """
+    Job metrics of Yoda, from the heartbeats of the Droids. A heartbeat updates the metrics of its job in O(log ranks);
+    getSnapshot() returns the content of jobMetrics-yoda.json. Optionally every heartbeat is also appended to a CSV
+    time series (timeSeriesFile), for the analysis of the scaling after the job.
+    """
+
+    def __init__(self, timeSeriesFile=None, clock=None):
+        self.jobs = {}
+        self.lock = threading.RLock()
+        self.timeSeries = None
+        self.clock = clock or time.time
+        if timeSeriesFile:
+            self.timeSeries = open(timeSeriesFile, 'a')
+            if self.timeSeries.tell() == 0:
+                self.timeSeries.write(",".join(TIME_SERIES_KEYS) + "\n")
+
+    def update(self, jobId, rank, params):
+        with self.lock:
+            if jobId not in self.jobs:
+                self.jobs[jobId] = JobMetrics()
+            self.jobs[jobId].update(rank, params)
+            if self.timeSeries:
+                row = [self.clock(), jobId, rank] + [params.get(key, '') for key in SUM_KEYS]
+                self.timeSeries.write(",".join([str(value) for value in row]) + "\n")
+
+    def getReport(self, jobId):
+        with self.lock:
+            return self.jobs[jobId].getReport()
+
+    def getSnapshot(self):
+        """ {jobId: {'ranks': {rank: latest heartbeat}, 'collect': report}} """
+        with self.lock:
+            snapshot = {}
+            for jobId, job in self.jobs.iteritems():
+                snapshot[jobId] = {'ranks': dict(job.ranks), 'collect': job.getReport()}
+            if self.timeSeries:
+                self.timeSeries.flush()
+            return snapshot
+
+    def close(self):
+        with self.lock:
+            if self.timeSeries:
+                self.timeSeries.close()
+                self.timeSeries = None
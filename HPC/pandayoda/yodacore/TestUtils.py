@@ -0,0 +1,37 @@
+import json
+
+
+class FakeCommunicator(object):
+    """
+    Interaction.Receiver replacement for the tests and benchmarks of the yodacore modules, keeps the response of
+    the handler. Set requesterRank before calling a handler for another rank.
+    """
+
+    def __init__(self, totalRanks=2, requesterRank=1):
+        self.totalRanks = totalRanks
+        self.requesterRank = requesterRank
+        self.response = None
+
+    def getRank(self):
+        return 0
+
+    def getTotalRanks(self):
+        return self.totalRanks
+
+    def getRequesterRank(self):
+        return self.requesterRank
+
+    def activeRanks(self):
+        return self.totalRanks > 0
+
+    def decrementNumRank(self):
+        self.totalRanks -= 1
+
+    def returnResponse(self, rData):
+        self.response = rData
+        # the response has to go through MPI
+        json.dumps(rData)
+        return True, None
+
+    def sendMessage(self, rData):
+        return True, None
@@ -1,5 +1,4 @@
 import commands
-import datetime
 import json
 import logging
 import math
@@ -16,16 +15,24 @@ from os.path import abspath as _abspath, join as _join
 # logging.basicConfig(filename='Yoda.log', level=logging.DEBUG)
 
 import Interaction,Database,Logger
+from EventScheduler import EventScheduler
+from JobPacker import JobPacker
+from MetricsAggregator import MetricsAggregator
+import EventRangeStore
+from EventRangeUpdates import decodeUpdates
+import JobTracker
+import Checkpoint
 from signal_block.signal_block import block_sig, unblock_sig
 #from HPC import EventServer
 
 # main Yoda class
 class Yoda(threading.Thread):
     class HelperThread(threading.Thread):
-        def __init__(self, logger, helperFunc, **kwds):
+        def __init__(self, logger, helperFunc, interval=60, **kwds):
             threading.Thread.__init__(self, **kwds)
             self.__log = logger
             self.__func = helperFunc
+            self.__interval = interval
             self._stop = threading.Event()
             self.__log.debug("HelperThread initialized.")
 
@@ -41,7 +48,7 @@ class Yoda(threading.Thread):
                 while True:
                     if self.stopped():
                         break
-                    if exec_time is None or exec_time < time.time() - 60:
+                    if exec_time is None or exec_time < time.time() - self.__interval:
                         self.__func()
                         exec_time = time.time()
                     time.sleep(1)
@@ -50,7 +57,9 @@ class Yoda(threading.Thread):
 
 
     # constructor
-    def __init__(self, globalWorkingDir, localWorkingDir, pilotJob=None, rank=None, nonMPIMode=False, outputDir=None, dumpEventOutputs=False):
+    def __init__(self, globalWorkingDir, localWorkingDir, pilotJob=None, rank=None, nonMPIMode=False, outputDir=None, dumpEventOutputs=False, walltime=None,
+                 metricsInterval=60, metricsTimeSeries=False, pandaUpdateInterval=30,
+                 checkpointInterval=Checkpoint.CHECKPOINT_INTERVAL, jobScheduler='packing', pandaServerURL=None):
         threading.Thread.__init__(self)
         self.globalWorkingDir = globalWorkingDir
         self.localWorkingDir = localWorkingDir
@@ -82,9 +91,13 @@ class Yoda(threading.Thread):
         # jobs which needs less than one rank
         self.jobRanksSmallPiece = []
         self.totalJobRanksSmallPiece = 0
+        # rank: set of the jobs the rank ran
         self.rankJobsTries = {}
 
         # scheduler policy:
+        # 'packing': JobPacker gives every rank the job which would finish last, from the cost of the jobs
+        # 'ranks': queues of jobs by needed ranks (initJobRanks), big jobs first for the first 90% of the ranks
+        self.jobScheduler = jobScheduler
         self.bigJobFirst = True
         self.lastRankForBigJobFirst = int(self.getTotalRanks() * 0.9)
 
@@ -92,14 +105,38 @@ class Yoda(threading.Thread):
         self.runningEventRanges = {}
         self.finishedEventRanges = []
 
-        self.readyJobsEventRanges = {}
+        # ready event ranges per job (deques), handed out by the scheduler
+        # walltime: seconds left in the allocation (None if unknown)
+        if self.jobScheduler == 'packing':
+            self.scheduler = JobPacker(walltime=walltime)
+        else:
+            self.scheduler = EventScheduler(walltime=walltime)
+        self.readyJobsEventRanges = self.scheduler.readyJobsEventRanges
         self.runningJobsEventRanges = {}
         self.finishedJobsEventRanges = {}
         self.stagedOutJobsEventRanges = {}
 
         self.updateEventRangesToDBTime = None
 
-        self.jobMetrics = {}
+        # event range state, written with the event status dumps every checkpointInterval seconds;
+        # a Yoda started in the same working dir resumes from it (see Checkpoint)
+        self.checkpointInterval = checkpointInterval
+        self.checkpoint = Checkpoint.Checkpoint(self.globalWorkingDir, logger=self.tmpLog)
+        # dump file: its version of the previous allocation, copied to the beginning of the new dump
+        self.resumedDumps = {}
+
+        # updates of event ranges staged out to the objectstore by the Droids, sent to PanDA in bulk
+        # every pandaUpdateInterval seconds, to pandaServerURL (default: the PanDA server settings of the pilot)
+        self.pandaUpdateInterval = pandaUpdateInterval
+        self.pandaServerURL = pandaServerURL
+        self.pandaEventRanges = []
+        self.pandaEventRangesLock = threading.Lock()
+
+        # job metrics from the Droid heartbeats, dumped every metricsInterval seconds
+        # metricsTimeSeries: also write every heartbeat to jobMetrics-ranks.csv
+        self.metricsInterval = metricsInterval
+        timeSeriesFile = os.path.join(self.globalWorkingDir, "jobMetrics-ranks.csv") if metricsTimeSeries else None
+        self.metrics = MetricsAggregator(timeSeriesFile=timeSeriesFile)
         self.jobsTimestamp = {}
         self.jobsRuningRanks = {}
 
@@ -191,9 +228,16 @@ class Yoda(threading.Thread):
                         self.cores = 10
                 except:
                      self.tmpLog.debug("Rank %s: failed to get core count" % (self.rank, traceback.format_exc()))
+                if self.jobScheduler == 'packing':
+                    continue
                 if job['neededRanks'] not in neededRanks:
                     neededRanks[job['neededRanks']] = []
                 neededRanks[job['neededRanks']].append(jobId)
+            if self.jobScheduler == 'packing':
+                # a rank takes at least two ranges per worker of a job
+                self.scheduler.minRanges = self.cores * 2
+                self.tmpLog.debug("Rank %s: Jobs scheduled by cost: %s" % (self.rank, self.jobs.keys()))
+                return True,self.jobRanks
             keys = neededRanks.keys()
             keys.sort(reverse=True)
             for key in keys:
@@ -267,17 +311,24 @@ class Yoda(threading.Thread):
     # make event table
     def makeJobsEventTable(self):
         try:
-            # load event ranges
-            tmpFile = open(os.path.join(self.globalWorkingDir, 'JobsEventRanges.json'))
-            eventRangeList = json.load(tmpFile)
-            tmpFile.close()
+            # load event ranges: the index of the sharded ranges (the shards are read on demand) or the whole list
+            indexFile = os.path.join(self.globalWorkingDir, EventRangeStore.INDEX_FILE)
+            if os.path.exists(indexFile):
+                eventRangeList = EventRangeStore.loadEventRanges(indexFile)
+            else:
+                tmpFile = open(os.path.join(self.globalWorkingDir, 'JobsEventRanges.json'))
+                eventRangeList = json.load(tmpFile)
+                tmpFile.close()
             # setup database
             # self.db.setupJobsEventTable(self.jobs,eventRangeList)
-            self.readyJobsEventRanges = eventRangeList
+            for jobId in eventRangeList:
+                self.scheduler.addEventRanges(jobId, eventRangeList[jobId])
             for jobId in self.readyJobsEventRanges:
                 self.runningJobsEventRanges[jobId] = {}
                 self.finishedJobsEventRanges[jobId] = []
                 self.stagedOutJobsEventRanges[jobId] = []
+                self.checkpoint.addJob(jobId, len(self.readyJobsEventRanges[jobId]))
+            self.resume()
             return True,None
         except:
             self.tmpLog.debug("Rank %s: %s" % (self.rank, traceback.format_exc()))
@@ -285,6 +336,29 @@ class Yoda(threading.Thread):
             errMsg = 'failed to make event table with {0}:{1}'.format(errtype.__name__,errvalue)
             return False,errMsg
         
+    def resume(self):
+        """ Resume from the checkpoint of a previous allocation, if there is one """
+        state = self.checkpoint.load()
+        if state is None:
+            return
+        self.tmpLog.info("Rank %s: resume from checkpoint of %s" % (self.rank, time.ctime(state['time'])))
+        for jobId in state['jobs']:
+            if jobId not in self.readyJobsEventRanges:
+                self.tmpLog.warning("Rank %s: job %s of the checkpoint is unknown" % (self.rank, jobId))
+                continue
+            if self.checkpoint.resume(jobId, self.readyJobsEventRanges[jobId], state['jobs'][jobId]) is not None:
+                self.resumeDumps(jobId)
+
+    def resumeDumps(self, jobId):
+        """ Keep the event status dumps of the previous allocation, the new dumps start with their records """
+        for type in ['', '.stagedOut']:
+            for fileName in self.getDumpFileNames(jobId, type):
+                # the dump of a resumed Yoda contains the older records
+                if os.path.exists(fileName):
+                    os.rename(fileName, fileName + ".resumed")
+                if os.path.exists(fileName + ".resumed"):
+                    self.resumedDumps[fileName] = fileName + ".resumed"
+
     def printEventStatus(self):
         try:
             for jobId in self.jobs:
@@ -333,8 +407,12 @@ class Yoda(threading.Thread):
                     tmpFile.close()
                     self.insertJobsEventRanges(eventRangeList)
                     for jobId in eventRangeList:
-                        for eventRange in eventRangeList[jobId]:
-                            self.readyJobsEventRanges[jobId].append(eventRange)
+                        self.scheduler.addEventRanges(jobId, eventRangeList[jobId])
+                elif file != EventRangeStore.INDEX_FILE and file.endswith(EventRangeStore.INDEX_SUFFIX):
+                    # sharded ranges are not inserted into the database
+                    eventRangeList = EventRangeStore.loadEventRanges(os.path.join(self.globalWorkingDir, file))
+                    for jobId in eventRangeList:
+                        self.scheduler.addEventRanges(jobId, eventRangeList[jobId])
             return True,None
         except:
             errtype,errvalue = sys.exc_info()[:2]
@@ -420,12 +498,19 @@ class Yoda(threading.Thread):
     # get job
     def getJob(self,params):
         rank = params['rank']
-        jobId, job = self.getJobScheduler(params)
-        if job is None:
+        if self.jobScheduler == 'packing':
+            jobId = self.scheduler.getJob(rank, exclude=self.rankJobsTries.get(rank, ()))
+            job = self.jobs[jobId] if jobId is not None else None
+        else:
+            jobId, job = self.getJobScheduler(params)
+        if job is None and self.jobScheduler != 'packing':
             ##### not disable reschedule job ranks, it will split jobs to additional ranks
             ##### instead, pilot will download more events then expected
-            self.rescheduleJobRanks()
-            jobId, job = self.getJobScheduler(params)
+            # the jobs of the rank queues are done: steal the job with the most remaining work per rank
+            jobId = self.scheduler.stealJob(rank, exclude=self.rankJobsTries.get(rank, []), minRanges=self.cores * 2)
+            if jobId is not None:
+                self.tmpLog.debug("Rank %s: rank %s steals job %s" % (self.rank, rank, jobId))
+                job = self.jobs[jobId]
 
         res = {'StatusCode':0,
                'job': job}
@@ -438,8 +523,10 @@ class Yoda(threading.Thread):
             if jobId not in self.jobsTimestamp:
                 self.jobsTimestamp[jobId] = {'startTime': time.time(), 'endTime': None}
             if rank not in self.rankJobsTries:
-                self.rankJobsTries[rank] = []
-            self.rankJobsTries[rank].append(jobId)
+                self.rankJobsTries[rank] = set()
+            self.rankJobsTries[rank].add(jobId)
+            if job is not None:
+                self.scheduler.addRank(jobId, rank)
 
         self.comm.returnResponse(res)
         self.tmpLog.debug('return response')
@@ -468,6 +555,7 @@ class Yoda(threading.Thread):
         if params['state'] in ['finished','failed']:
             # self.comm.decrementNumRank()
             self.jobsRuningRanks[jobId].remove(rank)
+            self.scheduler.removeRank(jobId, rank)
             endTime = time.time()
             if self.jobsTimestamp[params['jobId']]['endTime'] is None or self.jobsTimestamp[params['jobId']]['endTime'] < endTime:
                 self.jobsTimestamp[params['jobId']]['endTime'] = endTime
@@ -530,15 +618,15 @@ class Yoda(threading.Thread):
             nRanges = int(params['nRanges'])
         else:
             nRanges = 1
+        rank = params.get('rank', self.comm.getRequesterRank())
         eventRanges = []
         try:
-            for i in range(nRanges):
-                if len(self.readyJobsEventRanges[jobId]) > 0:
-                    eventRange = self.readyJobsEventRanges[jobId].pop(0)
-                    eventRanges.append(eventRange)
-                    self.runningJobsEventRanges[jobId][eventRange['eventRangeID']] = eventRange
-                else:
-                    break
+            # at least nRanges, more once the rank's processing rate is known
+            eventRanges = self.scheduler.getEventRanges(jobId, rank, nRanges)
+            self.checkpoint.handOut(jobId, rank, eventRanges)
+            runningEventRanges = self.runningJobsEventRanges[jobId]
+            for eventRange in eventRanges:
+                runningEventRanges[eventRange['eventRangeID']] = eventRange
         except:
             self.tmpLog.warning("Failed to get event ranges: %s" % traceback.format_exc())
             print self.readyJobsEventRanges
@@ -588,6 +676,7 @@ class Yoda(threading.Thread):
         if eventRangeID in self.runningJobsEventRanges[jobId]:
             # eventRange = self.runningEventRanges[eventRangeID]
             del self.runningJobsEventRanges[jobId][eventRangeID]
+        self.checkpoint.done(jobId, eventRangeID, stagedOut=(eventStatus == 'stagedOut'))
         if eventStatus == 'stagedOut':
             self.stagedOutJobsEventRanges[jobId].append((eventRangeID, eventStatus, output))
         else:
@@ -603,7 +692,8 @@ class Yoda(threading.Thread):
 
     # update event ranges
     def updateEventRanges(self,params):
-        for param in params:
+        pandaEventRanges = []
+        for param in decodeUpdates(params):
             # extract parameters
             jobId = param['jobId']
             eventRangeID = param['eventRangeID']
@@ -613,10 +703,17 @@ class Yoda(threading.Thread):
             if eventRangeID in self.runningJobsEventRanges[jobId]:
                 # eventRange = self.runningEventRanges[eventRangeID]
                 del self.runningJobsEventRanges[jobId][eventRangeID]
+            self.checkpoint.done(jobId, eventRangeID, stagedOut=(eventStatus == 'stagedOut'))
             if eventStatus == 'stagedOut':
                 self.stagedOutJobsEventRanges[jobId].append((eventRangeID, eventStatus, output))
+                pandaEventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': 'finished', 'objstoreID': param.get('objstoreID')})
             else:
                 self.finishedJobsEventRanges[jobId].append((eventRangeID, eventStatus, output))
+                if eventStatus.startswith("ERR") and self.jobs[jobId].get('yodaToOS', False):
+                    pandaEventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': 'failed'})
+        if pandaEventRanges:
+            with self.pandaEventRangesLock:
+                self.pandaEventRanges.extend(pandaEventRanges)
 
         # make response
         res = {'StatusCode':0}
@@ -626,6 +723,62 @@ class Yoda(threading.Thread):
         self.tmpLog.debug('return response')
 
 
+    def getPandaServerURL(self):
+        """ PanDA server URL for the event range updates """
+        if self.pandaServerURL:
+            return self.pandaServerURL
+        import pUtil
+        pshttpurl = pUtil.env['pshttpurl']
+        if '://' not in pshttpurl:
+            pshttpurl = 'https://' + pshttpurl
+        return '%s:%s/server/panda' % (pshttpurl, pUtil.env['psport'])
+
+    def updatePandaEventRanges(self, event_ranges):
+        """ Update event ranges on the Event Server """
+        self.tmpLog.debug("Updating %s event ranges.." % len(event_ranges))
+        import pUtil
+
+        message = ""
+        url = self.getPandaServerURL()
+
+        node={}
+        node['eventRanges']=json.dumps(event_ranges)
+
+        # open connection
+        ret = pUtil.httpConnect(node, url, path='.', mode="UPDATEEVENTRANGES")
+
+        status = ret[0]
+        if ret[0]: # non-zero return code
+            message = "Failed to update event range - error code = %d, error: %s" % (ret[0], ret[1])
+        else:
+            response = json.loads(json.dumps(ret[1]))
+            status = int(response['StatusCode'])
+            message = json.dumps(response['Returns'])
+
+        return status, message
+
+    def flushPandaEventRanges(self, bulkSize=1000):
+        """ Send the collected updates of the Droids to PanDA, bulkSize event ranges per request """
+        with self.pandaEventRangesLock:
+            eventRanges = self.pandaEventRanges
+            self.pandaEventRanges = []
+        failed = []
+        for i in range(0, len(eventRanges), bulkSize):
+            bulk = eventRanges[i:i + bulkSize]
+            try:
+                status, output = self.updatePandaEventRanges(bulk)
+                self.tmpLog.debug("updatePandaEventRanges(status: %s, output: %s)" % (status, output))
+            except:
+                status = -1
+                self.tmpLog.debug("Failed to update PanDA event ranges: %s" % traceback.format_exc())
+            if status != 0:
+                failed.extend(bulk)
+        if failed:
+            # retried with the next flush
+            with self.pandaEventRangesLock:
+                self.pandaEventRanges = failed + self.pandaEventRanges
+
+
     def updateFailedEventRanges(self):
         for failed_update in self.failed_updates:
             eventRangeID,eventStatus, output = failed_update
@@ -649,33 +802,45 @@ class Yoda(threading.Thread):
         except Exception as e:
             self.tmpLog.debug('updateRunningEventRangesToDB failed: %s, %s' % (str(e), traceback.format_exc()))
 
-    def dumpUpdates(self, jobId, outputs, type=''):
-        #if self.dumpEventOutputs == False:
-        #    return
-        timeNow = datetime.datetime.utcnow()
+    def getDumpFileNames(self, jobId, type=''):
+        """ Event status dump and metadata xml of a job """
         #outFileName = str(jobId) + "_" + timeNow.strftime("%Y-%m-%d-%H-%M-%S-%f") + '.dump' + type
         outFileName = str(jobId) + "_event_status.dump" + type
         outFileName = os.path.join(self.globalWorkingDir, outFileName)
+        metadataFileName = 'metadata-' + os.path.basename(outFileName).split('.dump')[0] + '.xml'
+        if self.outputDir:
+            metadataFileName = os.path.join(self.outputDir, metadataFileName)
+        else:
+            metadataFileName = os.path.join(self.globalWorkingDir, metadataFileName)
+        return outFileName, metadataFileName
+
+    def dumpUpdates(self, jobId, outputs, type=''):
+        #if self.dumpEventOutputs == False:
+        #    return
+        outFileName, metadataFileName = self.getDumpFileNames(jobId, type)
         outFile = open(outFileName + ".new", 'w')
         self.tmpLog.debug("dumpUpdates: dumpFileName %s" % (outFileName))
+        if outFileName in self.resumedDumps:
+            resumedFile = open(self.resumedDumps[outFileName])
+            shutil.copyfileobj(resumedFile, outFile)
+            resumedFile.close()
 
-        metadataFileName = None
         metafd = None
         # if self.dumpEventOutputs:
         if True:
-            metadataFileName = 'metadata-' + os.path.basename(outFileName).split('.dump')[0] + '.xml'
-            if self.outputDir:
-                metadataFileName = os.path.join(self.outputDir, metadataFileName)
-            else:
-                metadataFileName = os.path.join(self.globalWorkingDir, metadataFileName)
-
-
             self.tmpLog.debug("dumpUpdates: outputDir %s, metadataFileName %s" % (self.outputDir, metadataFileName))
             metafd = open(metadataFileName + ".new", "w")
             metafd.write('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n')
             metafd.write("<!-- Edited By POOL -->\n")
             metafd.write('<!DOCTYPE POOLFILECATALOG SYSTEM "InMemory">\n')
             metafd.write("<POOLFILECATALOG>\n")
+            if metadataFileName in self.resumedDumps:
+                # the File elements, they are indented
+                resumedFile = open(self.resumedDumps[metadataFileName])
+                for line in resumedFile:
+                    if line.startswith(" "):
+                        metafd.write(line)
+                resumedFile.close()
 
         for eventRangeID,status,output in outputs:
             outFile.write('{0} {1} {2} {3}\n'.format(str(jobId), str(eventRangeID), str(status), str(output)))
@@ -717,14 +882,14 @@ class Yoda(threading.Thread):
             self.tmpLog.debug('start to updateFinishedEventRangesToDB')
 
             for jobId in self.stagedOutJobsEventRanges:
-                if len(self.stagedOutJobsEventRanges[jobId]):
+                if len(self.stagedOutJobsEventRanges[jobId]) or self.getDumpFileNames(jobId, '.stagedOut')[0] in self.resumedDumps:
                     self.dumpUpdates(jobId, self.stagedOutJobsEventRanges[jobId], type='.stagedOut')
                     #for i in self.stagedOutJobsEventRanges[jobId]:
                     #    self.stagedOutJobsEventRanges[jobId].remove(i)
                     #self.stagedOutJobsEventRanges[jobId] = []
 
             for jobId in self.finishedJobsEventRanges:
-                if len(self.finishedJobsEventRanges[jobId]):
+                if len(self.finishedJobsEventRanges[jobId]) or self.getDumpFileNames(jobId)[0] in self.resumedDumps:
                     self.dumpUpdates(jobId, self.finishedJobsEventRanges[jobId])
                     #self.db.updateEventRanges(self.finishedEventRanges)
                     #for i in self.finishedJobsEventRanges[jobId]:
@@ -756,54 +921,6 @@ class Yoda(threading.Thread):
         self.comm.sendMessage(res)
         #self.comm.disconnect()
 
-    def collectMetrics(self, ranks):
-        metrics = {}
-        metricsReport = {}
-        for rank in ranks.keys():
-            for key in ranks[rank].keys():
-                if key in ["setupTime", "runningTime", 'totalTime', "cores", "queuedEvents", "processedEvents", "cpuConsumptionTime", 'avgTimePerEvent']:
-                    if key not in metrics:
-                        metrics[key] = 0
-                    metrics[key] += ranks[rank][key]
-
-        setupTime = []
-        runningTime = []
-        totalTime = []
-        stageoutTime = []
-        for rank in ranks.keys():
-            setupTime.append(ranks[rank]['setupTime'])
-            runningTime.append(ranks[rank]['runningTime'])
-            totalTime.append(ranks[rank]['totalTime'])
-            stageoutTime.append(ranks[rank]['totalTime'] - ranks[rank]['setupTime'] - ranks[rank]['runningTime'])
-        num_ranks = len(ranks.keys())
-        if num_ranks < 1:
-            num_ranks = 1
-        processedEvents = metrics['processedEvents']
-        if processedEvents < 1:
-            processedEvents = 1
-
-        metricsReport['avgYodaSetupTime'] = metrics['setupTime']/num_ranks
-        metricsReport['avgYodaRunningTime'] = metrics['runningTime']/num_ranks
-        metricsReport['avgYodaStageoutTime'] = (metrics['totalTime'] - metrics['setupTime'] - metrics['runningTime'])/num_ranks
-        metricsReport['avgYodaTotalTime'] = metrics['totalTime']/num_ranks
-        metricsReport['maxYodaSetupTime'] = max(setupTime)
-        metricsReport['maxYodaRunningTime'] = max(runningTime)
-        metricsReport['maxYodaStageoutTime'] = max(stageoutTime)
-        metricsReport['maxYodaTotalTime'] = max(totalTime)
-        metricsReport['minYodaSetupTime'] = min(setupTime)
-        metricsReport['minYodaRunningTime'] = min(runningTime)
-        metricsReport['minYodaStageoutTime'] = min(stageoutTime)
-        metricsReport['minYodaTotalTime'] = min(totalTime)
-        metricsReport['cores'] = metrics['cores']
-        metricsReport['cpuConsumptionTime'] = metrics['cpuConsumptionTime']
-        metricsReport['totalQueuedEvents'] = metrics['queuedEvents']
-        metricsReport['totalProcessedEvents'] = metrics['processedEvents']
-        metricsReport['avgTimePerEvent'] = metrics['avgTimePerEvent']/ num_ranks
-
-        for key in metricsReport:
-            metricsReport[key] = int(metricsReport[key])
-        return metricsReport
-
     def heartbeat(self, params):
         """
         {"jobId": , "rank": , "startTime": ,"readyTime": , "endTime": , "setupTime": , "totalTime": , "cores": , "processCPUHour": , "totalCPUHour": , "queuedEvents": , "processedEvents": , "cpuConsumptionTime": }
@@ -819,59 +936,63 @@ class Yoda(threading.Thread):
         self.comm.returnResponse(res)
         self.tmpLog.debug('return response')
 
-        if jobId not in self.jobMetrics:
-            self.jobMetrics[jobId] = {'ranks': {}, 'collect': {}}
-
-        self.jobMetrics[jobId]['ranks'][rank] = params
-        self.jobMetrics[jobId]['collect'] = self.collectMetrics(self.jobMetrics[jobId]['ranks'])
+        self.metrics.update(jobId, rank, params)
+        self.scheduler.updateRate(jobId, rank, params.get('processedEvents'), params.get('runningTime'), params.get('setupTime'))
 
         #self.dumpJobMetrics()
 
 
-    def dumpJobMetrics(self):
-        jobMetricsFileName = "jobMetrics-yoda.json"
+    def dumpJSON(self, fileName, data):
+        """ Write data to fileName in the global working dir, replacing the old file atomically """
+        path = os.path.join(self.globalWorkingDir, fileName)
+        self.tmpLog.debug("Dump %s" % path)
         try:
-            #outputDir = self.jobs[jobId]["GlobalWorkingDir"]
-            outputDir = self.globalWorkingDir
+            tmpFile = open(path + ".new", "w")
+            json.dump(data, tmpFile)
+            tmpFile.close()
+            os.rename(path + ".new", path)
         except:
-            self.tmpLog.debug("Failed to get job's global working dir: %s" % (traceback.format_exc()))
-            outputDir = self.globalWorkingDir
-        jobMetrics = os.path.join(outputDir, jobMetricsFileName)
-        self.tmpLog.debug("JobMetrics file: %s" % (jobMetrics + ".new"))
-        tmpFile = open(jobMetrics+ ".new", "w")
-        json.dump(self.jobMetrics, tmpFile)
-        tmpFile.close()
-
-        command = "mv %s.new %s" % (jobMetrics, jobMetrics)
-        retS, retOut = commands.getstatusoutput(command)
-        if retS:
-            self.tmpLog.debug('Failed to execute %s: %s' % (command, retOut))
+            self.tmpLog.debug("Failed to dump %s: %s" % (path, traceback.format_exc()))
+
+    def setState(self, state):
+        """ Write the state of Yoda for the HPCManager of the pilot (see JobTracker) """
+        self.tmpLog.info("Yoda state: %s" % state)
+        try:
+            JobTracker.writeState(self.globalWorkingDir, state)
+        except:
+            self.tmpLog.debug("Failed to write the state: %s" % traceback.format_exc())
+
+    def dumpJobMetrics(self):
+        self.dumpJSON("jobMetrics-yoda.json", self.metrics.getSnapshot())
 
     def dumpJobsStartTime(self):
-        jobsTimestampFileName = "jobsTimestamp-yoda.json"
-        outputDir = self.globalWorkingDir
-        jobsTimestampFile = os.path.join(outputDir, jobsTimestampFileName)
-        self.tmpLog.debug("JobsStartTime file: %s" % (jobsTimestampFile + ".new"))
-        tmpFile = open(jobsTimestampFile + ".new", "w")
-        json.dump(self.jobsTimestamp, tmpFile)
-        tmpFile.close()
-
-        command = "mv %s.new %s" % (jobsTimestampFile, jobsTimestampFile)
-        retS, retOut = commands.getstatusoutput(command)
-        if retS:
-            self.tmpLog.debug('Failed to execute %s: %s' % (command, retOut))
+        self.dumpJSON("jobsTimestamp-yoda.json", self.jobsTimestamp)
+
+    def writeCheckpoint(self, final=False):
+        """
+        Flush the updated event ranges to the dumps and write the checkpoint. The state is taken before the dumps,
+        so that the dumps have the outputs of all ranges which are done in the checkpoint.
+        """
+        try:
+            state = self.checkpoint.getState()
+            self.updateEventRangesToDB(force=True, final=final)
+            t0 = time.time()
+            size = self.checkpoint.write(state)
+            self.tmpLog.debug("Checkpoint written in %.3f s (%s bytes)" % (time.time() - t0, size))
+        except:
+            self.tmpLog.debug("Failed to write the checkpoint: %s" % traceback.format_exc())
 
     def helperFunction(self):
         # flush the updated event ranges to db
-        self.updateEventRangesToDB(force=True)
+        self.writeCheckpoint()
 
-        self.dumpJobMetrics()
         self.dumpJobsStartTime()
 
     # main yoda
     def runYoda(self):
         # get logger
         self.tmpLog.info('start')
+        self.setState('starting')
         # load job
         self.tmpLog.info('loading job')
         tmpStat,tmpOut = self.loadJobs()
@@ -898,9 +1019,14 @@ class Yoda(threading.Thread):
         self.tmpLog.info('print event status')
         tmpStat,tmpOut = self.printEventStatus()
 
+        self.setState('running')
         self.tmpLog.info('Initialize Helper thread')
-        helperThread = Yoda.HelperThread(self.tmpLog, self.helperFunction)
+        helperThread = Yoda.HelperThread(self.tmpLog, self.helperFunction, interval=self.checkpointInterval)
         helperThread.start()
+        metricsThread = Yoda.HelperThread(self.tmpLog, self.dumpJobMetrics, interval=self.metricsInterval)
+        metricsThread.start()
+        pandaThread = Yoda.HelperThread(self.tmpLog, self.flushPandaEventRanges, interval=self.pandaUpdateInterval)
+        pandaThread.start()
 
         # main loop
         self.tmpLog.info('main loop')
@@ -927,10 +1053,14 @@ class Yoda(threading.Thread):
                 self.tmpLog.error('unknown method={0} was requested from rank={1} '.format(method,
                                                                                       self.comm.getRequesterRank()))
         helperThread.stop()
+        metricsThread.stop()
+        pandaThread.stop()
         self.flushMessages()
+        self.flushPandaEventRanges()
         #self.updateFailedEventRanges()
-        self.updateEventRangesToDB(force=True)
+        self.writeCheckpoint(final=True)
         self.dumpJobMetrics()
+        self.metrics.close()
         self.dumpJobsStartTime()
         # final dump
         #self.tmpLog.info('final dumping')
@@ -938,6 +1068,7 @@ class Yoda(threading.Thread):
         self.tmpLog.info("post Exec job")
         self.postExecJob()
         self.finishDroids()
+        self.setState('finished')
         self.tmpLog.info('done')
         
 
@@ -947,6 +1078,7 @@ class Yoda(threading.Thread):
             self.runYoda()
         except:
             self.tmpLog.info("Excpetion to run Yoda: %s" % traceback.format_exc())
+            self.setState('failed')
             raise
 
     def flushMessages(self):
@@ -984,7 +1116,7 @@ class Yoda(threading.Thread):
             if len(self.jobsRuningRanks[jobId]) > 0:
                 self.jobsTimestamp[jobId]['endTime'] = time.time()
         self.dumpJobsStartTime()
-        self.updateEventRangesToDB(force=True, final=True)
+        self.writeCheckpoint(final=True)
 
     def stop(self, signum=None, frame=None):
         self.tmpLog.info('stop signal %s received' % signum)
@@ -1001,10 +1133,12 @@ class Yoda(threading.Thread):
         #self.updateFailedEventRanges()
         # final dump
         self.tmpLog.info('final dumping')
-        self.updateEventRangesToDB(force=True, final=True)
+        self.writeCheckpoint(final=True)
+        self.flushPandaEventRanges()
         #self.db.dumpUpdates(True)
         self.tmpLog.info("post Exec job")
         self.postExecJob()
+        self.setState('stopped')
         self.tmpLog.info('stop')
         #signal.siginterrupt(signum, True)
         unblock_sig(signum)
@@ -3,26 +3,27 @@ import datetime
 import json
 import logging
 import os
-import shutil
 import socket
-import sys
 import time
 import pickle
 import signal
 import threading
 import traceback
 from os.path import abspath as _abspath, join as _join
-from Queue import Queue
 
 # logging.basicConfig(filename='Droid.log', level=logging.DEBUG)
 
 from pandayoda.yodacore import Interaction,Database,Logger
+from pandayoda.yodacore.EventRangeUpdates import UpdateBatcher, encodeUpdates, FLUSH_INTERVAL, FLUSH_SIZE
 from EventServer.EventServerJobManager import EventServerJobManager
 from signal_block.signal_block import block_sig, unblock_sig
+from pandayoda.yodaexe.DroidReactor import DroidReactor, NotifyingQueue
+from pandayoda.yodaexe.InputCache import NodeInputCache
 
 
 class Droid(threading.Thread):
-    def __init__(self, globalWorkingDir, localWorkingDir, rank=None, nonMPIMode=False, reserveCores=0, outputDir=None):
+    def __init__(self, globalWorkingDir, localWorkingDir, rank=None, nonMPIMode=False, reserveCores=0, outputDir=None,
+                 updateInterval=FLUSH_INTERVAL, updateSize=FLUSH_SIZE):
         threading.Thread.__init__(self)
         self.__globalWorkingDir = globalWorkingDir
         self.__localWorkingDir = localWorkingDir
@@ -48,6 +49,7 @@ class Droid(threading.Thread):
         self.__poolFileCatalog = None
         self.__inputFiles = None
         self.__copyInputFiles = None
+        self.__inputCache = None
         self.__preSetup = None
         self.__postRun = None
         self.__ATHENA_PROC_NUMBER = 1
@@ -58,8 +60,15 @@ class Droid(threading.Thread):
 
         self.reserveCores = reserveCores
         self.__hostname = socket.getfqdn()
-
-        self.__outputs = Queue()
+        # node-local cache of the input files (CopyInputFiles), shared by the ranks of the node
+        self.__inputCacheDir = os.path.join(_abspath(self.__localWorkingDir), 'inputCache', self.__hostname)
+
+        # the main loop sleeps in the reactor until AthenaMP, the stager or the heartbeat timer needs it
+        self.__reactor = DroidReactor()
+        self.__heartbeatInterval = 60
+        self.__outputs = NotifyingQueue(self.__reactor.wakeup)
+        # event range updates are sent to Yoda in batches, every updateInterval seconds or updateSize updates
+        self.__updates = UpdateBatcher(flushInterval=updateInterval, flushSize=updateSize)
         self.__jobMetrics = {}
         self.__stagerThread = None
 
@@ -84,11 +93,11 @@ class Droid(threading.Thread):
         self.__currentDir = wkdir
 
     def postExecJob(self):
-        if self.__copyInputFiles and self.__inputFiles is not None and self.__poolFileCatalog is not None:
+        if self.__inputCache and self.__inputFiles is not None:
             for inputFile in self.__inputFiles:
                 localInputFile = os.path.join(os.getcwd(), os.path.basename(inputFile))
                 self.__tmpLog.debug("Rank %s: Remove input file: %s" % (self.__rank, localInputFile))
-                os.remove(localInputFile)
+                self.__inputCache.release(inputFile, os.getcwd())
 
         if self.__globalWorkingDir != self.__localWorkingDir:
             command = "cp -fr " + self.__currentDir + " " + self.__globalWorkingDir
@@ -128,19 +137,14 @@ class Droid(threading.Thread):
                 self.__tmpLog = Logger.Logger()
 
             if self.__copyInputFiles and self.__inputFiles is not None and self.__poolFileCatalog is not None:
+                # the inputs are copied once per node and linked into the rank directory,
+                # the PoolFileCatalog is rewritten once per node to point to the cache
+                self.__inputCache = NodeInputCache(self.__inputCacheDir, self.__rank, logger=self.__tmpLog)
                 for inputFile in self.__inputFiles:
-                    shutil.copy(inputFile, './')
-
-                pfc_name = os.path.basename(self.__poolFileCatalog)
-                pfc_name = os.path.join(os.getcwd(), pfc_name)
-                pfc_name_back = pfc_name + ".back"
-                shutil.copy2(self.__poolFileCatalog, pfc_name_back)
-                with open(pfc_name, 'wt') as pfc_out:
-                    with open(pfc_name_back, 'rt') as pfc_in:
-                        for line in pfc_in:
-                            pfc_out.write(line.replace('HPCWORKINGDIR', os.getcwd()))
-                    
-                job["AthenaMPCmd"] = job["AthenaMPCmd"].replace('HPCWORKINGDIR', os.getcwd())
+                    self.__inputCache.linkFile(inputFile, os.getcwd())
+                self.__inputCache.getPoolFileCatalog(self.__poolFileCatalog, 'HPCWORKINGDIR', os.getcwd())
+
+                job["AthenaMPCmd"] = job["AthenaMPCmd"].replace('HPCWORKINGDIR', self.__inputCacheDir)
 
             self.__esJobManager = EventServerJobManager(self.__rank, self.__ATHENA_PROC_NUMBER, workingDir=self.__jobWorkingDir)
             status, output = self.__esJobManager.preSetup(self.__preSetup)
@@ -194,13 +198,20 @@ class Droid(threading.Thread):
             time.sleep(1)
         self.__tmpLog.debug("Rank %s: stager thread finished" %(self.__rank))
 
+    def isStagerBusy(self):
+        """ The stager falls behind: do not ask for more events until its outputs are reported """
+        if self.__stagerThread and self.__stagerThread.isBusy():
+            self.__tmpLog.debug("Rank %s: stager is busy, not asking for more events" % self.__rank)
+            return True
+        return False
+
     def getEventRanges(self, nRanges=1):
         #if self.__firstGetEventRanges:
         #    request = {'nRanges': self.__ATHENA_PROC_NUMBER}
         #    self.__firstGetEventRanges = False
         #else:
         #    request = {'nRanges': nRanges}
-        request = {'jobId': self.__jobId, 'nRanges': nRanges}
+        request = {'jobId': self.__jobId, 'rank': self.__rank, 'nRanges': nRanges}
         self.__tmpLog.debug("Rank %s: getEventRanges(request: %s)" % (self.__rank, request))
         status, output = self.__comm.sendRequest('getEventRanges',request)
         self.__tmpLog.debug("Rank %s: (status: %s, output: %s)" % (self.__rank, status, output))
@@ -211,29 +222,6 @@ class Droid(threading.Thread):
                 return True, eventRanges
         return False, None
 
-    def updateEventRange(self, output):
-        try:
-            eventRangeID = output.split(",")[1]
-        except Exception, e:
-            self.__tmpLog.warning("Rank %s: failed to get eventRangeID from output: %s" % (self.__rank, output))
-            self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, str(e)))
-        status, output = self.copyOutput(output)
-        if status != 0:
-            self.__tmpLog.debug("Rank %s: failed to copy output from local working dir to global working dir: %s" % (self.__rank, output))
-            return False
-        request = {"eventRangeID": eventRangeID,
-                   'eventStatus': "finished",
-                   "output": output}
-        self.__tmpLog.debug("Rank %s: updateEventRange(request: %s)" % (self.__rank, request))
-        retStatus, retOutput = self.__comm.sendRequest('updateEventRange',request)
-        self.__tmpLog.debug("Rank %s: (status: %s, output: %s)" % (self.__rank, retStatus, retOutput))
-        if retStatus:
-            statusCode = retOutput["StatusCode"]
-            if statusCode == 0:
-                return True
-        return False
-
-
     def dumpUpdates(self, outputs):
         timeNow = datetime.datetime.utcnow()
         outFileName = 'rank_' + str(self.__rank) + '_' + timeNow.strftime("%Y-%m-%d-%H-%M-%S") + '.dump'
@@ -243,56 +231,18 @@ class Droid(threading.Thread):
             outFile.write('{0} {1} {2}\n'.format(eventRangeID,status,output))
         outFile.close()
 
-    def updatePandaEventRanges(self, event_ranges):
-        """ Update an event range on the Event Server """
-        self.__tmpLog.debug("Updating event ranges..")
-        try:
-            test = sys.modules['pUtil']
-        except:
-            self.__tmpLog.debug("loading pUtil")
-        import pUtil
-        
-        message = ""
-        #url = "https://aipanda007.cern.ch:25443/server/panda"
-        url = "https://pandaserver.cern.ch:25443/server/panda"
-        # eventRanges = [{'eventRangeID': '4001396-1800223966-4426028-1-2', 'eventStatus':'running'}, {'eventRangeID': '4001396-1800223966-4426028-2-2','eventStatus':'running'}]
-
-        node={}
-        node['eventRanges']=json.dumps(event_ranges)
-
-        # open connection
-        ret = pUtil.httpConnect(node, url, path='.', mode="UPDATEEVENTRANGES")
-        # response = json.loads(ret[1])
-
-        status = ret[0]
-        if ret[0]: # non-zero return code
-            message = "Failed to update event range - error code = %d, error: " % (ret[0], ret[1])
-        else:
-            response = json.loads(json.dumps(ret[1]))
-            status = int(response['StatusCode'])
-            message = json.dumps(response['Returns'])
-
-        return status, message
-
     def updateOutputs(self, signal=False, final=False):
-        outputs = []
-        stagedOutpus = []
         while not self.__outputs.empty():
-            output = self.__outputs.get()
-            outputs.append(output)
-            if output['eventStatus'] == 'stagedOut':
-                stagedOutpus.append({'eventRangeID': output['eventRangeID'], 'eventStatus': 'finished', 'objstoreID': output['objstoreID']})
-            elif output['eventStatus'].startswith("ERR") and self.__yodaToOS:
-                stagedOutpus.append({'eventRangeID': output['eventRangeID'], 'eventStatus': 'failed'})
-        if len(stagedOutpus):
-            self.__tmpLog.debug("Rank %s: updatePandaEventRanges(request: %s)" % (self.__rank, stagedOutpus))
-            retStatus, retOutput = self.updatePandaEventRanges(stagedOutpus)
-            if retStatus == 0:
-                self.__tmpLog.debug("Rank %s: updatePandaEventRanges(status: %s, output: %s)" % (self.__rank, retStatus, retOutput))
-        if outputs:
-            self.__tmpLog.debug("Rank %s: updateEventRanges(request: %s)" % (self.__rank, outputs))
-            retStatus, retOutput = self.__comm.sendRequest('updateEventRanges',outputs)
+            self.__updates.add(self.__outputs.get())
+        if len(self.__updates) and (final or self.__updates.isDue()):
+            outputs = self.__updates.flush()
+            self.__tmpLog.debug("Rank %s: updateEventRanges(%s event ranges: %s)" % (self.__rank, len(outputs), outputs))
+            retStatus, retOutput = self.__comm.sendRequest('updateEventRanges', encodeUpdates(outputs))
             self.__tmpLog.debug("Rank %s: (status: %s, output: %s)" % (self.__rank, retStatus, retOutput))
+            if not retStatus:
+                # sent again with the next batch
+                for output in outputs:
+                    self.__updates.add(output)
 
         return True
 
@@ -347,6 +297,10 @@ class Droid(threading.Thread):
                 return True
         return False
 
+    def heartbeatTimer(self):
+        self.heartbeat()
+        self.__tmpLog.info("Rank %s: os.times: %s" % (self.__rank, os.times()))
+
     def getAccountingMetrics(self):
         metrics = {}
         if self.__esJobManager:
@@ -416,12 +370,12 @@ class Droid(threading.Thread):
         # main loop
         failedNum = 0
         #self.__tmpLog.info("Rank %s: isDead: %s" % (self.__rank, self.__esJobManager.isDead()))
-        heartbeatTime = None
         self.__tmpLog.info("Rank %s: os.times: %s" % (self.__rank, os.times()))
+        self.__reactor.addTimer('heartbeat', self.__heartbeatInterval, self.heartbeatTimer)
         while not self.__esJobManager.isDead():
             #self.__tmpLog.info("Rank %s: isDead: %s" % (self.__rank, self.__esJobManager.isDead()))
             #self.__tmpLog.info("Rank %s: isNeedMoreEvents: %s" % (self.__rank, self.__esJobManager.isNeedMoreEvents()))
-            while self.__esJobManager.isNeedMoreEvents() > 0:
+            while self.__esJobManager.isNeedMoreEvents() > 0 and not self.isStagerBusy():
                 neededEvents = self.__esJobManager.isNeedMoreEvents()
                 self.__tmpLog.info("Rank %s: need %s events" % (self.__rank, neededEvents))
                 status, eventRanges = self.getEventRanges(neededEvents)
@@ -444,20 +398,21 @@ class Droid(threading.Thread):
 
             self.__esJobManager.poll()
             self.updateOutputs()
+            self.__reactor.runTimers()
 
-            time.sleep(0.001)
-            if heartbeatTime is None:
-                self.heartbeat()
-                heartbeatTime = time.time()
-            elif time.time() - heartbeatTime > 60:
-                self.heartbeat()
-                self.__tmpLog.info("Rank %s: os.times: %s" % (self.__rank, os.times()))
-                heartbeatTime = time.time()
+            # sleep until AthenaMP sends messages (or the child process exits), the stager has outputs or a timer is due
+            messageFileno = self.__esJobManager.getMessageFileno()
+            if messageFileno is None:
+                # the message pipe is closed, the child process is exiting
+                self.__reactor.wait(timeout=0.1)
+            else:
+                self.__reactor.wait([messageFileno], timeout=self.__updates.getTimeout())
 
+        self.__reactor.removeTimer('heartbeat')
         self.heartbeat()
         self.__esJobManager.flushMessages()
         self.stopStagerThread()
-        self.updateOutputs()
+        self.updateOutputs(final=True)
 
         self.__tmpLog.info("Rank %s: post exec job" % self.__rank)
         self.postExecJob()
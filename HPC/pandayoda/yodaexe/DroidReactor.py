@@ -0,0 +1,100 @@
+import errno
+import fcntl
+import os
+import select
+import time
+from Queue import Queue
+
+
+class NotifyingQueue(Queue):
+    """ Queue which calls notify() after every put(), e.g. to wake up the Droid main loop """
+
+    def __init__(self, notify, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self.__notify = notify
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self.__notify()
+
+
+class DroidReactor(object):
+    """
+    Wakeup source of the Droid main loop. wait() sleeps until one of the given descriptors is readable
+    (the AthenaMP message pipe of EventServerJobManager, which is also at EOF when the child process exited),
+    wakeup() was called from another thread (stager outputs) or a timer (heartbeat) is due.
+    """
+
+    def __init__(self, maxWaitTime=5):
+        # upper bound of a wait, for the conditions which do not wake up the loop
+        self.__maxWaitTime = maxWaitTime
+        self.__wakeupReader, self.__wakeupWriter = os.pipe()
+        for fd in (self.__wakeupReader, self.__wakeupWriter):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.__timers = {}
+        self.__wakeups = 0
+
+    def wakeup(self):
+        """ Wake up wait(), can be called from any thread """
+        try:
+            os.write(self.__wakeupWriter, 'x')
+        except OSError, e:
+            # the pipe is full: a wakeup is pending anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def addTimer(self, name, interval, func, delay=0):
+        """ Call func every interval seconds (the first time after delay seconds) from runTimers() """
+        self.__timers[name] = [time.time() + delay, interval, func]
+
+    def removeTimer(self, name):
+        if name in self.__timers:
+            del self.__timers[name]
+
+    def runTimers(self):
+        """ Call the due timers """
+        now = time.time()
+        for name, timer in self.__timers.items():
+            if timer[0] <= now:
+                timer[0] = now + timer[1]
+                timer[2]()
+
+    def getTimeout(self, timeout=None):
+        if timeout is None:
+            timeout = self.__maxWaitTime
+        if self.__timers:
+            timeout = min(timeout, min([timer[0] for timer in self.__timers.values()]) - time.time())
+        return max(timeout, 0)
+
+    def wait(self, fds=(), timeout=None):
+        """ Wait for a wakeup (at most timeout seconds), return the list of readable descriptors out of fds """
+        fds = [fd for fd in fds if fd is not None]
+        try:
+            readable, w, x = select.select([self.__wakeupReader] + fds, [], [], self.getTimeout(timeout))
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+        self.__wakeups += 1
+        if self.__wakeupReader in readable:
+            readable.remove(self.__wakeupReader)
+            try:
+                while os.read(self.__wakeupReader, 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        return readable
+
+    def getWakeups(self):
+        return self.__wakeups
+
+    def close(self):
+        for fd in (self.__wakeupReader, self.__wakeupWriter):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
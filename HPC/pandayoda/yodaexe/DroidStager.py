@@ -1,4 +1,3 @@
-import commands
 import datetime
 import json
 import logging
@@ -6,23 +5,67 @@ import os
 import shutil
 import socket
 import sys
+import tarfile
 import time
 import pickle
 import signal
 import threading
 import traceback
+import zlib
 from os.path import abspath as _abspath, join as _join
 
 # logging.basicConfig(filename='Droid.log', level=logging.DEBUG)
 
 from pandayoda.yodacore import Logger
+from pandayoda.yodaexe.StagerPipeline import StagerPipeline, Stage, QUEUE_SIZE
 
 import pUtil
 from objectstoreSiteMover import objectstoreSiteMover
 from Mover import getInitialTracingReport
-from ThreadPool import ThreadPool
+
+# outputs copied to the global working dir (or outputDir) in parallel, and waiting to be copied at most
+COPY_THREADS = 2
+COPY_QUEUE_SIZE = 100
+# node-local directory where the outputs wait until they are zipped (job['stagingDir'] overrides it)
+STAGING_DIR = '/dev/shm'
+# the outputs are zipped into node-local chunks of at most this many bytes or event ranges,
+# which are appended to the shared zip file at once
+ZIP_CHUNK_SIZE = 256 * 1024 * 1024
+ZIP_CHUNK_RANGES = 100
+# outputs in the pipeline at most before the Droid stops asking for more events (job['stager_max_pending'])
+MAX_PENDING = 2 * QUEUE_SIZE
+# seconds between the logs of the pipeline metrics
+METRICS_INTERVAL = 300
+BUFFER_SIZE = 1024 * 1024
+
+
+def adler32(filename):
+    """ adler32 checksum of a file, as hex string """
+    value = 1
+    handle = open(filename, 'rb')
+    try:
+        while True:
+            data = handle.read(BUFFER_SIZE)
+            if not data:
+                break
+            value = zlib.adler32(data, value)
+    finally:
+        handle.close()
+    return "%08x" % (value & 0xffffffff)
+
 
 class DroidStager(threading.Thread):
+    """
+    Stages out the outputs of AthenaMP in a pipeline of threads with bounded queues between the stages:
+      collect   split the output message, move the files to the node-local staging dir (zip only)
+      zip       add the files to a node-local tar chunk (yodaToZip)
+      checksum  size and adler32 of the files or chunk (yodaToZip, yodaToOS)
+      upload    append the chunk to the shared zip file (yodaToZip), put the files to the objectstore (yodaToOS) or copy
+                them to outputDir / the global working dir
+      report    put the update of every event range into the outputs queue of the Droid
+    The update of an event range is reported as soon as its outputs are done. When the stages fall behind, the
+    stager blocks on the first queue and isBusy() tells the Droid not to ask for more events.
+    """
     def __init__(self, globalWorkingDir, localWorkingDir, outputs=None, job=None, esJobManager=None, outputDir=None, rank=None, logger=None):
         threading.Thread.__init__(self)
         self.__globalWorkingDir = globalWorkingDir
@@ -50,7 +93,12 @@ class DroidStager(threading.Thread):
         self.__hostname = socket.getfqdn()
 
         self.__outputs = outputs
-        self.__threadpool = None
+        self.__pipeline = None
+        self.__stagingDir = None
+        self.__maxPending = MAX_PENDING
+        # the zip chunk being filled
+        self.__chunk = None
+        self.__chunkNumber = 0
         self.setup(job)
 
     def setup(self, job):
@@ -66,12 +114,28 @@ class DroidStager(threading.Thread):
                 self.__tmpLog.debug("Rank %s: either zipFileName(%s) is None or zipEventRanagesName(%s) is None, will not use zip output" % (self.__rank, self.__zipFileName, self.__zipEventRangesName))
                 self.__yodaToZip = False
             self.__copyOutputToGlobal =  job.get('copyOutputToGlobal', False)
+            self.__maxPending = int(job.get('stager_max_pending', MAX_PENDING))
 
-            if self.__yodaToOS:
+            collect = Stage('collect', self.collect, size=self.getSize)
+            report = Stage('report', self.report)
+            if self.__yodaToZip:
+                stagingDir = job.get('stagingDir', STAGING_DIR)
+                if stagingDir and os.path.isdir(stagingDir):
+                    self.__stagingDir = os.path.join(stagingDir, 'droid_staging_%s_rank_%s' % (self.__jobId, self.__rank))
+                    if not os.path.exists(self.__stagingDir):
+                        os.makedirs(self.__stagingDir)
+                else:
+                    self.__tmpLog.debug("Rank %s: staging dir %s does not exist, zip the outputs in place" % (self.__rank, stagingDir))
+                stages = [collect,
+                          Stage('zip', self.zipOutputs, flush=self.closeChunk, size=self.getSize),
+                          Stage('checksum', self.checksum, size=self.getSize),
+                          Stage('upload', self.appendChunk, size=self.getSize),
+                          report]
+            elif self.__yodaToOS:
                 setup = job.get('setup', None)
                 self.__esPath = job.get('esPath', None)
                 self.__os_bucket_id = job.get('os_bucket_id', None)
-                self.__report =  getInitialTracingReport(userid='Yoda', sitename='Yoda', dsname=None, eventType="objectstore", analysisJob=False, jobId=None, jobDefId=None, dn='Yoda')
+                self.__report =  getInitialTracingReport(userid='Yoda', sitename='Yoda', dsname=None, eventType="objectstore", analysisJob=False, jobId=None, jobDefId=None, dn='Yoda', taskID=None)
                 self.__siteMover = objectstoreSiteMover(setup, useTimerCommand=False)
                 self.__cores = int(job.get('ATHENA_PROC_NUMBER', 1))
 
@@ -79,12 +143,123 @@ class DroidStager(threading.Thread):
                     self.__stageout_threads = int(job.get('stageout_threads', None))
                 except:
                     self.__stageout_threads = self.__cores/8
-                self.__tmpLog.debug("Rank %s: start threadpool with %s threads" % (self.__rank, self.__stageout_threads))
-                self.__threadpool = ThreadPool(self.__stageout_threads)
-
+                self.__stageout_threads = max(self.__stageout_threads, 1)
+                self.__tmpLog.debug("Rank %s: stage out with %s threads" % (self.__rank, self.__stageout_threads))
+                stages = [collect,
+                          Stage('checksum', self.checksum, threads=self.__stageout_threads, size=self.getSize),
+                          Stage('upload', self.stageOutToOS, threads=self.__stageout_threads, size=self.getSize),
+                          report]
+            elif self.__outputDir or self.__copyOutputToGlobal or self.__localWorkingDir != self.__globalWorkingDir:
+                # copy in the background
+                copy_threads = int(job.get('copy_threads', COPY_THREADS))
+                self.__tmpLog.debug("Rank %s: copy outputs with %s threads" % (self.__rank, copy_threads))
+                stages = [collect, Stage('upload', self.copyOutputs, threads=copy_threads, queueSize=COPY_QUEUE_SIZE, size=self.getSize), report]
+            else:
+                stages = [collect, report]
+            for stage in stages:
+                stage.onError = self.failed
+            self.__pipeline = StagerPipeline(stages, logger=self.__tmpLog)
+            self.__pipeline.start()
         except:
             self.__tmpLog.error("Failed to setup Droid stager: %s" % str(traceback.format_exc()))
 
+    def getSize(self, item):
+        return item.get('size', 0)
+
+    def makeRequest(self, item, eventStatus=None, output=None):
+        """ The update of the event range for Yoda, with the original status and output by default """
+        item['request'] = {"jobId": self.__jobId, "eventRangeID": item['eventRangeID'], 'eventStatus': eventStatus or item['eventStatus'],
+                           "output": item['output'] if output is None else output}
+        return item
+
+    def isReported(self, item):
+        """ The update is made already (error, failure or nothing to do): the next stages pass the item on """
+        return 'request' in item or item.get('failed', False)
+
+    def failed(self, item, message):
+        """ A stage failed: report the event ranges with their original status and output """
+        self.__tmpLog.error("Rank %s: %s for %s" % (self.__rank, message, [subItem['eventRangeID'] for subItem in item.get('items', [item])]))
+        for subItem in item.get('items', [item]):
+            self.makeRequest(subItem)
+        item['failed'] = True
+        return [item]
+
+    def moveToStaging(self, filename):
+        """ Move an output to the staging dir, return its new path (the old one if it does not fit) """
+        new_file_name = os.path.join(self.__stagingDir, os.path.basename(filename))
+        try:
+            os.rename(filename, new_file_name)
+        except OSError:
+            try:
+                shutil.copyfile(filename, new_file_name)
+                os.remove(filename)
+            except (IOError, OSError), e:
+                self.__tmpLog.warning("Rank %s: failed to move %s to the staging dir, zip it in place: %s" % (self.__rank, filename, e))
+                if os.path.exists(new_file_name) and os.path.exists(filename):
+                    os.remove(new_file_name)
+                return filename
+        return new_file_name
+
+    def collect(self, item):
+        if item['eventStatus'].startswith("ERR"):
+            return [self.makeRequest(item)]
+        item['files'] = item['output'].split(",")[:-3]
+        if self.__stagingDir:
+            item['paths'] = [self.moveToStaging(filename) for filename in item['files']]
+        else:
+            item['paths'] = list(item['files'])
+        item['size'] = sum([os.path.getsize(path) for path in item['paths']])
+        if len(self.__pipeline.stages) == 2:
+            # nothing to do with the outputs
+            self.makeRequest(item)
+        return [item]
+
+    def zipOutputs(self, item):
+        """ Add the outputs to the current chunk, return the chunk when it is full """
+        if self.isReported(item):
+            return [item]
+        if self.__chunk is None:
+            self.__chunkNumber += 1
+            directory = self.__stagingDir or os.path.dirname(self.__zipFileName)
+            path = os.path.join(directory, "%s.rank_%s.%s.part" % (os.path.basename(self.__zipFileName), self.__rank, self.__chunkNumber))
+            self.__chunk = {'path': path, 'tar': tarfile.open(path, 'w'), 'items': [], 'size': 0}
+        chunk = self.__chunk
+        for filename in item['paths']:
+            self.__tmpLog.debug("Tar/zip: %s to %s" % (filename, chunk['path']))
+            handle = open(filename, 'rb')
+            try:
+                tarinfo = chunk['tar'].gettarinfo(arcname=os.path.basename(filename), fileobj=handle)
+                chunk['tar'].addfile(tarinfo, handle)
+            finally:
+                handle.close()
+            os.remove(filename)
+        chunk['items'].append(item)
+        chunk['size'] += item['size']
+        if chunk['size'] >= ZIP_CHUNK_SIZE or len(chunk['items']) >= ZIP_CHUNK_RANGES:
+            return self.closeChunk()
+        return []
+
+    def closeChunk(self):
+        if self.__chunk is None:
+            return []
+        chunk = self.__chunk
+        self.__chunk = None
+        try:
+            chunk['tar'].close()
+            chunk['paths'] = [chunk['path']]
+            chunk['size'] = os.path.getsize(chunk['path'])
+        except:
+            self.__tmpLog.warning("Rank %s: failed to close zip chunk %s: %s" % (self.__rank, chunk['path'], traceback.format_exc()))
+            return self.failed(chunk, "failed to close zip chunk")
+        finally:
+            del chunk['tar']
+        return [chunk]
+
+    def checksum(self, item):
+        if not self.isReported(item):
+            item['checksums'] = [adler32(path) for path in item['paths']]
+        return [item]
+
     def copyOutput(self, output, outputs):
         if self.__outputDir:
             for filename in outputs:
@@ -135,23 +310,6 @@ class DroidStager(threading.Thread):
                 output = output.replace(filename, new_file_name)
             return 0, output
 
-    def stageOutToOS(self, outputs):
-        ret_status = 0
-        ret_outputs = []
-        try:
-            for filename in outputs:
-                ret_status, pilotErrorDiag, surl, size, checksum, arch_type = self.__siteMover.put_data(filename, self.__esPath, lfn=os.path.basename(filename), report=self.__report, token=None, experiment='ATLAS')
-                if ret_status == 0:
-                    os.remove(filename)
-                    ret_outputs.append(surl)
-                else:
-                    self.__tmpLog.debug("Failed to stageout %s: %s %s" % (filename, ret_status, pilotErrorDiag))
-                    return ret_status, pilotErrorDiag
-        except:
-            self.__tmpLog.warning("Rank %s: Droid throws exception when staging out: %s" % (self.__rank, traceback.format_exc()))
-            ret_status = -1
-        return ret_status, ret_outputs
-
     def createAtomicLockFile(self, file_path):
         lockfile_name = os.path.join(os.path.dirname(file_path), "ATOMIC_LOCKFILE")
         try:
@@ -177,82 +335,85 @@ class DroidStager(threading.Thread):
         else:
             self.__tmpLog.warning("Released lock file: %s" % (lockfile_name))
 
-    def zipOutputs(self, eventRangeID, eventStatus, outputs):
+    def appendChunk(self, chunk):
+        """ Append the members of a zip chunk to the shared zip file, with the lock of its directory """
+        if self.isReported(chunk):
+            return [chunk]
+        while True:
+            fd, lockfile = self.createAtomicLockFile(self.__zipFileName)
+            if fd:
+                break
+            time.sleep(0.1)
         try:
-            for filename in outputs:
-                command = "tar -rf " + self.__zipFileName + " --directory=%s %s" %(os.path.dirname(filename), os.path.basename(filename))
-                self.__tmpLog.debug("Tar/zip: %s" % (command))
-                status, ret = commands.getstatusoutput(command)
-                if status:
-                    self.__tmpLog.debug("Failed to zip %s: %s, %s" % (filename, status, ret))
-                    return status, ret
-                else:
-                    os.remove(filename)
-        except:
-            self.__tmpLog.warning("Rank %s: Droid throws exception when zipping out: %s" % (self.__rank, traceback.format_exc()))
-            return -1, "Failed to zip outputs"
-        else:
-            handler = open(self.__zipEventRangesName, "a")
-            handler.write("%s %s %s\n" % (eventRangeID, eventStatus, outputs))
-            handler.close()
-        return 0, outputs
-
-    def stageOut(self, eventRangeID, eventStatus, output, retries=0):
-        if eventStatus.startswith("ERR"):
-            request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": output}
-        else:
-            outputs = output.split(",")[:-3]
-            if self.__yodaToZip:
-                self.__tmpLog.debug("Rank %s: start to zip outputs: %s" % (self.__rank, outputs))
-                retStatus, retOutput = self.zipOutputs(eventRangeID, eventStatus, outputs)
-                if retStatus != 0:
-                    self.__tmpLog.error("Rank %s: failed to zip outputs %s: %s" % (self.__rank, outputs, retOutput))
-                    request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": output}
-                else:
-                    self.__tmpLog.info("Rank %s: finished to zip outputs %s: %s" % (self.__rank, outputs, retOutput))
-                    request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': 'zipped', "output": retOutput}
-            elif self.__yodaToOS:
-                self.__tmpLog.debug("Rank %s: start to stage out outputs to objectstore: %s" % (self.__rank, outputs))
-                retStatus, retOutput = self.stageOutToOS(outputs)
-                if retStatus != 0:
-                    self.__tmpLog.error("Rank %s: failed to stagout outputs %s to objectstore: %s" % (self.__rank, outputs, retOutput))
-                    if retries < 1:
-                        self.stageOut(eventRangeID, eventStatus, output, retries=retries+1)
-                        request = None
-                    else:
-                        request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": output}
-                else:
-                    self.__tmpLog.info("Rank %s: finished to stageout outputs %s to objectstore: %s" % (self.__rank, outputs, retOutput))
-                    request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': 'stagedOut', "output": retOutput, 'objstoreID': self.__os_bucket_id}
+            if os.path.exists(self.__zipFileName):
+                zipTar = tarfile.open(self.__zipFileName, 'a')
             else:
-                self.__tmpLog.debug("Rank %s: start to copy outputs: %s" % (self.__rank, outputs))
-                retStatus, retOutput = self.copyOutput(output, outputs)
-                if retStatus != 0:
-                    self.__tmpLog.error("Rank %s: failed to copy outputs %s: %s" % (self.__rank, outputs, retOutput))
-                    request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": output}
-                else:
-                    self.__tmpLog.info("Rank %s: finished to copy outputs %s: %s" % (self.__rank, outputs, retOutput))
-                    request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": retOutput}
-        if request:
-            self.__outputs.put(request)
-
-    def bulkZipOutputs(self, outputs):
-        try:
-            while True:
-                fd, lockfile = self.createAtomicLockFile(self.__zipFileName)
-                if fd:
-                    break
-                time.sleep(0.1)
-            for outputMsg in outputs:
+                zipTar = tarfile.open(self.__zipFileName, 'w')
+            try:
+                chunkTar = tarfile.open(chunk['path'], 'r')
                 try:
-                    eventRangeID, eventStatus, output = outputMsg
-                    self.stageOut(eventRangeID, eventStatus, output, retries=0)
-                except:
-                    self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
-        except:
-            self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
+                    for tarinfo in chunkTar:
+                        zipTar.addfile(tarinfo, chunkTar.extractfile(tarinfo))
+                finally:
+                    chunkTar.close()
+            finally:
+                zipTar.close()
+            handler = open(self.__zipEventRangesName, "a")
+            for item in chunk['items']:
+                handler.write("%s %s %s\n" % (item['eventRangeID'], item['eventStatus'], item['files']))
+            handler.close()
         finally:
             self.releaseAtomicLockFile(fd, lockfile)
+        os.remove(chunk['path'])
+        self.__tmpLog.info("Rank %s: zipped %s event ranges (%s bytes, adler32 %s) to %s" % (self.__rank, len(chunk['items']), chunk['size'], chunk['checksums'][0], self.__zipFileName))
+        for item in chunk['items']:
+            self.makeRequest(item, 'zipped', item['files'])
+        return [chunk]
+
+    def stageOutToOS(self, item, retries=1):
+        if self.isReported(item):
+            return [item]
+        ret_outputs = []
+        for filename, fchecksum in zip(item['paths'], item['checksums']):
+            for i in range(retries + 1):
+                ret_status, pilotErrorDiag, surl, size, checksum, arch_type = self.__siteMover.put_data(filename, self.__esPath, lfn=os.path.basename(filename), report=self.__report, token=None, experiment='ATLAS',
+                                                                                                        fsize=os.path.getsize(filename), fchecksum=fchecksum)
+                if ret_status == 0:
+                    break
+                self.__tmpLog.debug("Failed to stageout %s: %s %s" % (filename, ret_status, pilotErrorDiag))
+            if ret_status != 0:
+                self.__tmpLog.error("Rank %s: failed to stagout outputs %s to objectstore: %s" % (self.__rank, item['paths'], pilotErrorDiag))
+                return [self.makeRequest(item)]
+            os.remove(filename)
+            ret_outputs.append(surl)
+        self.__tmpLog.info("Rank %s: finished to stageout outputs %s to objectstore: %s" % (self.__rank, item['paths'], ret_outputs))
+        self.makeRequest(item, 'stagedOut', ret_outputs)
+        item['request']['objstoreID'] = self.__os_bucket_id
+        return [item]
+
+    def copyOutputs(self, item):
+        if self.isReported(item):
+            return [item]
+        retStatus, retOutput = self.copyOutput(item['output'], item['paths'])
+        if retStatus != 0:
+            self.__tmpLog.error("Rank %s: failed to copy outputs %s: %s" % (self.__rank, item['paths'], retOutput))
+            return [self.makeRequest(item)]
+        self.__tmpLog.info("Rank %s: finished to copy outputs %s: %s" % (self.__rank, item['paths'], retOutput))
+        return [self.makeRequest(item, output=retOutput)]
+
+    def report(self, item):
+        items = item.get('items', [item])
+        for subItem in items:
+            self.__outputs.put(subItem['request'])
+        self.__pipeline.done(len(items))
+        return []
+
+    def isBusy(self):
+        """ Too many outputs wait in the pipeline: the Droid should not ask for more events """
+        return self.__pipeline is not None and self.__pipeline.getPending() >= self.__maxPending
+
+    def getMetrics(self):
+        return self.__pipeline.getMetrics() if self.__pipeline else []
 
     def stop(self):
         self.__stop.set()
@@ -261,32 +422,30 @@ class DroidStager(threading.Thread):
         return self.__isFinished
 
     def run(self):
+        metricsTime = time.time()
         while True:
             try:
                 outputs = self.__esJobManager.getOutputs()
                 if outputs:
                     self.__tmpLog.debug("Rank %s: getOutputs: %s" % (self.__rank, outputs))
-                    if self.__yodaToZip:
-                        self.bulkZipOutputs(outputs)
-                    else:
-                        for outputMsg in outputs:
-                            try:
-                                eventRangeID, eventStatus, output = outputMsg
-                                if self.__threadpool:
-                                    self.__tmpLog.debug("Rank %s: add event output to threadpool: %s" % (self.__rank, outputMsg))
-                                    self.__threadpool.add_task(self.stageOut, eventRangeID, eventStatus, output, retries=0)
-                                else:
-                                    self.stageOut(eventRangeID, eventStatus, output, retries=0)
-                            except:
-                                self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
-                                continue
+                    for eventRangeID, eventStatus, output in outputs:
+                        # blocks when the pipeline is full
+                        self.__pipeline.put({'eventRangeID': eventRangeID, 'eventStatus': eventStatus, 'output': output})
+                if time.time() - metricsTime > METRICS_INTERVAL:
+                    metricsTime = time.time()
+                    self.__tmpLog.info("Rank %s: stager metrics: %s" % (self.__rank, self.__pipeline.formatMetrics()))
             except:
                 self.__tmpLog.error("Rank %s: Stager Thread failed: %s" % (self.__rank, traceback.format_exc()))
             if self.__stop.isSet():
-                if self.__threadpool:
-                    self.__tmpLog.warning("Rank %s: wait threadpool to finish" % (self.__rank))
-                    self.__threadpool.wait_completion()
-                    self.__tmpLog.warning("Rank %s: threadpool finished" % (self.__rank))
+                if self.__pipeline:
+                    self.__tmpLog.warning("Rank %s: wait stager pipeline to finish" % (self.__rank))
+                    self.__pipeline.close()
+                    self.__tmpLog.info("Rank %s: stager metrics: %s" % (self.__rank, self.__pipeline.formatMetrics()))
+                if self.__stagingDir:
+                    try:
+                        os.rmdir(self.__stagingDir)
+                    except OSError:
+                        self.__tmpLog.warning("Rank %s: staging dir %s is not empty: %s" % (self.__rank, self.__stagingDir, os.listdir(self.__stagingDir)))
                 break
             time.sleep(1)
         self.__isFinished = True
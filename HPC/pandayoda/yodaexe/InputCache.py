@@ -0,0 +1,171 @@
+import errno
+import hashlib
+import os
+import socket
+import time
+
+# bytes per read/write when copying inputs into the cache
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+# a lock which was not touched for this long belongs to a dead rank
+STALE_LOCK_TIME = 600
+
+
+class NodeInputCache(object):
+    """
+    Node-local cache of the input files of the Droids (CopyInputFiles). The first rank of a node which needs a file
+    copies it into the cache, the other ranks of the node wait for it; all of them get a hard link (or a symlink if
+    their directory is on another file system) in their working directory. The copy is coordinated with lock files
+    created with O_EXCL, so it works between MPI ranks as well as between Droids of one process (non-MPI mode).
+
+    Every rank using a file also holds a hard link to it inside the cache, the link count of the cached file is the
+    number of its users: release() removes the file when the last user is done.
+    """
+
+    def __init__(self, cacheDir, rank, logger=None, staleLockTime=STALE_LOCK_TIME):
+        self.cacheDir = cacheDir
+        self.rank = rank
+        self.__log = logger
+        self.__staleLockTime = staleLockTime
+        self.__refsDir = os.path.join(cacheDir, '.refs')
+        for directory in (self.cacheDir, self.__refsDir):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.copied = 0
+
+    def debug(self, message):
+        if self.__log:
+            self.__log.debug("Rank %s: %s" % (self.rank, message))
+
+    def lock(self, name):
+        """ Take the lock of a cache entry, waiting for the rank holding it """
+        lockFile = os.path.join(self.cacheDir, '.%s.lock' % name)
+        wait = 0.01
+        while True:
+            try:
+                fd = os.open(lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+                os.write(fd, "%s %s %s" % (socket.gethostname(), os.getpid(), self.rank))
+                os.close(fd)
+                return lockFile
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.stat(lockFile).st_mtime > self.__staleLockTime:
+                    self.debug("Remove stale lock %s" % lockFile)
+                    os.remove(lockFile)
+                    continue
+            except OSError:
+                # released in the meantime
+                continue
+            time.sleep(wait)
+            wait = min(wait * 2, 1)
+
+    def unlock(self, lockFile):
+        os.remove(lockFile)
+
+    def copy(self, source, destination, lockFile):
+        """ Copy with large buffers into a temporary file which is renamed, keeping the lock alive """
+        tmpName = "%s.%s.part" % (destination, self.rank)
+        src = open(source, 'rb')
+        try:
+            dst = open(tmpName, 'wb')
+            try:
+                while True:
+                    buf = src.read(COPY_BUFFER_SIZE)
+                    if not buf:
+                        break
+                    dst.write(buf)
+                    os.utime(lockFile, None)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        os.rename(tmpName, destination)
+        self.copied += 1
+
+    def getFile(self, source):
+        """ Path of the cached copy of source, copied by this rank if no other rank of the node did it """
+        name = os.path.basename(source)
+        cached = os.path.join(self.cacheDir, name)
+        lockFile = self.lock(name)
+        try:
+            if not os.path.exists(cached):
+                self.debug("Copy input %s to node cache %s" % (source, self.cacheDir))
+                self.copy(source, cached, lockFile)
+            # reference of this rank, see release()
+            try:
+                os.link(cached, os.path.join(self.__refsDir, "%s.%s" % (name, self.rank)))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        finally:
+            self.unlock(lockFile)
+        return cached
+
+    def linkFile(self, source, directory):
+        """ Make source available in directory (hard link to the cached copy, or symlink), return the path """
+        cached = self.getFile(source)
+        path = os.path.join(directory, os.path.basename(source))
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(cached, path)
+        except OSError:
+            os.symlink(cached, path)
+        return path
+
+    def release(self, source, directory=None):
+        """ The rank does not need source anymore: remove its link, and the cached copy if nobody else uses it """
+        name = os.path.basename(source)
+        if directory:
+            path = os.path.join(directory, name)
+            if os.path.lexists(path):
+                os.remove(path)
+        cached = os.path.join(self.cacheDir, name)
+        lockFile = self.lock(name)
+        try:
+            ref = os.path.join(self.__refsDir, "%s.%s" % (name, self.rank))
+            if os.path.exists(ref):
+                os.remove(ref)
+            if os.path.exists(cached) and os.stat(cached).st_nlink == 1:
+                self.debug("Remove %s from node cache" % cached)
+                os.remove(cached)
+        finally:
+            self.unlock(lockFile)
+
+    def getPoolFileCatalog(self, poolFileCatalog, placeholder, directory):
+        """
+        PoolFileCatalog with placeholder replaced by the cache directory, rewritten once per node;
+        returns the path of a hard link (or symlink) to it in directory
+        """
+        name = os.path.basename(poolFileCatalog)
+        # every job has its own catalog with the same name
+        cached = os.path.join(self.cacheDir, "%s.%s" % (hashlib.md5(os.path.abspath(poolFileCatalog)).hexdigest()[:12], name))
+        lockFile = self.lock(os.path.basename(cached))
+        try:
+            if not os.path.exists(cached):
+                tmpName = "%s.%s.part" % (cached, self.rank)
+                pfc_out = open(tmpName, 'wt')
+                try:
+                    pfc_in = open(poolFileCatalog, 'rt')
+                    try:
+                        for line in pfc_in:
+                            pfc_out.write(line.replace(placeholder, self.cacheDir))
+                    finally:
+                        pfc_in.close()
+                finally:
+                    pfc_out.close()
+                os.rename(tmpName, cached)
+        finally:
+            self.unlock(lockFile)
+        path = os.path.join(directory, name)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(cached, path)
+        except OSError:
+            os.symlink(cached, path)
+        return path
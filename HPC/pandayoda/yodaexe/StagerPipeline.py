@@ -0,0 +1,192 @@
+import Queue
+import threading
+import time
+import traceback
+
+# items waiting in front of a stage at most, a full queue blocks the stage (or the producer) before it
+QUEUE_SIZE = 100
+# a stage with a pending batch (the zip chunk) passes it on when no new input came for so many seconds
+FLUSH_TIMEOUT = 5
+
+
+class StageMetrics(object):
+    """ Throughput and queue depth of a stage """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.maxDepth = 0
+        self.depthSum = 0
+        self.depthSamples = 0
+        self.lock = threading.Lock()
+
+    def sampleDepth(self, depth):
+        with self.lock:
+            self.maxDepth = max(self.maxDepth, depth)
+            self.depthSum += depth
+            self.depthSamples += 1
+
+    def add(self, busy, size=0, error=False):
+        with self.lock:
+            self.items += 1
+            self.bytes += size
+            self.busy += busy
+            if error:
+                self.errors += 1
+
+    def getSnapshot(self, elapsed, depth):
+        with self.lock:
+            return {'items': self.items, 'MB': round(self.bytes / 1048576., 2), 'errors': self.errors,
+                    'busy': round(self.busy, 3),
+                    'itemsPerSecond': round(self.items / elapsed, 3) if elapsed > 0 else 0,
+                    'MBPerBusySecond': round(self.bytes / 1048576. / self.busy, 2) if self.busy > 0 else 0,
+                    'queueDepth': depth, 'maxQueueDepth': self.maxDepth,
+                    'meanQueueDepth': round(float(self.depthSum) / self.depthSamples, 2) if self.depthSamples else 0}
+
+
+class Stage(object):
+    """
+    One stage of a StagerPipeline: threads calling func(item) for the items of a bounded queue. func returns the
+    list of items for the next stage. flush() is called (by a single thread stage) when no item came for
+    flushTimeout seconds and at the end, and returns items for the next stage as well. If func raises,
+    onError(item, message) gives the items to pass on instead.
+    """
+
+    def __init__(self, name, func, threads=1, queueSize=QUEUE_SIZE, flush=None, flushTimeout=FLUSH_TIMEOUT, size=None):
+        self.name = name
+        self.func = func
+        self.threads = threads
+        self.queue = Queue.Queue(queueSize)
+        self.flush = flush
+        self.flushTimeout = flushTimeout
+        # bytes of an item, for the metrics
+        self.size = size
+        self.onError = None
+        self.next = None
+        self.metrics = StageMetrics(name)
+        self.log = None
+        self.__running = 0
+        self.__lock = threading.Lock()
+        self.__workers = []
+
+    def put(self, item):
+        """ Blocks while the queue is full """
+        self.metrics.sampleDepth(self.queue.qsize())
+        self.queue.put(item)
+
+    def start(self):
+        self.__running = self.threads
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.run, name="%s-%s" % (self.name, i))
+            worker.setDaemon(True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def join(self):
+        for worker in self.__workers:
+            worker.join()
+
+    def emit(self, items):
+        for item in items or []:
+            self.next.put(item)
+
+    def call(self, func, item=None):
+        t0 = time.time()
+        error = False
+        try:
+            if item is None:
+                items = func()
+            else:
+                items = func(item)
+        except:
+            error = True
+            if self.log:
+                self.log.warning("Stager stage %s failed: %s" % (self.name, traceback.format_exc()))
+            items = self.onError(item, "%s failed" % self.name) if self.onError and item is not None else []
+        if item is not None:
+            self.metrics.add(time.time() - t0, self.size(item) if self.size else 0, error)
+        if self.next:
+            self.emit(items)
+
+    def run(self):
+        timeout = self.flushTimeout if self.flush else None
+        while True:
+            try:
+                if timeout is None:
+                    item = self.queue.get()
+                else:
+                    item = self.queue.get(True, timeout)
+            except Queue.Empty:
+                self.call(self.flush)
+                continue
+            if item is StagerPipeline.STOP:
+                break
+            self.call(self.func, item)
+        with self.__lock:
+            self.__running -= 1
+            last = self.__running == 0
+        if last:
+            # the other threads of the stage are done
+            if self.flush:
+                self.call(self.flush)
+            if self.next:
+                for i in range(self.next.threads):
+                    self.next.put(StagerPipeline.STOP)
+
+
+class StagerPipeline(object):
+    """
+    Chain of stages with bounded queues between them. put() blocks when the first queue is full, and
+    getPending() tells how many items were put and did not reach the end of the last stage (the producer uses it
+    for back-pressure). close() lets the stages finish the queued items and waits for them.
+    """
+    STOP = object()
+
+    def __init__(self, stages, logger=None):
+        self.stages = stages
+        for stage, nextStage in zip(stages, stages[1:] + [None]):
+            stage.next = nextStage
+            stage.log = logger
+        self.__log = logger
+        self.__lock = threading.Lock()
+        self.__put = 0
+        self.__done = 0
+        self.__startTime = None
+
+    def start(self):
+        self.__startTime = time.time()
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        with self.__lock:
+            self.__put += 1
+        self.stages[0].put(item)
+
+    def done(self, n=1):
+        """ n items left the pipeline, called by the last stage """
+        with self.__lock:
+            self.__done += n
+
+    def getPending(self):
+        with self.__lock:
+            return self.__put - self.__done
+
+    def close(self):
+        for i in range(self.stages[0].threads):
+            self.stages[0].put(StagerPipeline.STOP)
+        for stage in self.stages:
+            stage.join()
+
+    def getMetrics(self):
+        elapsed = time.time() - self.__startTime if self.__startTime else 0
+        return [(stage.name, stage.metrics.getSnapshot(elapsed, stage.queue.qsize())) for stage in self.stages]
+
+    def formatMetrics(self):
+        return "; ".join(["%s: %s items %s MB (%s/s), busy %s s, queue %s (max %s, mean %s), errors %s" %
+                          (name, m['items'], m['MB'], m['itemsPerSecond'], m['busy'], m['queueDepth'], m['maxQueueDepth'],
+                           m['meanQueueDepth'], m['errors'])
+                          for name, m in self.getMetrics()])
@@ -0,0 +1,159 @@
+# ImportProfiler.py
+#
+# Cumulative import time per module, to find the modules that make the pilot and the RunJob* subprocesses slow to
+# start (on a slow shared file system most of the time goes into locating, stat'ing and unmarshalling modules).
+# Enabled with the --profile-imports option of pilot.py and the RunJob* scripts, or with PILOT_PROFILE_IMPORTS=1 in
+# the environment (so that it is inherited by the subprocesses). The report is written to the log when the process
+# exits. enable() must be called before the modules of interest are imported.
+
+import os
+import sys
+import time
+import atexit
+import __builtin__
+
+OPTION = "--profile-imports"
+ENV_VARIABLE = "PILOT_PROFILE_IMPORTS"
+
+_original_import = __builtin__.__import__
+_stats = {}       # module name: [cumulative time, own time, number of imports that loaded new modules]
+_stack = []       # time spent in nested imports, per active import
+_enabled = False
+
+
+def _profiledImport(name, globals=None, locals=None, fromlist=None, level=-1):
+    """ __import__ replacement which records the time of every import that loaded a new module """
+
+    n = len(sys.modules)
+    _stack.append(0.0)
+    t0 = time.time()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - t0
+        nested = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        if len(sys.modules) > n:
+            # qualify implicit relative imports with the importing package
+            package = ""
+            if globals and level != 0 and '__name__' in globals and '__path__' in globals:
+                package = globals['__name__'] + "."
+            elif globals and level != 0 and '.' in globals.get('__name__', ''):
+                package = globals['__name__'].rsplit('.', 1)[0] + "."
+            key = name
+            if package and (package + name) in sys.modules:
+                key = package + name
+            entry = _stats.setdefault(key, [0.0, 0.0, 0])
+            entry[0] += elapsed
+            entry[1] += elapsed - nested
+            entry[2] += 1
+
+
+def isRequested(argv=None):
+    """ Was import profiling requested on the command line or in the environment? """
+
+    if argv is None:
+        argv = sys.argv
+    return OPTION in argv or os.environ.get(ENV_VARIABLE, "") not in ("", "0")
+
+
+def enable(argv=None, report=True):
+    """
+    Start profiling if requested. The option is removed from argv (the option parsers do not know it) and exported
+    to the environment for the subprocesses. The report is written at exit unless report=False.
+    """
+
+    global _enabled
+
+    if argv is None:
+        argv = sys.argv
+    if not isRequested(argv):
+        return False
+    while OPTION in argv:
+        argv.remove(OPTION)
+    os.environ[ENV_VARIABLE] = "1"
+
+    if not _enabled:
+        _enabled = True
+        __builtin__.__import__ = _profiledImport
+        if report:
+            atexit.register(writeReport)
+    return True
+
+
+def disable():
+    """ Stop profiling (the statistics are kept) """
+
+    global _enabled
+
+    __builtin__.__import__ = _original_import
+    _enabled = False
+
+
+def getStatistics():
+    """ Return a list of (module, cumulative time, own time) sorted by the cumulative time """
+
+    return sorted([(name, e[0], e[1]) for name, e in _stats.items()], key=lambda x: -x[1])
+
+
+def getReport(limit=40):
+    """ Return the report as a string """
+
+    stats = getStatistics()
+    total = sum([own for name, cumulative, own in stats])
+    lines = ["Import profile of %s (pid %d): %d modules imported in %.3f s" % \
+             (os.path.basename(sys.argv[0] or "python"), os.getpid(), len(stats), total),
+             "%10s %10s  %s" % ("cumul [s]", "own [s]", "module")]
+    for name, cumulative, own in stats[:limit]:
+        lines.append("%10.3f %10.3f  %s" % (cumulative, own, name))
+    if len(stats) > limit:
+        lines.append("(%d more modules)" % (len(stats) - limit))
+    return "\n".join(lines)
+
+
+def writeReport(limit=40):
+    """ Write the report to the pilot log """
+
+    try:
+        from pUtil import tolog
+        tolog(getReport(limit))
+    except Exception, e:
+        sys.stderr.write("%s\n(could not write to the pilot log: %s)\n" % (getReport(limit), e))
+
+
+def timeImport(module, python=None, heavy=(), cwd=None):
+    """
+    Import a module in a fresh interpreter and return (cumulative import time, list of 'heavy' modules loaded).
+    The module is imported from the directory of this file, the interpreter runs in cwd (default: the same directory).
+    """
+
+    import subprocess
+    import json
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    code = "import time, sys, json\n" \
+           "sys.path.insert(0, %r)\n" \
+           "t0 = time.time()\n" \
+           "import %s\n" \
+           "t = time.time() - t0\n" \
+           "sys.stdout.write('\\n' + json.dumps([t, [m for m in %r if sys.modules.get(m) is not None]]))\n" % (directory, module, list(heavy))
+    process = subprocess.Popen([python or sys.executable, "-c", code], cwd=cwd or directory,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise Exception("import %s failed: %s" % (module, stderr))
+    return tuple(json.loads(stdout.strip().splitlines()[-1]))
+
+
+if __name__ == "__main__":
+    # python ImportProfiler.py [module]: print the import profile of a module (default: RunJobNormal)
+    module = sys.argv[1] if len(sys.argv) > 1 else "RunJobNormal"
+    sys.argv[1:] = [OPTION]
+    enable(report=False)
+    t0 = time.time()
+    __import__(module)
+    t = time.time() - t0
+    disable()
+    print getReport(60)
+    print "import %s: %.3f s" % (module, t)
@@ -4,6 +4,7 @@ import re
 import commands
 from pUtil import tolog, readpar
 from FileHandling import getMaxWorkDirSize
+import ResourceSampler
 
 class Node:
     """ worker node information """
@@ -84,25 +85,31 @@ class Node:
     def collectWNInfo(self, diskpath):
         """ collect node information (cpu, memory and disk space) """
 
-        with open("/proc/meminfo", "r") as fd:
-            mems = fd.readline()
-            while mems:
-                if mems.upper().find("MEMTOTAL") != -1:
-                    self.mem = float(mems.split()[1])/1024
-                    break
+        # use the resident resource sampler for memory and cpu if it is running (see ResourceSampler.py)
+        snapshot = ResourceSampler.getSnapshot(diskpath)
+        if snapshot:
+            self.mem = snapshot['mem']
+            self.cpu = snapshot['cpu']
+        else:
+            with open("/proc/meminfo", "r") as fd:
                 mems = fd.readline()
-
-        with open("/proc/cpuinfo", "r") as fd:
-            lines = fd.readlines()
-            for line in lines:
-                if not string.find(line, "cpu MHz"):
-                    self.cpu = float(line.split(":")[1])
-                    break
-
-        diskpipe = os.popen("df -mP %s" % (diskpath)) # -m = MB
-        disks = diskpipe.read()
-        if not diskpipe.close():
-            self.disk = float(disks.splitlines()[1].split()[3])
+                while mems:
+                    if mems.upper().find("MEMTOTAL") != -1:
+                        self.mem = float(mems.split()[1])/1024
+                        break
+                    mems = fd.readline()
+
+            with open("/proc/cpuinfo", "r") as fd:
+                for line in fd:
+                    if not string.find(line, "cpu MHz"):
+                        self.cpu = float(line.split(":")[1])
+                        break
+
+        # the free space is used for space checks and must be current, a sampled value can be 'interval' seconds old
+        try:
+            self.disk = ResourceSampler.getFreeSpace(diskpath)
+        except OSError, e:
+            tolog("!!WARNING!!1999!! Failed to get free space of %s: %s" % (diskpath, e))
 
         return self.mem, self.cpu, self.disk
 
@@ -286,6 +293,10 @@ class Node:
             else:
                 tolog("Will not add max space = %d to job metrics" % (max_space))
 
+            # min/max/avg of the worker node resources sampled during the job
+            for name, value in ResourceSampler.getJobMetrics():
+                jobMetrics += self.addFieldToJobMetrics(name, value)
+
         return jobMetrics
 
     def getBenchmarkDictionary(self):
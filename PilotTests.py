@@ -0,0 +1,3391 @@
+# PilotTests.py
+#
+# Unit tests and benchmarks of the pilot components, against local stand-ins (S3/HTTP servers, fake clients)
+# instead of the real services. Run from the pilot directory:
+#
+#   python PilotTests.py [TestCase[.test] ...]      # unit tests, all by default
+#   python PilotTests.py benchmark <name> [args]     # benchmarks, see BENCHMARKS
+#
+# The pilot log of the tested components goes to a temporary directory, which is removed at exit.
+
+import os
+import sys
+import time
+import zlib
+import shutil
+import atexit
+import hashlib
+import tempfile
+import threading
+import tarfile
+import commands
+import multiprocessing
+import subprocess
+import urllib2
+import SimpleHTTPServer
+import re
+import json
+import types
+import errno
+import socket
+import logging
+import heapq
+import random
+import collections
+import Queue
+import unittest
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import xml.dom.minidom
+from binascii import hexlify
+from distutils.spawn import find_executable
+from collections import defaultdict
+
+import pUtil
+
+# also the messages logged when the tested modules are imported
+LOGDIR = tempfile.mkdtemp(prefix="PilotTests.")
+atexit.register(shutil.rmtree, LOGDIR, True)
+pUtil.setPilotlogFilename(os.path.join(LOGDIR, "pilotlog.txt"))
+
+# the HPC (Yoda/Droid) components are imported from the HPC directory, as in the HPC jobs
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "HPC"))
+
+import SiteMover
+import S3ObjectstoreSiteMover
+from S3ObjectstoreSiteMover import S3ObjctStore
+from StreamingArchiver import StreamingArchiver
+import CopytoolSetupCache
+from FAXSiteMover import FAXSiteMover
+import Job
+import Site
+import Mover
+import DeferredStageout
+from JobState import JobState
+import ProxyInspector
+from ProxyInspector import _TAG_SEQUENCE, _TAG_OID, _TAG_GENERALIZED_TIME
+import ResourceSampler
+from PilotErrors import PilotErrors
+from aria2cSiteMover import METALINK_NS, ARIA2C_OPTIONS, mergeMetalinks, parseMetalink, parseDownloadResults, verifyDownload
+import DiagnosticsScanner
+from Job import FileSpec
+from SiteInformation import SiteInformation
+import movers.mover
+from movers import JobMover
+from movers.replicas import replica_cache
+import ImportProfiler
+from pandayoda.yodacore import Interaction
+from pandayoda.yodacore.EventRangeUpdates import encodeUpdates, decodeUpdates, UpdateBatcher
+from pandayoda.yodaexe.DroidReactor import DroidReactor, NotifyingQueue
+from pandayoda.yodacore.TestUtils import FakeCommunicator
+from pandayoda.yodacore.Yoda import Yoda
+from pandayoda.yodacore.EventScheduler import EventScheduler
+from pandayoda.yodacore.MetricsAggregator import MetricsAggregator, RankExtrema, SUM_KEYS, TIME_SERIES_KEYS
+from pandayoda.yodacore.EventRangeStore import EventRangeQueue, writeEventRanges, loadEventRanges
+from pandayoda.yodaexe.InputCache import NodeInputCache
+from HPC.HPCManager import HPCManager
+from HPC.HPCManagerPlugins.fake import fake
+from pandayoda.yodacore.JobTracker import STATE_FILE, OUTPUT_SUFFIX, writeState, Backoff, JobTracker
+from pandayoda.yodacore.Checkpoint import STATE_FILE as CHECKPOINT_FILE, JobRanges, encodeBitmap, decodeBitmap
+from pandayoda.yodaexe.StagerPipeline import StagerPipeline, Stage
+from pandayoda.yodaexe import DroidStager
+from pandayoda.yodacore.JobPacker import DEFAULT_EVENT_TIME, EventTimeModel, JobPacker
+from SURLRegistry import SURLRegistry
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """ Register a benchmark, called with the remaining command line arguments """
+
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def haveModule(name):
+    """ True if the (optional) module can be imported """
+
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+# S3ObjectstoreSiteMover
+
+class S3StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Minimal S3 protocol: objects, ranged GETs and multipart uploads, no authentication """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def split(self):
+        parsed = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(parsed.query, keep_blank_values=True)
+        return parsed.path.strip("/"), dict([(k, v[0]) for k, v in query.items()])
+
+    def reply(self, status, body="", headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send(self, data):
+        # simulated per-connection bandwidth
+        rate = self.server.rate
+        blockSize = S3ObjectstoreSiteMover.BLOCK_SIZE
+        for i in range(0, len(data), blockSize):
+            self.wfile.write(data[i:i+blockSize])
+            if rate:
+                time.sleep(float(len(data[i:i+blockSize])) / rate)
+
+    def receive(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.rate:
+            time.sleep(float(len(data)) / self.server.rate)
+        return data
+
+    def do_HEAD(self):
+        path, query = self.split()
+        if "/" not in path:
+            return self.reply(200)
+        if path not in self.server.objects:
+            return self.reply(404)
+        data, etag = self.server.objects[path]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", '"%s"' % etag)
+        self.end_headers()
+
+    def do_GET(self):
+        path, query = self.split()
+        if path not in self.server.objects:
+            return self.reply(404, "<Error><Code>NoSuchKey</Code></Error>")
+        data, etag = self.server.objects[path]
+        status = 200
+        headers = {"ETag": '"%s"' % etag}
+        if "Range" in self.headers:
+            start, end = [int(x) for x in self.headers["Range"].split("=")[1].split("-")]
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+            data = data[start:end+1]
+            status = 206
+            if self.server.fault("short", start):
+                # announce the full range, but send half of it and drop the connection
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data[:len(data)/2])
+                self.close_connection = 1
+                return
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.send(data)
+
+    def do_PUT(self):
+        path, query = self.split()
+        data = self.receive()
+        etag = hashlib.md5(data).hexdigest()
+        if "uploadId" in query:
+            part_num = int(query["partNumber"])
+            self.server.uploads[query["uploadId"]][part_num] = data
+            if self.server.fault("etag", part_num):
+                etag = "0" * 32
+        else:
+            self.server.objects[path] = (data, etag)
+        self.reply(200, headers={"ETag": '"%s"' % etag})
+
+    def do_POST(self):
+        path, query = self.split()
+        body = self.receive()
+        if "uploads" in query:
+            upload_id = "upload%d" % (len(self.server.uploads) + 1)
+            self.server.uploads[upload_id] = {}
+            bucket, key = path.split("/", 1)
+            return self.reply(200, "<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>"
+                                   "</InitiateMultipartUploadResult>" % (bucket, key, upload_id))
+        parts = self.server.uploads.pop(query["uploadId"])
+        numbers = [int(node.firstChild.data) for node in xml.dom.minidom.parseString(body).getElementsByTagName("PartNumber")]
+        data = "".join([parts[n] for n in numbers])
+        etag = "%s-%d" % (hashlib.md5("".join([hashlib.md5(parts[n]).digest() for n in numbers])).hexdigest(), len(numbers))
+        self.server.objects[path] = (data, etag)
+        self.reply(200, "<CompleteMultipartUploadResult><Key>%s</Key><ETag>\"%s\"</ETag></CompleteMultipartUploadResult>" % (path, etag))
+
+    def do_DELETE(self):
+        path, query = self.split()
+        if "uploadId" in query:
+            self.server.uploads.pop(query["uploadId"], None)
+            self.server.aborted.append(query["uploadId"])
+        self.reply(204)
+
+
+class S3StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), S3StubHandler)
+        self.rate = rate
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.faults = {}
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def fault(self, kind, item):
+        """ Consume one injected fault, e.g. faults['etag'] = [2, 2] fails the first two uploads of part 2 """
+        self.lock.acquire()
+        try:
+            if item in self.faults.get(kind, []):
+                self.faults[kind].remove(item)
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def url(self, name):
+        return "s3://127.0.0.1:%d/bucket/%s" % (self.server_address[1], name)
+
+
+class S3ObjctStoreTest(unittest.TestCase):
+    """ Transfers against the in-process S3 stub server, they go through boto, only the checksum test runs without it """
+
+    def setUp(self):
+        self.server = S3StubServer()
+        self.workdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.workdir, "source")
+        f = open(self.source, "wb")
+        f.write(os.urandom(1000*1000 + 123))
+        f.close()
+        self.store = S3ObjctStore("secret", "access", False, False, threshold=500*1000, partSize=100*1000, threads=4)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def data(self, path):
+        f = open(path, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def testAdler32Combine(self):
+        a, b = os.urandom(70000), os.urandom(123457)
+        combined = S3ObjectstoreSiteMover.adler32_combine(zlib.adler32(a) & 0xffffffff, zlib.adler32(b) & 0xffffffff, len(b))
+        self.assertEqual(combined, zlib.adler32(a + b) & 0xffffffff)
+
+    @unittest.skipUnless(haveModule("boto"), "boto not found, skipping S3 transfer test")
+    def testMultipartUpload(self):
+        self.server.faults["etag"] = [3]
+        status, output, size, checksum = self.store.s3StageOutFile(self.source, self.server.url("out"), os.path.getsize(self.source))
+        self.assertEqual((status, output), (0, None))
+        self.assertEqual(size, os.path.getsize(self.source))
+        self.assertEqual(checksum, SiteMover.SiteMover.adler32(self.source))
+        self.assertEqual(self.server.objects["bucket/out"][0], self.data(self.source))
+        self.assertTrue(self.server.objects["bucket/out"][1].endswith("-11"))
+
+    @unittest.skipUnless(haveModule("boto"), "boto not found, skipping S3 transfer test")
+    def testMultipartUploadFailure(self):
+        self.server.faults["etag"] = [2] * S3ObjectstoreSiteMover.PART_RETRIES
+        status, output, size, checksum = self.store.s3StageOutFile(self.source, self.server.url("out"))
+        self.assertEqual(status, -1)
+        self.assertTrue("part 2" in output)
+        self.assertEqual(len(self.server.aborted), 1)
+        self.assertFalse("bucket/out" in self.server.objects)
+
+    @unittest.skipUnless(haveModule("boto"), "boto not found, skipping S3 transfer test")
+    def testRangedDownload(self):
+        self.store.s3StageOutFile(self.source, self.server.url("in"))
+        self.server.faults["short"] = [200*1000]
+        destination = os.path.join(self.workdir, "destination")
+        status, output, size, checksum = self.store.s3StageInFile(self.server.url("in"), destination, os.path.getsize(self.source))
+        self.assertEqual((status, output), (0, None))
+        self.assertEqual(size, os.path.getsize(self.source))
+        self.assertEqual(checksum, SiteMover.SiteMover.adler32(self.source))
+        self.assertEqual(self.data(destination), self.data(self.source))
+
+    @unittest.skipUnless(haveModule("boto"), "boto not found, skipping S3 transfer test")
+    def testSingleStream(self):
+        self.store.threshold = 10*1000*1000
+        status, output, size, checksum = self.store.s3StageOutFile(self.source, self.server.url("small"))
+        self.assertEqual((status, checksum), (0, None))
+        self.assertFalse(self.server.objects["bucket/small"][1].endswith("-1"))
+        destination = os.path.join(self.workdir, "destination")
+        status, output, size, checksum = self.store.s3StageInFile(self.server.url("small"), destination)
+        self.assertEqual((status, checksum), (0, None))
+        self.assertEqual(self.data(destination), self.data(self.source))
+
+
+@benchmark("s3")
+def benchmarkS3(args):
+    """ S3 transfers with a simulated per-connection bandwidth: python PilotTests.py benchmark s3 [MB] [MB/s] """
+
+    megabytes = 64
+    rate = 20
+    if len(args) > 0:
+        megabytes = int(args[0])
+    if len(args) > 1:
+        rate = float(args[1])
+
+    default = S3ObjectstoreSiteMover.TRANSFER_THREADS
+    server = S3StubServer(rate=rate*1024**2)
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, "source")
+        f = open(source, "wb")
+        for i in range(megabytes):
+            f.write(os.urandom(1024**2))
+        f.close()
+        destination = os.path.join(workdir, "destination")
+
+        for threads in [1, default, 2*default]:
+            store = S3ObjctStore("secret", "access", False, False, threshold=S3ObjectstoreSiteMover.MIN_PART_SIZE,
+                                 partSize=8*1024**2, threads=threads)
+            t0 = time.time()
+            status, output, size, checksum = store.s3StageOutFile(source, server.url("bench"))
+            t1 = time.time()
+            assert status == 0, output
+            status, output, size, checksum = store.s3StageInFile(server.url("bench"), destination)
+            t2 = time.time()
+            assert status == 0, output
+            print "%d MB, %.0f MB/s per connection, %d thread(s): upload %.2f s, download %.2f s" % (megabytes, rate, threads, t1 - t0, t2 - t1)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+
+# StreamingArchiver
+
+@benchmark("archiver")
+def benchmarkArchiver(args):
+    """ Event service output archives: python PilotTests.py benchmark archiver [nFiles] [threads] [maxShardSizeMB] """
+
+    nFiles = 100000
+    threads = 4
+    maxShardSize = 64
+    if len(args) > 0:
+        nFiles = int(args[0])
+    if len(args) > 1:
+        threads = int(args[1])
+    if len(args) > 2:
+        maxShardSize = int(args[2])
+
+    def log(msg):
+        pass
+
+    def createOutputs(workdir, name):
+        statusFile = os.path.join(workdir, "%s_event_status.dump" % name)
+        handle = open(statusFile, 'w')
+        for i in range(nFiles):
+            filename = os.path.join(workdir, "%s.HITS.%s.pool.root" % (name, i))
+            output = open(filename, 'w')
+            output.write("x" * 512)
+            output.close()
+            handle.write("1 1-2-%s finished %s,ID:1,CPU:1,WALL:1\n" % (i, filename))
+        handle.close()
+        return statusFile
+
+    def oldZip(statusFile, zipFileName, zipEventRangeName):
+        # the per line/per file logic of RunJobHpcEvent.zipOutputs before the streaming archiver
+        tar = tarfile.open(zipFileName, 'w')
+        zipEventRange = open(zipEventRangeName, 'w')
+        for line in open(statusFile):
+            eventRangeID = line.split(" ")[1]
+            status = line.split(" ")[2]
+            output = line.split(" ")[3]
+            outputs = output.split(",")[:-3]
+            for out in outputs:
+                if not os.path.exists(out):
+                    continue
+                tar.add(out, arcname=os.path.basename(out))
+                os.remove(out)
+            zipEventRange.write("%s %s %s\n" % (eventRangeID, status, output))
+        tar.close()
+        zipEventRange.close()
+        return SiteMover_adler32(zipFileName)
+
+    def SiteMover_adler32(filename):
+        # the second read pass the movers do today
+        adler = 1L
+        for line in open(filename, 'rb'):
+            adler = zlib.adler32(line, adler)
+        return adler
+
+    workdir = tempfile.mkdtemp()
+    try:
+        statusFile = createOutputs(workdir, "old")
+        t0 = time.time()
+        oldZip(statusFile, os.path.join(workdir, "old.tar"), os.path.join(workdir, "old.ranges"))
+        t1 = time.time()
+        print "old zipOutputs + adler32: %s files in %.2f s" % (nFiles, t1 - t0)
+
+        statusFile = createOutputs(workdir, "new")
+        t0 = time.time()
+        archiver = StreamingArchiver(os.path.join(workdir, "new.tar"), os.path.join(workdir, "new.ranges"), maxShardSize=maxShardSize * 1024 * 1024, threads=threads, log=log)
+        archiver.start()
+        archiver.addEventStatusFile(statusFile)
+        shards = archiver.close()
+        t1 = time.time()
+        print "streaming archiver (%s threads, %s MB shards): %s files, %s shards in %.2f s" % (threads, maxShardSize, nFiles, len(shards), t1 - t0)
+    finally:
+        shutil.rmtree(workdir)
+
+
+# CopytoolSetupCache
+
+@benchmark("setup")
+def benchmarkCopytoolSetup(args):
+    """ Offline, with a fake setup script which takes 'delay' seconds to source:
+        python PilotTests.py benchmark setup [delay] [transfers] """
+
+    delay = 2.0
+    transfers = 10
+    if len(args) > 0:
+        delay = float(args[0])
+    if len(args) > 1:
+        transfers = int(args[1])
+
+    workdir = tempfile.mkdtemp()
+    try:
+        bindir = os.path.join(workdir, "bin")
+        os.mkdir(bindir)
+        tool = os.path.join(bindir, "fakecp")
+        handle = open(tool, "w")
+        handle.write("#!/bin/sh\ncp \"$1\" \"$2\"\n")
+        handle.close()
+        os.chmod(tool, 0755)
+
+        setupScript = os.path.join(workdir, "setup.sh")
+        handle = open(setupScript, "w")
+        handle.write("sleep %s\nexport PATH=%s:$PATH\nexport FAKE_SETUP_DONE=1\n" % (delay, bindir))
+        handle.close()
+
+        src = os.path.join(workdir, "src")
+        open(src, "w").write("x" * 1024)
+        # '.' instead of 'source', so that this also works where /bin/sh is not bash
+        setupStr = ". %s;" % setupScript
+
+        # old: verify (source + which) per mover instance, source again per copy command
+        t0 = time.time()
+        for i in range(transfers):
+            commands.getstatusoutput("%s which fakecp" % setupStr)
+            s, o = commands.getstatusoutput("%s fakecp %s %s.%d" % (setupStr, src, src, i))
+            assert s == 0, o
+        t1 = time.time()
+        print "re-sourcing setup: %d transfers in %.2f s" % (transfers, t1 - t0)
+
+        # new: probe once, run copy commands in the captured environment
+        t0 = time.time()
+        for i in range(transfers):
+            status, output = CopytoolSetupCache.probeSetup(setupStr, "fakecp")
+            assert status == 0, output
+            s, o = CopytoolSetupCache.getstatusoutput("%s fakecp %s %s.%d" % (setupStr, src, src, i), setupStr, "fakecp")
+            assert s == 0, o
+        t1 = time.time()
+        print "cached setup probe: %d transfers in %.2f s" % (transfers, t1 - t0)
+
+        # the FAX mover runs xrdcp, its setup must be probed (and cached) for xrdcp, not for 'fax'
+        tool = os.path.join(bindir, "xrdcp")
+        handle = open(tool, "w")
+        handle.write("#!/bin/sh\ncp \"$1\" \"$2\"\n")
+        handle.close()
+        os.chmod(tool, 0755)
+
+        mover = FAXSiteMover(setupStr)
+        status, output = mover.verifySetup(setupStr, "ATLAS")
+        assert status == 0, output
+        assert CopytoolSetupCache.getEnv(setupStr, FAXSiteMover.realCopyCommand) is not None
+        cmd, env = CopytoolSetupCache.splitCommand("%s xrdcp %s %s.fax" % (setupStr, src, src), setupStr, FAXSiteMover.realCopyCommand)
+        assert env is not None and cmd.startswith("xrdcp"), cmd
+        print "FAX setup verified and cached for %s" % FAXSiteMover.realCopyCommand
+    finally:
+        shutil.rmtree(workdir)
+
+
+# DeferredStageout
+
+@benchmark("stageout")
+def benchmarkDeferredStageout(args):
+    """ Synthetic, no server or storage needed: python PilotTests.py benchmark stageout [jobs] [transfer seconds] [workers]
+        Creates holding jobs in a temporary dir and stages them out with a local 'mv' mover, alternating between two
+        endpoints, once one job after the other and once with the worker pool. """
+
+    njobs = int(args[0]) if len(args) > 0 else 24
+    delay = float(args[1]) if len(args) > 1 else 0.5
+    workers = int(args[2]) if len(args) > 2 else 8
+
+    updates = []
+    transfers = multiprocessing.Queue()
+    destination = {}
+
+    def mv_put_data(pfc, dsname, sitename, ce, **kwargs):
+        job = kwargs['job']
+        transfers.put((time.time(), 1, DeferredStageout.GetDestinationEndpoint(job)))
+        time.sleep(delay)
+        for name in job.outFiles:
+            shutil.move(os.path.join(job.datadir, name), os.path.join(destination['dir'], name))
+        transfers.put((time.time(), -1, DeferredStageout.GetDestinationEndpoint(job)))
+        return 0, "", None, "", len(job.outFiles), 0, None
+
+    def update_server(job_state, **kwargs):
+        updates.append(os.getpid())
+        return 0, {}
+
+    def run(workers):
+        # stand-ins for the mover, the server and the metadata, set on the modules where the stage-out looks them up
+        DeferredStageout.updatePandaServer = update_server
+        DeferredStageout.setGuids = lambda job_state, files, **kwargs: True
+        DeferredStageout.updateOutPFC = lambda job, **kwargs: "PoolFileCatalog.xml"
+        Mover.mover_put_data = mv_put_data
+        pUtil.getMetadata = lambda *args, **kwargs: ""
+        pUtil.postJobTask = lambda *args, **kwargs: None
+
+        del updates[:]
+        base = tempfile.mkdtemp()
+        destination['dir'] = os.path.join(base, "destination")
+        os.mkdir(destination['dir'])
+
+        thisSite = Site.Site()
+        thisSite.sitename = "SYNTHETIC"
+        thisSite.computingElement = "local"
+        thisSite.workdir = base
+        dead = time.time() - 86400
+        for i in range(njobs):
+            job = Job.Job()
+            job.jobId = str(1000 + i)
+            job.trf = "Reco_tf.py"
+            job.result = ["holding", 0, 0]
+            job.outFiles = ["out.%d.root" % i]
+            job.ddmEndPointOut = ["ENDPOINT_%d" % (i % 2)]
+            job.datadir = os.path.join(base, "Panda_Pilot_%d" % i, "PandaJob_%d_data" % i)
+            os.makedirs(job.datadir)
+            open(os.path.join(job.datadir, job.outFiles[0]), "w").write("x")
+            site = Site.Site()
+            site.sitename = thisSite.sitename
+            site.workdir = os.path.dirname(job.datadir)
+            JobState().put(job, site, {'xml': ''})
+            os.utime(JobState().getFilename(site.workdir, job.jobId), (dead, dead))
+
+        DeferredStageout.env.update({'thisSite': thisSite, 'uflag': '', 'workerNode': None, 'experiment': 'ATLAS',
+                                     'pilot_initdir': base, 'proxycheckFlag': False})
+
+        cwd = os.getcwd()
+        t0 = time.time()
+        n = DeferredStageout.DeferredStageout([base], 0, deferredStageoutWorkers=workers, maxEndpointTransfers=2)
+        t = time.time() - t0
+        os.chdir(cwd)
+        moved = len(os.listdir(destination['dir']))
+        shutil.rmtree(base)
+
+        active = {}
+        peak = {}
+        events = []
+        while not transfers.empty():
+            events.append(transfers.get())
+        for _, change, endpoint in sorted(events):
+            active[endpoint] = active.get(endpoint, 0) + change
+            peak[endpoint] = max(peak.get(endpoint, 0), active[endpoint])
+
+        return "%d workers: %d/%d jobs staged out, %d files moved, %d server updates from %d process(es) in %.2f s, " \
+               "peak transfers per endpoint %s" % (workers, n, njobs, moved, len(updates), len(set(updates)), t, peak)
+
+    results = [run(1), run(workers)]
+    print "\n".join(results)
+
+
+# ProxyInspector
+
+class ProxyInspectorTest(unittest.TestCase):
+    """ Unit tests with locally generated, self-signed proxies (requires the openssl command) """
+
+    def setUp(self):
+        if not find_executable("openssl"):
+            self.skipTest("openssl is not available")
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        ProxyInspector.clear()
+
+    def der(self, tag, content):
+        """ DER encode a tag/content pair """
+
+        length = len(content)
+        if length < 0x80:
+            header = chr(length)
+        else:
+            digits = "%x" % (length)
+            digits = "0" * (len(digits) % 2) + digits
+            header = chr(0x80 | (len(digits) / 2)) + digits.decode("hex")
+        return chr(tag) + header + content
+
+    def vomsExtension(self, notAfters):
+        """ Return the DER value of a VOMS extension with ACs valid until notAfters (signatures are dummies) """
+
+        acs = ""
+        for notAfter in notAfters:
+            period = self.der(_TAG_SEQUENCE,
+                              self.der(_TAG_GENERALIZED_TIME, time.strftime("%Y%m%d%H%M%SZ", time.gmtime(time.time() - 3600))) +
+                              self.der(_TAG_GENERALIZED_TIME, time.strftime("%Y%m%d%H%M%SZ", time.gmtime(notAfter))))
+            algorithm = self.der(_TAG_SEQUENCE, self.der(_TAG_OID, "\x2a\x86\x48\x86\xf7\x0d\x01\x01\x0b"))
+            acinfo = self.der(_TAG_SEQUENCE,
+                              self.der(0x02, "\x01") +                     # version
+                              self.der(_TAG_SEQUENCE, "") +                # holder
+                              self.der(0xa0, "") +                         # issuer
+                              algorithm +                                  # signature
+                              self.der(0x02, "\x2a") +                     # serialNumber
+                              period +                                     # attrCertValidityPeriod
+                              self.der(_TAG_SEQUENCE, ""))                 # attributes
+            acs += self.der(_TAG_SEQUENCE, acinfo + algorithm + self.der(0x03, "\x00"))
+        return self.der(_TAG_SEQUENCE, self.der(_TAG_SEQUENCE, acs))
+
+    def makeProxy(self, name, days=1, acs=None):
+        """ Create a self-signed proxy file (certificate followed by its key) """
+
+        cert = os.path.join(self.workdir, name + ".pem")
+        key = os.path.join(self.workdir, name + ".key")
+        cmd = ["openssl", "req", "-x509", "-newkey", "rsa:1024", "-nodes", "-keyout", key, "-out", cert,
+               "-days", str(days), "-subj", "/DC=test/CN=%s/CN=proxy" % (name)]
+        if acs:
+            cmd += ["-addext", "1.3.6.1.4.1.8005.100.100.5=DER:%s" % (hexlify(self.vomsExtension(acs)))]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+
+        path = os.path.join(self.workdir, name)
+        handle = open(path, "w")
+        handle.write(open(cert).read() + open(key).read())
+        handle.close()
+        return path
+
+    def test_grid_proxy(self):
+        """ A proxy without VOMS attributes has a lifetime, but no VOMS lifetime """
+
+        path = self.makeProxy("grid", days=2)
+        self.assertAlmostEqual(ProxyInspector.getTimeLeft(path, voms=False), 2*86400, delta=60)
+        self.assertEqual(ProxyInspector.getTimeLeft(path), None)
+
+    def test_voms_proxy(self):
+        """ The VOMS lifetime is the earliest AC notAfter """
+
+        now = int(time.time())
+        path = self.makeProxy("voms", days=4, acs=[now + 12*3600, now + 36*3600])
+        info = ProxyInspector.inspectProxy(path)
+        self.assertEqual(info['vomsNotAfter'], now + 12*3600)
+        self.assertAlmostEqual(ProxyInspector.getTimeLeft(path), 12*3600, delta=60)
+        self.assertAlmostEqual(ProxyInspector.getTimeLeft(path, voms=False), 4*86400, delta=60)
+
+    def test_expired_attributes(self):
+        """ Expired VOMS attributes have no time left """
+
+        path = self.makeProxy("expired", acs=[int(time.time()) - 60])
+        self.assertEqual(ProxyInspector.getTimeLeft(path), 0)
+
+    def test_cache(self):
+        """ A proxy file is parsed once, and again when it is replaced """
+
+        path = self.makeProxy("cached", acs=[int(time.time()) + 3600])
+        info = ProxyInspector.inspectProxy(path)
+        self.assertTrue(ProxyInspector.inspectProxy(path) is info)
+
+        replacement = self.makeProxy("replacement", acs=[int(time.time()) + 7200])
+        os.rename(replacement, path)
+        self.assertAlmostEqual(ProxyInspector.getTimeLeft(path), 7200, delta=60)
+
+    def test_unparseable(self):
+        """ Files which can not be parsed are left to the external tools """
+
+        path = os.path.join(self.workdir, "garbage")
+        handle = open(path, "w")
+        handle.write("-----BEGIN CERTIFICATE-----\nMIIBnotreallyDER\n-----END CERTIFICATE-----\n")
+        handle.close()
+        self.assertEqual(ProxyInspector.inspectProxy(path), None)
+        self.assertEqual(ProxyInspector.getTimeLeft(path), None)
+        self.assertEqual(ProxyInspector.inspectProxy(os.path.join(self.workdir, "missing")), None)
+
+
+# ResourceSampler
+
+class ResourceSamplerTest(unittest.TestCase):
+    """ Sampler tests on a fake /proc """
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+        self.write("meminfo", "MemTotal:       16384000 kB\nMemFree:         2048000 kB\n"
+                              "MemAvailable:    8192000 kB\nBuffers:          102400 kB\n")
+        self.write("cpuinfo", "processor\t: 0\nmodel name\t: Fake CPU @ 2.40GHz\ncpu MHz\t\t: 2400.000\n\n"
+                              "processor\t: 1\nmodel name\t: Fake CPU @ 2.40GHz\ncpu MHz\t\t: 1200.000\n\n")
+        self.write("loadavg", "1.50 1.00 0.50 2/345 6789\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def write(self, name, data):
+        # rewrite in place, the sampler keeps the file open
+        fd = open(os.path.join(self.proc, name), "r+" if os.path.exists(os.path.join(self.proc, name)) else "w")
+        fd.write(data)
+        fd.truncate()
+        fd.close()
+
+    def testSnapshot(self):
+        sampler = ResourceSampler.ResourceSampler(interval=3600, paths=[self.proc], proc_root=self.proc)
+        snapshot = sampler.getSnapshot(self.proc)
+        self.assertEqual(snapshot['mem'], 16000.0)
+        self.assertEqual(snapshot['memAvailable'], 8000.0)
+        self.assertEqual(snapshot['cpu'], 2400.0)
+        self.assertEqual(snapshot['cpuModel'], "Fake CPU @ 2.40GHz")
+        self.assertEqual(snapshot['numberOfCpus'], 2)
+        self.assertEqual(snapshot['load'], (1.5, 1.0, 0.5))
+        self.assertTrue(abs(snapshot['disk'] - ResourceSampler.getFreeSpace(self.proc)) < 100)
+
+    def testMemAvailableFallback(self):
+        self.write("meminfo", "MemTotal: 1024 kB\nMemFree: 512 kB\nBuffers: 256 kB\nCached: 256 kB\n")
+        sampler = ResourceSampler.ResourceSampler(interval=3600, proc_root=self.proc)
+        self.assertEqual(sampler.getSnapshot()['memAvailable'], 1.0)
+
+    def testStatistics(self):
+        sampler = ResourceSampler.ResourceSampler(interval=3600, proc_root=self.proc)
+        self.write("loadavg", "3.50 1.00 0.50 2/345 6789\n")
+        sampler.sample()
+        self.write("loadavg", "1.00 1.00 0.50 2/345 6789\n")
+        sampler.sample()
+        _min, _max, _avg, _n = sampler.getStatistics()["load"]
+        self.assertEqual((_min, _max, _avg, _n), (1.0, 3.5, 2.0, 3))
+
+    def testResetStatistics(self):
+        sampler = ResourceSampler.ResourceSampler(interval=3600, proc_root=self.proc)
+        self.write("loadavg", "9.00 1.00 0.50 2/345 6789\n")
+        sampler.sample()
+        sampler.resetStatistics()
+        self.assertEqual(sampler.getStatistics(), {})
+        self.write("loadavg", "2.00 1.00 0.50 2/345 6789\n")
+        sampler.sample()
+        self.assertEqual(sampler.getStatistics()["load"], (2.0, 2.0, 2.0, 1))
+
+    def testWatch(self):
+        sampler = ResourceSampler.ResourceSampler(interval=3600, proc_root=self.proc)
+        self.assertEqual(sampler.getSnapshot()['paths'], {})
+        self.assertTrue(sampler.getSnapshot(self.proc)['disk'] > 0)
+        self.assertEqual(sampler.getMountPoints()[self.proc], ResourceSampler.getMountPoint(self.proc))
+
+    def testThread(self):
+        sampler = ResourceSampler.start(interval=0.05, paths=[self.proc], proc_root=self.proc)
+        try:
+            self.write("loadavg", "9.00 1.00 0.50 2/345 6789\n")
+            time.sleep(0.3)
+            self.assertEqual(ResourceSampler.getSnapshot(self.proc)['load'][0], 9.0)
+            self.assertEqual(dict(ResourceSampler.getJobMetrics())["nodeLoadMax"], "9.00")
+        finally:
+            ResourceSampler.stop()
+        sampler.join(1)
+        self.assertFalse(sampler.isAlive())
+        self.assertEqual(ResourceSampler.getSnapshot(), None)
+
+
+@benchmark("sampler")
+def benchmarkResourceSampler(args):
+    """ Compare with the per call parsing of the old Node.collectWNInfo(): python PilotTests.py benchmark sampler [calls] """
+
+    calls = 200
+    if len(args) > 0:
+        calls = int(args[0])
+    path = os.getcwd()
+
+    t0 = time.time()
+    for i in range(calls):
+        fd = open("/proc/meminfo", "r")
+        fd.read()
+        fd.close()
+        fd = open("/proc/cpuinfo", "r")
+        fd.readlines()
+        fd.close()
+        pipe = os.popen("df -mP %s" % (path))
+        pipe.read()
+        pipe.close()
+    t1 = time.time()
+    print "per call /proc parsing and df: %d calls in %.3f s" % (calls, t1 - t0)
+
+    sampler = ResourceSampler.start(interval=60, paths=[path])
+    t0 = time.time()
+    for i in range(calls):
+        ResourceSampler.getSnapshot(path)
+    t1 = time.time()
+    print "resource sampler snapshot:     %d calls in %.3f s" % (calls, t1 - t0)
+
+    t0 = time.time()
+    for i in range(calls):
+        sampler.sample()
+    t1 = time.time()
+    print "resource sampler sample:       %d samples in %.3f s" % (calls, t1 - t0)
+    ResourceSampler.stop()
+
+
+# aria2cSiteMover
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Aria2cTest(unittest.TestCase):
+    """ Metalink handling and downloads from a local HTTP server holding two replica directories """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.workdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+        self.server = ThreadingServer(("127.0.0.1", 0), QuietHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        base = "http://127.0.0.1:%d" % (self.server.server_address[1])
+
+        # replica directories siteA and siteB, and a Rucio like metalink per file
+        self.files = {}
+        os.mkdir("metalinks")
+        for site in ["siteA", "siteB"]:
+            os.mkdir(site)
+        for i, size in enumerate([3*1024**2 + 17, 1024**2, 12345]):
+            name = "EVNT.%d.pool.root" % (i)
+            data = os.urandom(size)
+            for site in ["siteA", "siteB"]:
+                f = open(os.path.join(site, name), "wb")
+                f.write(data)
+                f.close()
+            adler = "%08x" % (zlib.adler32(data) & 0xffffffff)
+            self.files[name] = (size, adler)
+            f = open(os.path.join("metalinks", name + ".meta4"), "w")
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<metalink xmlns="%s">\n'
+                    ' <file name="%s">\n  <identity>mc16:%s</identity>\n  <hash type="adler32">%s</hash>\n'
+                    '  <hash type="md5">%s</hash>\n  <size>%d</size>\n'
+                    '  <url location="A" priority="1">%s/siteA/%s</url>\n  <url location="B" priority="2">%s/siteB/%s</url>\n'
+                    ' </file>\n</metalink>\n' % (METALINK_NS, name, name, adler, hashlib.md5(data).hexdigest(), size, base, name, base, name))
+            f.close()
+        self.base = base
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.workdir)
+
+    def metalinks(self):
+        return [urllib2.urlopen("%s/metalinks/%s.meta4" % (self.base, name)).read() for name in sorted(self.files.keys())]
+
+    def testMergeMetalinks(self):
+        merged = mergeMetalinks(self.metalinks())
+        entries = parseMetalink(merged)
+        self.assertEqual(sorted(entries.keys()), sorted(self.files.keys()))
+        for name, (size, adler) in self.files.items():
+            self.assertEqual(entries[name]['size'], size)
+            self.assertEqual(entries[name]['hashes']['adler32'], adler)
+            self.assertEqual(len(entries[name]['urls']), 2)
+
+        single = parseMetalink(mergeMetalinks([merged], names=["EVNT.1.pool.root"]))
+        self.assertEqual(single.keys(), ["EVNT.1.pool.root"])
+
+    def testParseDownloadResults(self):
+        output = """
+[#2089b0 3.0MiB/3.0MiB(100%) CN:2 DL:0B]
+Download Results:
+gid   |stat|avg speed  |path/URI
+======+====+===========+=======================================================
+2089b0|OK  |    43MiB/s|/data/work/EVNT.0.pool.root
+7a2b4c|ERR |       0B/s|/data/work/EVNT.1.pool.root
+c1d2e3|INPR|    12MiB/s|/data/work/EVNT.2.pool.root
+
+Status Legend:
+(OK):download completed.(ERR):error occurred.(INPR):download in-progress.
+"""
+        self.assertEqual(parseDownloadResults(output),
+                         {"EVNT.0.pool.root": "OK", "EVNT.1.pool.root": "ERR", "EVNT.2.pool.root": "INPR"})
+
+    def testVerifyDownload(self):
+        error = PilotErrors()
+        entries = parseMetalink(mergeMetalinks(self.metalinks()))
+        name = "EVNT.2.pool.root"
+        path = os.path.join(self.workdir, name)
+        shutil.copy(os.path.join("siteA", name), path)
+        self.assertEqual(verifyDownload(path, entries[name])[0], 0)
+
+        # md5 only metalink
+        del entries[name]['hashes']['adler32']
+        self.assertEqual(verifyDownload(path, entries[name])[0], 0)
+
+        data = open(path, "rb").read()
+        f = open(path, "wb")
+        f.write(chr(ord(data[0]) ^ 1) + data[1:])
+        f.close()
+        self.assertEqual(verifyDownload(path, parseMetalink(mergeMetalinks(self.metalinks()))[name])[0], error.ERR_GETADMISMATCH)
+        self.assertEqual(verifyDownload(path, entries[name])[0], error.ERR_GETMD5MISMATCH)
+
+        f = open(path, "ab")
+        f.write("x")
+        f.close()
+        self.assertEqual(verifyDownload(path, entries[name])[0], error.ERR_GETWRONGSIZE)
+
+    def testAria2c(self):
+        s, o = commands.getstatusoutput("which aria2c")
+        if s != 0:
+            self.skipTest("aria2c not found, skipping download test")
+
+        metalink = os.path.join(self.workdir, "AllInput.xml.meta4")
+        f = open(metalink, "w")
+        f.write(mergeMetalinks(self.metalinks()))
+        f.close()
+        options = ARIA2C_OPTIONS
+        s, o = commands.getstatusoutput("aria2c -j %d -x %d -s %d --min-split-size=1M --summary-interval=0 --dir=%s %s" %\
+                                        (options['max_concurrent_downloads'], options['max_connection_per_server'], options['split'], self.workdir, metalink))
+        self.assertEqual(s, 0, o)
+        results = parseDownloadResults(o)
+        entries = parseMetalink(open(metalink).read())
+        for name in self.files.keys():
+            self.assertEqual(results.get(name), "OK")
+            self.assertEqual(verifyDownload(os.path.join(self.workdir, name), entries[name]), (0, ""))
+
+
+# DiagnosticsScanner
+
+def oldGrep(patterns, file_name):
+    """ The previous pUtil.grep() """
+    matched_lines = []
+    p = []
+    for pattern in patterns:
+        p.append(re.compile(pattern))
+    f = open(file_name, "r")
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        for cp in p:
+            if re.search(cp, line):
+                matched_lines.append(line)
+    f.close()
+    return matched_lines
+
+
+class DiagnosticsScannerTest(unittest.TestCase):
+    """ The scanner against the previous pUtil.grep() """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "athena_stdout.txt")
+        DiagnosticsScanner.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        DiagnosticsScanner.clear()
+
+    def write(self, text):
+        f = open(self.filename, "w")
+        f.write(text)
+        f.close()
+
+    def testRequiredLiterals(self):
+        self.assertEqual(DiagnosticsScanner.requiredLiterals("St9bad_alloc"), ["St9bad_alloc"])
+        self.assertEqual(sorted(DiagnosticsScanner.requiredLiterals("St9bad_alloc|std::bad_alloc")), ["St9bad_alloc", "std::bad_alloc"])
+        self.assertEqual(DiagnosticsScanner.requiredLiterals(r".* run #\d+ (\d+) events processed so far.*"), [" events processed so far"])
+        self.assertEqual(DiagnosticsScanner.requiredLiterals(r"\d+ ab"), [" ab"])
+        self.assertEqual(DiagnosticsScanner.requiredLiterals(r"\d+ a"), None)
+        self.assertEqual(DiagnosticsScanner.requiredLiterals("(?i)FATAL"), None)
+
+    def testSameAsGrep(self):
+        lines = ["event #%d, run #0 %d events processed so far\n" % (i, i + 1) for i in range(50)]
+        lines[7] = "CaloTrkMuIdAlg2.sysExecute()             ERROR St9bad_alloc std::bad_alloc\n"
+        lines[20] = "^ anchored FATAL\n"
+        lines[33] = "AthAlgSeq.sysExecute()                   FATAL  Standard std::exception is caught\n"
+        self.write("".join(lines) + "no newline at the end FATAL")
+        for patterns in (["St9bad_alloc", "std::bad_alloc"], ["FATAL"], ["^\^ anch", r"\d+ events"],
+                         ["std::bad_alloc|FATAL"], ["(?i)fatal", "bad_alloc$"]):
+            self.assertEqual(DiagnosticsScanner.grep(patterns, self.filename), oldGrep(patterns, self.filename))
+
+    def testBlocksAndOffsets(self):
+        old = DiagnosticsScanner.BLOCK_SIZE
+        DiagnosticsScanner.BLOCK_SIZE = 7
+        try:
+            self.write("a\nJob Report produced by x\nlong line without any newline in the first blocks\nJob Report produced by y\n")
+            result = DiagnosticsScanner.scan(self.filename)
+        finally:
+            DiagnosticsScanner.BLOCK_SIZE = old
+        self.assertEqual(result.count("job_report"), 2)
+        self.assertEqual(result.getLineNumbers("job_report"), [2, 4])
+        self.assertEqual(result.numberOfLines, 4)
+        f = open(self.filename)
+        f.seek(result.getOffsets("job_report")[1])
+        self.assertEqual(f.readline(), "Job Report produced by y\n")
+        f.close()
+
+    def testCache(self):
+        self.write("std::bad_alloc\n")
+        DiagnosticsScanner.registerPattern("bad_alloc", "test_alloc")
+        result = DiagnosticsScanner.scan(self.filename)
+        self.assertTrue(DiagnosticsScanner.scan(self.filename) is result)
+
+        # a new pattern is scanned for without losing the old hits
+        DiagnosticsScanner.registerPattern("std::", "test_std")
+        self.assertTrue(DiagnosticsScanner.scan(self.filename) is result)
+        self.assertEqual(result.count("test_std"), 1)
+
+        # a changed file is rescanned
+        self.write("std::bad_alloc\nstd::bad_alloc again\n")
+        os.utime(self.filename, (0, 0))
+        result = DiagnosticsScanner.scan(self.filename)
+        self.assertEqual(result.count("test_alloc"), 2)
+        DiagnosticsScanner._patterns.pop("test_alloc")
+        DiagnosticsScanner._patterns.pop("test_std")
+
+    def testKeptLines(self):
+        self.write("".join(["line %d match\n" % i for i in range(3*DiagnosticsScanner.KEEP_LINES + 5)]))
+        DiagnosticsScanner.registerPattern("match", "test_match")
+        result = DiagnosticsScanner.scan(self.filename)
+        self.assertTrue(len(result.text["test_match"]) <= 2*DiagnosticsScanner.KEEP_LINES)
+        self.assertEqual(result.getLines("test_match", last=1), ["line %d match\n" % (3*DiagnosticsScanner.KEEP_LINES + 4)])
+        lines = result.getLines("test_match")
+        self.assertEqual(len(lines), 3*DiagnosticsScanner.KEEP_LINES + 5)
+        self.assertEqual(lines[150], "line 150 match\n")
+        DiagnosticsScanner._patterns.pop("test_match")
+
+    def testEmptyMatches(self):
+        old = DiagnosticsScanner.BLOCK_SIZE
+        DiagnosticsScanner.BLOCK_SIZE = 7
+        try:
+            self.write("a\nJob Report produced by x\nlong line without any newline in the first blocks\nb\n")
+            for patterns in (["^"], ["z*"], ["^", "Report"]):
+                self.assertEqual(DiagnosticsScanner.grep(patterns, self.filename), oldGrep(patterns, self.filename))
+                DiagnosticsScanner.clear()
+        finally:
+            DiagnosticsScanner.BLOCK_SIZE = old
+            for pattern in ("^", "z*", "Report"):
+                DiagnosticsScanner._patterns.pop(pattern)
+
+    def testCacheSize(self):
+        for i in range(DiagnosticsScanner.MAX_CACHED_FILES + 5):
+            self.write("line %d\n" % i)
+            os.rename(self.filename, self.filename + str(i))
+            DiagnosticsScanner.scan(self.filename + str(i))
+        self.assertEqual(len(DiagnosticsScanner._cache), DiagnosticsScanner.MAX_CACHED_FILES)
+        self.assertFalse(os.path.abspath(self.filename + "0") in DiagnosticsScanner._cache)
+        self.assertTrue(os.path.abspath(self.filename + str(DiagnosticsScanner.MAX_CACHED_FILES + 4)) in DiagnosticsScanner._cache)
+
+
+@benchmark("scanner")
+def benchmarkDiagnosticsScanner(args):
+    """ Diagnose a synthetic payload stdout of 'size' MB, the previous per-check scans vs one scan:
+        python PilotTests.py benchmark scanner [MB] """
+
+    size = int(args[0]) if len(args) > 0 else 2048
+
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(workdir, "athena_stdout.txt")
+        line = "AthenaEventLoopMgr                                   INFO   ===>>>  done processing event #%d, run #222222 %d events processed so far  <<<===\n"
+        noise = "RecoAlgorithm                             DEBUG Tool output x=%d y=3.14 status=ok track parameters updated\n"
+        f = open(filename, "w")
+        written = 0
+        event = 0
+        chunk = []
+        while written < size*1024*1024:
+            chunk = []
+            for i in range(1000):
+                event += 1
+                chunk.append(line % (event, event) if i % 10 == 0 else noise % event)
+                if event % 1000000 == 0:
+                    chunk.append("PoolSvc ERROR St9bad_alloc in the middle\n")
+            data = "".join(chunk)
+            f.write(data)
+            written += len(data)
+        f.write("==== Job Report produced by x ====\nsummary\n==== Job Report produced by x ====\nsummary\n")
+        f.write("SQLite error: prepare 5 database is locked Error SQLiteStatement sqlite\n")
+        f.close()
+        print "synthetic log: %d MB" % (os.path.getsize(filename) / 1024 / 1024)
+
+        # previous code: every check reads the file again
+        t0 = time.time()
+        old = oldGrep(["St9bad_alloc", "std::bad_alloc"], filename)
+        t1 = time.time()
+        oldEvents = oldGrep(["events processed so far"], filename)[-1]
+        t2 = time.time()
+        oldGrep(["Job Report produced by"], filename)
+        t3 = time.time()
+        commands.getoutput('grep "prepare 5 database is locked" %s | grep "Error SQLiteStatement"' % filename)
+        t4 = time.time()
+        print "previous: bad_alloc %.1f s, events %.1f s, job report %.1f s, sqlite (grep) %.1f s, total %.1f s" % \
+              (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t4 - t0)
+
+        # scanner: one pass, all checks answered from the cache
+        DiagnosticsScanner.registerPattern("St9bad_alloc")
+        DiagnosticsScanner.registerPattern("std::bad_alloc")
+        DiagnosticsScanner.registerPattern("events processed so far")
+        DiagnosticsScanner.registerPattern("prepare 5 database is locked", "sqlite_locked")
+        t0 = time.time()
+        new = DiagnosticsScanner.grep(["St9bad_alloc", "std::bad_alloc"], filename)
+        t1 = time.time()
+        newEvents = DiagnosticsScanner.scan(filename).getLines("events processed so far", last=1)[0]
+        DiagnosticsScanner.scan(filename).getOffsets("job_report")
+        DiagnosticsScanner.scan(filename).getLines("sqlite_locked")
+        t2 = time.time()
+        print "scanner: first check (scan) %.1f s, all other checks %.3f s, total %.1f s" % (t1 - t0, t2 - t1, t2 - t0)
+        assert new == old and newEvents == oldEvents
+    finally:
+        shutil.rmtree(workdir)
+
+
+# movers.replicas
+
+@benchmark("replicas")
+def benchmarkReplicas(args):
+    """ JobMover.resolve_replicas() with a fake Rucio client and a synthetic schedconf:
+        python PilotTests.py benchmark replicas [files] [replicas per file] [queues in schedconf] """
+
+    nfiles = int(args[0]) if len(args) > 0 else 5000
+    nreplicas = int(args[1]) if len(args) > 1 else 10
+    nqueues = int(args[2]) if len(args) > 2 else 100
+
+    calls = []
+
+    class Client(object):
+        """ fake Rucio client: every file has nreplicas replicas at different RSEs, 2 pfns each """
+
+        def list_replicas(self, dids, schemes, **kwargs):
+            calls.append(len(dids))
+            for did in dids:
+                pfns = {}
+                rses = {}
+                for i in range(nreplicas):
+                    rse = 'RSE_%d_DATADISK' % i
+                    for j, scheme in enumerate(['root', 'srm']):
+                        pfn = '%s://se%d.example.org:1094//atlas/%s/%s' % (scheme, i, did['scope'], did['name'])
+                        pfns[pfn] = {'rse': rse, 'priority': 2 * i + j + 1, 'type': 'DISK'}
+                        rses.setdefault(rse, []).append(pfn)
+                yield {'scope': did['scope'], 'name': did['name'], 'bytes': 1000, 'adler32': '0a0b0c0d', 'md5': None,
+                       'pfns': pfns, 'rses': rses}
+
+    rucio = types.ModuleType('rucio')
+    rucio.client = types.ModuleType('rucio.client')
+    rucio.client.Client = Client
+    sys.modules['rucio'] = rucio
+    sys.modules['rucio.client'] = rucio.client
+
+    # keep the log messages per file out of the timings
+    pUtil.tolog = lambda msg: None
+    movers.mover.tolog = lambda msg: None
+
+    class ExperimentStub(object):
+        def useTracingService(self):
+            return False
+
+    class BenchmarkSiteInformation(SiteInformation):
+        def getExperimentObject(self):
+            return ExperimentStub()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['PilotHomeDir'] = workdir
+    try:
+        # synthetic schedconf (the real one lists all queues) with local storages of the benchmark queue
+        schedconf = {}
+        for q in range(nqueues):
+            schedconf['QUEUE_%d' % q] = {'astorages': {'pr': ['RSE_%d_DATADISK' % (q % nreplicas), 'RSE_%d_SCRATCHDISK' % q]},
+                                         'aprotocols': {}, 'copytools': {'rucio': {'setup': ''}},
+                                         'params': dict(('param%d' % i, 'value%d' % i) for i in range(100))}
+        schedconf['QUEUE_0']['astorages']['pr'] = ['RSE_3_DATADISK', 'RSE_7_DATADISK']
+        f = open(os.path.join(workdir, 'agis_schedconf.cvmfs.json'), 'w')
+        json.dump(schedconf, f)
+        f.close()
+
+        ddmconf = {}
+        for i in range(nreplicas):
+            ddm = 'RSE_%d_DATADISK' % i
+            ddmconf[ddm] = {'site': 'SITE_%d' % i, 'state': 'ACTIVE', 'type': 'DISK',
+                            'aprotocols': {'r': [['root://se%d.example.org:1094' % i, 1, '//atlas']]}}
+
+        si = BenchmarkSiteInformation()
+        si.setQueueName('QUEUE_0')
+
+        def resolve_replicas_per_file(mover, files):
+            """ the look-up before StorageIndex and ReplicaCache: the associated storages and the protocols of the
+                local ddms are resolved for every file, and Rucio is queried on every attempt """
+            pandaqueue = mover.si.getQueueName()
+            for fdat in files:
+                fdat.inputddms = mover.si.resolvePandaAssociatedStorages(pandaqueue).get(pandaqueue, {}).get('pr', {})
+            bquery = {'schemes': ['srm', 'root', 'davs', 'gsiftp', 'https'],
+                      'dids': [dict(scope=e.scope, name=e.lfn) for e in files]}
+            files_lfn = dict(((e.scope, e.lfn), e) for e in files)
+            for r in list(Client().list_replicas(**bquery)):
+                fdat = files_lfn.get((r['scope'], r['name']))
+                fdat.replicas = []
+                ordered_replicas = {}
+                for pfn, xdat in sorted(r.get('pfns', {}).iteritems(), key=lambda x: x[1]['priority']):
+                    ordered_replicas.setdefault(xdat.get('rse'), []).append(pfn)
+                for ddm in fdat.inputddms:
+                    pfns = ordered_replicas.get(ddm)
+                    if not pfns:
+                        continue
+                    ddm_se, ddm_path = '', ''
+                    def_protocol = mover.ddmconf[ddm].get('aprotocols', {}).get('r', [])
+                    def_protocol = def_protocol[0] if def_protocol else None
+                    if def_protocol:
+                        ddm_se, ddm_path = def_protocol[0], def_protocol[2]
+                    fdat.replicas.append((ddm, pfns, ddm_se, ddm_path))
+            return files
+
+        class OutdatedClient(Client):
+            """ Rucio client without geoip sorting """
+
+            def list_replicas(self, dids, schemes):
+                return Client.list_replicas(self, dids, schemes)
+
+        runs = [('before', 'per file look-up', False, resolve_replicas_per_file),
+                ('after', 'storage index + cache', False, JobMover.resolve_replicas),
+                ('after', 'remote inputs, outdated Rucio', True, JobMover.resolve_replicas)]
+        for label, name, allowRemoteInputs, resolve in runs:
+            if allowRemoteInputs:
+                rucio.client.Client = OutdatedClient
+            replica_cache.clear()
+            del calls[:]
+            for attempt in range(1, 3):
+                files = [FileSpec(lfn='file_%d.root' % n, scope='mc16', ddmendpoint='RSE_0_DATADISK',
+                                  filesize=1000, checksum='ad:0a0b0c0d', allowRemoteInputs=allowRemoteInputs) for n in range(nfiles)]
+                mover = JobMover(None, si, useTracingService=False)
+                mover.ddmconf.update(ddmconf)
+                mover.detect_client_location = lambda: {'ip': '127.0.0.1', 'fqdn': 'localhost', 'site': 'SITE_0'}
+                t0 = time.time()
+                resolve(mover, files)
+                t = time.time() - t0
+                print "%-6s %-30s attempt %d: resolved %d files x %d replicas in %.2f s (%d Rucio queries so far), first file: %s" % \
+                      (label, name, attempt, nfiles, nreplicas, t, len(calls), [e[0] for e in files[0].replicas][:3])
+    finally:
+        shutil.rmtree(workdir)
+
+
+# ImportProfiler
+
+class ImportTimeTest(unittest.TestCase):
+    """ Import time regression test of RunJobNormal, and the profiler itself """
+
+    # modules which must not be loaded by a normal job
+    HEAVY_MODULES = ["saga", "radical", "boto", "rucio", "yampl", "RunJobHPC", "RunJobEvent", "RunJobFactory",
+                     "CMSExperiment", "AMSTaiwanExperiment", "xrootdSiteMover", "GFAL2SiteMover", "S3ObjectstoreSiteMover"]
+
+    # upper bound of the import time of RunJobNormal (a cold start on a slow file system takes longer)
+    MAX_IMPORT_TIME = 2.0
+
+    def testRunJobNormal(self):
+        # in the log directory: the pilot modules write files to the current directory when imported
+        t, heavy = ImportProfiler.timeImport("RunJobNormal", heavy=self.HEAVY_MODULES, cwd=LOGDIR)
+        self.assertEqual(heavy, [])
+        self.assertTrue(t < self.MAX_IMPORT_TIME, "importing RunJobNormal took %.2f s" % t)
+
+    def testProfiler(self):
+        self.assertFalse(ImportProfiler.isRequested(["pilot.py"]))
+        argv = ["pilot.py", ImportProfiler.OPTION, "-s", "SITE"]
+        self.assertTrue(ImportProfiler.enable(argv, report=False))
+        try:
+            self.assertEqual(argv, ["pilot.py", "-s", "SITE"])
+            module = __import__("wave")
+        finally:
+            ImportProfiler.disable()
+            del os.environ[ImportProfiler.ENV_VARIABLE]
+        names = [name for name, cumulative, own in ImportProfiler.getStatistics()]
+        self.assertTrue(module.__name__ in names, names)
+        self.assertTrue("Import profile" in ImportProfiler.getReport())
+
+
+# DroidReactor
+
+class DroidReactorTest(unittest.TestCase):
+    """ Wakeups, descriptors and timers of the Droid main loop """
+
+    def setUp(self):
+        self.reactor = DroidReactor(maxWaitTime=1)
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def testWakeup(self):
+        queue = NotifyingQueue(self.reactor.wakeup)
+        threading.Timer(0.1, queue.put, ['output']).start()
+        t0 = time.time()
+        self.reactor.wait()
+        self.assertTrue(time.time() - t0 < 0.5)
+        self.assertEqual(queue.get(False), 'output')
+        # the wakeups were consumed: the next wait times out
+        for i in range(10000):
+            self.reactor.wakeup()
+        self.reactor.wait()
+        t0 = time.time()
+        self.reactor.wait(timeout=0.2)
+        self.assertTrue(time.time() - t0 >= 0.15)
+
+    def testReadable(self):
+        r, w = os.pipe()
+        try:
+            self.assertEqual(self.reactor.wait([r, None], timeout=0), [])
+            os.write(w, 'x')
+            self.assertEqual(self.reactor.wait([r]), [r])
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def testTimers(self):
+        calls = []
+        self.reactor.addTimer('heartbeat', 0.2, lambda: calls.append(time.time()))
+        self.reactor.runTimers()
+        self.assertEqual(len(calls), 1)
+        t0 = time.time()
+        self.reactor.wait()
+        self.assertTrue(0.15 <= time.time() - t0 < 0.5)
+        self.reactor.runTimers()
+        self.assertEqual(len(calls), 2)
+        self.reactor.removeTimer('heartbeat')
+        self.assertEqual(self.reactor.getTimeout(), 1)
+
+
+FAKE_ATHENAMP = r'''
+import os, sys, json, time, select, socket
+channel, eventTime, cpuFile = sys.argv[1], float(sys.argv[2]), sys.argv[3]
+workers = int(os.environ.get('ATHENA_PROC_NUMBER', 1))
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+sock.bind('\0yampl_%s_client' % channel)
+server = '\0yampl_%s' % channel
+for i in range(workers):
+    sock.sendto('Ready for events', server)
+running, noMoreEvents = [], False
+while running or not noMoreEvents:
+    timeout = max(min(running)[0] - time.time(), 0) if running else None
+    if select.select([sock], [], [], timeout)[0]:
+        message = sock.recv(65536)
+        if 'No more events' in message:
+            noMoreEvents = True
+        else:
+            for eventRange in json.loads(message):
+                running.append((time.time() + eventTime, eventRange['eventRangeID']))
+    for deadline, eventRangeID in sorted(running):
+        if deadline <= time.time():
+            running.remove((deadline, eventRangeID))
+            sock.sendto('/tmp/fake/%s.pool.root,ID:%s,CPU:1,WALL:1' % (eventRangeID, eventRangeID), server)
+            if not noMoreEvents:
+                sock.sendto('Ready for events', server)
+t = os.times()
+open(cpuFile, 'w').write('%f' % (t[0] + t[1]))
+'''
+
+
+class FakeYamplServerSocket(object):
+    """ yampl.ServerSocket on a datagram socket, for the fake AthenaMP """
+
+    def __init__(self, name, context):
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__socket.bind('\0yampl_%s' % name)
+        self.__socket.setblocking(0)
+        self.__peer = None
+
+    def try_recv_raw(self):
+        try:
+            buf, self.__peer = self.__socket.recvfrom(65536)
+        except IOError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return -1, None
+        return len(buf), buf
+
+    def send_raw(self, message):
+        self.__socket.sendto(message, self.__peer)
+
+
+class FakeDroidYoda(threading.Thread):
+    """ Answers the requests of a Droid in non-MPI mode: one job with nEvents event ranges """
+
+    def __init__(self, job, nEvents):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.job = job
+        self.nEvents = nEvents
+        self.updates = 0
+
+    def run(self):
+        sentJob, nextEvent = False, 0
+        while True:
+            request = json.loads(Interaction.recvQueue.get())
+            method, params = request['method'], request['params']
+            answer = {'StatusCode': 0}
+            if method == 'getJob':
+                answer['job'] = None if sentJob else self.job
+                sentJob = True
+            elif method == 'getEventRanges':
+                n = min(params['nRanges'], self.nEvents - nextEvent)
+                answer['eventRanges'] = [{'eventRangeID': '1-%d' % i, 'LFN': 'EVNT.pool.root', 'GUID': 'GUID',
+                                          'startEvent': i, 'lastEvent': i} for i in range(nextEvent, nextEvent + n)]
+                nextEvent += n
+            elif method == 'updateEventRanges':
+                self.updates += len(decodeUpdates(params))
+            Interaction.sendQueue.put(json.dumps(answer))
+            if method == 'finishDroid':
+                break
+
+
+@benchmark("droid")
+def benchmarkDroid(args):
+    """ CPU overhead of a Droid running a job with a fake AthenaMP process (and a fake yampl and Yoda), i.e. the CPU time
+        not used by the payload: python PilotTests.py benchmark droid [events] [workers] [seconds per event] """
+
+    nEvents = int(args[0]) if len(args) > 0 else 2000
+    workers = int(args[1]) if len(args) > 1 else 64
+    eventTime = float(args[2]) if len(args) > 2 else 1.0
+
+    # Droid imports yampl with the EventServerJobManager
+    yampl = types.ModuleType('yampl')
+    yampl.ServerSocket = FakeYamplServerSocket
+    sys.modules['yampl'] = yampl
+    logging.disable(logging.CRITICAL)
+    from pandayoda.yodaexe.Droid import Droid
+
+    workdir = tempfile.mkdtemp()
+    try:
+        script = os.path.join(workdir, 'fake_athenamp.py')
+        open(script, 'w').write(FAKE_ATHENAMP)
+        cpuFile = os.path.join(workdir, 'athenamp_cpu')
+        job = {'JobId': 1, 'ATHENA_PROC_NUMBER': workers, 'TokenExtractCmd': None,
+               'AthenaMPCmd': '%s %s PILOT_EVENTRANGECHANNEL_CHANGE_ME %s %s' % (sys.executable, script, eventTime, cpuFile)}
+        yoda = FakeDroidYoda(job, nEvents)
+        yoda.start()
+        droid = Droid(workdir, workdir, rank=0, nonMPIMode=True)
+        t0, c0 = time.time(), os.times()
+        droid.run()
+        t1, c1 = time.time(), os.times()
+        yoda.join(10)
+        athenaCPU = float(open(cpuFile).read())
+        droidCPU = c1[0] + c1[1] - c0[0] - c0[1]
+        managerCPU = c1[2] + c1[3] - c0[2] - c0[3] - athenaCPU
+        print "%d events, %d workers, %.3f s per event: wall %.1f s, %d outputs updated" % \
+              (nEvents, workers, eventTime, t1 - t0, yoda.updates)
+        print "CPU overhead: Droid process %.2f s, ESJobManager child process %.2f s (fake AthenaMP %.2f s)" % \
+              (droidCPU, managerCPU, athenaCPU)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir)
+
+
+# EventScheduler
+
+class EventSchedulerTest(unittest.TestCase):
+    """ Chunk sizes, ranks and job stealing of the event range scheduler """
+
+    def setUp(self):
+        self.now = 0
+        self.scheduler = EventScheduler(walltime=3600, clock=lambda: self.now)
+        self.scheduler.addEventRanges('1', range(1000))
+        self.scheduler.addEventRanges('2', range(100))
+
+    def testChunks(self):
+        scheduler = self.scheduler
+        scheduler.addRank('1', 1)
+        scheduler.addRank('1', 2)
+        # unknown rate: as many ranges as asked for, in order
+        self.assertEqual(scheduler.getEventRanges('1', 1, 4), [0, 1, 2, 3])
+        # 0.1 event/s: 60 ranges for the request interval
+        scheduler.updateRate('1', 1, 6, 60)
+        self.assertEqual(len(scheduler.getEventRanges('1', 1, 4)), 60)
+        # tail of the job: at most half of the fair share of the rest
+        scheduler.updateRate('1', 1, 100, 60)
+        self.assertEqual(len(scheduler.getEventRanges('1', 1, 4)), 936 / 4)
+        # tail of the allocation: what the rank can process until the end
+        self.now = 3500
+        scheduler.updateRate('1', 1, 6, 60)
+        self.assertEqual(len(scheduler.getEventRanges('1', 1, 4)), 10)
+        self.assertEqual(scheduler.getNumberOfReadyEventRanges(), 692 + 100)
+        # the rate of another job is not used
+        scheduler.updateRate('2', 1, 600, 60)
+        self.assertEqual(len(scheduler.getEventRanges('1', 1, 4)), 10)
+
+    def testRanks(self):
+        scheduler = self.scheduler
+        scheduler.addRank('1', 1)
+        scheduler.updateRate('1', 1, 6, 60)
+        scheduler.addRank('2', 1)
+        self.assertEqual(scheduler.jobsRanks['1'], set())
+        self.assertEqual(scheduler.rankRates, {})
+        scheduler.removeRank('1', 1)
+        self.assertEqual(scheduler.rankJobs, {1: '2'})
+        scheduler.removeRank('2', 1)
+        scheduler.removeRank(None, 3)
+        self.assertEqual(scheduler.rankJobs, {})
+
+    def testStealJob(self):
+        scheduler = self.scheduler
+        for rank in range(20):
+            scheduler.addRank('1', rank)
+        self.assertEqual(scheduler.stealJob(30), '2')
+        self.assertEqual(scheduler.stealJob(30, exclude=['2']), '1')
+        self.assertEqual(scheduler.stealJob(30, minRanges=500), '1')
+        self.assertEqual(scheduler.stealJob(30, minRanges=5000), None)
+
+
+# simulated allocations
+MPI_OVERHEAD = 0.001   # seconds of rank 0 per request besides the handler
+MPI_LATENCY = 0.0005   # seconds, one way
+SETUP_TIME = 300       # seconds, AthenaMP initialisation
+EVENT_TIME = 120       # seconds per event and worker, on average
+STAGER_CYCLE = 1       # seconds, DroidStager polls the outputs of AthenaMP every second
+PANDA_INTERVAL = 30    # seconds between the bulk PanDA updates of Yoda
+HEARTBEAT_TIME = 60
+EVENTS_PER_WORKER = 3
+N_JOBS = 20
+
+
+class DroidState(object):
+    """ A simulated Droid: workers, event ranges in its buffer and the pending request to rank 0 """
+
+    def __init__(self, rank, workers, speed):
+        self.rank = rank
+        self.workers = workers
+        self.speed = speed
+        self.jobId = None
+        self.lastDone = 0
+        self.finished = False
+
+    def startJob(self, jobId, now):
+        self.jobId = jobId
+        self.readyTime = now + SETUP_TIME
+        self.idle = self.workers
+        self.buffer = []
+        self.done = 0
+        self.inserted = 0
+        self.noMoreEvents = False
+        self.pending = False
+
+    def neededEvents(self):
+        if self.noMoreEvents:
+            return 0
+        return self.done + self.workers - self.inserted
+
+
+def simulateScheduling(nRanges, nRanks, workers, walltime=None, seed=1):
+    rng = random.Random(seed)
+
+    # jobs of different sizes and event times; the needed ranks are estimated from a wrong event time (+-30%)
+    eventTimes, sizes, weights = {}, {}, {}
+    for j in range(N_JOBS):
+        jobId = str(1000 + j)
+        eventTimes[jobId] = rng.uniform(60, 180)
+        weights[jobId] = rng.uniform(0.2, 1.8)
+    total = sum(weights.values())
+    for jobId in weights:
+        sizes[jobId] = int(nRanges * weights[jobId] / total)
+    sizes[jobId] += nRanges - sum(sizes.values())
+    estimated = dict((jobId, sizes[jobId] * eventTimes[jobId] * rng.uniform(0.7, 1.3)) for jobId in sizes)
+    total = sum(estimated.values())
+    jobs, jobsEventRanges = {}, {}
+    for jobId in sizes:
+        jobs[jobId] = {'JobId': jobId, 'ATHENA_PROC_NUMBER': workers, 'neededRanks': max(1, int(round(nRanks * estimated[jobId] / total)))}
+        lfn, guid = 'EVNT.%s._000001.pool.root.1' % jobId, 'GUID-%s' % jobId
+        jobsEventRanges[jobId] = [{'eventRangeID': '%s-%d' % (jobId, i), 'LFN': lfn, 'GUID': guid, 'startEvent': i, 'lastEvent': i, 'scope': 'mc16'} for i in xrange(sizes[jobId])]
+
+    clock = [0.0]
+    workdir = tempfile.mkdtemp()
+    # the shards are read during the simulation
+    try:
+        json.dump(jobs, open(os.path.join(workdir, 'HPCJobs.json'), 'w'))
+        writeEventRanges(workdir, jobsEventRanges)
+        del jobsEventRanges
+        os.chdir(workdir)
+        yoda = Yoda(workdir, workdir, rank=0, nonMPIMode=True)
+        yoda.comm = FakeCommunicator(nRanks + 1)
+        yoda.lastRankForBigJobFirst = int(yoda.getTotalRanks() * 0.9)
+        if hasattr(yoda, 'scheduler'):
+            yoda.scheduler = yoda.scheduler.__class__(walltime=walltime, startTime=0, clock=lambda: clock[0])
+            yoda.readyJobsEventRanges = yoda.scheduler.readyJobsEventRanges
+        yoda.loadJobs()
+        yoda.initJobRanks()
+        yoda.makeJobsEventTable()
+
+        droids = dict((rank, DroidState(rank, workers, rng.uniform(0.8, 1.2))) for rank in range(1, nRanks + 1))
+        queue, seq = [], [0]
+        stats = {'requests': {}, 'rank0Busy': 0.0, 'stranded': 0, 'inFlight': 0, 'processed': 0}
+        server = [0.0]
+
+        def schedule(t, kind, rank, data=None):
+            seq[0] += 1
+            heapq.heappush(queue, (t, seq[0], kind, rank, data))
+
+        def request(t, droid, method, params):
+            schedule(t + MPI_LATENCY, 'request', droid.rank, (method, params))
+
+        def startWorkers(t, droid):
+            if t < droid.readyTime:
+                return
+            meanTime = eventTimes[droid.jobId] * droid.speed
+            while droid.idle and droid.buffer:
+                eventRangeID = droid.buffer.pop()
+                droid.idle -= 1
+                schedule(t + meanTime * rng.uniform(0.5, 1.5), 'done', droid.rank, (droid.jobId, eventRangeID))
+
+        def step(t, droid):
+            startWorkers(t, droid)
+            if not droid.pending and droid.neededEvents() > 0:
+                droid.pending = True
+                request(t, droid, 'getEventRanges', {'jobId': droid.jobId, 'rank': droid.rank, 'nRanges': droid.neededEvents()})
+            elif droid.noMoreEvents and not droid.pending and droid.idle == droid.workers and not droid.buffer:
+                droid.pending = True
+                request(t, droid, 'finishJob', {'jobId': droid.jobId, 'rank': droid.rank, 'state': 'finished'})
+
+        for rank in droids:
+            schedule(0, 'start', rank)
+        while queue:
+            t, s, kind, rank, data = heapq.heappop(queue)
+            if walltime and t > walltime:
+                break
+            droid = droids[rank]
+            if kind == 'start':
+                request(t, droid, 'getJob', {'rank': rank})
+            elif kind == 'request':
+                # rank 0 serves the requests one after the other
+                method, params = data
+                start = max(t, server[0])
+                clock[0] = start
+                yoda.comm.requesterRank = rank
+                t0 = time.time()
+                getattr(yoda, method)(params)
+                service = time.time() - t0 + MPI_OVERHEAD
+                server[0] = start + service
+                stats['rank0Busy'] += service
+                stats['requests'][method] = stats['requests'].get(method, 0) + 1
+                if method != 'updateEventRanges' and method != 'heartbeat':
+                    schedule(server[0] + MPI_LATENCY, 'response', rank, (method, yoda.comm.response))
+            elif kind == 'response':
+                method, response = data
+                droid.pending = False
+                if method == 'getJob':
+                    if response['job'] is None:
+                        droid.finished = True
+                        continue
+                    droid.startJob(response['job']['JobId'], t)
+                    schedule(droid.readyTime, 'ready', rank)
+                    schedule(t + HEARTBEAT_TIME, 'heartbeat', rank, droid.jobId)
+                elif method == 'getEventRanges':
+                    eventRanges = response['eventRanges']
+                    if not eventRanges:
+                        droid.noMoreEvents = True
+                    droid.inserted += len(eventRanges)
+                    droid.buffer.extend([eventRange['eventRangeID'] for eventRange in eventRanges])
+                elif method == 'finishJob':
+                    droid.pending = True
+                    request(t, droid, 'getJob', {'rank': rank})
+                    continue
+                step(t, droid)
+            elif kind == 'ready':
+                step(t, droid)
+            elif kind == 'done':
+                jobId, eventRangeID = data
+                droid.done += 1
+                droid.idle += 1
+                droid.lastDone = t
+                stats['processed'] += 1
+                request(t, droid, 'updateEventRanges', [{'jobId': jobId, 'eventRangeID': eventRangeID, 'eventStatus': 'finished', 'output': 'out'}])
+                step(t, droid)
+            elif kind == 'heartbeat':
+                if data != droid.jobId or droid.finished:
+                    continue
+                runningTime = max(t - droid.readyTime, 0)
+                request(t, droid, 'heartbeat', {'jobId': droid.jobId, 'rank': rank, 'processedEvents': droid.done,
+                                                'runningTime': runningTime, 'setupTime': SETUP_TIME, 'totalTime': runningTime + SETUP_TIME,
+                                                'cores': workers, 'queuedEvents': droid.inserted, 'cpuConsumptionTime': 0, 'avgTimePerEvent': 0})
+                schedule(t + HEARTBEAT_TIME, 'heartbeat', rank, data)
+
+        if walltime:
+            stats['stranded'] = sum([len(droid.buffer) for droid in droids.values() if droid.jobId])
+            stats['inFlight'] = sum([droid.workers - droid.idle for droid in droids.values() if droid.jobId and not droid.finished])
+            stats['makespan'] = walltime
+        else:
+            stats['makespan'] = max([droid.lastDone for droid in droids.values()])
+        end = stats['makespan']
+        stats['tailIdle'] = sum([workers * (end - droid.lastDone) for droid in droids.values() if droid.lastDone]) / 3600.
+        stats['neverUsed'] = len([droid for droid in droids.values() if not droid.lastDone])
+        stats['coreHours'] = nRanks * workers * end / 3600.
+        stats['ready'] = sum([len(eventRanges) for eventRanges in yoda.readyJobsEventRanges.values()])
+        return stats
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir)
+
+
+@benchmark("scheduler")
+def benchmarkScheduler(args):
+    """ Discrete event simulation of Yoda serving the Droids of an allocation. The Yoda request handlers run for real,
+        behind a fake communicator; rank 0 serves one request at a time (measured handler time plus MPI overhead).
+        Reports the makespan, the idle time of the workers at the tail and the requests seen by rank 0, or with a
+        walltime, how many ranges were left unprocessed in the Droid buffers when the allocation ended:
+        python PilotTests.py benchmark scheduler [ranges] [ranks] [workers per rank] [walltime in s] """
+
+    nRanges = int(args[0]) if len(args) > 0 else 1000000
+    nRanks = int(args[1]) if len(args) > 1 else 5000
+    workers = int(args[2]) if len(args) > 2 else 16
+    walltime = float(args[3]) if len(args) > 3 else None
+
+    logging.disable(logging.CRITICAL)
+    t0 = time.time()
+    stats = simulateScheduling(nRanges, nRanks, workers, walltime)
+    print "%d ranges, %d ranks x %d workers, %d jobs%s (simulated in %.0f s)" % \
+          (nRanges, nRanks, workers, N_JOBS, ", walltime %d s" % walltime if walltime else "", time.time() - t0)
+    print "makespan %.0f s, processed %d, tail idle %.0f core-hours (%.1f%% of %.0f), ranks never used %d" % \
+          (stats['makespan'], stats['processed'], stats['tailIdle'], 100. * stats['tailIdle'] / stats['coreHours'], stats['coreHours'], stats['neverUsed'])
+    print "rank 0: requests %s, busy %.0f s (%.1f%%)" % \
+          (sorted(stats['requests'].items()), stats['rank0Busy'], 100. * stats['rank0Busy'] / stats['makespan'])
+    if walltime:
+        print "at the end of the walltime: %d ranges waiting in Droid buffers, %d being processed, %d ready in Yoda" % \
+              (stats['stranded'], stats['inFlight'], stats['ready'])
+
+
+# MetricsAggregator
+
+def collectMetrics(ranks):
+    """ the full recomputation, as Yoda.collectMetrics did it """
+    sums = dict((key, 0) for key in SUM_KEYS)
+    for rank in ranks:
+        for key in SUM_KEYS:
+            sums[key] += ranks[rank][key]
+    setupTime = [ranks[rank]['setupTime'] for rank in ranks]
+    runningTime = [ranks[rank]['runningTime'] for rank in ranks]
+    totalTime = [ranks[rank]['totalTime'] for rank in ranks]
+    stageoutTime = [ranks[rank]['totalTime'] - ranks[rank]['setupTime'] - ranks[rank]['runningTime'] for rank in ranks]
+    num_ranks = max(len(ranks), 1)
+    report = {'avgYodaSetupTime': sums['setupTime'] / num_ranks,
+              'avgYodaRunningTime': sums['runningTime'] / num_ranks,
+              'avgYodaStageoutTime': (sums['totalTime'] - sums['setupTime'] - sums['runningTime']) / num_ranks,
+              'avgYodaTotalTime': sums['totalTime'] / num_ranks,
+              'maxYodaSetupTime': max(setupTime), 'maxYodaRunningTime': max(runningTime),
+              'maxYodaStageoutTime': max(stageoutTime), 'maxYodaTotalTime': max(totalTime),
+              'minYodaSetupTime': min(setupTime), 'minYodaRunningTime': min(runningTime),
+              'minYodaStageoutTime': min(stageoutTime), 'minYodaTotalTime': min(totalTime),
+              'cores': sums['cores'], 'cpuConsumptionTime': sums['cpuConsumptionTime'],
+              'totalQueuedEvents': sums['queuedEvents'], 'totalProcessedEvents': sums['processedEvents'],
+              'avgTimePerEvent': sums['avgTimePerEvent'] / num_ranks}
+    for key in report:
+        report[key] = int(report[key])
+    return report
+
+
+def heartbeats(nRanks, nBeats, seed=1):
+    """ heartbeats of nRanks ranks running 2 jobs, every rank sends nBeats of them """
+    rng = random.Random(seed)
+    for beat in range(nBeats):
+        for rank in range(1, nRanks + 1):
+            setupTime = rng.randint(100, 400)
+            runningTime = beat * 60 + rng.randint(0, 60)
+            yield str(rank % 2), rank, {'jobId': str(rank % 2), 'rank': rank, 'setupTime': setupTime,
+                                        'runningTime': runningTime, 'totalTime': setupTime + runningTime + rng.randint(0, 30),
+                                        'cores': 16, 'queuedEvents': rng.randint(0, 1000), 'processedEvents': rng.randint(0, 1000),
+                                        'cpuConsumptionTime': rng.randint(0, 10000), 'avgTimePerEvent': rng.randint(50, 200)}
+
+
+class MetricsAggregatorTest(unittest.TestCase):
+    """ The incremental metrics against the full recomputation """
+
+    def testReport(self):
+        aggregator = MetricsAggregator()
+        ranks = {}
+        for i, (jobId, rank, params) in enumerate(heartbeats(50, 20)):
+            aggregator.update(jobId, rank, params)
+            ranks.setdefault(jobId, {})[rank] = params
+            if i % 7 == 0:
+                self.assertEqual(aggregator.getReport(jobId), collectMetrics(ranks[jobId]))
+        snapshot = aggregator.getSnapshot()
+        self.assertEqual(sorted(snapshot.keys()), ['0', '1'])
+        for jobId in snapshot:
+            self.assertEqual(snapshot[jobId]['ranks'], ranks[jobId])
+            self.assertEqual(snapshot[jobId]['collect'], collectMetrics(ranks[jobId]))
+
+    def testExtrema(self):
+        extrema = RankExtrema()
+        self.assertEqual((extrema.getMin(), extrema.getMax()), (0, 0))
+        for i in range(1000):
+            extrema.update(i % 3, i)
+        self.assertEqual((extrema.getMin(), extrema.getMax()), (997, 999))
+        extrema.update(2, -1)
+        self.assertEqual((extrema.getMin(), extrema.getMax()), (-1, 999))
+        self.assertTrue(len(extrema.minHeap) <= 2 * 3 + 64 + 1)
+
+    def testTimeSeries(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            fileName = os.path.join(workdir, 'metrics.csv')
+            aggregator = MetricsAggregator(timeSeriesFile=fileName, clock=lambda: 10)
+            for jobId, rank, params in heartbeats(3, 2):
+                aggregator.update(jobId, rank, params)
+            aggregator.close()
+            lines = open(fileName).read().splitlines()
+            self.assertEqual(lines[0], ",".join(TIME_SERIES_KEYS))
+            self.assertEqual(len(lines), 7)
+            self.assertEqual(lines[-1], ",".join([str(value) for value in [10, jobId, rank] + [params[key] for key in SUM_KEYS]]))
+        finally:
+            shutil.rmtree(workdir)
+
+
+@benchmark("metrics")
+def benchmarkMetrics(args):
+    """ CPU time of the heartbeats on rank 0, recomputing the metrics of all ranks (as Yoda did) vs incremental updates:
+        python PilotTests.py benchmark metrics [ranks] [heartbeats per rank] """
+
+    nRanks = int(args[0]) if len(args) > 0 else 10000
+    nBeats = int(args[1]) if len(args) > 1 else 3
+    beats = list(heartbeats(nRanks, nBeats))
+    ranks = {}
+    t0 = time.time()
+    for jobId, rank, params in beats:
+        ranks.setdefault(jobId, {})[rank] = params
+        collectMetrics(ranks[jobId])
+    full = time.time() - t0
+    aggregator = MetricsAggregator()
+    t0 = time.time()
+    for jobId, rank, params in beats:
+        aggregator.update(jobId, rank, params)
+        aggregator.getReport(jobId)
+    incremental = time.time() - t0
+    print "%d ranks, %d heartbeats: full recomputation %.2f s (%.3f ms per heartbeat), incremental %.2f s (%.3f ms per heartbeat)" % \
+          (nRanks, len(beats), full, 1000 * full / len(beats), incremental, 1000 * incremental / len(beats))
+
+
+# EventRangeStore
+
+def syntheticEventRanges(jobId, nRanges):
+    for i in xrange(nRanges):
+        yield {'eventRangeID': '%s-%d-%d' % (jobId, i / 1000, i), 'LFN': 'EVNT.%s._%06d.pool.root.1' % (jobId, i / 1000),
+               'GUID': '%08X-0000-0000-0000-%012X' % (int(jobId), i / 1000), 'startEvent': i % 1000 + 1, 'lastEvent': i % 1000 + 1,
+               'scope': 'mc16_13TeV'}
+
+
+class EventRangeStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def testRoundTrip(self):
+        eventRanges = list(syntheticEventRanges('1', 25))
+        eventRanges[12]['PFN'] = '/data/EVNT.pool.root'
+        del eventRanges[13]['scope']
+        indexFile = writeEventRanges(self.workdir, {'1': eventRanges, '2': []}, shardSize=10)
+        jobsEventRanges = loadEventRanges(indexFile)
+        queue = jobsEventRanges['1']
+        self.assertEqual(len(queue), 25)
+        self.assertEqual(len(jobsEventRanges['2']), 0)
+        self.assertFalse(jobsEventRanges['2'])
+        self.assertEqual(collections.deque.__len__(queue), 0)
+        self.assertEqual(queue.popEventRanges(3), eventRanges[:3])
+        self.assertEqual(len(queue), 22)
+        self.assertEqual(len(queue.shards), 2)
+        # more than a shard at once
+        self.assertEqual(queue.popEventRanges(15), eventRanges[3:18])
+        # ranges added as dicts come after the ranges read already, before the next shards
+        queue.extend([{'eventRangeID': 'extra'}])
+        self.assertEqual(len(queue), 8)
+        self.assertEqual(queue.popEventRanges(100), eventRanges[18:20] + [{'eventRangeID': 'extra'}] + eventRanges[20:])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.popEventRanges(1), [])
+
+    def testSkip(self):
+        eventRanges = list(syntheticEventRanges('1', 45))
+        indexFile = writeEventRanges(self.workdir, {'1': eventRanges}, shardSize=10)
+        queue = loadEventRanges(indexFile)['1']
+        self.assertEqual(queue.skip(33, keep=[2, 25]), [eventRanges[2], eventRanges[25]])
+        self.assertEqual(len(queue), 12)
+        # the second shard was dropped unread
+        self.assertEqual(queue.popEventRanges(5), eventRanges[33:38])
+        self.assertEqual(queue.skip(100, keep=[1]), [eventRanges[39]])
+        self.assertEqual(len(queue), 0)
+        queue = EventRangeQueue(eventRanges)
+        self.assertEqual(queue.skip(3, keep=[0]), [eventRanges[0]])
+        self.assertEqual(len(queue), 42)
+
+    def testScheduler(self):
+        scheduler = EventScheduler()
+        indexFile = writeEventRanges(self.workdir, {'1': syntheticEventRanges('1', 30)}, shardSize=10)
+        for jobId, queue in loadEventRanges(indexFile).items():
+            scheduler.addEventRanges(jobId, queue)
+        scheduler.addEventRanges('1', [{'eventRangeID': 'extra'}])
+        self.assertEqual(scheduler.getNumberOfReadyEventRanges('1'), 31)
+        self.assertEqual([eventRange['eventRangeID'] for eventRange in scheduler.getEventRanges('1', 1, 2)], ['extra', '1-0-0'])
+        self.assertEqual(scheduler.stealJob(2), '1')
+
+
+# what Yoda does at startup: read the ranges and hand out the first ranges of every job
+# (run in a new process, so that the memory of the tests and of the writing is not counted)
+LOAD_EVENTRANGES = r'''
+import os, sys, json, time, resource
+sys.path.insert(0, sys.argv[1])
+from pandayoda.yodacore.EventRangeStore import INDEX_FILE, EventRangeQueue, loadEventRanges
+workdir, mode = sys.argv[2], sys.argv[3]
+t0 = time.time()
+if mode == 'sharded':
+    jobsEventRanges = loadEventRanges(os.path.join(workdir, INDEX_FILE))
+else:
+    tmpFile = open(os.path.join(workdir, 'JobsEventRanges.json'))
+    jobsEventRanges = dict((jobId, EventRangeQueue(eventRanges)) for jobId, eventRanges in json.load(tmpFile).iteritems())
+    tmpFile.close()
+for jobId in jobsEventRanges:
+    jobsEventRanges[jobId].popEventRanges(16)
+startup = time.time() - t0
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+t0 = time.time()
+n = 0
+for jobId in jobsEventRanges:
+    n += len(jobsEventRanges[jobId].popEventRanges(100000))
+print json.dumps({'startup': startup, 'rss': rss, 'popTime': (time.time() - t0) / n})
+'''
+
+
+@benchmark("rangestore")
+def benchmarkRangeStore(args):
+    """ Yoda startup time and memory with the ranges in JobsEventRanges.json vs sharded (each measured in a new process):
+        python PilotTests.py benchmark rangestore [ranges] [jobs] """
+
+    nRanges = int(args[0]) if len(args) > 0 else 5000000
+    nJobs = int(args[1]) if len(args) > 1 else 20
+    workdir = tempfile.mkdtemp()
+    try:
+        jobIds = [str(1000 + j) for j in range(nJobs)]
+        t0 = time.time()
+        writeEventRanges(workdir, dict((jobId, syntheticEventRanges(jobId, nRanges / nJobs)) for jobId in jobIds))
+        writeTime = time.time() - t0
+        # JobsEventRanges.json, written without building the whole document in memory
+        t0 = time.time()
+        outputFile = open(os.path.join(workdir, 'JobsEventRanges.json'), 'w')
+        outputFile.write('{')
+        for j, jobId in enumerate(jobIds):
+            outputFile.write('%s"%s": [' % (', ' if j else '', jobId))
+            outputFile.write(', '.join([json.dumps(eventRange) for eventRange in syntheticEventRanges(jobId, nRanges / nJobs)]))
+            outputFile.write(']')
+        outputFile.write('}')
+        outputFile.close()
+        jsonWriteTime = time.time() - t0
+        print "%d ranges in %d jobs: written in %.1f s sharded, %.1f s as JobsEventRanges.json" % (nRanges, nJobs, writeTime, jsonWriteTime)
+        hpcDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "HPC")
+        for mode in ['json', 'sharded']:
+            process = subprocess.Popen([sys.executable, '-c', LOAD_EVENTRANGES, hpcDir, workdir, mode], stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            if process.returncode:
+                print "%-8s failed with exit code %s" % (mode, process.returncode)
+                continue
+            result = json.loads(output.strip().splitlines()[-1])
+            print "%-8s startup %.2f s, max RSS %.0f MB, %.1f us per range handed out" % \
+                  (mode, result['startup'], result['rss'], result['popTime'] * 1e6)
+    finally:
+        shutil.rmtree(workdir)
+
+
+# InputCache
+
+def runCacheRank(rank, cacheDir, inputs, pfc, workdir, results):
+    rankDir = os.path.join(workdir, 'rank_%s' % rank)
+    os.makedirs(rankDir)
+    cache = NodeInputCache(cacheDir, rank)
+    for inputFile in inputs:
+        cache.linkFile(inputFile, rankDir)
+    path = cache.getPoolFileCatalog(pfc, 'HPCWORKINGDIR', rankDir)
+    results.put((rank, cache.copied, open(path).read(), [os.stat(os.path.join(rankDir, os.path.basename(f))).st_ino for f in inputs]))
+
+
+class NodeInputCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.inputs = []
+        for i in range(3):
+            name = os.path.join(self.workdir, 'EVNT.%d.pool.root' % i)
+            open(name, 'wb').write(os.urandom(100000 + i))
+            self.inputs.append(name)
+        self.pfc = os.path.join(self.workdir, 'PoolFileCatalog.xml')
+        open(self.pfc, 'w').write('<File><pfn name="HPCWORKINGDIR/EVNT.0.pool.root"/></File>\n')
+        self.cacheDir = os.path.join(self.workdir, 'inputCache', 'node1')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def check(self, results, nRanks):
+        results = [results.get(timeout=30) for i in range(nRanks)]
+        # every file copied once, the same inode for all ranks
+        self.assertEqual(sum([copied for rank, copied, pfc, inodes in results]), len(self.inputs))
+        self.assertEqual(len(set([tuple(inodes) for rank, copied, pfc, inodes in results])), 1)
+        for rank, copied, pfc, inodes in results:
+            self.assertEqual(pfc, '<File><pfn name="%s/EVNT.0.pool.root"/></File>\n' % self.cacheDir)
+        for inputFile in self.inputs:
+            self.assertEqual(open(inputFile).read(), open(os.path.join(self.cacheDir, os.path.basename(inputFile))).read())
+
+    def testProcesses(self):
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=runCacheRank, args=(rank, self.cacheDir, self.inputs, self.pfc, self.workdir, results))
+                     for rank in range(1, 9)]
+        for process in processes:
+            process.start()
+        self.check(results, 8)
+        for process in processes:
+            process.join()
+
+    def testThreads(self):
+        results = Queue.Queue()
+        threads = [threading.Thread(target=runCacheRank, args=(rank, self.cacheDir, self.inputs, self.pfc, self.workdir, results))
+                   for rank in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        self.check(results, 8)
+        for thread in threads:
+            thread.join()
+
+    def testRelease(self):
+        caches = [NodeInputCache(self.cacheDir, rank) for rank in range(2)]
+        dirs = []
+        for rank, cache in enumerate(caches):
+            dirs.append(os.path.join(self.workdir, 'rank_%s' % rank))
+            os.makedirs(dirs[-1])
+            cache.linkFile(self.inputs[0], dirs[-1])
+        cached = os.path.join(self.cacheDir, os.path.basename(self.inputs[0]))
+        caches[0].release(self.inputs[0], dirs[0])
+        self.assertTrue(os.path.exists(cached))
+        self.assertFalse(os.path.exists(os.path.join(dirs[0], os.path.basename(self.inputs[0]))))
+        caches[1].release(self.inputs[0], dirs[1])
+        self.assertFalse(os.path.exists(cached))
+        # copied again for the next user
+        caches[0].linkFile(self.inputs[0], dirs[0])
+        self.assertEqual(caches[0].copied, 2)
+
+    def testStaleLock(self):
+        cache = NodeInputCache(self.cacheDir, 1, staleLockTime=0.5)
+        lockFile = cache.lock('EVNT.0.pool.root')
+        t0 = time.time()
+        cache.getFile(self.inputs[0])
+        self.assertTrue(time.time() - t0 >= 0.5)
+        self.assertFalse(os.path.exists(lockFile))
+
+
+@benchmark("inputcache")
+def benchmarkInputCache(args):
+    """ Every rank copying the inputs vs the node cache:
+        python PilotTests.py benchmark inputcache [ranks] [files] [MB per file] """
+
+    nRanks = int(args[0]) if len(args) > 0 else 16
+    nFiles = int(args[1]) if len(args) > 1 else 4
+    size = int(args[2]) if len(args) > 2 else 100
+    workdir = tempfile.mkdtemp()
+    try:
+        inputs = []
+        block = os.urandom(1024 * 1024)
+        for i in range(nFiles):
+            name = os.path.join(workdir, 'EVNT.%d.pool.root' % i)
+            f = open(name, 'wb')
+            for j in range(size):
+                f.write(block)
+            f.close()
+            inputs.append(name)
+        os.system("sync")
+
+        def copyRank(rank):
+            rankDir = os.path.join(workdir, 'copy', 'rank_%s' % rank)
+            os.makedirs(rankDir)
+            for inputFile in inputs:
+                shutil.copy(inputFile, rankDir)
+
+        def cacheRank(rank):
+            rankDir = os.path.join(workdir, 'cache', 'rank_%s' % rank)
+            os.makedirs(rankDir)
+            cache = NodeInputCache(os.path.join(workdir, 'inputCache'), rank)
+            for inputFile in inputs:
+                cache.linkFile(inputFile, rankDir)
+
+        for name, func in [('copy per rank', copyRank), ('node cache', cacheRank)]:
+            processes = [multiprocessing.Process(target=func, args=(rank,)) for rank in range(nRanks)]
+            t0 = time.time()
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            out = os.popen("du -sm %s" % os.path.join(workdir, name == 'copy per rank' and 'copy' or 'inputCache')).read().split()[0]
+            print "%-14s %d ranks x %d files x %d MB: %.2f s, %s MB written" % (name, nRanks, nFiles, size, time.time() - t0, out)
+    finally:
+        shutil.rmtree(workdir)
+
+
+# EventRangeUpdates
+
+def makeUpdates(n, jobId='1', rank=1):
+    updates = []
+    for i in range(n):
+        eventRangeID = '%s-%d-%d' % (jobId, rank, i)
+        update = {'jobId': jobId, 'eventRangeID': eventRangeID,
+                  'output': '/lustre/atlas/proj/yoda/rank_%d/HITS.%s.pool.root,ID:%s,CPU:110,WALL:118' % (rank, eventRangeID, eventRangeID)}
+        if i % 10 == 9:
+            update['eventStatus'] = 'ERR_ATHENAMP_PARSE'
+        else:
+            update['eventStatus'] = 'stagedOut'
+            update['objstoreID'] = 1234
+        updates.append(update)
+    return updates
+
+
+class EventRangeUpdatesTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        updates = makeUpdates(50) + makeUpdates(5, jobId='2') + [{'jobId': '1', 'eventRangeID': 'z', 'eventStatus': 'zipped', 'output': ['a', 'b']}]
+        message = encodeUpdates(updates)
+        self.assertEqual(message['count'], len(updates))
+        # transported as JSON
+        decoded = decodeUpdates(json.loads(json.dumps(message)))
+        key = lambda update: update['eventRangeID']
+        self.assertEqual(sorted(decoded, key=key), sorted(updates, key=key))
+        self.assertTrue(len(json.dumps(message)) < len(json.dumps(updates)) / 4)
+
+    def testOldFormat(self):
+        updates = makeUpdates(3)
+        self.assertEqual(decodeUpdates(updates), updates)
+        self.assertEqual(decodeUpdates(encodeUpdates([])), [])
+
+    def testBatcher(self):
+        clock = [100.0]
+        batcher = UpdateBatcher(flushInterval=10, flushSize=3, clock=lambda: clock[0])
+        self.assertEqual(batcher.getTimeout(), None)
+        self.assertFalse(batcher.isDue())
+        batcher.add({'eventRangeID': 1})
+        clock[0] = 104
+        batcher.add({'eventRangeID': 2})
+        self.assertEqual(batcher.getTimeout(), 6)
+        self.assertFalse(batcher.isDue())
+        clock[0] = 110
+        self.assertTrue(batcher.isDue())
+        self.assertEqual(len(batcher.flush()), 2)
+        self.assertEqual(len(batcher), 0)
+        for i in range(3):
+            batcher.add({'eventRangeID': i})
+        self.assertTrue(batcher.isDue())
+
+    def testYoda(self):
+        workdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(workdir)
+            yoda = Yoda(workdir, workdir, rank=0, nonMPIMode=True)
+            yoda.comm = FakeCommunicator()
+            yoda.jobs = {'1': {'yodaToOS': True}}
+            yoda.runningJobsEventRanges = {'1': {}}
+            yoda.finishedJobsEventRanges = {'1': []}
+            yoda.stagedOutJobsEventRanges = {'1': []}
+            yoda.updateEventRanges(json.loads(json.dumps(encodeUpdates(makeUpdates(20)))))
+            self.assertEqual(len(yoda.stagedOutJobsEventRanges['1']), 18)
+            self.assertEqual(len(yoda.finishedJobsEventRanges['1']), 2)
+            self.assertEqual(yoda.comm.response, {'StatusCode': 0})
+            pandaUpdates = dict((update['eventRangeID'], update) for update in yoda.pandaEventRanges)
+            self.assertEqual(len(pandaUpdates), 20)
+            self.assertEqual(pandaUpdates['1-1-0'], {'eventRangeID': '1-1-0', 'eventStatus': 'finished', 'objstoreID': 1234})
+            self.assertEqual(pandaUpdates['1-1-9'], {'eventRangeID': '1-1-9', 'eventStatus': 'failed'})
+            # old Droids
+            yoda.updateEventRanges(makeUpdates(1))
+            self.assertEqual(len(yoda.pandaEventRanges), 21)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+
+    def testYodaWithoutObjstoreID(self):
+        workdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(workdir)
+            yoda = Yoda(workdir, workdir, rank=0, nonMPIMode=True)
+            yoda.comm = FakeCommunicator()
+            yoda.jobs = {'1': {'yodaToOS': True}}
+            yoda.runningJobsEventRanges = {'1': {}}
+            yoda.finishedJobsEventRanges = {'1': []}
+            yoda.stagedOutJobsEventRanges = {'1': []}
+            updates = [{'jobId': '1', 'eventRangeID': '1-1-0', 'eventStatus': 'stagedOut', 'output': 'out'}]
+            # decodeUpdates() leaves out objstoreID if there is none
+            yoda.updateEventRanges(json.loads(json.dumps(encodeUpdates(updates))))
+            self.assertEqual(yoda.comm.response, {'StatusCode': 0})
+            self.assertEqual(yoda.pandaEventRanges, [{'eventRangeID': '1-1-0', 'eventStatus': 'finished', 'objstoreID': None}])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+
+
+@benchmark("updates")
+def benchmarkUpdates(args):
+    """ The updates of the Droids to rank 0 (with Yoda.updateEventRanges and a fake communicator), one request per stager
+        cycle and a PanDA update from every rank (as the Droids did) vs batched requests forwarded to PanDA by Yoda:
+        python PilotTests.py benchmark updates [ranks] [workers] [seconds] """
+
+    nRanks = int(args[0]) if len(args) > 0 else 5000
+    workers = int(args[1]) if len(args) > 1 else 16
+    duration = int(args[2]) if len(args) > 2 else 1800
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(1)
+
+    # completion times of the events of every rank
+    events = []
+    for rank in range(1, nRanks + 1):
+        updates = iter(makeUpdates(int(duration / EVENT_TIME * workers * 2), rank=rank))
+        for worker in range(workers):
+            t = rng.uniform(0, EVENT_TIME)
+            while t < duration:
+                events.append((t, rank, updates.next()))
+                t += EVENT_TIME * rng.uniform(0.5, 1.5)
+    events.sort()
+
+    def perCycle():
+        """ the outputs of a stager cycle in a request (and a PanDA update) as soon as they are copied """
+        pending = {}
+        for t, rank, update in events:
+            cycle = int(t / STAGER_CYCLE) + 1
+            if rank in pending and pending[rank][0] != cycle:
+                yield pending[rank][0] * STAGER_CYCLE, pending.pop(rank)[1]
+            pending.setdefault(rank, (cycle, []))[1].append((t, update))
+        for rank in pending:
+            yield pending[rank][0] * STAGER_CYCLE, pending[rank][1]
+
+    def batched():
+        batchers = {}
+        clock = [0.0]
+        timers = []
+        for t, rank, update in events:
+            while timers and timers[0][0] <= t:
+                due, r, first = heapq.heappop(timers)
+                if r in batchers and batchers[r].firstTime == first:
+                    clock[0] = due
+                    yield due, batchers.pop(r).flush()
+            clock[0] = t
+            if rank not in batchers:
+                batchers[rank] = UpdateBatcher(clock=lambda: clock[0])
+            batcher = batchers[rank]
+            wasEmpty = not len(batcher)
+            batcher.add((t, update))
+            if batcher.isDue():
+                yield t, batchers.pop(rank).flush()
+            elif wasEmpty:
+                heapq.heappush(timers, (t + batcher.flushInterval, rank, t))
+        for rank in batchers:
+            yield batchers[rank].firstTime + batchers[rank].flushInterval, batchers[rank].flush()
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        print "%d ranks x %d workers, %d s, %d event ranges" % (nRanks, workers, duration, len(events))
+        for name, requests, encode in [('per stager cycle', perCycle, None), ('batched', batched, encodeUpdates)]:
+            yoda = Yoda(workdir, workdir, rank=0, nonMPIMode=True)
+            yoda.comm = FakeCommunicator()
+            yoda.jobs = {'1': {'yodaToOS': True}}
+            yoda.runningJobsEventRanges = {'1': {}}
+            yoda.finishedJobsEventRanges = {'1': []}
+            yoda.stagedOutJobsEventRanges = {'1': []}
+            messages = sorted(requests())
+            server = 0.0
+            busy = 0.0
+            latencies = []
+            size = 0
+            for sendTime, batch in messages:
+                updates = [update for t, update in batch]
+                data = json.dumps({'method': 'updateEventRanges', 'params': encode(updates) if encode else updates})
+                size += len(data)
+                # rank 0: decode the request and run the handler, one request after the other
+                t0 = time.time()
+                yoda.updateEventRanges(json.loads(data)['params'])
+                service = time.time() - t0 + MPI_OVERHEAD
+                start = max(sendTime + MPI_LATENCY, server)
+                server = start + service
+                busy += service
+                latencies.extend([server - t for t, update in batch])
+            latencies.sort()
+            if encode:
+                # Yoda forwards the updates to PanDA in bulk
+                pandaRequests = int(duration / PANDA_INTERVAL) * ((len(events) * PANDA_INTERVAL / duration + 999) / 1000)
+            else:
+                pandaRequests = len(messages)
+            print "%-16s %8d requests, %6.0f per s at rank 0 (busy %.1f%%), %5.0f bytes per request, latency mean %.2f s, p99 %.2f s, %d PanDA requests" % \
+                  (name, len(messages), len(messages) / duration, 100 * busy / duration, float(size) / len(messages),
+                   sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.99)], pandaRequests)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+# JobTracker
+
+def writeDump(directory, name, lines):
+    """ as Yoda.dumpUpdates: written to a new file which is renamed """
+    path = os.path.join(directory, name)
+    tmpFile = open(path + ".new", 'w')
+    tmpFile.write("".join(["%s\n" % line for line in lines]))
+    tmpFile.close()
+    os.rename(path + ".new", path)
+
+
+class FakeYodaScript(threading.Thread):
+    """ Plays a script of (delay, action, argument) on the Yoda directory """
+
+    def __init__(self, directory, script):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.script = script
+        self.times = {}
+
+    def run(self):
+        for delay, action, argument in self.script:
+            time.sleep(delay)
+            if action == 'state':
+                writeState(self.directory, argument)
+            elif action == 'batch':
+                # state of the job in the batch system
+                fake.script = [argument]
+            else:
+                writeDump(self.directory, action, argument)
+            self.times[(action, str(argument))] = time.time()
+
+
+class JobTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        fake.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def testBackoff(self):
+        backoff = Backoff(10, 60)
+        self.assertEqual([backoff.next() for i in range(5)], [10, 20, 40, 60, 60])
+        backoff.reset()
+        self.assertEqual(backoff.next(), 10)
+
+    def testSchedulerFallback(self):
+        clock = [0.0]
+        states = ['Queue'] * 4 + ['Failed']
+        tracker = JobTracker(self.workdir, lambda: states.pop(0), minQueryInterval=10, maxQueryInterval=40,
+                             clock=lambda: clock[0])
+        while clock[0] < 200 and tracker.poll() != 'Failed':
+            clock[0] += 1
+        # queried at 0, 10, 30, 70, 110
+        self.assertEqual(clock[0], 110)
+        self.assertEqual(tracker.queries, 5)
+
+    def testKilledRunningJob(self):
+        # killed after hours of running, without Yoda writing its final state
+        writeState(self.workdir, 'running')
+        for killed in range(6 * 3600, 6 * 3600 + 1800, 100):
+            clock = [0.0]
+            tracker = JobTracker(self.workdir, lambda: 'Failed' if clock[0] >= killed else 'Running',
+                                 clock=lambda: clock[0])
+            while clock[0] < 2 * killed and tracker.poll() != 'Failed':
+                clock[0] += 1
+            self.assertTrue(clock[0] - killed <= 300)
+
+    def testYodaState(self):
+        clock = [0.0]
+        tracker = JobTracker(self.workdir, lambda: 'Queue', minQueryInterval=10, clock=lambda: clock[0])
+        self.assertEqual(tracker.poll(), 'Queue')
+        writeState(self.workdir, 'running')
+        # without querying the batch system
+        self.assertEqual(tracker.poll(), 'Running')
+        self.assertEqual(tracker.queries, 1)
+        writeState(self.workdir, 'finished')
+        clock[0] = 1000
+        self.assertEqual(tracker.poll(), 'Complete')
+        self.assertEqual(tracker.queries, 1)
+        tracker.reset()
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, STATE_FILE)))
+        self.assertEqual(tracker.poll(), 'Queue')
+
+    def testOutputs(self):
+        tracker = JobTracker(self.workdir, lambda: 'Running', settleTime=0.2)
+        self.assertEqual(tracker.getOutputFiles(), [])
+        writeDump(self.workdir, '1_event_status.dump', ['1 1-1 finished out'])
+        self.assertEqual(tracker.getOutputFiles(), [])
+        time.sleep(0.3)
+        self.assertEqual(tracker.getOutputFiles(), [os.path.join(self.workdir, '1_event_status.dump')])
+        self.assertEqual(tracker.getOutputFiles(), [])
+        # rewritten with more lines
+        writeDump(self.workdir, '1_event_status.dump', ['1 1-1 finished out', '1 1-2 finished out'])
+        time.sleep(0.3)
+        self.assertEqual(tracker.getOutputFiles(), [os.path.join(self.workdir, '1_event_status.dump')])
+        os.rename(os.path.join(self.workdir, '1_event_status.dump'), os.path.join(self.workdir, '1_event_status.dump.BAK'))
+        self.assertEqual(tracker.getOutputFiles(), [])
+
+    def testHPCManager(self):
+        fake.script = ['Queue'] * 100
+        manager = HPCManager(globalWorkingDir=self.workdir)
+        manager.setupPlugin('fake')
+        manager._HPCManager__jobs = {'1': {}}
+        manager.submit()
+        self.assertEqual(manager.getHPCJobId(), '1234')
+        # checked every second
+        yoda = FakeYodaScript(self.workdir, [(1.5, 'state', 'running'),
+                                       (1.5, '2017-01-01-00-00-00.dump', ['1-1 finished /out/1.pool.root,ID:1-1,CPU:1,WALL:1', '1-2 failed 8']),
+                                       (1.5, 'state', 'finished')])
+        yoda.start()
+        states, outputs = [], []
+        t0 = time.time()
+        while time.time() - t0 < 20:
+            states.append(manager.poll())
+            outputs.extend(manager.getOutputs())
+            if manager.isFinished():
+                break
+            manager.waitForChange(5)
+        yoda.join()
+        outputs.extend(manager.getOutputs())
+        self.assertEqual(states[0], 'Queue')
+        self.assertEqual(states[-1], 'Complete')
+        self.assertTrue('Running' in states)
+        self.assertEqual(outputs, [('1-1', 'finished', '/out/1.pool.root'), ('1-2', 'failed', '8\n')])
+        # noticed within a second, the batch system queried once
+        self.assertTrue(time.time() - yoda.times[('state', 'finished')] < 1.5)
+        self.assertEqual(fake.queries, 1)
+
+
+@benchmark("tracker")
+def benchmarkTracker(args):
+    """ Delays until the completion of the HPC job and the output dumps are noticed, and batch system queries: the pilot
+        loop querying the batch system and listing the directory every 30 s vs waiting on the tracker. Yoda runs for
+        [seconds] and writes [dumps] dumps, while the pilot loops as RunJobHpcEvent.runHPCEvent (poll, getOutputs,
+        30 s sleep), the times are divided by [time scale]:
+        python PilotTests.py benchmark tracker [seconds] [dumps] [time scale] """
+
+    duration = float(args[0]) if len(args) > 0 else 6 * 3600
+    nDumps = int(args[1]) if len(args) > 1 else 50
+    scale = float(args[2]) if len(args) > 2 else 600
+    logging.disable(logging.CRITICAL)
+    workdir = tempfile.mkdtemp()
+    try:
+        interval = float(duration) / (nDumps + 1) / scale
+        for mode in ['sleep', 'tracker']:
+            fake.reset()
+            fake.script = ['Running']
+            plugin = fake(None)
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+            script = [(0, 'state', 'running')] + [(interval, '%d.dump' % i, ['%d-1 finished out' % i]) for i in range(nDumps)] + \
+                     [(interval, 'state', 'finished'), (60. / scale, 'batch', 'Complete')]
+            yoda = FakeYodaScript(workdir, script)
+            tracker = JobTracker(workdir, lambda: plugin.poll('1234'), minQueryInterval=60. / scale, maxQueryInterval=300. / scale,
+                                 checkInterval=1. / scale, settleTime=1. / scale)
+            delays = []
+            yoda.start()
+            while True:
+                if mode == 'sleep':
+                    # HPCManager.poll and getOutputs as they were
+                    state = plugin.poll('1234')
+                    paths = [os.path.join(workdir, name) for name in os.listdir(workdir) if name.endswith(OUTPUT_SUFFIX)]
+                else:
+                    state = tracker.poll()
+                    paths = tracker.getOutputFiles()
+                for path in paths:
+                    name = os.path.basename(path)
+                    delays.append(time.time() - yoda.times[(name, str(['%s-1 finished out' % name.split('.')[0]]))])
+                    os.rename(path, path + '.BAK')
+                if state == 'Complete':
+                    break
+                if mode == 'sleep':
+                    time.sleep(30. / scale)
+                else:
+                    tracker.wait(30. / scale)
+            completion = time.time() - yoda.times[('state', 'finished')]
+            yoda.join()
+            print "%-8s completion noticed after %5.1f s, outputs after %5.1f s on average (max %5.1f s), %4d batch system queries" % \
+                  (mode, completion * scale, sum(delays) / max(len(delays), 1) * scale, max(delays or [0]) * scale, fake.queries)
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Checkpoint
+
+def numberedEventRanges(jobId, nRanges):
+    for i in xrange(nRanges):
+        yield {'eventRangeID': '%s-%d' % (jobId, i), 'LFN': 'EVNT.%s._000001.pool.root.1' % jobId, 'GUID': 'GUID-%s' % jobId,
+               'startEvent': i, 'lastEvent': i, 'scope': 'mc16'}
+
+
+def makeYodaWorkdir(jobsRanges, shardSize=1000):
+    workdir = tempfile.mkdtemp()
+    jobs = dict((jobId, {'JobId': jobId, 'ATHENA_PROC_NUMBER': 4, 'neededRanks': 1}) for jobId in jobsRanges)
+    json.dump(jobs, open(os.path.join(workdir, 'HPCJobs.json'), 'w'))
+    writeEventRanges(workdir, dict((jobId, numberedEventRanges(jobId, jobsRanges[jobId])) for jobId in jobsRanges), shardSize=shardSize)
+    return workdir
+
+
+def startYoda(workdir):
+    """ what runYoda does before the main loop """
+    os.chdir(workdir)
+    yoda = Yoda(workdir, workdir, rank=0, nonMPIMode=True)
+    yoda.comm = FakeCommunicator()
+    yoda.loadJobs()
+    yoda.initJobRanks()
+    status, output = yoda.makeJobsEventTable()
+    if not status:
+        raise Exception(output)
+    return yoda
+
+
+def getEventRanges(yoda, jobId, rank, nRanges):
+    yoda.comm.requesterRank = rank
+    yoda.getEventRanges({'jobId': jobId, 'rank': rank, 'nRanges': nRanges})
+    return [eventRange['eventRangeID'] for eventRange in yoda.comm.response['eventRanges']]
+
+
+def updateRanges(yoda, jobId, eventRangeIDs, status='finished'):
+    yoda.updateEventRanges([{'jobId': jobId, 'eventRangeID': eventRangeID, 'eventStatus': status, 'output': 'out', 'objstoreID': 1}
+                            for eventRangeID in eventRangeIDs])
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdirs = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for workdir in self.workdirs:
+            shutil.rmtree(workdir)
+
+    def makeWorkdir(self, jobsRanges, shardSize=10):
+        self.workdirs.append(makeYodaWorkdir(jobsRanges, shardSize))
+        return self.workdirs[-1]
+
+    def testJobRanges(self):
+        jobRanges = JobRanges(20)
+        jobRanges.handOut(1, [{'eventRangeID': str(i)} for i in range(10)])
+        self.assertTrue(jobRanges.done('3'))
+        self.assertTrue(jobRanges.done('9', stagedOut=True))
+        self.assertFalse(jobRanges.done('3'))
+        self.assertFalse(jobRanges.done('unknown'))
+        self.assertEqual([position for position in range(10) if jobRanges.isDone(position)], [3, 9])
+        self.assertEqual(jobRanges.getNotDone(), [0, 1, 2, 4, 5, 6, 7, 8])
+        state = jobRanges.getState()
+        self.assertEqual(state['cursor'], 10)
+        self.assertEqual(sorted(state['inFlight']['1']), [0, 1, 2, 4, 5, 6, 7, 8])
+        self.assertEqual(decodeBitmap(encodeBitmap(state['finished'])), bytearray([8, 0]))
+        # requeued positions are handed out first
+        jobRanges.requeued.extend([0, 1])
+        jobRanges.handOut(2, [{'eventRangeID': 'a'}, {'eventRangeID': 'b'}, {'eventRangeID': 'c'}])
+        self.assertEqual(jobRanges.inFlight['a'], (0, 2))
+        self.assertEqual(jobRanges.inFlight['c'], (10, 2))
+
+    def testKillAndRestart(self):
+        workdir = self.makeWorkdir({'1': 45, '2': 12})
+        yoda = startYoda(workdir)
+        first = getEventRanges(yoda, '1', 1, 8)
+        second = getEventRanges(yoda, '1', 2, 25)
+        other = getEventRanges(yoda, '2', 3, 4)
+        updateRanges(yoda, '1', first[:6])
+        updateRanges(yoda, '1', second[:20], status='stagedOut')
+        updateRanges(yoda, '2', other[:1], status='ERR_ATHENA')
+        yoda.writeCheckpoint()
+        # reported after the checkpoint: lost with the allocation
+        updateRanges(yoda, '1', first[6:])
+        yoda.updateEventRangesToDB(force=True)
+        del yoda
+
+        # new allocation
+        yoda = startYoda(workdir)
+        self.assertEqual(yoda.scheduler.getNumberOfReadyEventRanges('1'), 45 - 26)
+        self.assertEqual(yoda.scheduler.getNumberOfReadyEventRanges('2'), 12 - 1)
+        # the ranges in flight come first, then the ranges which were never handed out
+        resumed = getEventRanges(yoda, '1', 5, 10)
+        self.assertEqual(resumed, first[6:] + second[20:] + ['1-33', '1-34', '1-35'])
+        self.assertEqual(getEventRanges(yoda, '2', 5, 100), other[1:] + ['2-%d' % i for i in range(4, 12)])
+        # the outputs of the first allocation are kept in the dumps
+        yoda.updateEventRangesToDB(force=True)
+        lines = open(os.path.join(workdir, '1_event_status.dump.stagedOut')).read().splitlines()
+        self.assertEqual(len(lines), 20)
+        updateRanges(yoda, '1', resumed)
+        yoda.writeCheckpoint()
+        yoda.updateEventRangesToDB(force=True)
+        lines = open(os.path.join(workdir, '1_event_status.dump')).read().splitlines()
+        self.assertEqual([line.split()[1] for line in lines], first + resumed)
+        metadata = open(os.path.join(workdir, 'metadata-1_event_status.xml')).read()
+        self.assertEqual(metadata.count('<File '), 8 + 10)
+        self.assertEqual(metadata.count('<POOLFILECATALOG>'), 1)
+        del yoda
+
+        # killed again before anything was handed out: the same state
+        yoda = startYoda(workdir)
+        self.assertEqual(yoda.scheduler.getNumberOfReadyEventRanges('1'), 45 - 36)
+        self.assertEqual(getEventRanges(yoda, '1', 1, 100), ['1-%d' % i for i in range(36, 45)])
+        yoda.updateEventRangesToDB(force=True)
+        lines = open(os.path.join(workdir, '1_event_status.dump')).read().splitlines()
+        self.assertEqual(len(lines), 18)
+
+    def testMismatch(self):
+        workdir = self.makeWorkdir({'1': 20})
+        yoda = startYoda(workdir)
+        updateRanges(yoda, '1', getEventRanges(yoda, '1', 1, 10))
+        yoda.writeCheckpoint()
+        del yoda
+        # other input: the checkpoint is not used
+        writeEventRanges(workdir, {'1': numberedEventRanges('1', 30)}, shardSize=10)
+        yoda = startYoda(workdir)
+        self.assertEqual(yoda.scheduler.getNumberOfReadyEventRanges('1'), 30)
+
+    def testSimulation(self):
+        # ranks processing random chunks, Yoda killed at random points and resumed from its last checkpoint:
+        # every range is done in the end, only ranges not done at the last checkpoint are handed out again
+        rng = random.Random(1)
+        workdir = self.makeWorkdir({'1': 500, '2': 300}, shardSize=64)
+        done, handedOut = set(), {}
+        for allocation in range(10):
+            yoda = startYoda(workdir)
+            checkpointed = set(done)
+            lost = set()
+            for i in range(rng.randint(5, 40)):
+                jobId = rng.choice(['1', '2'])
+                rank = rng.randint(1, 8)
+                eventRangeIDs = getEventRanges(yoda, jobId, rank, rng.randint(1, 30))
+                for eventRangeID in eventRangeIDs:
+                    self.assertFalse(eventRangeID in checkpointed)
+                    handedOut[eventRangeID] = handedOut.get(eventRangeID, 0) + 1
+                finished = [eventRangeID for eventRangeID in eventRangeIDs if rng.random() < 0.8]
+                updateRanges(yoda, jobId, finished, status=rng.choice(['finished', 'stagedOut']))
+                lost.update(finished)
+                if rng.random() < 0.3:
+                    yoda.writeCheckpoint()
+                    done.update(lost)
+                    lost = set()
+            del yoda
+        yoda = startYoda(workdir)
+        for jobId in ['1', '2']:
+            while True:
+                eventRangeIDs = getEventRanges(yoda, jobId, 1, 50)
+                if not eventRangeIDs:
+                    break
+                for eventRangeID in eventRangeIDs:
+                    self.assertFalse(eventRangeID in done)
+                done.update(eventRangeIDs)
+        self.assertEqual(len(done), 800)
+
+
+@benchmark("checkpoint")
+def benchmarkCheckpoint(args):
+    """ Time and size of a checkpoint, time to resume:
+        python PilotTests.py benchmark checkpoint [ranges] [jobs] [ranks] [workers] """
+
+    nRanges = int(args[0]) if len(args) > 0 else 2000000
+    nJobs = int(args[1]) if len(args) > 1 else 20
+    nRanks = int(args[2]) if len(args) > 2 else 5000
+    workers = int(args[3]) if len(args) > 3 else 16
+    logging.disable(logging.CRITICAL)
+    jobIds = [str(1000 + j) for j in range(nJobs)]
+    workdir = makeYodaWorkdir(dict((jobId, nRanges / nJobs) for jobId in jobIds), shardSize=100000)
+    try:
+        yoda = startYoda(workdir)
+        # half of the ranges done, every rank has a chunk in flight
+        rank = 0
+        for jobId in jobIds:
+            eventRangeIDs = getEventRanges(yoda, jobId, 1, nRanges / nJobs / 2)
+            updateRanges(yoda, jobId, eventRangeIDs, status='stagedOut')
+            for j in range(nRanks / nJobs):
+                rank += 1
+                getEventRanges(yoda, jobId, rank, workers * 2)
+        times = []
+        for i in range(5):
+            t0 = time.time()
+            size = yoda.checkpoint.write()
+            times.append(time.time() - t0)
+        print "%d ranges in %d jobs, %d ranks x %d ranges in flight" % (nRanges, nJobs, nRanks, workers * 2)
+        print "checkpoint: %.0f ms, %.1f kB" % (min(times) * 1000, size / 1024.)
+        del yoda
+        t0 = time.time()
+        yoda = startYoda(workdir)
+        print "startup with resume: %.2f s, %d ready ranges" % (time.time() - t0, yoda.scheduler.getNumberOfReadyEventRanges())
+        del yoda
+        os.rename(os.path.join(workdir, CHECKPOINT_FILE), os.path.join(workdir, CHECKPOINT_FILE + ".old"))
+        t0 = time.time()
+        yoda = startYoda(workdir)
+        print "startup without checkpoint: %.2f s, %d ready ranges" % (time.time() - t0, yoda.scheduler.getNumberOfReadyEventRanges())
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir)
+
+
+# StagerPipeline
+
+class StagerPipelineTest(unittest.TestCase):
+
+    def testOrder(self):
+        out = []
+        pipeline = StagerPipeline([Stage('double', lambda item: [item * 2]),
+                                   Stage('split', lambda item: [item, item + 1]),
+                                   Stage('report', lambda item: out.append(item) or pipeline.done() or [])])
+        pipeline.start()
+        for i in range(10):
+            pipeline.put(i)
+        pipeline.close()
+        self.assertEqual(out, [j for i in range(10) for j in (2 * i, 2 * i + 1)])
+        metrics = dict(pipeline.getMetrics())
+        self.assertEqual(metrics['double']['items'], 10)
+        self.assertEqual(metrics['report']['items'], 20)
+        # two report items per put item
+        self.assertEqual(pipeline.getPending(), -10)
+
+    def testBackPressure(self):
+        release = threading.Event()
+        out = []
+
+        def slow(item):
+            release.wait()
+            out.append(item)
+            pipeline.done()
+            return []
+
+        pipeline = StagerPipeline([Stage('collect', lambda item: [item], queueSize=2), Stage('upload', slow, queueSize=2)])
+        pipeline.start()
+        producer = threading.Thread(target=lambda: [pipeline.put(i) for i in range(20)])
+        producer.start()
+        time.sleep(0.3)
+        # 1 in upload, 2 queued for it, 1 in collect, 2 queued for it: the producer is blocked
+        self.assertTrue(producer.isAlive())
+        self.assertEqual(pipeline.getPending(), 7)
+        metrics = dict(pipeline.getMetrics())
+        self.assertEqual(metrics['upload']['queueDepth'], 2)
+        self.assertEqual(metrics['collect']['queueDepth'], 2)
+        release.set()
+        producer.join()
+        pipeline.close()
+        self.assertEqual(sorted(out), range(20))
+        self.assertEqual(pipeline.getPending(), 0)
+        self.assertEqual(dict(pipeline.getMetrics())['upload']['maxQueueDepth'], 2)
+
+    def testFlushAndErrors(self):
+        batch, out = [], []
+
+        def collect(item):
+            if item == 3:
+                raise IOError("no such file")
+            batch.append(item)
+            if len(batch) == 4:
+                return flush()
+            return []
+
+        def flush():
+            if not batch:
+                return []
+            items = [list(batch)]
+            del batch[:]
+            return items
+
+        stage = Stage('zip', collect, flush=flush, flushTimeout=0.2)
+        stage.onError = lambda item, message: [('failed', item, message)]
+        pipeline = StagerPipeline([stage, Stage('report', lambda item: out.append(item) or [], threads=2)])
+        pipeline.start()
+        for i in range(6):
+            pipeline.put(i)
+        time.sleep(0.5)
+        # the rest of the batch after the timeout
+        self.assertEqual(sorted(out), [[0, 1, 2, 4], [5], ('failed', 3, 'zip failed')])
+        pipeline.put(7)
+        pipeline.close()
+        self.assertEqual(out[-1], [7])
+        self.assertEqual(dict(pipeline.getMetrics())['zip']['errors'], 1)
+        self.assertTrue('zip: 7 items' in pipeline.formatMetrics())
+
+
+# DroidStager
+
+class FakeJobManager:
+    def __init__(self):
+        self.outputs = []
+        self.lock = threading.Lock()
+
+    def add(self, outputs):
+        with self.lock:
+            self.outputs += outputs
+
+    def getOutputs(self):
+        with self.lock:
+            outputs, self.outputs = self.outputs, []
+        return outputs
+
+
+class MoveSiteMover:
+    """ put_data() moves the file to the destination dir, fails the files in failures as many times as given """
+    failures = {}
+    release = None
+    calls = []
+
+    def __init__(self, setup, useTimerCommand=False):
+        pass
+
+    def put_data(self, source, destination, fsize=0, fchecksum=0, **pdict):
+        if MoveSiteMover.release:
+            MoveSiteMover.release.wait()
+        name = os.path.basename(source)
+        MoveSiteMover.calls.append((name, fsize, fchecksum))
+        if MoveSiteMover.failures.get(name, 0) > 0:
+            MoveSiteMover.failures[name] -= 1
+            return -1, "put failed", None, 0, 0, None
+        if fsize != os.path.getsize(source) or fchecksum != DroidStager.adler32(source):
+            return -1, "checksum mismatch", None, 0, 0, None
+        shutil.copy(source, os.path.join(destination, name))
+        return 0, "", "s3://bucket/%s" % name, fsize, fchecksum, 'ES'
+
+
+def makeOutputs(directory, rank, n, size=100, start=0):
+    outputs = []
+    for i in range(start, start + n):
+        path = os.path.join(directory, 'rank_%s' % rank, 'HITS.%s.%s.pool.root' % (rank, i))
+        handle = open(path, 'wb')
+        handle.write(os.urandom(size))
+        handle.close()
+        outputs.append(('range-%s-%s' % (rank, i), 'finished', '%s,ID:range-%s-%s,CPU:1,WALL:1' % (path, rank, i)))
+    return outputs
+
+
+def runStager(workdir, job, outputs, rank=0, wait=True):
+    jobManager = FakeJobManager()
+    queue = Queue.Queue()
+    # the objectstore site mover of the stager
+    DroidStager.objectstoreSiteMover = MoveSiteMover
+    stager = DroidStager.DroidStager(workdir, workdir, outputs=queue, job=job, esJobManager=jobManager, rank=rank)
+    jobManager.add(outputs)
+    stager.start()
+    if wait:
+        stopStager(stager)
+    return stager, jobManager, queue
+
+
+def stopStager(stager):
+    stager.stop()
+    while not stager.isFinished():
+        time.sleep(0.1)
+
+
+def getRequests(queue):
+    requests = {}
+    while not queue.empty():
+        request = queue.get()
+        requests[request['eventRangeID']] = request
+    return requests
+
+
+class DroidStagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.staging = tempfile.mkdtemp()
+        self.esPath = os.path.join(self.workdir, 'objectstore')
+        for directory in ['rank_0', 'rank_1', 'objectstore']:
+            os.makedirs(os.path.join(self.workdir, directory))
+        MoveSiteMover.failures = {}
+        MoveSiteMover.release = None
+        MoveSiteMover.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+        shutil.rmtree(self.staging)
+
+    def testObjectstore(self):
+        outputs = makeOutputs(self.workdir, 0, 20)
+        outputs.append(('range-err', 'ERR_ATHENAMP_PROCESS', 'ERR_ATHENAMP_PROCESS: crashed'))
+        MoveSiteMover.failures = {'HITS.0.3.pool.root': 1, 'HITS.0.5.pool.root': 2}
+        job = {'JobId': '1', 'yodaToOS': True, 'esPath': self.esPath, 'os_bucket_id': 7, 'stageout_threads': 3}
+        stager, jobManager, queue = runStager(self.workdir, job, outputs)
+        requests = getRequests(queue)
+        self.assertEqual(len(requests), 21)
+        for eventRangeID, eventStatus, output in outputs:
+            request = requests[eventRangeID]
+            if eventRangeID in ('range-err', 'range-0-5'):
+                # passed through, failed twice
+                self.assertEqual((request['eventStatus'], request['output']), (eventStatus, output))
+                continue
+            name = os.path.basename(output.split(',')[0])
+            self.assertEqual(request['eventStatus'], 'stagedOut')
+            self.assertEqual(request['output'], ['s3://bucket/%s' % name])
+            self.assertEqual(request['objstoreID'], 7)
+            self.assertTrue(os.path.exists(os.path.join(self.esPath, name)))
+            self.assertFalse(os.path.exists(output.split(',')[0]))
+        # retried once
+        self.assertEqual(len([call for call in MoveSiteMover.calls if call[0] == 'HITS.0.3.pool.root']), 2)
+        self.assertEqual(len([call for call in MoveSiteMover.calls if call[0] == 'HITS.0.5.pool.root']), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.workdir, 'rank_0', 'HITS.0.5.pool.root')))
+        metrics = dict(stager.getMetrics())
+        self.assertEqual(metrics['collect']['items'], 21)
+        self.assertEqual(metrics['checksum']['items'], 21)
+        self.assertEqual(metrics['report']['items'], 21)
+
+    def testZip(self):
+        zipFileName = os.path.join(self.workdir, 'EventService_premerge.tar')
+        job = {'JobId': '1', 'yodaToZip': True, 'zipFileName': zipFileName, 'stagingDir': self.staging,
+               'zipEventRangesName': os.path.join(self.workdir, 'EventService_premerge.tar.ranges')}
+        outputs = [makeOutputs(self.workdir, rank, 150) for rank in (0, 1)]
+        # two ranks appending to the same zip file
+        stagers = [runStager(self.workdir, job, outputs[rank], rank=rank, wait=False) for rank in (0, 1)]
+        for stager, jobManager, queue in stagers:
+            stopStager(stager)
+        names = []
+        for (stager, jobManager, queue), rankOutputs in zip(stagers, outputs):
+            requests = getRequests(queue)
+            self.assertEqual(len(requests), 150)
+            for eventRangeID, eventStatus, output in rankOutputs:
+                path = output.split(',')[0]
+                self.assertEqual(requests[eventRangeID]['eventStatus'], 'zipped')
+                self.assertEqual(requests[eventRangeID]['output'], [path])
+                self.assertFalse(os.path.exists(path))
+                names.append(os.path.basename(path))
+            metrics = dict(stager.getMetrics())
+            # 100 ranges per chunk
+            self.assertEqual(metrics['zip']['items'], 150)
+            self.assertEqual(metrics['upload']['items'], 2)
+        tar = tarfile.open(zipFileName)
+        self.assertEqual(sorted(tar.getnames()), sorted(names))
+        tar.close()
+        self.assertEqual(len(open(job['zipEventRangesName']).readlines()), 300)
+        # the staging dirs and the chunks are removed
+        self.assertEqual(os.listdir(self.staging), [])
+        self.assertFalse([name for name in os.listdir(self.workdir) if name.endswith('.part')])
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, 'ATOMIC_LOCKFILE')))
+
+    def testBackPressure(self):
+        MoveSiteMover.release = threading.Event()
+        job = {'JobId': '1', 'yodaToOS': True, 'esPath': self.esPath, 'stageout_threads': 1, 'stager_max_pending': 5}
+        stager, jobManager, queue = runStager(self.workdir, job, makeOutputs(self.workdir, 0, 10), wait=False)
+        try:
+            time.sleep(1.5)
+            self.assertTrue(stager.isBusy())
+            self.assertTrue(queue.empty())
+        finally:
+            MoveSiteMover.release.set()
+            stopStager(stager)
+        self.assertFalse(stager.isBusy())
+        self.assertEqual(len(getRequests(queue)), 10)
+
+
+@benchmark("stager")
+def benchmarkStager(args):
+    """ Stage out time and pipeline metrics: python PilotTests.py benchmark stager [outputs] [MB per output] [zip|os] """
+
+    nOutputs = int(args[0]) if len(args) > 0 else 1000
+    size = int(float(args[1]) * 1048576) if len(args) > 1 else 1048576
+    mode = args[2] if len(args) > 2 else 'zip'
+    logging.disable(logging.CRITICAL)
+    workdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(workdir, 'rank_0'))
+    os.makedirs(os.path.join(workdir, 'objectstore'))
+    try:
+        if mode == 'zip':
+            job = {'JobId': '1', 'yodaToZip': True, 'zipFileName': os.path.join(workdir, 'EventService_premerge.tar'),
+                   'zipEventRangesName': os.path.join(workdir, 'EventService_premerge.tar.ranges')}
+        else:
+            job = {'JobId': '1', 'yodaToOS': True, 'esPath': os.path.join(workdir, 'objectstore'), 'stageout_threads': 4}
+        outputs = makeOutputs(workdir, 0, nOutputs, size)
+        t0 = time.time()
+        stager, jobManager, queue = runStager(workdir, job, outputs)
+        print "%s outputs of %s bytes (%s): %.2f s" % (nOutputs, size, mode, time.time() - t0)
+        print "\n".join(["  %s: %s" % item for item in stager.getMetrics()])
+    finally:
+        shutil.rmtree(workdir)
+
+
+# JobPacker
+
+def syntheticJobs(nRanges, rng):
+    """ Jobs of different sizes, times per event (worker seconds) and setup times """
+    jobs, weights = {}, {}
+    for j in range(N_JOBS):
+        jobId = str(1000 + j)
+        weights[jobId] = rng.uniform(0.2, 1.8)
+        jobs[jobId] = {'eventTime': rng.uniform(30, 300), 'setupTime': rng.uniform(200, 400)}
+    total = sum(weights.values())
+    for jobId in jobs:
+        jobs[jobId]['events'] = max(1, int(nRanges * weights[jobId] / total))
+    return jobs, None
+
+
+def loadTrace(filename):
+    """ Jobs and relative rank speeds from the last heartbeat of every rank of every job """
+    last = {}
+    handle = open(filename)
+    keys = handle.readline().strip().split(",")
+    for line in handle:
+        row = dict(zip(keys, line.strip().split(",")))
+        last[(row['jobId'], row['rank'])] = row
+    handle.close()
+    sums = defaultdict(lambda: [0, 0.0, 0.0, 0])
+    for (jobId, rank), row in last.iteritems():
+        processedEvents = int(float(row['processedEvents'] or 0))
+        if processedEvents <= 0:
+            continue
+        workerTime = float(row['runningTime']) * int(float(row['cores'] or 1))
+        sums[jobId][0] += processedEvents
+        sums[jobId][1] += workerTime
+        sums[jobId][2] += float(row['setupTime'] or 0)
+        sums[jobId][3] += 1
+    jobs = dict((jobId, {'events': s[0], 'eventTime': s[1] / s[0], 'setupTime': s[2] / s[3]}) for jobId, s in sums.iteritems())
+    speeds = []
+    for (jobId, rank), row in last.iteritems():
+        processedEvents = int(float(row['processedEvents'] or 0))
+        if jobId in jobs and processedEvents > 0:
+            workerTime = float(row['runningTime']) * int(float(row['cores'] or 1))
+            speeds.append(workerTime / processedEvents / jobs[jobId]['eventTime'])
+    return jobs, speeds
+
+
+def simulatePacking(jobs, nRanks, workers, policy, speeds=None, traceFile=None, seed=1):
+    """ Run the allocation with the Yoda handlers behind a fake communicator, return the statistics """
+    rng = random.Random(seed)
+    clock = [0.0]
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    try:
+        hpcJobs = {}
+        for jobId, spec in jobs.iteritems():
+            hpcJobs[jobId] = {'JobId': jobId, 'ATHENA_PROC_NUMBER': workers,
+                              'neededRanks': round(spec['events'] * 1.0 / (workers * EVENTS_PER_WORKER), 2)}
+        json.dump(hpcJobs, open(os.path.join(workdir, 'HPCJobs.json'), 'w'))
+        os.chdir(workdir)
+        yoda = Yoda(workdir, workdir, rank=0, nonMPIMode=True, metricsTimeSeries=traceFile is not None, jobScheduler=policy)
+        yoda.comm = FakeCommunicator(nRanks + 1)
+        yoda.lastRankForBigJobFirst = int(yoda.getTotalRanks() * 0.9)
+        yoda.scheduler = yoda.scheduler.__class__(startTime=0, clock=lambda: clock[0])
+        yoda.readyJobsEventRanges = yoda.scheduler.readyJobsEventRanges
+        yoda.metrics.clock = lambda: clock[0]
+        yoda.loadJobs()
+        yoda.initJobRanks()
+        for jobId, spec in jobs.iteritems():
+            yoda.scheduler.addEventRanges(jobId, range(spec['events']))
+
+        droids = {}
+        for rank in range(1, nRanks + 1):
+            droids[rank] = {'rank': rank, 'speed': rng.choice(speeds) if speeds else rng.uniform(0.8, 1.2),
+                            'jobId': None, 'lastDone': 0, 'jobs': 0}
+        queue, seq = [], [0]
+        stats = {'processed': 0, 'jobEnd': {}}
+
+        def schedule(t, kind, rank, data=None):
+            seq[0] += 1
+            heapq.heappush(queue, (t, seq[0], kind, rank, data))
+
+        def getJob(t, droid):
+            clock[0] = t
+            yoda.getJob({'rank': droid['rank']})
+            job = yoda.comm.response['job']
+            if job is None:
+                droid['jobId'] = None
+                return
+            spec = jobs[job['JobId']]
+            droid.update({'jobId': job['JobId'], 'start': t, 'readyTime': t + spec['setupTime'], 'idle': workers,
+                          'buffer': [], 'done': 0, 'noMoreEvents': False})
+            droid['jobs'] += 1
+            schedule(droid['readyTime'], 'step', droid['rank'], job['JobId'])
+            schedule(t + HEARTBEAT_TIME, 'heartbeat', droid['rank'], job['JobId'])
+
+        def heartbeat(t, droid):
+            clock[0] = t
+            spec = jobs[droid['jobId']]
+            yoda.heartbeat({'jobId': droid['jobId'], 'rank': droid['rank'], 'processedEvents': droid['done'],
+                            'runningTime': max(t - droid['readyTime'], 0), 'setupTime': min(t - droid['start'], spec['setupTime']),
+                            'totalTime': t - droid['start'], 'cores': workers, 'queuedEvents': 0, 'cpuConsumptionTime': 0, 'avgTimePerEvent': 0})
+
+        def step(t, droid):
+            if t < droid['readyTime']:
+                return
+            jobId = droid['jobId']
+            if len(droid['buffer']) < droid['idle'] and not droid['noMoreEvents']:
+                clock[0] = t
+                eventRanges = yoda.scheduler.getEventRanges(jobId, droid['rank'], droid['idle'] - len(droid['buffer']))
+                if not eventRanges:
+                    droid['noMoreEvents'] = True
+                droid['buffer'].extend(eventRanges)
+            eventTime = jobs[jobId]['eventTime'] * droid['speed']
+            while droid['idle'] and droid['buffer']:
+                droid['buffer'].pop()
+                droid['idle'] -= 1
+                schedule(t + eventTime * rng.uniform(0.5, 1.5), 'done', droid['rank'], jobId)
+            if droid['noMoreEvents'] and droid['idle'] == workers and not droid['buffer']:
+                heartbeat(t, droid)
+                yoda.finishJob({'jobId': jobId, 'rank': droid['rank'], 'state': 'finished'})
+                getJob(t, droid)
+
+        for rank in sorted(droids):
+            getJob(0, droids[rank])
+        while queue:
+            t, s, kind, rank, jobId = heapq.heappop(queue)
+            droid = droids[rank]
+            if jobId != droid['jobId']:
+                continue
+            if kind == 'done':
+                droid['done'] += 1
+                droid['idle'] += 1
+                droid['lastDone'] = t
+                stats['processed'] += 1
+                stats['jobEnd'][jobId] = max(stats['jobEnd'].get(jobId, 0), t)
+                step(t, droid)
+            elif kind == 'step':
+                step(t, droid)
+            elif kind == 'heartbeat':
+                heartbeat(t, droid)
+                schedule(t + HEARTBEAT_TIME, 'heartbeat', rank, jobId)
+
+        end = stats['makespan'] = max([droid['lastDone'] for droid in droids.values()])
+        stats['tailIdle'] = sum([workers * (end - droid['lastDone']) for droid in droids.values()]) / 3600.
+        stats['coreHours'] = nRanks * workers * end / 3600.
+        stats['jobSwitches'] = sum([droid['jobs'] for droid in droids.values()]) - nRanks
+        stats['ready'] = yoda.scheduler.getNumberOfReadyEventRanges()
+        if traceFile:
+            yoda.metrics.close()
+            shutil.copy(os.path.join(workdir, "jobMetrics-ranks.csv"), traceFile)
+        return stats
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+class JobPackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.packer = JobPacker(walltime=36000, clock=lambda: self.now, minRanges=10)
+
+    def testModel(self):
+        model = EventTimeModel(priorEvents=10)
+        self.assertEqual(model.getEventTime('1'), DEFAULT_EVENT_TIME)
+        self.assertTrue(model.update('1', 1, 10, 100, 300))
+        # no prior but its own measurement yet
+        self.assertEqual(model.getEventTime('1'), 10)
+        self.assertEqual(model.getEventTime('2'), 10)
+        # cumulative heartbeats replace the previous one of the rank
+        self.assertTrue(model.update('1', 1, 30, 300, 300))
+        self.assertFalse(model.update('1', 1, 30, 300, 300))
+        model.update('2', 1, 10, 20)
+        self.assertEqual(model.getPrior(), 320 / 40.)
+        self.assertAlmostEqual(model.getEventTime('2'), (10 * 8 + 20) / 20.)
+        self.assertEqual(model.getSetupTime('1'), 300)
+        self.assertEqual(model.getSetupTime('2'), 300)
+        self.assertFalse(model.update('3', 1, 0, 10))
+        self.assertFalse(model.update('3', 1, None, 10))
+
+    def testPacking(self):
+        packer = self.packer
+        packer.addEventRanges('1', range(600))
+        packer.addEventRanges('2', range(600))
+        packer.addEventRanges('3', range(5))
+        ranks = {}
+        for rank in range(1, 4):
+            jobId = packer.getJob(rank)
+            packer.addRank(jobId, rank)
+            ranks[rank] = jobId
+        # every job gets a rank first, the biggest first
+        self.assertEqual(sorted(ranks.values()), ['1', '2', '3'])
+        self.assertEqual(ranks[3], '3')
+        # job 1 is three times slower than job 2
+        packer.updateRate(ranks[1], 1, 100, 3000, 100)
+        packer.updateRate(ranks[2], 2, 100, 1000, 100)
+        for rank in range(4, 12):
+            jobId = packer.getJob(rank)
+            packer.addRank(jobId, rank)
+        self.assertEqual(len(packer.jobsRanks[ranks[1]]), 7)
+        self.assertEqual(len(packer.jobsRanks[ranks[2]]), 3)
+        # job 3 is too small for another rank
+        self.assertEqual(len(packer.jobsRanks['3']), 1)
+
+    def testReassign(self):
+        packer = self.packer
+        packer.addEventRanges('1', range(1000))
+        packer.addEventRanges('2', range(100))
+        for rank in range(1, 5):
+            packer.addRank(packer.getJob(rank), rank)
+        self.assertEqual(len(packer.jobsRanks['1']), 3)
+        # job 2 runs dry: its rank goes to job 1, the rank which ran job 1 already cannot take it again
+        self.assertEqual(packer.jobsRanks['2'], set([2]))
+        packer.getEventRanges('2', 2, 100)
+        packer.removeRank('2', 2)
+        self.assertEqual(packer.getJob(2, exclude=set(['2'])), '1')
+        self.assertEqual(packer.getJob(1, exclude=set(['1'])), None)
+        self.assertEqual(packer.getJob(5), '1')
+        # a new measurement or new ranges update the heap
+        packer.updateRate('1', 1, 10, 100)
+        packer.addEventRanges('3', range(50))
+        self.assertEqual(packer.getJob(5), '3')
+        # no time left for the setup
+        packer.updateRate('1', 3, 10, 100, 600)
+        self.now = 36000 - 500
+        self.assertEqual(packer.getJob(5), None)
+
+    def testSimulation(self):
+        rng = random.Random(3)
+        jobs, speeds = syntheticJobs(4000, rng)
+        workdir = tempfile.mkdtemp()
+        try:
+            trace = os.path.join(workdir, 'trace.csv')
+            recorded = simulatePacking(jobs, 40, 8, 'ranks', traceFile=trace)
+            replayJobs, speeds = loadTrace(trace)
+        finally:
+            shutil.rmtree(workdir)
+        self.assertEqual(recorded['processed'], sum([spec['events'] for spec in jobs.values()]))
+        self.assertEqual(sorted(replayJobs.keys()), sorted(jobs.keys()))
+        for jobId in jobs:
+            self.assertEqual(replayJobs[jobId]['events'], jobs[jobId]['events'])
+        ranks = simulatePacking(replayJobs, 40, 8, 'ranks', speeds)
+        packing = simulatePacking(replayJobs, 40, 8, 'packing', speeds)
+        for stats in (ranks, packing):
+            self.assertEqual(stats['processed'], recorded['processed'])
+            self.assertEqual(stats['ready'], 0)
+        self.assertTrue(packing['makespan'] < ranks['makespan'])
+
+
+@benchmark("packing")
+def benchmarkPacking(args):
+    """ Replays a heartbeat trace (jobMetrics-ranks.csv of a Yoda run with --metricsTimeSeries) in a discrete event
+        simulation of the allocation, once with the rank queues of Yoda.initJobRanks ('ranks') and once with the
+        JobPacker ('packing'), and compares the makespans. The jobs (events, time per event, setup time) and the speeds
+        of the ranks are taken from the trace; without a trace ('-'), a synthetic one is recorded first with 'ranks':
+        python PilotTests.py benchmark packing [trace] [ranks] [workers per rank] """
+
+    trace = args[0] if len(args) > 0 and args[0] != '-' else None
+    nRanks = int(args[1]) if len(args) > 1 else 500
+    workers = int(args[2]) if len(args) > 2 else 16
+
+    logging.disable(logging.CRITICAL)
+    if trace:
+        jobs, speeds = loadTrace(trace)
+    else:
+        jobs, speeds = syntheticJobs(nRanks * workers * 20, random.Random(1))
+        trace = tempfile.mktemp(suffix='.csv')
+        t0 = time.time()
+        simulatePacking(jobs, nRanks, workers, 'ranks', traceFile=trace)
+        print "synthetic trace recorded in %.0f s" % (time.time() - t0)
+        jobs, speeds = loadTrace(trace)
+        os.remove(trace)
+    print "%d jobs, %d events, %d ranks x %d workers" % (len(jobs), sum([spec['events'] for spec in jobs.values()]), nRanks, workers)
+    for policy in ('ranks', 'packing'):
+        t0 = time.time()
+        stats = simulatePacking(jobs, nRanks, workers, policy, speeds)
+        jobEnds = sorted(stats['jobEnd'].values())
+        print "%-8s makespan %.0f s, first job done %.0f s, tail idle %.0f core-hours (%.1f%% of %.0f), job switches %d (simulated in %.0f s)" % \
+              (policy, stats['makespan'], jobEnds[0], stats['tailIdle'], 100. * stats['tailIdle'] / stats['coreHours'], stats['coreHours'],
+               stats['jobSwitches'], time.time() - t0)
+
+
+# SURLRegistry
+
+class SURLRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def testJournalAndCompaction(self):
+        registry = SURLRegistry(self.workdir, 1, compactEntries=5)
+        for i in range(7):
+            self.assertTrue(registry.add("guid-%d" % i, "srm://se/file.%d" % i))
+        # compacted after 5 entries, 2 in the journal
+        self.assertEqual(json.load(open(registry.filename)), dict(("guid-%d" % i, "srm://se/file.%d" % i) for i in range(5)))
+        self.assertEqual(len(open(registry.journal).readlines()), 2)
+        self.assertEqual(len(SURLRegistry(self.workdir, 1)), 7)
+        self.assertTrue(registry.compact())
+        self.assertFalse(os.path.exists(registry.journal))
+        self.assertEqual(len(json.load(open(registry.filename))), 7)
+        registry.replace({'a': 'b'})
+        self.assertEqual(SURLRegistry(self.workdir, 1).getDictionary(), {'a': 'b'})
+
+    def testCrash(self):
+        registry = SURLRegistry(self.workdir, 1, compactEntries=3)
+        for i in range(4):
+            registry.add("guid-%d" % i, "srm://se/file.%d" % i)
+        # killed while appending an entry
+        open(registry.journal, "a").write("guid-4\tsrm://se/fi")
+        recovered = SURLRegistry(self.workdir, 1)
+        self.assertEqual(len(recovered), 4)
+        self.assertEqual(recovered.get("guid-3"), "srm://se/file.3")
+        # the dictionary file of older pilots is read as well
+        json.dump({'old': 'srm://se/old'}, open(os.path.join(self.workdir, "surlDictionary-2.json"), "w"))
+        self.assertEqual(SURLRegistry(self.workdir, 2).get('old'), 'srm://se/old')
+
+    def testOtherProcess(self):
+        writer = SURLRegistry(self.workdir, 1, compactEntries=3)
+        reader = SURLRegistry(self.workdir, 1)
+        writer.add("guid-0", "srm://se/file.0")
+        reader.refresh()
+        self.assertEqual(reader.getDictionary(), {"guid-0": "srm://se/file.0"})
+        for i in range(1, 5):
+            writer.add("guid-%d" % i, "srm://se/file.%d" % i)
+        reader.refresh()
+        self.assertEqual(reader.getDictionary(), writer.getDictionary())
+        # the reader adds (log file) after the writer
+        reader.add("guid-log", "srm://se/log")
+        writer.refresh()
+        self.assertEqual(len(writer), 6)
+
+    def testUpdateXMLWithSURLs(self):
+        xml = ""
+        for i in range(3):
+            xml += '<File ID="guid-%d">\n  <metadata att_name="surl" att_value="guid-%d-surltobeset"/>\n</File>\n' % (i, i)
+        SiteMover.SiteMover.updateSURLDictionary("guid-0", "srm://se/file.0", self.workdir, 3)
+        SiteMover.SiteMover.updateSURLDictionary("guid-2", "srm://se/file.2", self.workdir, 3)
+        updated = pUtil.updateXMLWithSURLs('ATLAS', xml, self.workdir, 3, False)
+        self.assertTrue('att_value="srm://se/file.0"' in updated)
+        self.assertTrue('att_value="srm://se/file.2"' in updated)
+        self.assertFalse('surltobeset' in updated)
+        self.assertEqual(updated.count('<File ID'), 3)
+        # job recovery keeps the line of the missing guid
+        self.assertTrue('guid-1-surltobeset' in pUtil.updateXMLWithSURLs('ATLAS', xml, self.workdir, 3, True))
+        self.assertEqual(SiteMover.SiteMover.getSURLDictionary(self.workdir, 3), {"guid-0": "srm://se/file.0", "guid-2": "srm://se/file.2"})
+
+
+@benchmark("surls")
+def benchmarkSURLs(args):
+    """ SURL dictionary updates after every transfer and the metadata update of the job, rewriting the dictionary file
+        (as SiteMover did) vs the registry: python PilotTests.py benchmark surls [outputs] """
+
+    nOutputs = int(args[0]) if len(args) > 0 else 20000
+    workdir = tempfile.mkdtemp()
+    try:
+        outputs = [("%08d-0000-0000-0000-000000000000" % i, "srm://se.example.org/atlas/rucio/mc16/HITS.%08d.pool.root.1" % i)
+                   for i in range(nOutputs)]
+        xml = "".join(['<File ID="%s">\n  <metadata att_name="surl" att_value="%s-surltobeset"/>\n</File>\n' % (guid, guid)
+                       for guid, surl in outputs])
+        # the dictionary file read and rewritten after every transfer
+        filename = os.path.join(workdir, "surlDictionary-1.json")
+        t0 = time.time()
+        for guid, surl in outputs:
+            surls = json.load(open(filename)) if os.path.exists(filename) else {}
+            surls[guid] = surl
+            json.dump(surls, open(filename, "w"))
+        rewrite = time.time() - t0
+        t0 = time.time()
+        for guid, surl in outputs:
+            SiteMover.SiteMover.updateSURLDictionary(guid, surl, workdir, 2)
+        registry = time.time() - t0
+        t0 = time.time()
+        updated = pUtil.updateXMLWithSURLs('ATLAS', xml, workdir, 2, False)
+        update = time.time() - t0
+        assert updated.count("srm://") == nOutputs
+        print "%d outputs: dictionary rewritten per transfer %.2f s, registry %.2f s, updateXMLWithSURLs %.2f s" % \
+              (nOutputs, rewrite, registry, update)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        if len(sys.argv) < 3 or sys.argv[2] not in BENCHMARKS:
+            print "usage: python PilotTests.py benchmark <%s> [args]" % ("|".join(sorted(BENCHMARKS.keys())))
+            sys.exit(1)
+        BENCHMARKS[sys.argv[2]](sys.argv[3:])
+    else:
+        unittest.main()
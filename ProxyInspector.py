@@ -0,0 +1,234 @@
+# ProxyInspector.py
+#
+# In-process inspection of X.509 (VOMS) proxy files.
+# The proxy lifetime checks used to fork arcproxy or voms-proxy-info (through the full environment setup) every
+# time. This module reads the proxy PEM file itself: the notAfter times of all certificates in the file, and the
+# notAfter times of the VOMS attribute certificates (AC) embedded in the VOMS extension. Signatures are not verified,
+# only the remaining lifetime is answered. Results are cached per file and re-read when the inode, mtime or size of
+# the file changes. For files which can not be parsed, None is returned and the callers fall back to the external
+# tools.
+
+import os
+import re
+import time
+import base64
+import calendar
+import threading
+from binascii import hexlify
+
+from pUtil import tolog
+
+# DER encoded object identifier of the VOMS AC extension, 1.3.6.1.4.1.8005.100.100.5
+VOMS_AC_OID = "\x2b\x06\x01\x04\x01\xbe\x45\x64\x64\x05"
+
+_TAG_SEQUENCE = 0x30
+_TAG_OID = 0x06
+_TAG_OCTET_STRING = 0x04
+_TAG_UTC_TIME = 0x17
+_TAG_GENERALIZED_TIME = 0x18
+_TAG_EXTENSIONS = 0xa3
+
+_PEM_CERTIFICATE = re.compile(r"-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----", re.DOTALL)
+
+_cache = {}
+_lock = threading.Lock()
+
+
+class ProxyParseError(Exception):
+    pass
+
+
+def getProxyPath():
+    """ Return the path of the proxy file, $X509_USER_PROXY or the grid default """
+
+    return os.environ.get('X509_USER_PROXY', "/tmp/x509up_u%d" % (os.getuid()))
+
+
+def readTLV(data, offset):
+    """ Read a DER tag/length header at offset, return (tag, start, end) of the content """
+
+    if offset + 2 > len(data):
+        raise ProxyParseError("truncated DER header at %d" % (offset))
+    tag = ord(data[offset])
+    length = ord(data[offset + 1])
+    offset += 2
+    if length & 0x80:
+        n = length & 0x7f
+        if n == 0 or n > 4 or offset + n > len(data):
+            raise ProxyParseError("unsupported DER length at %d" % (offset))
+        length = int(hexlify(data[offset:offset + n]), 16)
+        offset += n
+    if offset + length > len(data):
+        raise ProxyParseError("truncated DER content at %d" % (offset))
+    return tag, offset, offset + length
+
+
+def children(data, start, end):
+    """ Return [(tag, start, end)] of the DER elements between start and end """
+
+    elements = []
+    while start < end:
+        tag, _start, _end = readTLV(data, start)
+        elements.append((tag, _start, _end))
+        start = _end
+    return elements
+
+
+def parseTime(tag, value):
+    """ Convert an UTCTime or GeneralizedTime to seconds since the epoch """
+
+    if not value.endswith("Z"):
+        raise ProxyParseError("time is not in UTC: %s" % (value))
+    value = value[:-1].split(".")[0]
+    if tag == _TAG_UTC_TIME:
+        # YYMMDDHHMM[SS], years 50-99 are 19xx
+        year = int(value[:2])
+        value = ("19%s" if year >= 50 else "20%s") % (value)
+    if len(value) == 12:
+        value += "00"
+    if len(value) != 14:
+        raise ProxyParseError("unsupported time format: %s" % (value))
+    return calendar.timegm(time.strptime(value, "%Y%m%d%H%M%S"))
+
+
+def findACValidity(data, start, end, found):
+    """ Collect the notAfter times of all validity periods (SEQUENCE of two GeneralizedTimes) in the VOMS extension """
+
+    elements = children(data, start, end)
+    if len(elements) == 2 and all([tag == _TAG_GENERALIZED_TIME for tag, _start, _end in elements]):
+        found.append(parseTime(_TAG_GENERALIZED_TIME, data[elements[1][1]:elements[1][2]]))
+        return
+    for tag, _start, _end in elements:
+        # constructed elements only (SEQUENCE, SET, explicit tags)
+        if tag & 0x20:
+            findACValidity(data, _start, _end, found)
+
+
+def parseCertificate(der):
+    """ Return (notAfter, [VOMS AC notAfter, ..]) of a DER encoded certificate """
+
+    tag, start, end = readTLV(der, 0)
+    if tag != _TAG_SEQUENCE:
+        raise ProxyParseError("certificate is not a SEQUENCE")
+    tag, start, end = readTLV(der, start)
+    if tag != _TAG_SEQUENCE:
+        raise ProxyParseError("tbsCertificate is not a SEQUENCE")
+    tbs = children(der, start, end)
+
+    # skip the optional explicit version
+    if tbs and tbs[0][0] == 0xa0:
+        tbs = tbs[1:]
+    # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo, ...
+    if len(tbs) < 6 or tbs[3][0] != _TAG_SEQUENCE:
+        raise ProxyParseError("unexpected tbsCertificate structure")
+    validity = children(der, tbs[3][1], tbs[3][2])
+    if len(validity) != 2:
+        raise ProxyParseError("unexpected validity structure")
+    notAfter = parseTime(validity[1][0], der[validity[1][1]:validity[1][2]])
+
+    acs = []
+    for tag, start, end in tbs[6:]:
+        if tag != _TAG_EXTENSIONS:
+            continue
+        tag, start, end = readTLV(der, start)
+        for _tag, _start, _end in children(der, start, end):
+            extension = children(der, _start, _end)
+            if extension[0][0] != _TAG_OID or der[extension[0][1]:extension[0][2]] != VOMS_AC_OID:
+                continue
+            tag, value_start, value_end = extension[-1]
+            if tag != _TAG_OCTET_STRING:
+                raise ProxyParseError("VOMS extension value is not an OCTET STRING")
+            findACValidity(der, value_start, value_end, acs)
+
+    return notAfter, acs
+
+
+def parseProxy(pem):
+    """
+    Parse the certificates of a proxy file, return a dictionary with
+    'notAfter': the end of the validity of the proxy (the earliest notAfter of all certificates in the file)
+    'vomsNotAfter': the end of the validity of the VOMS attributes (the earliest AC notAfter), None without VOMS AC
+    """
+
+    blocks = _PEM_CERTIFICATE.findall(pem)
+    if not blocks:
+        raise ProxyParseError("no certificates found")
+
+    notAfters = []
+    acs = []
+    for block in blocks:
+        try:
+            der = base64.b64decode("".join(block.split()))
+        except TypeError, e:
+            raise ProxyParseError("invalid base64 data: %s" % (e))
+        notAfter, _acs = parseCertificate(der)
+        notAfters.append(notAfter)
+        acs += _acs
+
+    return {'notAfter': min(notAfters), 'vomsNotAfter': min(acs) if acs else None}
+
+
+def inspectProxy(path=None):
+    """ Return the (cached) validity dictionary of parseProxy() for a proxy file, None if it can not be parsed """
+
+    if not path:
+        path = getProxyPath()
+    try:
+        st = os.stat(path)
+    except OSError, e:
+        tolog("Can not inspect proxy %s: %s" % (path, e))
+        return None
+    stamp = (st.st_ino, st.st_mtime, st.st_size)
+
+    _lock.acquire()
+    try:
+        entry = _cache.get(path)
+    finally:
+        _lock.release()
+    if entry and entry[0] == stamp:
+        return entry[1]
+
+    try:
+        handle = open(path)
+        try:
+            info = parseProxy(handle.read())
+        finally:
+            handle.close()
+    except Exception, e:
+        tolog("Can not parse proxy %s: %s" % (path, e))
+        info = None
+
+    _lock.acquire()
+    try:
+        _cache[path] = (stamp, info)
+    finally:
+        _lock.release()
+    return info
+
+
+def getTimeLeft(path=None, voms=True):
+    """
+    Return the remaining lifetime of a proxy in seconds (of its VOMS attributes if voms is set), None if the
+    proxy file can not be parsed or (with voms set) has no VOMS attributes
+    """
+
+    info = inspectProxy(path)
+    if info is None:
+        return None
+    notAfter = info['notAfter']
+    if voms:
+        if info['vomsNotAfter'] is None:
+            return None
+        # the attributes can not outlive the proxy
+        notAfter = min(notAfter, info['vomsNotAfter'])
+    return max(int(notAfter - time.time()), 0)
+
+
+def clear():
+    """ Forget all cached proxy files """
+
+    _lock.acquire()
+    try:
+        _cache.clear()
+    finally:
+        _lock.release()
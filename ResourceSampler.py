@@ -0,0 +1,400 @@
+# ResourceSampler.py
+#
+# Resident worker node resource sampler.
+# Node.collectWNInfo() used to parse /proc/meminfo and the whole of /proc/cpuinfo, and fork 'df' for the disk space,
+# on every call. The sampler thread keeps memory, cpu model/count/frequency, load and the free space of the watched
+# paths in a shared snapshot instead, refreshed every 'interval' seconds. /proc/meminfo and /proc/loadavg are kept
+# open and re-read from the start, the free space is read with os.statvfs(). The snapshot also keeps min/max/avg
+# statistics of the samples, which are reported with the job metrics and reset when a job starts.
+# Space checks must not use the sampled free space, which can be 'interval' seconds old; Node.collectWNInfo()
+# always reads the free space of the requested path with os.statvfs().
+#
+# Usage:
+#   ResourceSampler.start(interval=60)            # once, from the pilot
+#   snapshot = ResourceSampler.getSnapshot(path)  # None if no sampler is running
+
+import os
+import time
+import atexit
+import threading
+
+from pUtil import tolog
+
+# /proc/cpuinfo is large on many-core nodes and the cpu frequency changes slowly, only re-read it every N samples
+CPUINFO_SAMPLES = 10
+
+_sampler = None
+_lock = threading.Lock()
+
+
+def readMeminfo(data):
+    """ Return the /proc/meminfo fields as a dictionary, values in kB """
+
+    info = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            try:
+                info[fields[0].rstrip(':')] = int(fields[1])
+            except ValueError:
+                pass
+    return info
+
+
+def readCpuinfo(data):
+    """ Return (model name, MHz of the first cpu, number of cpus) from /proc/cpuinfo """
+
+    model = ""
+    mhz = 0.0
+    count = 0
+    for line in data.splitlines():
+        if line.startswith("processor"):
+            count += 1
+        elif line.startswith("model name") and not model:
+            model = line.split(":", 1)[1].strip()
+        elif line.startswith("cpu MHz") and not mhz:
+            try:
+                mhz = float(line.split(":", 1)[1])
+            except ValueError:
+                pass
+    return model, mhz, count
+
+
+def readLoadavg(data):
+    """ Return the 1, 5 and 15 minute load averages from /proc/loadavg """
+
+    fields = data.split()
+    return tuple([float(field) for field in fields[:3]])
+
+
+def getFreeSpace(path):
+    """ Return the space available to unprivileged users under path in MB (i.e. the 'Available' column of df -mP) """
+
+    st = os.statvfs(path)
+    return float(st.f_bavail) * st.f_frsize / 1024**2
+
+
+def getMountPoint(path):
+    """ Return the mount point of path """
+
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class Statistics(object):
+    """ Running min/max/avg of a sampled value """
+
+    def __init__(self):
+        self.min = None
+        self.max = None
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if self.count == 0 or value > self.max:
+            self.max = value
+        self.total += value
+        self.count += 1
+
+    def avg(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+
+class ResourceSampler(threading.Thread):
+    """ Daemon thread sampling the worker node resources every 'interval' seconds """
+
+    def __init__(self, interval=60, paths=None, proc_root="/proc"):
+        threading.Thread.__init__(self, name="ResourceSampler")
+        self.setDaemon(True)
+
+        self.interval = interval
+        self.proc_root = proc_root
+
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__files = {}
+        self.__samples = 0
+
+        # the shared snapshot, replaced (not modified) on every sample
+        self.__snapshot = {'time': None, 'mem': 0.0, 'memFree': 0.0, 'memAvailable': 0.0,
+                           'cpu': 0.0, 'cpuModel': "", 'numberOfCpus': 0, 'load': (0.0, 0.0, 0.0), 'disk': {}}
+        self.__statistics = {}
+        self.__paths = {}
+        for path in paths or []:
+            self.watch(path, sample=False)
+
+        self.sample()
+
+    def __read(self, name):
+        """ Read a /proc file from the start, keeping it open between samples """
+
+        fd = self.__files.get(name)
+        if fd is None:
+            fd = open(os.path.join(self.proc_root, name), "r")
+            self.__files[name] = fd
+        else:
+            fd.seek(0)
+        return fd.read()
+
+    def __addStatistics(self, name, value):
+        if name not in self.__statistics:
+            self.__statistics[name] = Statistics()
+        self.__statistics[name].add(value)
+
+    def watch(self, path, sample=True):
+        """ Add a path to the free space sampling, and sample it right away """
+
+        self.__lock.acquire()
+        try:
+            known = path in self.__paths
+            if not known:
+                self.__paths[path] = getMountPoint(path)
+        finally:
+            self.__lock.release()
+
+        if not known and sample:
+            self.sampleDisk(path)
+
+    def sampleDisk(self, path):
+        """ Update the free space of one path in the snapshot """
+
+        try:
+            free = getFreeSpace(path)
+        except OSError, e:
+            tolog("!!WARNING!!1999!! Failed to get free space of %s: %s" % (path, e))
+            return
+
+        self.__lock.acquire()
+        try:
+            disk = dict(self.__snapshot['disk'])
+            disk[path] = free
+            self.__snapshot = dict(self.__snapshot, disk=disk)
+            self.__addStatistics("diskFree:%s" % (path), free)
+        finally:
+            self.__lock.release()
+
+    def sample(self):
+        """ Take one sample of all resources """
+
+        snapshot = dict(self.__snapshot)
+        snapshot['time'] = time.time()
+
+        try:
+            meminfo = readMeminfo(self.__read("meminfo"))
+            snapshot['mem'] = meminfo.get('MemTotal', 0) / 1024.0
+            snapshot['memFree'] = meminfo.get('MemFree', 0) / 1024.0
+            # MemAvailable is only known to kernels >= 3.14
+            available = meminfo.get('MemAvailable')
+            if available is None:
+                available = meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+            snapshot['memAvailable'] = available / 1024.0
+        except (IOError, OSError), e:
+            tolog("!!WARNING!!1999!! Failed to read meminfo: %s" % (e))
+
+        if self.__samples % CPUINFO_SAMPLES == 0:
+            try:
+                fd = open(os.path.join(self.proc_root, "cpuinfo"), "r")
+                try:
+                    snapshot['cpuModel'], snapshot['cpu'], snapshot['numberOfCpus'] = readCpuinfo(fd.read())
+                finally:
+                    fd.close()
+            except (IOError, OSError), e:
+                tolog("!!WARNING!!1999!! Failed to read cpuinfo: %s" % (e))
+
+        try:
+            snapshot['load'] = readLoadavg(self.__read("loadavg"))
+        except (IOError, OSError, ValueError), e:
+            tolog("!!WARNING!!1999!! Failed to read loadavg: %s" % (e))
+
+        self.__lock.acquire()
+        try:
+            paths = self.__paths.keys()
+        finally:
+            self.__lock.release()
+
+        disk = {}
+        for path in paths:
+            try:
+                disk[path] = getFreeSpace(path)
+            except OSError, e:
+                tolog("!!WARNING!!1999!! Failed to get free space of %s: %s" % (path, e))
+        snapshot['disk'] = disk
+
+        self.__lock.acquire()
+        try:
+            self.__snapshot = snapshot
+            self.__samples += 1
+            self.__addStatistics("memAvailable", snapshot['memAvailable'])
+            self.__addStatistics("load", snapshot['load'][0])
+            for path in disk.keys():
+                self.__addStatistics("diskFree:%s" % (path), disk[path])
+        finally:
+            self.__lock.release()
+
+        return snapshot
+
+    def getSnapshot(self, path=None):
+        """
+        Return a copy of the latest snapshot. If path is given, the snapshot also has 'disk' set to the
+        free space of that path (the path is added to the sampled paths if needed).
+        """
+
+        if path:
+            self.watch(path)
+
+        self.__lock.acquire()
+        try:
+            snapshot = dict(self.__snapshot)
+        finally:
+            self.__lock.release()
+
+        disk = snapshot['disk']
+        snapshot['paths'] = dict(disk)
+        snapshot['disk'] = disk.get(path, 0.0) if path else 0.0
+        return snapshot
+
+    def getStatistics(self):
+        """ Return {name: (min, max, avg, number of samples)} of the sampled values """
+
+        self.__lock.acquire()
+        try:
+            return dict([(name, (s.min, s.max, s.avg(), s.count)) for name, s in self.__statistics.items()])
+        finally:
+            self.__lock.release()
+
+    def resetStatistics(self):
+        """ Forget the statistics of the earlier samples, e.g. those of the previous job """
+
+        self.__lock.acquire()
+        try:
+            self.__statistics = {}
+        finally:
+            self.__lock.release()
+
+    def getMountPoints(self):
+        """ Return {path: mount point} of the sampled paths """
+
+        self.__lock.acquire()
+        try:
+            return dict(self.__paths)
+        finally:
+            self.__lock.release()
+
+    def run(self):
+        while not self.__stop.isSet():
+            self.__stop.wait(self.interval)
+            if self.__stop.isSet():
+                break
+            try:
+                self.sample()
+            except Exception, e:
+                tolog("!!WARNING!!1999!! Resource sampling failed: %s" % (e))
+
+        for fd in self.__files.values():
+            try:
+                fd.close()
+            except:
+                pass
+
+    def stop(self):
+        self.__stop.set()
+
+
+def start(interval=60, paths=None, proc_root="/proc"):
+    """ Start the process-wide sampler (if not already running) and return it """
+
+    global _sampler
+
+    _lock.acquire()
+    try:
+        if _sampler is None or not _sampler.isAlive():
+            _sampler = ResourceSampler(interval=interval, paths=paths, proc_root=proc_root)
+            _sampler.start()
+            tolog("Started resource sampler (interval: %d s)" % (interval))
+        else:
+            for path in paths or []:
+                _sampler.watch(path)
+        return _sampler
+    finally:
+        _lock.release()
+
+
+def stop(timeout=1):
+    """ Stop the process-wide sampler """
+
+    global _sampler
+
+    _lock.acquire()
+    try:
+        sampler = _sampler
+        _sampler = None
+    finally:
+        _lock.release()
+
+    if sampler is not None:
+        sampler.stop()
+        if sampler.isAlive() and sampler is not threading.currentThread():
+            sampler.join(timeout)
+
+# let the sampler thread finish before the interpreter tears down the modules
+atexit.register(stop)
+
+
+def getSampler():
+    """ Return the running process-wide sampler, or None """
+
+    sampler = _sampler
+    if sampler is not None and sampler.isAlive():
+        return sampler
+    return None
+
+
+def getSnapshot(path=None):
+    """ Return the latest snapshot of the running sampler (see ResourceSampler.getSnapshot), or None """
+
+    sampler = getSampler()
+    if sampler is None:
+        return None
+    return sampler.getSnapshot(path)
+
+
+def resetStatistics():
+    """ Start new statistics for the job metrics of the next job (called when a job starts) """
+
+    sampler = getSampler()
+    if sampler is not None:
+        sampler.resetStatistics()
+
+
+def getJobMetrics():
+    """ Return the sampled min/max/avg values as (name, value) job metrics fields """
+
+    sampler = getSampler()
+    if sampler is None:
+        return []
+
+    statistics = sampler.getStatistics()
+    fields = []
+    if "load" in statistics:
+        _min, _max, _avg, _n = statistics["load"]
+        fields.append(("nodeLoadAvg", "%.2f" % (_avg)))
+        fields.append(("nodeLoadMax", "%.2f" % (_max)))
+    if "memAvailable" in statistics:
+        _min, _max, _avg, _n = statistics["memAvailable"]
+        fields.append(("nodeMemAvailMin", "%d" % (_min)))
+        fields.append(("nodeMemAvailAvg", "%d" % (_avg)))
+
+    # the lowest free space seen on any of the sampled paths
+    disk = [statistics[name][0] for name in statistics.keys() if name.startswith("diskFree:")]
+    if disk:
+        fields.append(("nodeDiskFreeMin", "%d" % (min(disk))))
+    return fields
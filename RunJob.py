@@ -9,6 +9,10 @@
 #   Subclasses should implement all needed methods prototyped in this class
 #   Note: not compatible with Singleton Design Pattern due to the subclassing
 
+# Start the import profiler (if requested, e.g. inherited from the pilot) before the pilot modules are loaded
+import ImportProfiler
+ImportProfiler.enable()
+
 # Standard python modules
 import os, sys, commands, time
 import traceback
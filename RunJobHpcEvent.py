@@ -5,13 +5,13 @@
 #   Implemented as a singleton class
 #   http://stackoverflow.com/questions/42558/python-and-the-singleton-pattern
 
-import commands
 import json
 import os
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
@@ -25,6 +25,7 @@ import RunJobUtilities
 import Mover as mover
 
 from ThreadPool import ThreadPool
+from StreamingArchiver import StreamingArchiver
 from RunJob import RunJob              # Parent RunJob class
 from JobState import JobState
 from JobRecovery import JobRecovery
@@ -85,6 +86,11 @@ class RunJobHpcEvent(RunJob):
         self.__yoda_to_zip = False
         self.__es_to_zip = False
         self.__stageout_status = False
+        self.__zip_shard_size = 0
+        self.__zip_threads = 1
+        # the archive shards are staged out by several threads, the job state is updated once per job
+        self.__stagingOutLock = threading.Lock()
+        self.__stagingOutJobs = set()
 
         # for recovery
         self.__jobStateFile = None
@@ -218,6 +224,8 @@ class RunJobHpcEvent(RunJob):
         res['localWorkingDir'] =  values.get('localWorkingDir', None)
         res['parallel_jobs'] = values.get('parallel_jobs', 1)
         res['events_limit_per_job'] = int(values.get('events_limit_per_job', 1000))
+        res['zip_shard_size_mb'] = int(values.get('zip_shard_size_mb', 0))
+        res['zip_threads'] = int(values.get('zip_threads', 1))
 
         if 'debug' in res['queue']:
             res['walltime_m'] = 30
@@ -270,6 +278,8 @@ class RunJobHpcEvent(RunJob):
         self.__nJobs = defRes['parallel_jobs']
         self.__stageout_threads = defRes['stageout_threads']
         self.__copyOutputToGlobal = defRes['copyOutputToGlobal']
+        self.__zip_shard_size = defRes['zip_shard_size_mb'] * 1024 * 1024
+        self.__zip_threads = defRes['zip_threads']
 
         tolog("Setup HPC Manager")
         hpcManager = HPCManager(globalWorkingDir=self.__pilotWorkingDir, localWorkingDir=defRes['localWorkingDir'], logFileName=logFileName, copyInputFiles=self.__copyInputFiles)
@@ -1177,7 +1187,8 @@ class RunJobHpcEvent(RunJob):
                     #self.stageOutHPCEvent(output)
                     threadpool.add_task(self.stageOutHPCEvent, output)
 
-                time.sleep(30)
+                # woken up early by the completion of the HPC job or new outputs
+                hpcManager.waitForChange(30)
                 self.updateHPCEventRanges()
 
             tolog("HPCManager Job Finished")
@@ -1310,64 +1321,175 @@ class RunJobHpcEvent(RunJob):
         except:
             tolog("Failed in check job metrics: %s" % traceback.format_exc())
 
-    def zipOutputs(self, job, zipEventRangeName, zipFileName):
+    def zipOutputs(self, job, zipEventRangeName, zipFileName, onShard=None):
+        """
+        Archive the finished outputs listed in the event status dump, return the list of archive shards.
+        With onShard the dump is not renamed here, the caller does it once every shard is staged out.
+        """
+
         eventstatus = str(job.jobId) + "_event_status.dump"
         if os.path.exists(eventstatus + ".zipped"):
             tolog("Event status dump file %s exist. It's already zipped." % eventstatus + ".zipped")
-            return
+            return []
         if not os.path.exists(eventstatus):
             tolog("Event status dump file %s doesn't exist. checking backup file" % eventstatus)
             eventstatus = eventstatus + ".backup"
             if not os.path.exists(eventstatus):
                 tolog("Event status backup dump file %s doesn't exist." % eventstatus)
-                return
+                return []
+
+        tolog("Creating zip/tar file: %s (shard size: %s, threads: %s)" % (zipFileName, self.__zip_shard_size, self.__zip_threads))
+        archiver = StreamingArchiver(zipFileName, zipEventRangeName, maxShardSize=self.__zip_shard_size, threads=self.__zip_threads,
+                                     onShard=onShard, stageoutThreads=self.__stageout_threads)
+        archiver.start()
+        try:
+            archiver.addEventStatusFile(eventstatus)
+        finally:
+            shards = archiver.close()
+        if onShard is None or not shards:
+            tolog("Zip finished, Rename %s to %s" % (eventstatus, eventstatus + ".zipped"))
+            os.rename(eventstatus, eventstatus + ".zipped")
+        return shards
+
+    def getPendingZipShardsFile(self, job):
+        """ File listing the archive shards of a job which are not staged out yet """
+
+        return str(job.jobId) + "_event_status.dump.shards"
+
+    def finishZipShards(self, job, nStagedOut, failedShards):
+        """
+        Record the archive shards which failed to stage out, so that they are retried by the next stageOutZipFile().
+        Only when all shards are staged out the event status dump is renamed to .zipped.
+        """
+
+        self.setProcessedEvents(job, nStagedOut)
+        pendingFile = self.getPendingZipShardsFile(job)
+        if failedShards:
+            tolog("%s archive shards of job %s failed to stage out, will retry: %s" % (len(failedShards), job.jobId, [shard['path'] for shard in failedShards]))
+            handle = open(pendingFile + ".tmp", 'w')
+            json.dump({'nStagedOut': nStagedOut, 'shards': failedShards}, handle)
+            handle.close()
+            os.rename(pendingFile + ".tmp", pendingFile)
+            return
+
+        eventstatus = str(job.jobId) + "_event_status.dump"
+        if not os.path.exists(eventstatus):
+            eventstatus = eventstatus + ".backup"
+        if os.path.exists(eventstatus):
+            tolog("All archive shards staged out, Rename %s to %s" % (eventstatus, str(job.jobId) + "_event_status.dump.zipped"))
+            os.rename(eventstatus, str(job.jobId) + "_event_status.dump.zipped")
+        if os.path.exists(pendingFile):
+            os.remove(pendingFile)
+
+    def retryZipShards(self, job, espath, os_bucket_id):
+        """ Stage out the archive shards which failed before, return False if there are none """
+
+        pendingFile = self.getPendingZipShardsFile(job)
+        if not os.path.exists(pendingFile):
+            return False
+
+        handle = open(pendingFile)
+        pending = json.load(handle)
+        handle.close()
+
+        nStagedOut = pending['nStagedOut']
+        failedShards = []
+        for shard in pending['shards']:
+            tolog("Retrying stage-out of archive shard %s" % shard['path'])
+            nEventRanges = self.stageOutZipShard(job, shard['path'], shard['eventRangesPath'], espath, os_bucket_id, fsize=shard['size'], fchecksum=shard['checksum'])
+            if nEventRanges is None:
+                failedShards.append(shard)
+            else:
+                nStagedOut += nEventRanges
+        self.finishZipShards(job, nStagedOut, failedShards)
+        return True
+
+    def isZipSharded(self):
+        """ Are the event service outputs archived into several shards which are staged out while zipping? """
 
-        file = open(eventstatus)
-        import tarfile
-        tar = tarfile.open(zipFileName, 'w')
-        zipEventRange = open(zipEventRangeName, 'w')
+        return self.__es_to_zip and (self.__zip_shard_size > 0 or self.__zip_threads > 1) and not self.__copyOutputToGlobal
 
-        tolog("Creating zip/tar file: %s" % zipFileName)
+    def stageOutZipShard(self, job, zipFileName, zipEventRangeName, espath, os_bucket_id, fsize=0, fchecksum=0):
+        """ Stage out one tar/zip file and update the event ranges it contains, return the number of event ranges (None on failure) """
+
+        dsname, datasetDict = self.getJobDatasets(job)
+        report = getInitialTracingReport(userid=job.prodUserID, sitename=self.__jobSite.sitename, dsname=dsname, eventType="objectstore", analysisJob=False, jobId=job.jobId, jobDefId=job.jobDefinitionID, dn=job.prodUserID)
+        # called from several stage-out threads: each shard gets its own site mover
+        siteMover = objectstoreSiteMover(self.__siteMover.getSetup())
+        ret_status, pilotErrorDiag, surl, size, checksum, arch_type = siteMover.put_data(zipFileName, espath, lfn=os.path.basename(zipFileName), report=report, token=None, experiment='ATLAS', fsize=fsize, fchecksum=fchecksum)
+        if ret_status != 0:
+            tolog("Failed to stageout %s: %s" % (zipFileName, pilotErrorDiag))
+            return None
+
+        eventRanges = []
+        self.setJobStagingOut(job, os_bucket_id)
+        file = open(zipEventRangeName)
         for line in file:
-            #tolog("line: %s" % line)
+            line = line.strip()
+            if len(line):
+                eventRangeID = line.split(" ")[0]
+                eventStatus = line.split(" ")[1]
+                eventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': eventStatus, 'objstoreID': os_bucket_id})
+        file.close()
+        for chunkEventRanges in pUtil.chunks(eventRanges, 100):
+            tolog("Update event ranges: %s" % chunkEventRanges)
             try:
-                # jobId, eventRangeID,status,output = line.split(" ")
-                jobId = line.split(" ")[0]
-                eventRangeID = line.split(" ")[1]
-                status = line.split(" ")[2]
-                output = line.split(" ")[3]
-                if status.startswith("ERR"):
-                    status = 'failed'
+                status, output = self.updateEventRanges(chunkEventRanges)
+                tolog("Update Event ranges status: %s, output: %s" % (status, output))
             except:
-                tolog("Failed to parse %s at line: %s: %s" % (eventstatus, line, traceback.format_exc()))
-            if status == 'failed':
-                zipEventRange.write("%s %s %s\n" % (eventRangeID, status, output))
-            if not status == 'finished':
-                continue
-            outputs = output.split(",")[:-3]
-            for out in outputs:
-                #tolog("Adding file: %s" % out)
-                if not os.path.exists(out):
-                    tolog("File %s doesn't exist" % out)
-                    continue
-                tar.add(out, arcname=os.path.basename(out))
-                os.remove(out)
-            zipEventRange.write("%s %s %s\n" % (eventRangeID, status, output))
-        tar.close()
-        zipEventRange.close()
-        tolog("Zip finished, Rename %s to %s" % (eventstatus, eventstatus + ".zipped"))
-        os.rename(eventstatus, eventstatus + ".zipped")
+                tolog("Failed to update EventRanges: %s" % traceback.format_exc())
+                try:
+                    status, output = self.updateEventRanges(chunkEventRanges)
+                    tolog("Update Event ranges status: %s, output: %s" % (status, output))
+                except:
+                    tolog("Failed to update EventRanges: %s" % traceback.format_exc())
+        tolog("delete zip file: %s" % zipFileName)
+        try:
+            os.remove(zipFileName)
+        except OSError:
+            tolog("Failed to delete zip file %s: %s" % (zipFileName, traceback.format_exc()))
+        return len(eventRanges)
+
+    def setJobStagingOut(self, job, os_bucket_id):
+        """ Set the job to transferring when its first tar/zip file is staged out, the other ones do not update PanDA again """
+
+        with self.__stagingOutLock:
+            if job.jobId in self.__stagingOutJobs:
+                return
+            self.__jobs[job.jobId]['job'].outputZipBucketID = os_bucket_id
+            self.updateJobState(job, 'transferring', 'stagingOut', final=False, updatePanda=True)
+            self.__stagingOutJobs.add(job.jobId)
+
+    def setProcessedEvents(self, job, nEventRanges):
+        if job.yodaJobMetrics and 'totalProcessedEvents' in job.yodaJobMetrics:
+            job.yodaJobMetrics['totalProcessedEvents'] = nEventRanges
+            job.nEventsW = job.yodaJobMetrics['totalProcessedEvents']
 
     def stageOutZipFile(self, job, espath, os_bucket_id):
         try:
-            dsname, datasetDict = self.getJobDatasets(job)
-
             tolog("Checking zip status of job %s" % job.jobId)
             zipFileName = job.outputZipName
             zipEventRangeName = job.outputZipEventRangesName
             tolog("Checking zip file: %s" % zipFileName)
+
+            if self.isZipSharded() and zipFileName and zipEventRangeName:
+                # the outputs of the shards which failed to stage out are already removed, only the shards can be retried
+                if self.retryZipShards(job, espath, os_bucket_id):
+                    return
+
+                # every finished shard is staged out by the archiver's stage-out threads while the next ones are written
+                def onShard(shard):
+                    shard.nStagedOut = self.stageOutZipShard(job, shard.path, shard.eventRangesPath, espath, os_bucket_id, fsize=shard.size, fchecksum=shard.checksum)
+                shards = self.zipOutputs(job, zipEventRangeName, zipFileName, onShard=onShard)
+                if shards:
+                    failedShards = [{'path': shard.path, 'eventRangesPath': shard.eventRangesPath, 'size': shard.size, 'checksum': shard.checksum}
+                                    for shard in shards if getattr(shard, 'nStagedOut', None) is None]
+                    self.finishZipShards(job, sum([shard.nStagedOut or 0 for shard in shards if hasattr(shard, 'nStagedOut')]), failedShards)
+                    return
+
+            shards = []
             if self.__es_to_zip:
-                self.zipOutputs(job, zipEventRangeName, zipFileName)
+                shards = self.zipOutputs(job, zipEventRangeName, zipFileName)
 
             if zipFileName is None or (not os.path.exists(zipFileName)):
                 tolog("Zip file %s doesn't exits, will not stage out." % (zipFileName))
@@ -1394,41 +1516,15 @@ class RunJobHpcEvent(RunJob):
 
                 return
 
-            report = getInitialTracingReport(userid=job.prodUserID, sitename=self.__jobSite.sitename, dsname=dsname, eventType="objectstore", analysisJob=False, jobId=job.jobId, jobDefId=job.jobDefinitionID, dn=job.prodUserID)
-            ret_status, pilotErrorDiag, surl, size, checksum, arch_type = self.__siteMover.put_data(zipFileName, espath, lfn=os.path.basename(zipFileName), report=report, token=None, experiment='ATLAS')
-            if ret_status == 0:
-                eventRanges = []
-                self.__jobs[job.jobId]['job'].outputZipBucketID = os_bucket_id
-                self.updateJobState(job, 'transferring', 'stagingOut', final=False, updatePanda=True)
-                dumpFile = job.outputZipEventRangesName
-                file = open(dumpFile)
-                for line in file:
-                    line = line.strip()
-                    if len(line):
-                        eventRangeID = line.split(" ")[0]
-                        eventStatus = line.split(" ")[1]
-                        eventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': eventStatus, 'objstoreID': os_bucket_id})
-                if job.yodaJobMetrics and 'totalProcessedEvents' in job.yodaJobMetrics:
-                    job.yodaJobMetrics['totalProcessedEvents'] = len(eventRanges)
-                    job.nEventsW = job.yodaJobMetrics['totalProcessedEvents']
-                for chunkEventRanges in pUtil.chunks(eventRanges, 100):
-                    tolog("Update event ranges: %s" % chunkEventRanges)
-                    try:
-                        status, output = self.updateEventRanges(chunkEventRanges)
-                        tolog("Update Event ranges status: %s, output: %s" % (status, output))
-                    except:
-                        tolog("Failed to update EventRanges: %s" % traceback.format_exc())
-                        try:
-                            status, output = self.updateEventRanges(chunkEventRanges)
-                            tolog("Update Event ranges status: %s, output: %s" % (status, output))
-                        except:
-                            tolog("Failed to update EventRanges: %s" % traceback.format_exc())
-                command = "rm -f %s" % zipFileName
-                tolog("delete zip file: %s" % command)
-                status, output = commands.getstatusoutput(command)
-                tolog("status: %s, output: %s" % (status, output))
-            else:
-                tolog("Failed to stageout %s: %s" % (zipFileName, pilotErrorDiag))
+            # the archiver already knows size and adler32 of a freshly written zip file, the mover does not need to read it again
+            fsize = 0
+            fchecksum = 0
+            if len(shards) == 1:
+                fsize = shards[0].size
+                fchecksum = shards[0].checksum
+            nEventRanges = self.stageOutZipShard(job, zipFileName, zipEventRangeName, espath, os_bucket_id, fsize=fsize, fchecksum=fchecksum)
+            if nEventRanges:
+                self.setProcessedEvents(job, nEventRanges)
         except:
             tolog("Failed to stageout zip file for job %s: %s" % (job.jobId, traceback.format_exc()))
 
@@ -1505,7 +1601,7 @@ class RunJobHpcEvent(RunJob):
                 if state and state == 'Complete':
                     break
 
-                time.sleep(30)
+                hpcManager.waitForChange(30)
 
             tolog("HPCManager Job Finished")
             self.__hpcStatue = 'stagingOut'
@@ -5,6 +5,11 @@ import random
 import socket
 import urlparse
 import traceback
+import threading
+import hashlib
+import base64
+import zlib
+from StringIO import StringIO
 
 from TimerCommand import TimerCommand
 import SiteMover
@@ -17,6 +22,63 @@ from configSiteMover import config_sm
 
 CMD_CHECKSUM = config_sm.COMMAND_MD5
 
+# files of at least MULTIPART_THRESHOLD bytes are uploaded in parts and downloaded with ranged GETs of PART_SIZE bytes,
+# TRANSFER_THREADS at a time, each part is tried up to PART_RETRIES times
+# (can be set per queue with s3_multipart_threshold=<MB>,s3_part_size=<MB>,s3_threads=<N> in the catchall field)
+MULTIPART_THRESHOLD = 64*1024**2
+PART_SIZE = 16*1024**2
+MIN_PART_SIZE = 5*1024**2 # S3 minimum for all but the last part
+TRANSFER_THREADS = 4
+PART_RETRIES = 3
+BLOCK_SIZE = 1024**2
+
+def adler32_combine(adler1, adler2, len2):
+    """ Return the adler32 of the concatenation of two blocks, given the checksums of both and the length of the second """
+
+    BASE = 65521
+    rem = len2 % BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % BASE
+    sum1 += (adler2 & 0xffff) + BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + BASE - rem
+    if sum1 >= BASE:
+        sum1 -= BASE
+    if sum1 >= BASE:
+        sum1 -= BASE
+    if sum2 >= (BASE << 1):
+        sum2 -= (BASE << 1)
+    if sum2 >= BASE:
+        sum2 -= BASE
+    return sum1 | (sum2 << 16)
+
+def combine_part_checksums(parts):
+    """ Return the adler32 (hex) of a file from the {part number: (adler32, size)} of its parts """
+
+    checksum = 1L
+    for part_num in sorted(parts.keys()):
+        adler, size = parts[part_num]
+        checksum = adler32_combine(checksum, adler, size)
+    return "%08x" % (checksum & 0xffffffff)
+
+def getTransferOptions():
+    """ Return the multipart/ranged transfer options, with the catchall overrides of the queue """
+
+    options = {'threshold': MULTIPART_THRESHOLD, 'partSize': PART_SIZE, 'threads': TRANSFER_THREADS}
+    try:
+        values = {}
+        for catchall in readpar("catchall").split(","):
+            if '=' in catchall:
+                values[catchall.split('=')[0].strip()] = catchall.split('=')[1].strip()
+        if 's3_multipart_threshold' in values:
+            options['threshold'] = int(float(values['s3_multipart_threshold'])*1024**2)
+        if 's3_part_size' in values:
+            options['partSize'] = max(int(float(values['s3_part_size'])*1024**2), MIN_PART_SIZE)
+        if 's3_threads' in values:
+            options['threads'] = max(int(values['s3_threads']), 1)
+    except:
+        tolog("Failed to read S3 transfer options from catchall, using defaults: %s" % (sys.exc_info()[1]))
+    return options
+
 class S3ObjectstoreSiteMover(SiteMover.SiteMover):
     """ SiteMover that uses boto S3 client for both get and put """
     # no registration is done
@@ -77,7 +139,9 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
             tolog("Failed to get the keyPair name for S3 objectstore")
             return PilotErrors.ERR_GETKEYPAIR, "Failed to get the keyPair name for S3 objectstore"
 
-        self.s3Objectstore = S3ObjctStore(keyPair["privateKey"], keyPair["publicKey"], os_is_secure, self._useTimerCommand)
+        options = getTransferOptions()
+        self.s3Objectstore = S3ObjctStore(keyPair["privateKey"], keyPair["publicKey"], os_is_secure, self._useTimerCommand,
+                                          threshold=options['threshold'], partSize=options['partSize'], threads=options['threads'])
 
         return 0, ""
 
@@ -297,9 +361,12 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
         if remoteChecksum:
             checksumType = self.getChecksumType(remoteChecksum)
 
+        transferChecksum = None
         if checksumType == 'adler32':
             # S3 boto doesn't support adler32, remoteChecksum set to None
-            status, output, remoteSize, remoteChecksum = self.stageInFile(source, destination, remoteSize, None)
+            # (ranged downloads return the adler32 of the written file instead)
+            status, output, remoteSize, transferChecksum = self.stageInFile(source, destination, remoteSize, None)
+            remoteChecksum = None
         else:
             status, output, remoteSize, remoteChecksum = self.stageInFile(source, destination, remoteSize, remoteChecksum)
         if report:
@@ -309,10 +376,16 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
              self.log("Failed to stagein this file: %s" % output)
              return  PilotErrors.ERR_STAGEINFAILED, output
 
-        status, output, localSize, localChecksum = self.getLocalFileInfo(destination, checksumType)
-        if status:
-            self.log("Failed to get local file(%s) info." % destination)
-            return status, output
+        if transferChecksum:
+            # computed while writing the file, verify it against the known checksum instead of reading the file again
+            localSize, localChecksum = remoteSize, transferChecksum
+            remoteChecksum = sourceChecksum
+            self.log("Using adler32 computed during transfer: %s" % (localChecksum))
+        else:
+            status, output, localSize, localChecksum = self.getLocalFileInfo(destination, checksumType)
+            if status:
+                self.log("Failed to get local file(%s) info." % destination)
+                return status, output
 
         status, output = self.verifyStage(localSize, localChecksum, remoteSize, remoteChecksum)
 
@@ -321,7 +394,7 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
         self.log("Finished to stagin file %s(status:%s, output:%s)" % (source, status, output))
         return status, output
 
-    def stageOut(self, source, destination, token, experiment=None, outputDir=None, timeout=3600, os_bucket_id=-1, report=None):
+    def stageOut(self, source, destination, token, experiment=None, outputDir=None, timeout=3600, os_bucket_id=-1, report=None, sourceSize=None, sourceChecksum=None):
         """Stage in the source file"""
         self.log("Starting to stageout file %s to %s with token: %s, os_bucket_id: %s" % (source, destination, token, os_bucket_id))
 
@@ -329,11 +402,16 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
         if status:
             return status, output, None, None
 
-        status, output, localSize, localChecksum = self.getLocalFileInfo(source)
-        self.log("getLocalFileInfo  status: %s, output: %s, localSize: %s, localChecksum: %s" % ( status, output, localSize, localChecksum))
-        if status:
-            self.log("Failed to get local file(%s) info." % destination)
-            return status, output, None, None
+        if sourceSize and sourceChecksum and self.getChecksumType(sourceChecksum) == "adler32":
+            # size and adler32 were computed by the caller while writing the file (e.g. StreamingArchiver), don't read it again
+            localSize, localChecksum = sourceSize, sourceChecksum
+            self.log("Using known local file info, localSize: %s, localChecksum: %s" % (localSize, localChecksum))
+        else:
+            status, output, localSize, localChecksum = self.getLocalFileInfo(source)
+            self.log("getLocalFileInfo  status: %s, output: %s, localSize: %s, localChecksum: %s" % ( status, output, localSize, localChecksum))
+            if status:
+                self.log("Failed to get local file(%s) info." % destination)
+                return status, output, None, None
 
         if report:
             report['filesize'] = localSize
@@ -349,6 +427,10 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
              self.log("Failed to stageout this file: %s" % output)
              return  PilotErrors.ERR_STAGEOUTFAILED, output, localSize, localChecksum
 
+        if remoteChecksum and self.getChecksumType(remoteChecksum) != self.getChecksumType(localChecksum):
+            # multipart uploads return the adler32 of the uploaded data, which can only be compared with an adler32
+            remoteChecksum = None
+
         # remoteSize, remoteChecksum = self.getRemoteFileInfo(destination)
         # self.log("getRemoteFileInfo remoteSize: %s, remoteChecksum: %s" % (remoteSize, remoteChecksum))
         status, output = self.verifyStage(localSize, localChecksum, remoteSize, remoteChecksum)
@@ -440,7 +522,7 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
         else:
             report['eventType'] = 'put_es'
 
-        status, output, size, checksum = self.stageOut(source, surl, token, experiment, outputDir=outputDir, timeout=timeout, os_bucket_id=os_bucket_id, report=report)
+        status, output, size, checksum = self.stageOut(source, surl, token, experiment, outputDir=outputDir, timeout=timeout, os_bucket_id=os_bucket_id, report=report, sourceSize=fsize, sourceChecksum=fchecksum)
         if status !=0:
             errors = PilotErrors()
             state = errors.getErrorName(status)
@@ -475,7 +557,7 @@ class S3ObjctStore(object):
             cls._instance = super(S3ObjctStore, cls).__new__(cls, *args, **kwargs)
         return cls._instance
 
-    def __init__(self, privateKey, publicKey, is_secure, useTimerCommand):
+    def __init__(self, privateKey, publicKey, is_secure, useTimerCommand, threshold=MULTIPART_THRESHOLD, partSize=PART_SIZE, threads=TRANSFER_THREADS, retries=PART_RETRIES):
         self.access_key = publicKey
         self.secret_key = privateKey
         self.hostname = None
@@ -483,6 +565,195 @@ class S3ObjctStore(object):
         self.is_secure = is_secure
         self.buckets = {}
         self._useTimerCommand = useTimerCommand
+        self.threshold = threshold
+        self.partSize = partSize
+        self.threads = threads
+        self.retries = retries
+        self.__local = threading.local()
+
+    def parse_url(self, url):
+        """ Return (hostname, port, bucket name, key name) of an S3 url """
+
+        parsed = urlparse.urlparse(url)
+        hostname = parsed.netloc.partition(':')[0]
+        port = int(parsed.netloc.partition(':')[2])
+        path = parsed.path.strip("/")
+
+        pos = path.index("/")
+        return hostname, port, path[:pos], path[pos+1:]
+
+    def get_thread_bucket(self, hostname, port, bucket_name):
+        """ Return the bucket on a connection of the calling thread (boto connections can not be shared between threads) """
+
+        import boto
+        import boto.s3.connection
+
+        buckets = getattr(self.__local, 'buckets', None)
+        if buckets is None:
+            buckets = self.__local.buckets = {}
+
+        bucket_key = "%s_%s_%s" % (hostname, port, bucket_name)
+        if bucket_key not in buckets:
+            conn = boto.connect_s3(
+                aws_access_key_id = self.access_key,
+                aws_secret_access_key = self.secret_key,
+                host = hostname,
+                port = port,
+                is_secure=self.is_secure,
+                calling_format = boto.s3.connection.OrdinaryCallingFormat(),
+                )
+            buckets[bucket_key] = conn.get_bucket(bucket_name, validate=False)
+        return buckets[bucket_key]
+
+    def getParts(self, size):
+        """ Return the (part number, offset, length) of the parts of a file """
+
+        parts = []
+        offset = 0
+        while offset < size:
+            length = min(self.partSize, size - offset)
+            parts.append((len(parts) + 1, offset, length))
+            offset += length
+        return parts
+
+    def runParts(self, function, parts):
+        """ Run function(part number, offset, length) for all parts with a thread pool, return the list of errors """
+
+        from ThreadPool import ThreadPool
+
+        errors = []
+        lock = threading.Lock()
+
+        def _run(part_num, offset, length):
+            if errors:
+                # another part failed for good, the transfer will fail anyway
+                return
+            for attempt in range(1, self.retries + 1):
+                try:
+                    function(part_num, offset, length)
+                    return
+                except Exception, e:
+                    tolog("Transfer of part %d/%d failed (attempt %d/%d): %s" % (part_num, len(parts), attempt, self.retries, e))
+                    error = "part %d: %s" % (part_num, e)
+            lock.acquire()
+            errors.append(error)
+            lock.release()
+
+        pool = ThreadPool(min(self.threads, len(parts)), poll_timeout=0.1)
+        for part_num, offset, length in parts:
+            pool.add_task(_run, part_num, offset, length)
+        pool.wait_completion()
+
+        return errors
+
+    def s3MultipartStageOutFile(self, source, destination, size):
+        """ Upload source in parts with parallel part uploads, return the size and the adler32 of the uploaded data """
+
+        from boto.s3.multipart import MultiPartUpload
+
+        hostname, port, bucket_name, key_name = self.parse_url(destination)
+        mp = self.get_thread_bucket(hostname, port, bucket_name).initiate_multipart_upload(key_name)
+        parts = self.getParts(size)
+        tolog("Uploading %s in %d parts of %d B with %d threads (upload id: %s)" % (source, len(parts), self.partSize, self.threads, mp.id))
+
+        uploaded = {}
+        lock = threading.Lock()
+
+        def _upload(part_num, offset, length):
+            f = open(source, 'rb')
+            try:
+                f.seek(offset)
+                data = f.read(length)
+            finally:
+                f.close()
+            if len(data) != length:
+                raise Exception("read %d B instead of %d B from %s" % (len(data), length, source))
+
+            md5 = hashlib.md5(data)
+            part = MultiPartUpload(self.get_thread_bucket(hostname, port, bucket_name))
+            part.key_name = key_name
+            part.id = mp.id
+            # the server verifies the part against the Content-MD5 header, the returned etag is checked as well
+            key = part.upload_part_from_file(StringIO(data), part_num, md5=(md5.hexdigest(), base64.b64encode(md5.digest())), size=length)
+            etag = key.etag.strip('"').strip("'")
+            if etag != md5.hexdigest():
+                raise Exception("checksum mismatch, local md5 %s, server etag %s" % (md5.hexdigest(), etag))
+
+            lock.acquire()
+            uploaded[part_num] = (md5, zlib.adler32(data) & 0xffffffff, length)
+            lock.release()
+
+        errors = self.runParts(_upload, parts)
+        if errors or len(uploaded) != len(parts):
+            try:
+                mp.cancel_upload()
+            except Exception, e:
+                tolog("Failed to abort multipart upload %s: %s" % (mp.id, e))
+            raise Exception("multipart upload failed: %s" % ("; ".join(errors)))
+
+        xml = "<CompleteMultipartUpload>"
+        for part_num in sorted(uploaded.keys()):
+            xml += "<Part><PartNumber>%d</PartNumber><ETag>\"%s\"</ETag></Part>" % (part_num, uploaded[part_num][0].hexdigest())
+        xml += "</CompleteMultipartUpload>"
+        result = self.get_thread_bucket(hostname, port, bucket_name).complete_multipart_upload(key_name, mp.id, xml)
+
+        # the etag of a multipart object is the md5 of the part md5s
+        expected = "%s-%d" % (hashlib.md5("".join([uploaded[n][0].digest() for n in sorted(uploaded.keys())])).hexdigest(), len(uploaded))
+        etag = (result.etag or "").strip('"').strip("'")
+        if etag != expected:
+            raise Exception("multipart checksum mismatch, expected etag %s, server etag %s" % (expected, etag))
+
+        return size, combine_part_checksums(dict([(n, uploaded[n][1:]) for n in uploaded.keys()]))
+
+    def s3RangedStageInFile(self, source, destination, size):
+        """ Download source with parallel ranged GETs into a preallocated file, return the size and the adler32 of the written data """
+
+        hostname, port, bucket_name, key_name = self.parse_url(source)
+        parts = self.getParts(size)
+        tolog("Downloading %s in %d parts of %d B with %d threads" % (source, len(parts), self.partSize, self.threads))
+
+        # preallocate the file, every part is written at its offset through its own file descriptor
+        # (python 2 has no os.pwrite)
+        fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+        downloaded = {}
+        lock = threading.Lock()
+
+        def _download(part_num, offset, length):
+            key = self.get_thread_bucket(hostname, port, bucket_name).new_key(key_name)
+            key.open_read(headers={'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+            received = 0
+            checksum = 1L
+            fd = os.open(destination, os.O_WRONLY)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                while received < length:
+                    data = key.resp.read(min(BLOCK_SIZE, length - received))
+                    if not data:
+                        break
+                    checksum = zlib.adler32(data, checksum)
+                    received += len(data)
+                    while data:
+                        data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
+                key.close(fast=True)
+            if received != length:
+                raise Exception("received %d B instead of %d B" % (received, length))
+
+            lock.acquire()
+            downloaded[part_num] = (checksum & 0xffffffff, length)
+            lock.release()
+
+        errors = self.runParts(_download, parts)
+        if errors or len(downloaded) != len(parts):
+            raise Exception("ranged download failed: %s" % ("; ".join(errors)))
+
+        return size, combine_part_checksums(downloaded)
 
     def get_key(self, url, create=False):
         import boto
@@ -568,8 +839,11 @@ class S3ObjctStore(object):
                 retCode = -1
                 retStr = "source file(%s) cannot be found" % source
 
-            key.get_contents_to_filename(destination)
-            retSize = key.size
+            if key.size >= self.threshold and self.threads > 1:
+                retSize, retChecksum = self.s3RangedStageInFile(source, destination, key.size)
+            else:
+                key.get_contents_to_filename(destination)
+                retSize = key.size
 
             # for big file with multiple parts, key.etag is not the md5
             # if key.md5 and key.md5 != key.etag.strip('"').strip("'"):
@@ -609,19 +883,24 @@ class S3ObjctStore(object):
         retSize = None
         retChecksum = None
         try:
-            key = self.get_key(destination, create=True)
-            if key is None:
-                retCode = -1
-                retStr = "Failed to create S3 key on destination (%s)" % destination
-            # key.set_metadata("md5", sourceChecksum)
-            size = key.set_contents_from_filename(source)
-
-            retSize = key.size
+            size = os.path.getsize(source)
+            if size >= self.threshold and self.threads > 1:
+                retSize, retChecksum = self.s3MultipartStageOutFile(source, destination, size)
+                key = None
+            else:
+                key = self.get_key(destination, create=True)
+                if key is None:
+                    retCode = -1
+                    retStr = "Failed to create S3 key on destination (%s)" % destination
+                # key.set_metadata("md5", sourceChecksum)
+                size = key.set_contents_from_filename(source)
+
+                retSize = key.size
             # if key.md5 != key.etag.strip('"').strip("'"):
             #     return -1, "client side checksum(key.md5=%s) doesn't match server side checksum(key.etag=%s)" % (key.md5, key.etag.strip('"').strip("'"))
-            if sourceSize and str(sourceSize) != str(key.size):
+            if sourceSize and str(sourceSize) != str(retSize):
                 retCode = -1
-                retStr = "source size(%s) doesn't match key size(%s)" % (sourceSize, key.size)
+                retStr = "source size(%s) doesn't match key size(%s)" % (sourceSize, retSize)
             #if sourceChecksum and sourceChecksum != key.md5:
             #    retCode = -1
             #    retStr = "source checksum(%s) doesn't match key checksum(%s)" % (sourceChecksum, key.md5)
@@ -0,0 +1,176 @@
+# SURLRegistry.py
+#
+# Per-job registry of the SURLs of the transferred output files (guid -> surl).
+# SiteMover.updateSURLDictionary used to read the whole surlDictionary-<jobId>.json, add one guid and write the whole
+# file back after every successful transfer, and updateXMLWithSURLs read the file once more. The registry keeps the
+# dictionary in memory and appends every new entry to a journal next to the dictionary file (one "guid<TAB>surl" line
+# per entry). Every 'compactEntries' entries, and when the dictionary is replaced, the dictionary file is rewritten
+# through a temporary file and a rename and the journal is removed, so the dictionary file itself stays in the format
+# the other pilot tools read. A crash leaves the dictionary file and the journal, which load() replays (an incomplete
+# last line is ignored).
+# The pilot reads the SURLs of the files RunJob transferred in another process: refresh() only stats the two files and
+# reads what was appended to the journal since, or reloads everything when the dictionary file was rewritten.
+#
+# Usage:
+#   registry = SiteMover.getSURLRegistry(workDir, jobId)    # cached per job
+#   registry.add(guid, surl)
+#   surl = registry.get(guid)
+
+import os
+import threading
+
+from pUtil import tolog
+from FileHandling import getExtension
+
+# journal entries appended before the dictionary file is rewritten
+COMPACT_ENTRIES = 1000
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+
+class SURLRegistry(object):
+    """ guid -> surl dictionary of a job, in memory, persisted as dictionary file + append-only journal """
+
+    def __init__(self, directory, jobId, compactEntries=COMPACT_ENTRIES):
+        self.filename = os.path.join(directory, "surlDictionary-%s.%s" % (jobId, getExtension()))
+        self.journal = self.filename + ".journal"
+        self.compactEntries = compactEntries
+        self.surls = {}
+        self.stamp = None      # the dictionary file as it was read or written
+        self.offset = 0        # bytes of the journal read or written
+        self.pending = 0       # entries in the journal
+        self.lock = threading.RLock()
+        self.load()
+
+    def __len__(self):
+        return len(self.surls)
+
+    def get(self, guid, default=None):
+        return self.surls.get(guid, default)
+
+    def getDictionary(self):
+        """ Copy of the dictionary """
+        with self.lock:
+            return dict(self.surls)
+
+    def load(self):
+        """ Read the dictionary file and replay the journal """
+        with self.lock:
+            self.surls = {}
+            self.stamp = _stamp(self.filename)
+            self.offset = 0
+            self.pending = 0
+            if self.stamp is not None:
+                try:
+                    fp = open(self.filename, "r")
+                except IOError, e:
+                    tolog("!!WARNING!!1800!! Failed to open SURL dictionary for reading: %s" % str(e))
+                else:
+                    try:
+                        if self.filename.endswith('json'):
+                            from json import load
+                        else:
+                            from pickle import load
+                        self.surls = load(fp)
+                    except Exception, e:
+                        tolog("!!WARNING!!1800!! Could not deserialize SURL dictionary: %s, %s" % (self.filename, e))
+                    fp.close()
+            self.readJournal()
+            tolog("Loaded SURL dictionary with %d keys (%d from the journal): filename=%s" % (len(self.surls), self.pending, self.filename))
+
+    def readJournal(self):
+        """ Apply the journal entries appended since the last read """
+        try:
+            fp = open(self.journal, "r")
+        except IOError:
+            return
+        try:
+            fp.seek(self.offset)
+            data = fp.read()
+        finally:
+            fp.close()
+        # an incomplete last line is read again next time
+        end = data.rfind("\n") + 1
+        for line in data[:end].splitlines():
+            guid, sep, surl = line.partition("\t")
+            if sep:
+                self.surls[guid] = surl
+                self.pending += 1
+        self.offset += end
+
+    def refresh(self):
+        """ Pick up the changes of other processes """
+        with self.lock:
+            if _stamp(self.filename) != self.stamp:
+                self.load()
+                return
+            try:
+                size = os.path.getsize(self.journal)
+            except OSError:
+                size = 0
+            if size < self.offset:
+                # the journal was compacted into a dictionary file with the same stamp
+                self.load()
+            elif size > self.offset:
+                self.readJournal()
+
+    def add(self, guid, surl):
+        """ Add a guid and its surl, return False if the entry could not be persisted """
+        guid, surl = str(guid), str(surl)
+        with self.lock:
+            self.refresh()
+            self.surls[guid] = surl
+            line = "%s\t%s\n" % (guid, surl)
+            try:
+                fp = open(self.journal, "a")
+                try:
+                    fp.write(line)
+                finally:
+                    fp.close()
+            except IOError, e:
+                tolog("!!WARNING!!1800!! Could not append to SURL journal %s: %s" % (self.journal, e))
+                return self.compact()
+            self.offset += len(line)
+            self.pending += 1
+            if self.pending >= self.compactEntries:
+                return self.compact()
+            return True
+
+    def replace(self, surls):
+        """ Replace the whole dictionary """
+        with self.lock:
+            self.surls = dict(surls)
+            return self.compact()
+
+    def compact(self):
+        """ Write the dictionary file atomically and remove the journal """
+        with self.lock:
+            tmpname = self.filename + ".tmp"
+            try:
+                fp = open(tmpname, "w")
+                try:
+                    if self.filename.endswith('json'):
+                        from json import dump
+                    else:
+                        from pickle import dump
+                    dump(self.surls, fp)
+                finally:
+                    fp.close()
+                os.rename(tmpname, self.filename)
+            except Exception, e:
+                tolog("!!WARNING!!1800!! Could not write SURL dictionary file: %s, %s" % (self.filename, e))
+                return False
+            self.stamp = _stamp(self.filename)
+            try:
+                os.remove(self.journal)
+            except OSError:
+                pass
+            self.offset = 0
+            self.pending = 0
+            return True
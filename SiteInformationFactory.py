@@ -4,29 +4,22 @@
 #   Based the on Factory Design Pattern
 #   Note: not compatible with Singleton Design Pattern due to the subclassing
 
-from types import TypeType
-from SiteInformation import SiteInformation
-from ATLASSiteInformation import ATLASSiteInformation
-from AMSTaiwanSiteInformation import AMSTaiwanSiteInformation
-from CMSSiteInformation import CMSSiteInformation
-from NordugridATLASSiteInformation import NordugridATLASSiteInformation
-from OtherSiteInformation import OtherSiteInformation
+# experiment name: name of the module and class, imported on first use
+siteInformationModules = {"generic": "SiteInformation",
+                          "ATLAS": "ATLASSiteInformation",
+                          "AMSTaiwan": "AMSTaiwanSiteInformation",
+                          "CMS": "CMSSiteInformation",
+                          "Nordugrid-ATLAS": "NordugridATLASSiteInformation",
+                          "Other": "OtherSiteInformation"}
 
 class SiteInformationFactory(object):
 
     def newSiteInformation(self, experiment):
         """ Generate a new site information object """
 
-        # get all classes
-        siteInformationClasses = [j for (i,j) in globals().iteritems() if isinstance(j, TypeType) and issubclass(j, SiteInformation)]
-
-        # loop over all subclasses
-        for siteInformationClass in siteInformationClasses:
-            si = siteInformationClass()
-
-            # return the matching experiment class
-            if si.getExperiment() == experiment:
-                return siteInformationClass
+        name = siteInformationModules.get(experiment)
+        if name:
+            return getattr(__import__(name), name)
 
         # if no class was found, raise an error
         raise ValueError('SiteInformationFactory: No such class: "%s"' % (experiment))
@@ -14,6 +14,7 @@ from PilotErrors import PilotErrors
 from timed_command import timed_command
 from configSiteMover import config_sm
 from FileHandling import getExtension, getTracingReportFilename, writeJSON
+from SURLRegistry import SURLRegistry
 
 PERMISSIONS_DIR = config_sm.PERMISSIONS_DIR
 PERMISSIONS_FILE = config_sm.PERMISSIONS_FILE
@@ -51,6 +52,8 @@ class SiteMover(object):
     timeout = 5*3600
     useTracingService = True
     filesInRucioDataset = {}
+    # SURL registries of the jobs: (directory, jobId): SURLRegistry
+    surlRegistries = {}
 
     CONDPROJ = ['oflcond', 'comcond', 'cmccond', 'tbcond', 'tbmccond', 'testcond']
     PRODFTYPE = ['AOD', 'CBNT', 'ESD', 'EVNT', 'HIST', 'HITS', 'RDO', 'TAG', 'log', 'NTUP']
@@ -868,77 +871,30 @@ class SiteMover(object):
         return os.path.join(directory, "surlDictionary-%s.%s" % (jobId, getExtension()))
 
     @classmethod
-    def getSURLDictionary(self, directory, jobId):
-        """ get the SURL dictionary from file """
-
-        surlDictionary = {}
+    def getSURLRegistry(self, directory, jobId):
+        """ return the SURL registry of the job (kept in memory, see SURLRegistry) """
 
-        # open the dictionary for reading
-        filename = self.getSURLDictionaryFilename(directory, jobId)
-        if not os.path.exists(filename):
-            tolog("SURL dictionary does not exist: %s (will be created)" % (filename))
-            return surlDictionary
-        try:
-            fp = open(filename, "r")
-        except OSError, e:
-            tolog("!!WARNING!!1800!! Failed to open SURL dictionary for reading: %s" % str(e))
+        key = (os.path.abspath(directory), str(jobId))
+        registry = SiteMover.surlRegistries.get(key)
+        if registry is None:
+            registry = SURLRegistry(directory, jobId)
+            SiteMover.surlRegistries[key] = registry
         else:
-            # get the dictionary
-            importedLoad = False
-            if filename.endswith('json'):
-                try:
-                    from json import load
-                except Exception, e:
-                    tolog("!!WARNING!!1800!! Could not import load function from json module (too old python version?): %s" % str(e))
-                else:
-                    importedLoad = True
-            else:
-                from pickle import load
-                importedLoad = True
+            # another process (RunJob) may have added SURLs
+            registry.refresh()
+        return registry
 
-            if importedLoad:
-                # load the dictionary from file
-                try:
-                    # load the dictionary from file
-                    surlDictionary = load(fp)
-                except:
-                    tolog("!!WARNING!!1800!! JobState could not deserialize file: %s" % (filename))
-                else:
-                    tolog("Deserialized surl dictionary with %d keys: filename=%s" % (len(surlDictionary.keys()), filename))
-                    #tolog("surlDictionary=%s" % str(surlDictionary))
-            fp.close()
+    @classmethod
+    def getSURLDictionary(self, directory, jobId):
+        """ get a copy of the SURL dictionary """
 
-        return surlDictionary
+        return self.getSURLRegistry(directory, jobId).getDictionary()
 
     @classmethod
     def putSURLDictionary(self, surlDictionary, directory, jobId):
         """ store the updated SURL dictionary """
 
-        status = False
-
-        # open the dictionary for writing
-        filename = self.getSURLDictionaryFilename(directory, jobId)
-        try:
-            fp = open(filename, "w")
-        except OSError, e:
-            tolog("!!WARNING!!1800!! Could not open SURL dictionary for writing: %s" % str(e))
-        else:
-            # write the dictionary
-            if filename.endswith('json'):
-                from json import dump
-            else:
-                from pickle import dump
-            try:
-                # write the dictionary to file
-                dump(surlDictionary, fp)
-            except Exception, e:
-                tolog("!!WARNING!!1800!! Could not encode data to SURL dictionary file: %s, %s" % (filename, str(e)))
-            else:
-                status = True
-
-                fp.close()
-
-        return status
+        return self.getSURLRegistry(directory, jobId).replace(surlDictionary)
 
     @classmethod
     def updateSURLDictionary(self, guid, surl, directory, jobId):
@@ -947,15 +903,10 @@ class SiteMover(object):
         status = False
         tolog("Adding GUID (%s) and SURL (%s) to dictionary" % (guid, surl))
 
-        # (re-)open dictionary if possible (the dictionary will be empty if the function is called for the first time)
-        surlDictionary = self.getSURLDictionary(directory, jobId)
-
-        # add the guid and surl to the dictionary
-        surlDictionary[guid] = surl
-
-        # store the updated dictionary
-        if self.putSURLDictionary(surlDictionary, directory, jobId):
-            tolog("Successfully updated SURL dictionary (which currectly has %d key(s))" % len(surlDictionary.keys()))
+        # only the new entry is written (to the journal of the dictionary)
+        registry = self.getSURLRegistry(directory, jobId)
+        if registry.add(guid, surl):
+            tolog("Successfully updated SURL dictionary (which currectly has %d key(s))" % len(registry))
             status = True
         else:
             tolog("!!FAILED!!1800!! SURL dictionary could not be updated (later LFC registration will not work)")
@@ -1,54 +1,47 @@
 from futil import *
 from pUtil import tolog
 
-from SiteMover import SiteMover                             # OU_OCHEP_SWT2
-from dCacheSiteMover import dCacheSiteMover                 # ANALY_AGLT2
-from BNLdCacheSiteMover import BNLdCacheSiteMover           # None
-from xrootdSiteMover import xrootdSiteMover                 # SLAC, GLOW-ATLAS
-from xrdcpSiteMover import xrdcpSiteMover                   # ANALY_CERN_XROOTD
-from CastorSiteMover import CastorSiteMover                 #
-from dCacheLFCSiteMover import dCacheLFCSiteMover           # UBC
-from lcgcpSiteMover import lcgcpSiteMover                   # LYON, CERN, MANC, LANCS, FZK
-from lcgcp2SiteMover import lcgcp2SiteMover                 # US sites; AGLT2 
-from stormSiteMover import stormSiteMover                   # Bologna
-from mvSiteMover import mvSiteMover                         # NDGF
-from rfcpLFCSiteMover import rfcpLFCSiteMover               # GLASGOW (works for all DPM sites)
-from castorSvcClassSiteMover import castorSvcClassSiteMover # RAL (needs extra configuation to map space tokens to service classes)
-from LocalSiteMover import LocalSiteMover                   # HU, MWT2 
-from ChirpSiteMover import ChirpSiteMover                   # Munich
-from curlSiteMover import curlSiteMover                     # ASGC
-from FAXSiteMover import FAXSiteMover                       # CVMFS sites
-from objectstoreSiteMover import objectstoreSiteMover       #
-from aria2cSiteMover import aria2cSiteMover                 #
-from GFAL2SiteMover import GFAL2SiteMover                   # GFAL2
-from GSIftpSiteMover import GSIftpSiteMover                 # HPC sites
-from S3SiteMover import S3SiteMover                         # S3
-
-mover_selector = {
-    SiteMover.copyCommand : SiteMover,
-    dCacheSiteMover.copyCommand : dCacheSiteMover,
-    BNLdCacheSiteMover.copyCommand : BNLdCacheSiteMover,
-    xrootdSiteMover.copyCommand : xrootdSiteMover,
-    xrdcpSiteMover.copyCommand : xrdcpSiteMover,
-    CastorSiteMover.copyCommand : CastorSiteMover,
-    dCacheLFCSiteMover.copyCommand : dCacheLFCSiteMover,
-    lcgcpSiteMover.copyCommand : lcgcpSiteMover,
-    lcgcp2SiteMover.copyCommand : lcgcp2SiteMover,
-    stormSiteMover.copyCommand : stormSiteMover,
-    mvSiteMover.copyCommand : mvSiteMover,
-    rfcpLFCSiteMover.copyCommand : rfcpLFCSiteMover,
-    castorSvcClassSiteMover.copyCommand : castorSvcClassSiteMover,
-    LocalSiteMover.copyCommand : LocalSiteMover,
-    ChirpSiteMover.copyCommand : ChirpSiteMover,
-    curlSiteMover.copyCommand : curlSiteMover,
-    FAXSiteMover.copyCommand : FAXSiteMover,
-    aria2cSiteMover.copyCommand : aria2cSiteMover,
-    objectstoreSiteMover.copyCommand : objectstoreSiteMover,
-    GFAL2SiteMover.copyCommand : GFAL2SiteMover,
-    GSIftpSiteMover.copyCommand : GSIftpSiteMover,
-    S3SiteMover.copyCommand : S3SiteMover
+# copy command: name of the site mover module and class, the module is imported on first use
+mover_modules = {
+    "cp": "SiteMover",                                      # OU_OCHEP_SWT2
+    "dccp": "dCacheSiteMover",                              # ANALY_AGLT2
+    "BNLdccp": "BNLdCacheSiteMover",                        # None
+    "xcp": "xrootdSiteMover",                               # SLAC, GLOW-ATLAS
+    "xrdcp": "xrdcpSiteMover",                              # ANALY_CERN_XROOTD
+    "rfcp": "CastorSiteMover",                              #
+    "dccplfc": "dCacheLFCSiteMover",                        # UBC
+    "lcg-cp": "lcgcpSiteMover",                             # LYON, CERN, MANC, LANCS, FZK
+    "lcg-cp2": "lcgcp2SiteMover",                           # US sites; AGLT2
+    "storm": "stormSiteMover",                              # Bologna
+    "mv": "mvSiteMover",                                    # NDGF
+    "rfcplfc": "rfcpLFCSiteMover",                          # GLASGOW (works for all DPM sites)
+    "rfcpsvcclass": "castorSvcClassSiteMover",              # RAL (needs extra configuation to map space tokens to service classes)
+    "lsm": "LocalSiteMover",                                # HU, MWT2
+    "chirp": "ChirpSiteMover",                              # Munich
+    "curl": "curlSiteMover",                                # ASGC
+    "fax": "FAXSiteMover",                                  # CVMFS sites
+    "objectstore": "objectstoreSiteMover",                  #
+    "aria2c": "aria2cSiteMover",                            #
+    "gfal-copy": "GFAL2SiteMover",                          # GFAL2
+    "gsiftp": "GSIftpSiteMover",                            # HPC sites
+    "S3": "S3SiteMover"                                     # S3
     }
 
+# copy command: site mover class, for the movers imported so far
+mover_selector = {}
+
+def getSiteMoverClass(sitemover):
+    """ Return the site mover class for the copy command, import its module if needed (KeyError for unknown movers) """
+
+    ret = mover_selector.get(sitemover)
+    if not ret:
+        name = mover_modules[sitemover]
+        ret = getattr(__import__(name), name)
+        if ret.copyCommand != sitemover:
+            tolog("!!WARNING!!2999!! Site mover %s has copy command %s, expected %s" % (name, ret.copyCommand, sitemover))
+        mover_selector[sitemover] = ret
+    return ret
+
 def getSiteMover(sitemover, setup_file='', *args, **kwrds):
     """The setup file is singled out from the other arguments in case the farm method would like
     to chek its existence or use it. Anyway if no setup_file is assigned no unnamed arguments are passed (*args is empty)
@@ -63,10 +56,10 @@ def getSiteMover(sitemover, setup_file='', *args, **kwrds):
     elif sitemover == 'lcgcp2':
         sitemover = 'lcg-cp2'
     try:
-        ret = mover_selector[sitemover]
+        ret = getSiteMoverClass(sitemover)
     except KeyError:
-        tolog("!!WARNING!!2999!! Site mover %s not found (%s), returning SiteMover - using local copy"%(sitemover, mover_selector.keys()))
-        ret = SiteMover
+        tolog("!!WARNING!!2999!! Site mover %s not found (%s), returning SiteMover - using local copy"%(sitemover, mover_modules.keys()))
+        ret = getSiteMoverClass("cp")
         # TODO: ? return OtherMover?
         return ret.getSiteMover(*args, **kwrds)
     tolog("Returning site mover %s (setup: %s)" % (ret, setup_file))
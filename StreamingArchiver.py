@@ -0,0 +1,252 @@
+# StreamingArchiver.py
+#
+# Build event service output archives in one pass over the event status dump.
+# Entries are parsed once, files are added through their open descriptor (one fstat per file),
+# the adler32 of every archive is computed while it is written and finished archive shards
+# can be handed straight to stage-out while the remaining shards are still being written.
+
+import os
+import zlib
+import tarfile
+import threading
+import traceback
+
+try:
+    import Queue            # Python 2
+except ImportError:
+    import queue as Queue   # Python 3
+
+from pUtil import tolog
+
+
+def parseEventStatusLine(line):
+    """ Parse one line of the <jobId>_event_status.dump file """
+    # format: jobId eventRangeID status output
+    # returns (eventRangeID, status, output, files) or None for unparseable lines
+
+    fields = line.strip().split(" ", 3)
+    if len(fields) < 4:
+        return None
+    eventRangeID = fields[1]
+    status = fields[2]
+    output = fields[3]
+    if status.startswith("ERR"):
+        status = 'failed'
+    files = []
+    if status == 'finished':
+        files = output.split(",")[:-3]
+    return eventRangeID, status, output, files
+
+
+class Adler32Writer(object):
+    """ File-like wrapper computing the adler32 checksum and size of everything written """
+
+    def __init__(self, fileobj):
+        self.__fileobj = fileobj
+        self.__adler = 1L
+        self.__size = 0
+
+    def write(self, data):
+        self.__adler = zlib.adler32(data, self.__adler)
+        self.__size += len(data)
+        self.__fileobj.write(data)
+
+    def tell(self):
+        return self.__size
+
+    def flush(self):
+        self.__fileobj.flush()
+
+    def close(self):
+        self.__fileobj.close()
+
+    def getSize(self):
+        return self.__size
+
+    def getChecksum(self):
+        """ Return the adler32 checksum as an 8 character hex string """
+
+        adler = self.__adler
+        # correct for bug 32 bit zlib
+        if adler < 0:
+            adler = adler + 2**32
+        return "%08x" % adler
+
+
+class ArchiveShard(object):
+    """ One finished (or in progress) archive together with the event ranges it covers """
+
+    def __init__(self, index, path, eventRangesPath):
+        self.index = index
+        self.path = path
+        self.eventRangesPath = eventRangesPath
+        self.eventRanges = []
+        self.nFiles = 0
+        self.size = 0
+        self.checksum = None
+
+    def __str__(self):
+        return "<ArchiveShard %s path=%s files=%s ranges=%s size=%s adler32=%s>" %\
+               (self.index, self.path, self.nFiles, len(self.eventRanges), self.size, self.checksum)
+
+
+class StreamingArchiver(object):
+    """
+    Write event service outputs into size capped tar archives using parallel writer threads.
+
+    With the defaults (maxShardSize=0, threads=1) exactly one archive is written to zipFileName,
+    and the event range list to zipEventRangesName, as the old zipOutputs() did.
+    Otherwise every writer thread fills its own shards and shard N > 0 is written to <root>_N<ext>
+    of both names.
+    If onShard is given it is called with every finished ArchiveShard from a separate
+    stage-out thread pool, so that archiving and stage-out overlap.
+    """
+
+    def __init__(self, zipFileName, zipEventRangesName, maxShardSize=0, threads=1, onShard=None, stageoutThreads=1, removeInputs=True, log=tolog):
+        self.__zipFileName = zipFileName
+        self.__zipEventRangesName = zipEventRangesName
+        self.__maxShardSize = maxShardSize
+        self.__threads = max(1, threads)
+        self.__onShard = onShard
+        self.__stageoutThreads = max(1, stageoutThreads)
+        self.__removeInputs = removeInputs
+        self.__log = log
+
+        self.__entries = Queue.Queue(1000 * self.__threads)
+        self.__shardLock = threading.Lock()
+        self.__nextShard = 0
+        self.__shards = []
+        self.__writers = []
+        self.__stageoutPool = None
+
+    def getShardNames(self, index):
+        """ Return the archive and event ranges file names of shard index """
+
+        if index == 0:
+            return self.__zipFileName, self.__zipEventRangesName
+        root, ext = os.path.splitext(self.__zipFileName)
+        rangesRoot, rangesExt = os.path.splitext(self.__zipEventRangesName)
+        return "%s_%s%s" % (root, index, ext), "%s_%s%s" % (rangesRoot, index, rangesExt)
+
+    def __newShard(self):
+        self.__shardLock.acquire()
+        try:
+            index = self.__nextShard
+            self.__nextShard += 1
+        finally:
+            self.__shardLock.release()
+        path, eventRangesPath = self.getShardNames(index)
+        shard = ArchiveShard(index, path, eventRangesPath)
+        writer = Adler32Writer(open(path, 'wb'))
+        tar = tarfile.open(path, 'w', fileobj=writer)
+        return shard, writer, tar
+
+    def __closeShard(self, shard, writer, tar):
+        tar.close()
+        writer.close()
+        shard.size = writer.getSize()
+        shard.checksum = writer.getChecksum()
+        handle = open(shard.eventRangesPath, 'w')
+        handle.write("".join(["%s %s %s\n" % eventRange for eventRange in shard.eventRanges]))
+        handle.close()
+
+        self.__shardLock.acquire()
+        try:
+            self.__shards.append(shard)
+        finally:
+            self.__shardLock.release()
+        self.__log("Closed archive shard %s" % (shard))
+
+        if self.__onShard:
+            self.__stageoutPool.add_task(self.__onShard, shard)
+
+    def __addFile(self, tar, filename):
+        """ Add a file through its open descriptor, return the number of bytes added or None if it is missing """
+
+        try:
+            handle = open(filename, 'rb')
+        except IOError:
+            self.__log("File %s doesn't exist" % (filename))
+            return None
+        try:
+            tarinfo = tar.gettarinfo(arcname=os.path.basename(filename), fileobj=handle)
+            tar.addfile(tarinfo, handle)
+        finally:
+            handle.close()
+        if self.__removeInputs:
+            os.remove(filename)
+        return tarinfo.size
+
+    def __writerLoop(self):
+        shard = writer = tar = None
+        while True:
+            entry = self.__entries.get()
+            if entry is None:
+                break
+            eventRangeID, status, output, files = entry
+            try:
+                if shard is None:
+                    shard, writer, tar = self.__newShard()
+                for filename in files:
+                    if self.__addFile(tar, filename) is not None:
+                        shard.nFiles += 1
+                shard.eventRanges.append((eventRangeID, status, output))
+                if self.__maxShardSize and writer.getSize() >= self.__maxShardSize:
+                    self.__closeShard(shard, writer, tar)
+                    shard = writer = tar = None
+            except:
+                self.__log("Failed to archive event range %s: %s" % (eventRangeID, traceback.format_exc()))
+        if shard is not None:
+            try:
+                self.__closeShard(shard, writer, tar)
+            except:
+                self.__log("Failed to close archive shard %s: %s" % (shard, traceback.format_exc()))
+
+    def start(self):
+        """ Start the writer threads (and the stage-out pool) """
+
+        if self.__onShard:
+            from ThreadPool import ThreadPool
+            self.__stageoutPool = ThreadPool(self.__stageoutThreads)
+        for i in range(self.__threads):
+            writer = threading.Thread(target=self.__writerLoop)
+            writer.setDaemon(True)
+            writer.start()
+            self.__writers.append(writer)
+
+    def add(self, eventRangeID, status, output, files):
+        """ Queue one event range, only finished and failed event ranges are archived/listed """
+
+        if status in ('finished', 'failed'):
+            self.__entries.put((eventRangeID, status, output, files))
+
+    def addEventStatusFile(self, eventStatusFile):
+        """ Stream an event status dump file into the archiver """
+
+        handle = open(eventStatusFile)
+        try:
+            for line in handle:
+                try:
+                    entry = parseEventStatusLine(line)
+                except:
+                    entry = None
+                if entry is None:
+                    self.__log("Failed to parse %s at line: %s" % (eventStatusFile, line))
+                    continue
+                self.add(*entry)
+        finally:
+            handle.close()
+
+    def close(self):
+        """ Wait for all shards to be written (and staged out), return the list of shards """
+
+        for i in range(len(self.__writers)):
+            self.__entries.put(None)
+        for writer in self.__writers:
+            writer.join()
+        self.__writers = []
+
+        if self.__stageoutPool:
+            self.__stageoutPool.wait_completion()
+            self.__stageoutPool = None
+        return sorted(self.__shards, key=lambda shard: shard.index)
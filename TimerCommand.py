@@ -20,8 +20,9 @@ import subprocess, threading
 import multiprocessing
 
 class TimerCommand(object):
-    def __init__(self, cmd=None):
+    def __init__(self, cmd=None, env=None):
         self.cmd = cmd
+        self.env = env
         self.process = None
         self.stdout = None
         self.stderr = None
@@ -30,7 +31,7 @@ class TimerCommand(object):
     def run(self, timeout=3600):
         def target():
             # print 'Thread started'
-            self.process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, preexec_fn=os.setsid)
+            self.process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, preexec_fn=os.setsid, env=self.env)
             self.stdout, self.stderr = self.process.communicate()
             # print 'Thread finished'
 
@@ -28,6 +28,133 @@ class replica:
     scope = None
 
 
+METALINK_NS = "urn:ietf:params:xml:ns:metalink"
+
+# default number of parallel downloads (-j), connections per server (-x) and segments per file (-s),
+# can be set per queue with aria2c_max_concurrent_downloads=<N>,aria2c_max_connection_per_server=<N>,aria2c_split=<N>
+# in the catchall field
+ARIA2C_OPTIONS = {'max_concurrent_downloads': 4, 'max_connection_per_server': 4, 'split': 4}
+
+# maximum number of concurrent metalink requests to Rucio
+METALINK_REQUESTS = 10
+
+def _item(values, i, default):
+    """ Return values[i], or default if the list is too short """
+
+    if values and i < len(values):
+        return values[i]
+    return default
+
+def getAria2cOptions():
+    """ Return the aria2c parallelism options, with the catchall overrides of the queue """
+
+    options = dict(ARIA2C_OPTIONS)
+    try:
+        for catchall in readpar("catchall").split(","):
+            if '=' in catchall and catchall.split('=')[0].strip().startswith("aria2c_"):
+                name = catchall.split('=')[0].strip()[len("aria2c_"):]
+                if name in options:
+                    options[name] = max(int(catchall.split('=')[1]), 1)
+    except:
+        tolog("Failed to read aria2c options from catchall, using defaults: %s" % (sys.exc_info()[1]))
+    return options
+
+def mergeMetalinks(documents, names=None):
+    """ Merge the file entries of several metalink documents into one document (optionally only those of the given file names) """
+
+    from xml.dom import minidom
+
+    merged = minidom.getDOMImplementation().createDocument(METALINK_NS, "metalink", None)
+    root = merged.documentElement
+    root.setAttribute("xmlns", METALINK_NS)
+    found = []
+    for document in documents:
+        for node in minidom.parseString(document).getElementsByTagNameNS("*", "file"):
+            name = node.getAttribute("name")
+            if name in found or (names is not None and name not in names):
+                continue
+            found.append(name)
+            root.appendChild(merged.importNode(node, True))
+    return merged.toxml("utf-8")
+
+def parseMetalink(document):
+    """ Return {file name: {'size': .., 'hashes': {type: value}, 'urls': [..]}} of a metalink document """
+
+    from xml.dom import minidom
+
+    def text(node):
+        return "".join([child.data for child in node.childNodes if child.nodeType == child.TEXT_NODE]).strip()
+
+    entries = {}
+    for node in minidom.parseString(document).getElementsByTagNameNS("*", "file"):
+        entry = {'size': None, 'hashes': {}, 'urls': []}
+        for size in node.getElementsByTagNameNS("*", "size"):
+            entry['size'] = long(text(size))
+        for _hash in node.getElementsByTagNameNS("*", "hash"):
+            entry['hashes'][_hash.getAttribute("type").lower()] = text(_hash).lower()
+        for url in node.getElementsByTagNameNS("*", "url"):
+            entry['urls'].append(text(url))
+        entries[node.getAttribute("name")] = entry
+    return entries
+
+def parseDownloadResults(output):
+    """ Return {file name: status} from the 'Download Results' table printed by aria2c (status is OK, ERR, INPR or RM) """
+
+    results = {}
+    table = False
+    for line in output.splitlines():
+        if line.startswith("Download Results:"):
+            table = True
+            continue
+        if not table:
+            continue
+        if line.startswith("Status Legend:"):
+            break
+        fields = line.split("|")
+        if len(fields) != 4 or fields[0].strip() in ("gid", "") or fields[0].startswith("="):
+            continue
+        results[os.path.basename(fields[3].strip())] = fields[1].strip()
+    return results
+
+def verifyDownload(filename, entry=None, fsize=0, fchecksum=0):
+    """ Verify a downloaded file against the size and hashes of its metalink entry (or the dispatcher values), return (ec, pilotErrorDiag) """
+
+    error = PilotErrors()
+
+    size = fsize
+    csumtype = "default"
+    checksum = fchecksum
+    if entry:
+        if entry['size']:
+            size = entry['size']
+        if entry['hashes'].has_key('adler32'):
+            csumtype, checksum = "adler32", entry['hashes']['adler32']
+        elif entry['hashes'].has_key('md5'):
+            csumtype, checksum = "md5sum", entry['hashes']['md5']
+    if csumtype == "default" and checksum != 0 and checksum != "":
+        csumtype = SiteMover.SiteMover.getChecksumType(checksum)
+
+    ec, pilotErrorDiag, dstfsize, dstfchecksum = SiteMover.SiteMover.getLocalFileInfo(filename, csumtype=csumtype)
+    if ec != 0:
+        return ec, pilotErrorDiag
+
+    if size and long(size) != 0 and long(dstfsize) != long(size):
+        pilotErrorDiag = "Remote and local file sizes do not match for %s (%s != %s)" % (os.path.basename(filename), str(dstfsize), str(size))
+        tolog("!!WARNING!!2990!! %s" % (pilotErrorDiag))
+        return error.ERR_GETWRONGSIZE, pilotErrorDiag
+
+    if checksum and dstfchecksum != checksum and not SiteMover.SiteMover.isDummyChecksum(checksum):
+        pilotErrorDiag = "Remote and local checksums (of type %s) do not match for %s (%s != %s)" %\
+                         (csumtype, os.path.basename(filename), dstfchecksum, checksum)
+        tolog("!!WARNING!!2990!! %s" % (pilotErrorDiag))
+        if csumtype == "adler32":
+            return error.ERR_GETADMISMATCH, pilotErrorDiag
+        else:
+            return error.ERR_GETMD5MISMATCH, pilotErrorDiag
+
+    return 0, ""
+
+
 # placing the import lfc here breaks compilation on non-lfc sites
 # import lfc
 
@@ -49,6 +176,11 @@ class aria2cSiteMover(SiteMover.SiteMover):
     has_md5sum = True
     has_chmod = False
     timeout = 3600
+
+    # input files of the job and their download results, see init_data()
+    _inputFiles = []
+    _results = None
+
     """ get proxy """
 
     try:
@@ -165,58 +297,157 @@ class aria2cSiteMover(SiteMover.SiteMover):
         Mappings from surl to https turl will come from ddm eventually
         to cover surls from remote SEs.
         For now just add the mapping for the local SE from copysetup.
+        The metalinks of the files are requested from Rucio concurrently and merged into one metalink.
         """
-	site_name=self.site_name
-	local_se_token=site_name+"_DATADISK"
-	tolog("local SE token: %s"%(local_se_token))
-       # self.surl2https_map has key is srm hostname, then tuple of (from,to) regexp replace
+        site_name=self.site_name
+        local_se_token=site_name+"_DATADISK"
+        tolog("local SE token: %s"%(local_se_token))
+        # self.surl2https_map has key is srm hostname, then tuple of (from,to) regexp replace
         dirAcc = getDirectAccessDic(readpar('copysetupin'))
         if not dirAcc:
-          dirAcc = getDirectAccessDic(readpar('copysetup'))
-       # extract srm host for key
+            dirAcc = getDirectAccessDic(readpar('copysetup'))
+        # extract srm host for key
         srmhost=None
         if dirAcc:
-          srmhost = self.hostFromSurl(dirAcc['oldPrefix'])
-        for guid in replicas.keys():
-          reps = replicas[guid]
-          tolog("Got replicas=%s for guid=%s" % (str(reps), guid))
+            srmhost = self.hostFromSurl(dirAcc['oldPrefix'])
 
         try:
-			token_file=open('token_file', 'r')
+            token_file=open('token_file', 'r')
         except IOError, e:
-			tolog ("!!WARNING!! Failed to open file: %s"%(e))
-			raise Exception("!!FAILED!!1099!! Cannot open file with token!")
+            tolog ("!!WARNING!! Failed to open file: %s"%(e))
+            raise Exception("!!FAILED!!1099!! Cannot open file with token!")
         else:
-			token_rucio=token_file.readline()
-			pos2print=token_rucio.find("CN")
-			token_rucio2print=token_rucio[:pos2print]+'(Hidden token)'
-			tolog("Token I am using: %s" %(token_rucio2print))
-	httpredirector = readpar('httpredirector')
-	if not httpredirector:
-            cmd = "curl -1 -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://rucio-lb-prod.cern.ch/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio,reps[0].scope,reps[0].filename)
-            cmd2print = "curl -1 -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://rucio-lb-prod.cern.ch/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio2print,reps[0].scope,reps[0].filename)
-	else:
+            token_rucio=token_file.readline()
+            pos2print=token_rucio.find("CN")
+            token_rucio2print=token_rucio[:pos2print]+'(Hidden token)'
+            tolog("Token I am using: %s" %(token_rucio2print))
+        httpredirector = readpar('httpredirector')
+
+        metalinkCommands = []
+        for guid in replicas.keys():
+            reps = replicas[guid]
+            tolog("Got replicas=%s for guid=%s" % (str(reps), guid))
+            metalinkCommands.append(self.getMetalinkCommand(reps[0], token_rucio, token_rucio2print, httpredirector))
+
+        metalinks = []
+        for i in range(0, len(metalinkCommands), METALINK_REQUESTS):
+            processes = []
+            for cmd, cmd2print in metalinkCommands[i:i+METALINK_REQUESTS]:
+                tolog("curl command to be executed: %s" %(cmd2print))
+                processes.append(Popen(cmd, stdout=PIPE,stderr=PIPE, shell=True))
+            for metalink_cmd in processes:
+                metalink, stderr=metalink_cmd.communicate()
+                tolog("Metalink given by rucio %s" %(metalink))
+                if not "location" in metalink:
+                    tolog("In surls2metalink: command std error: %s" %(stderr))
+                    tolog("!!WARNING!!1099!! No metalink to download file, or error in metalink!")
+                    raise Exception("!!FAILED!!1099!! No metalink to download file, or error in metalink!")
+                metalinks.append(metalink)
+
+        if len(metalinks) == 1:
+            metalink = metalinks[0]
+        else:
+            metalink = mergeMetalinks(metalinks)
+        mlfile = open(metalinkFile,'w')
+        mlfile.write(metalink)
+        mlfile.close()
+
+    def getMetalinkCommand(self, rep, token_rucio, token_rucio2print, httpredirector):
+        """ Return the curl command (and the command with hidden token for the log) to get the metalink of a replica from Rucio """
+
+        if not httpredirector:
+            cmd = "curl -1 -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://rucio-lb-prod.cern.ch/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio,rep.scope,rep.filename)
+            cmd2print = "curl -1 -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://rucio-lb-prod.cern.ch/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio2print,rep.scope,rep.filename)
+        else:
+            tolog("HTTP redirector I am using: %s" %(httpredirector))
             if "http" in httpredirector:
-           	tolog("HTTP redirector I am using: %s" %(httpredirector))
-                cmd = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem %s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio,httpredirector,reps[0].scope,reps[0].filename)
-                cmd2print = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem %s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio2print,httpredirector,reps[0].scope,reps[0].filename)
+                cmd = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem %s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio,httpredirector,rep.scope,rep.filename)
+                cmd2print = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem %s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio2print,httpredirector,rep.scope,rep.filename)
             else:
-           	tolog("HTTP redirector I am using: %s" %(httpredirector))
-                cmd = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://%s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio,httpredirector,reps[0].scope,reps[0].filename)
-                cmd2print = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://%s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio2print,httpredirector,reps[0].scope,reps[0].filename)
-
-        tolog("curl command to be executed: %s" %(cmd2print))
-        metalink_cmd=Popen(cmd, stdout=PIPE,stderr=PIPE, shell=True)
-	metalink, stderr=metalink_cmd.communicate()
-        tolog("Metalink given by rucio %s" %(metalink))
-	if not "location" in metalink:
-           tolog("In surls2metalink: command std error: %s" %(stderr))
-           tolog("!!WARNING!!1099!! No metalink to download file, or error in metalink!")
-           raise Exception("!!FAILED!!1099!! No metalink to download file, or error in metalink!")
-	else:
-           mlfile = open(metalinkFile,'w')
-           mlfile.write(metalink)
-           mlfile.close()
+                cmd = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://%s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio,httpredirector,rep.scope,rep.filename)
+                cmd2print = "curl -1 -v -H \"%s\" -H 'Accept: application/metalink4+xml'  --cacert cabundle.pem https://%s/replicas/%s/%s?select=geoip&schemes=https,http "%(token_rucio2print,httpredirector,rep.scope,rep.filename)
+        return cmd, cmd2print
+
+    def getCommand(self, metalink, cabundleFile, path, options=None):
+        """ Return the aria2c command for a metalink """
+
+        # used aria2c options (see also get_data()):
+        # -j: number of files downloaded in parallel
+        # -x: connections per server, -s: segments per file, fetched from different replicas where possible
+        # --check-integrity: verify the metalink hashes known to aria2c (adler32 is verified by the pilot)
+        if options is None:
+            options = getAria2cOptions()
+        #--check-certificate=false makes it easier(sles11)
+        return '%s -j %d -x %d -s %d --min-split-size=20M --uri-selector=adaptive --check-integrity=true --summary-interval=0 '\
+               '--dir=%s --ca-certificate=%s --certificate=%s --private-key=%s --auto-file-renaming=false --continue --server-stat-of=aria2cperf.txt %s' %\
+               (self.copyCommand, options['max_concurrent_downloads'], options['max_connection_per_server'], options['split'],
+                path, cabundleFile, self.sslCert, self.sslCert, metalink)
+
+    def init_data(self, job):
+        """ Remember the input files of the job, they are all downloaded by one aria2c process on the first get_data() call """
+
+        self._inputFiles = []
+        self._results = None
+        if not job or not job.inFiles:
+            return
+        for i in range(len(job.inFiles)):
+            if job.inFiles[i] == "":
+                continue
+            self._inputFiles.append({'lfn': job.inFiles[i],
+                                      'scope': _item(job.scopeIn, i, ""),
+                                      'fsize': _item(job.filesizeIn, i, 0),
+                                      'fchecksum': _item(job.checksumIn, i, 0),
+                                      'access': _item(job.prodDBlockToken, i, "")})
+
+    def getAllData(self, path, cabundleFile, useCT):
+        """ Download all input files of the job with one aria2c process, return {lfn: (ec, pilotErrorDiag)} """
+
+        error = PilotErrors()
+
+        # files read directly by athena are not downloaded
+        directIn, useFileStager = self.getTransferModes()
+        files = []
+        for f in self._inputFiles:
+            if directIn and not useCT and f['access'] != 'local' and self.isRootFileName(f['lfn']):
+                continue
+            files.append(f)
+        if not files:
+            return {}
+
+        replicas = {}
+        for f in files:
+            rep = replica()
+            rep.filename = f['lfn']
+            rep.scope = f['scope'].replace("/",".")
+            rep.filesize = f['fsize']
+            rep.csumvalue = f['fchecksum']
+            replicas[f['lfn']] = [rep]
+
+        metalink = 'AllInput.xml.meta4'
+        tolog("Getting metalink for %d files from Rucio" % (len(files)))
+        try:
+            self.surls2metalink(replicas, metalink)
+            entries = parseMetalink(open(metalink).read())
+        except Exception, e:
+            tolog("!!WARNING!!2999!! Failed to create metalink for all input files, files will be downloaded one by one: %s" % (e))
+            return {}
+
+        _cmd_str = self.getCommand(metalink, cabundleFile, path)
+        tolog("Executing command: %s" % (_cmd_str))
+        t0 = time()
+        s, o = commands.getstatusoutput(_cmd_str)
+        tolog(o)
+        results = parseDownloadResults(o)
+        tolog("aria2c finished in %d s (exit code %d): %s" % (time() - t0, s, str(results)))
+
+        status = {}
+        for f in files:
+            lfn = f['lfn']
+            if results.get(lfn) != "OK":
+                status[lfn] = (error.ERR_STAGEINFAILED, "aria2c failed to download %s (status: %s)" % (lfn, results.get(lfn, "unknown")))
+            else:
+                status[lfn] = verifyDownload(os.path.join(path, lfn), entries.get(lfn), f['fsize'], f['fchecksum'])
+        return status
 
     def hostFromSurl(self,surl):
         re_srmhost = re.compile('^srm://([^/|:|\(]*)')
@@ -231,11 +462,10 @@ class aria2cSiteMover(SiteMover.SiteMover):
         """ copy input file from SE to local dir """
        # determine which timeout option to use
         timeout_option = "--connect-timeout 300 --timeout %d" % (self.timeout)
-        sslCert = self.sslCert
         sslKey = self.sslKey
         sslCertDir = self.sslCertDir
 
-        # used aria2c options:
+        # used aria2c options (see getCommand):
         # --certificate Client certificate file and password (SSL)(proxy)
         # --private-key user proxy again
         # --ca-certificate: concatenate *.0 in cert dir to make bundle
@@ -329,11 +559,31 @@ class aria2cSiteMover(SiteMover.SiteMover):
            s, o = commands.getstatusoutput(_cmd_str)
 
 
+        # All input files are downloaded with one aria2c process on the first call, the later calls only pick up the results
+        # (see init_data())
+        if self._results is None and lfn in [f['lfn'] for f in self._inputFiles]:
+            report['relativeStart'] = time()
+            report['transferStart'] = time()
+            self._results = self.getAllData(path, cabundleFile, useCT)
+
+        if self._results and lfn in self._results:
+            ec, pilotErrorDiag = self._results[lfn]
+            if ec == 0:
+                tolog("%s was downloaded and verified by the aria2c process for all input files" % (lfn))
+                report['validateStart'] = time()
+                updateFileState(lfn, workDir, jobId, mode="file_state", state="transferred", ftype="input")
+                self.prepareReport('DONE', report)
+                return 0, ""
+            tolog("!!WARNING!!2999!! Download of all input files failed for %s: %s (will retry this file alone)" % (lfn, pilotErrorDiag))
+
         # If metalink file not created(including all inputs)
         # then make one just for this input
 
-        if os.path.exists('AllInput.xml.meta4'):
-          metalink='AllInput.xml.meta4'
+        if os.path.exists('AllInput.xml.meta4') and lfn in parseMetalink(open('AllInput.xml.meta4').read()):
+          metalink='%s.meta4' % (lfn)
+          mlfile = open(metalink, 'w')
+          mlfile.write(mergeMetalinks([open('AllInput.xml.meta4').read()], names=[lfn]))
+          mlfile.close()
         else:
 	  tolog("Getting metalink from Rucio")
           rep = replica()
@@ -362,8 +612,7 @@ class aria2cSiteMover(SiteMover.SiteMover):
 			word_occour +=1
 	tolog("number of links: %s, using only the first" % (str(word_occour)))
 
-        #--check-certificate=false makes it easier(sles11)
-        _cmd_str = '%s -j 1 --ca-certificate=%s --certificate=%s --private-key=%s --auto-file-renaming=false --continue --server-stat-of=aria2cperf.txt %s'%(self.copyCommand, cabundleFile,sslCert,sslCert,metalink)
+        _cmd_str = self.getCommand(metalink, cabundleFile, path)
 
 
         # invoke the transfer commands
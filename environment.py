@@ -45,6 +45,8 @@ def set_environment():
     env['jobRequestFlag'] = True               # Ask server for initial job (read from file otherwise)
     env['debugLevel'] = 0                      # 0: debug info off, 1: display function name when called, 2: full debug info
     env['maxNumberOfRecoveryAttempts'] = 15    # As attempted by the job recovery
+    env['deferredStageoutWorkers'] = 4         # Number of job dirs processed concurrently by the job recovery
+    env['maxEndpointTransfers'] = 2            # Concurrent job recovery transfers per destination endpoint, 0: no limit
     env['stagein'] = False                     # Set to True during stagein phase
     env['stageout'] = False                    # Set to True during stageout phase
     env['queuename'] = ""                      # Name of queue used to download config info
@@ -64,6 +66,8 @@ def set_environment():
     env['proxycheckFlag'] = True               # True (default): perform proxy validity checks, False: no check
     env['wrapperFlag'] = False                 # True for wrappers that expect an exit code via return, False (default) when exit() can be used
     env['cleanupLimit'] = 2                    # Cleanup time limit in hours, see Cleaner.py
+    env['cleanupTimeBudget'] = 60              # Maximum duration of the disk cleanup in seconds, see Cleaner.py
+    env['resourceSamplerInterval'] = 60        # Worker node resource sampling interval in seconds, see ResourceSampler.py
     env['logTransferred'] = False              # Boolean to keep track of whether the log has been transferred or not
     env['errorLabel'] = "WARNING"              # Set to FAILED when job recovery is not used
     env['nSent'] = 0                           # Throttle variable
@@ -10,6 +10,7 @@
 
 from . import getSiteMover
 from .trace_report import TraceReport
+from .replicas import StorageIndex, replica_cache
 
 from FileStateClient import updateFileState, dumpFileStates
 from PilotErrors import PilotException, PilotErrors
@@ -208,6 +209,11 @@ class JobMover(object):
 
         xfiles = [] # consider only normal ddmendpoints (skip OS)
 
+        # build and order list of local ddms: resolved once for all files
+        pandaqueue = self.si.getQueueName()
+        inputddms = self.si.resolvePandaAssociatedStorages(pandaqueue).get(pandaqueue, {}).get('pr', {})
+        storage_index = StorageIndex(self.ddmconf, inputddms)
+
         for fdat in files:
             ddmdat = self.ddmconf.get(fdat.ddmendpoint)
             if not ddmdat:
@@ -229,8 +235,7 @@ class JobMover(object):
             #localddms = ddms.get(ddmdat['site'])
             # sort and filter ddms (as possible input source)
             #fdat.inputddms = self._prepare_input_ddm(ddmdat, localddms)
-            pandaqueue = self.si.getQueueName()
-            fdat.inputddms = self.si.resolvePandaAssociatedStorages(pandaqueue).get(pandaqueue, {}).get('pr', {})
+            fdat.inputddms = inputddms
 
             #if fdat.storageId in [-1, None] or ddmdat.type not in ['OS_ES']: ## redundant, double check -- just ported from old workflow ?
             xfiles.append(fdat)
@@ -238,10 +243,6 @@ class JobMover(object):
         if not xfiles: # no files for replica look-up
             return files
 
-        # load replicas from Rucio
-        from rucio.client import Client
-        c = Client()
-
         ## for the time being until Rucio bug with geo-ip sorting is resolved
         ## do apply either simple query list_replicas() without geoip sort to resolve LAN replicas in case of directaccesstype=[None, LAN]
         # otherwise in case of directaccesstype=WAN mode do query geo sorted list_replicas() with location data passed
@@ -252,33 +253,28 @@ class JobMover(object):
 
         allowRemoteInputs = True in set(e.allowRemoteInputs for e in xfiles)
 
-        try:
-            query = bquery.copy()
-            if allowRemoteInputs:
-                location = self.detect_client_location()
-                if not location:
-                    raise Exception("Failed to get client location")
-                query.update(sort='geoip', client_location=location)
-                # query.update(sort='geoip', client_location=location, domain='lan') # remove lan again after testing
+        # reuse replicas resolved by a previous (recent) stage-in attempt
+        cached_replicas, missing = replica_cache.get(replica_cache.query_key(bquery, allowRemoteInputs), [(e.scope, e.lfn) for e in xfiles])
+        if cached_replicas:
+            self.log("Reuse cached Rucio replicas for %s files" % len(cached_replicas))
+        bquery['dids'] = [dict(scope=scope, name=name) for scope, name in missing]
 
-            try:
-                self.log('Call rucio.list_replicas() with query=%s' % query)
-                replicas = c.list_replicas(**query)
-            except TypeError, e:
-                if query == bquery:
-                    raise
-                self.log("WARNING: Detected outdated Rucio list_replicas(), cannot do geoip-sorting: %s .. fallback to old list_replicas() call" % e)
-                replicas = c.list_replicas(**bquery)
+        replicas = []
+        if missing:
+            replicas = self.list_replicas(bquery, allowRemoteInputs)
 
-        except Exception, e:
-            raise PilotException("Failed to get replicas from Rucio: %s" % e, code=PilotErrors.ERR_FAILEDLFCGETREPS)
-
-        replicas = list(replicas)
-        self.log("replicas received from Rucio: %s" % replicas)
+        replicas = cached_replicas + replicas
 
         files_lfn = dict(((e.scope, e.lfn), e) for e in xfiles)
         #self.log("files_lfn=%s" % files_lfn)
 
+        def get_preferred_replica(replicas, allowed_schemas):
+            for replica in replicas:
+                for schema in allowed_schemas:
+                    if replica and replica.startswith('%s://' % schema):
+                        return replica
+            return None
+
         for r in replicas:
             k = r['scope'], r['name']
             fdat = files_lfn.get(k)
@@ -288,33 +284,13 @@ class JobMover(object):
             fdat.replicas = [] # reset replicas list
 
             # manually sort replicas by priority value .. can be removed once Rucio server-side fix will be delivered
-            ordered_replicas = {}
-            for pfn, xdat in sorted(r.get('pfns', {}).iteritems(), key=lambda x: x[1]['priority']):
-                ordered_replicas.setdefault(xdat.get('rse'), []).append(pfn)
-
-            def get_preferred_replica(replicas, allowed_schemas):
-                for replica in replicas:
-                    for schema in allowed_schemas:
-                        if replica and replica.startswith('%s://' % schema):
-                            return replica
-                return None
+            ordered_replicas = storage_index.group_pfns(r)
 
             has_direct_remoteinput_replicas = False
 
-            # local replicas
-            for ddm in fdat.inputddms: ## iterate over local ddms and check if replica is exist here
-
-                #pfns = r.get('rses', {}).get(ddm)  ## use me when Rucio server-side sort fix will be deployed
-                pfns = ordered_replicas.get(ddm)    ## quick workaround, use mannually sorted data
-
-                if not pfns: # no replica found for given local ddm
-                    continue
-
-                ddm_se, ddm_path = '',''
-                def_protocol = self.ddmconf[ddm].get('aprotocols', {}).get('r', [])  ## fix me later: use 'read_lan' then fallback to 'read_wan'
-                def_protocol = def_protocol[0] if def_protocol else None  ## take first entry
-                if def_protocol:
-                    ddm_se, ddm_path = def_protocol[0], def_protocol[2]
+            # local replicas, ordered by the preference of the local ddms
+            #pfns = r.get('rses', {}).get(ddm)  ## use me when Rucio server-side sort fix will be deployed
+            for ddm, pfns, ddm_se, ddm_path in storage_index.local_replicas(ordered_replicas):
 
                 fdat.replicas.append((ddm, pfns, ddm_se, ddm_path))
 
@@ -365,6 +341,44 @@ class JobMover(object):
 
         return files
 
+    def list_replicas(self, bquery, allowRemoteInputs):
+        """
+            Load replicas from Rucio, the result is cached for the next stage-in attempts
+            :return: list of replicas
+        """
+
+        # load replicas from Rucio
+        from rucio.client import Client
+        c = Client()
+
+        try:
+            query = bquery.copy()
+            if allowRemoteInputs:
+                location = self.detect_client_location()
+                if not location:
+                    raise Exception("Failed to get client location")
+                query.update(sort='geoip', client_location=location)
+                # query.update(sort='geoip', client_location=location, domain='lan') # remove lan again after testing
+
+            try:
+                self.log('Call rucio.list_replicas() with query=%s' % query)
+                replicas = c.list_replicas(**query)
+            except TypeError, e:
+                if query == bquery:
+                    raise
+                self.log("WARNING: Detected outdated Rucio list_replicas(), cannot do geoip-sorting: %s .. fallback to old list_replicas() call" % e)
+                replicas = c.list_replicas(**bquery)
+
+        except Exception, e:
+            raise PilotException("Failed to get replicas from Rucio: %s" % e, code=PilotErrors.ERR_FAILEDLFCGETREPS)
+
+        replicas = list(replicas)
+        self.log("replicas received from Rucio: %s" % replicas)
+
+        replica_cache.put(replica_cache.query_key(bquery, allowRemoteInputs), replicas)
+
+        return replicas
+
 
     def get_directaccess(self):
         """
@@ -0,0 +1,127 @@
+"""
+  Helpers for JobMover.resolve_replicas():
+  StorageIndex -- the input storages of a job (RSE -> ddmendpoint, protocol, priority, is_local),
+                  built once per replica look-up from ddmconf and the queue's associated storages
+  ReplicaCache -- short-lived process-wide cache of Rucio list_replicas() results,
+                  so that repeated stage-in attempts do not query Rucio again
+"""
+
+import time
+import threading
+
+REPLICA_CACHE_TIME = 300  # seconds, lifetime of cached Rucio replicas
+
+
+class StorageIndex(object):
+    """
+        Index of the storages to read job inputs from:
+        RSE name -> (ddmendpoint, (ddm_se, ddm_path), priority, is_local)
+    """
+
+    def __init__(self, ddmconf, inputddms):
+        """
+            :param ddmconf: DDM endpoints configuration (AGIS)
+            :param inputddms: ordered list of local ddmendpoints (schedconf 'astorages' for the 'pr' activity)
+        """
+
+        self.inputddms = list(inputddms or [])
+        self.entries = {}
+
+        for priority, ddm in enumerate(self.inputddms):
+            if ddm in self.entries:
+                continue
+            ddm_se, ddm_path = '', ''
+            def_protocol = (ddmconf.get(ddm) or {}).get('aprotocols', {}).get('r', [])  ## fix me later: use 'read_lan' then fallback to 'read_wan'
+            def_protocol = def_protocol[0] if def_protocol else None  ## take first entry
+            if def_protocol:
+                ddm_se, ddm_path = def_protocol[0], def_protocol[2]
+            self.entries[ddm] = (ddm, (ddm_se, ddm_path), priority, True)
+
+    def lookup(self, rse):
+        """ :return: (ddmendpoint, (ddm_se, ddm_path), priority, is_local) for given RSE """
+
+        return self.entries.get(rse) or (rse, ('', ''), None, False)
+
+    def is_local(self, rse):
+        return rse in self.entries
+
+    @staticmethod
+    def group_pfns(replica):
+        """
+            Group the pfns of a Rucio replica by RSE, each group ordered by the pfn priority
+            (manual sort, can be removed once the Rucio server-side fix is delivered)
+            :return: dict('rse': [pfn1, pfn2, ..])
+        """
+
+        ordered_replicas = {}
+        for pfn, xdat in sorted(replica.get('pfns', {}).iteritems(), key=lambda x: x[1]['priority']):
+            ordered_replicas.setdefault(xdat.get('rse'), []).append(pfn)
+
+        return ordered_replicas
+
+    def local_replicas(self, ordered_replicas):
+        """
+            Select the replicas stored at the local ddms
+            :param ordered_replicas: pfns grouped by RSE, see group_pfns()
+            :return: list of (ddmendpoint, pfns, ddm_se, ddm_path) ordered by the preference of the local ddms
+        """
+
+        entries = self.entries
+        found = [entries[rse] for rse in ordered_replicas if rse in entries]
+        found.sort(key=lambda x: x[2])
+
+        return [(ddm, ordered_replicas[ddm], ddm_se, ddm_path) for ddm, (ddm_se, ddm_path), priority, is_local in found]
+
+
+class ReplicaCache(object):
+    """
+        Process-wide cache of Rucio replicas, keyed by the requested query type (schemes and sort order) and (scope, name)
+    """
+
+    def __init__(self, cache_time=REPLICA_CACHE_TIME):
+        self.cache_time = cache_time
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, qkey, dids):
+        """
+            :param qkey: query key, see query_key()
+            :param dids: list of (scope, name)
+            :return: (list of cached replicas, list of dids which are not cached)
+        """
+
+        now = time.time()
+        replicas, missing = [], []
+        with self.lock:
+            for did in dids:
+                e = self.data.get((qkey, did))
+                if e and now - e[0] < self.cache_time:
+                    replicas.append(e[1])
+                else:
+                    missing.append(did)
+
+        return replicas, missing
+
+    def put(self, qkey, replicas):
+        now = time.time()
+        with self.lock:
+            for r in replicas:
+                self.data[(qkey, (r['scope'], r['name']))] = (now, r)
+            # drop expired entries
+            for k in [k for k, e in self.data.iteritems() if now - e[0] >= self.cache_time]:
+                del self.data[k]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    @staticmethod
+    def query_key(bquery, allowRemoteInputs):
+        """
+            Key of the replicas requested by JobMover.list_replicas(bquery, allowRemoteInputs): geoip sorted or not,
+            also when an outdated Rucio client could not sort them
+        """
+        return tuple(bquery.get('schemes', [])), bool(allowRemoteInputs)
+
+
+replica_cache = ReplicaCache()
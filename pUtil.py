@@ -2502,64 +2502,38 @@ def grep(patterns, file_name):
     # -> [list containing the lines below]
     #   CaloTrkMuIdAlg2.sysExecute()             ERROR St9bad_alloc
     #   AthAlgSeq.sysExecute()                   FATAL  Standard std::exception is caught
+    # (the file is only read once for all registered diagnostics patterns, see DiagnosticsScanner)
 
-    matched_lines = []
-    p = []
-    for pattern in patterns:
-        p.append(re.compile(pattern))
+    import DiagnosticsScanner
 
+    matched_lines = []
     try:
-        f = open(file_name, "r")
-    except IOError, e:
+        matched_lines = DiagnosticsScanner.grep(patterns, file_name)
+    except (IOError, OSError), e:
         tolog("!!WARNING!!2999!! %s" % e)
-    else:
-        while True:
-            # get the next line in the file
-            line = f.readline()
-            if not line:
-                break
-
-            # can the search pattern be found
-            for cp in p:
-                if re.search(cp, line):
-                    matched_lines.append(line)
-        f.close()
     return matched_lines
 
 def getJobReport(filename):
     """ Extract the job report from the stdout, or the last N lines """
 
+    import DiagnosticsScanner
+
     report = ""
     if os.path.exists(filename):
-        pattern = re.compile("Job Report produced by")
         try:
+            offsets = DiagnosticsScanner.scan(filename).getOffsets("job_report")
             f = open(filename, "r")
-        except IOError, e:
+        except (IOError, OSError), e:
             tolog("!!WARNING!!1299!! %s" % e)
         else:
             matched_lines = []
-            status = True
-            first_report = True
-            while status:
-                # get the next line in the file
-                line = f.readline()
-                if not line:
-                    break
 
-                # find the start position of the job report and grab all remaining lines
-                if re.search(pattern, line) and first_report:
-                    # the job report is repeated, only grab it the second time it appears
-                    first_report = False
-                elif re.search(pattern, line) and not first_report:
-                    # save the job report title line
-                    line = line.replace("=====", "-")
-                    matched_lines.append(line)
-                    while True:
-                        line = f.readline()
-                        if not line:
-                            status = False
-                            break
-                        matched_lines.append(line)
+            # the job report is repeated, only grab it the second time it appears (and all remaining lines)
+            if len(offsets) > 1:
+                f.seek(offsets[1])
+                # save the job report title line
+                matched_lines.append(f.readline().replace("=====", "-"))
+                matched_lines.append(f.read())
 
             # grab the last couple of lines in case the trf failed before the job report was printed
             if len(matched_lines) == 0:
@@ -2990,12 +2964,11 @@ def updateXMLWithEndpoints(xml, filenames, endpoints):
 def updateXMLWithSURLs(experiment, node_xml, workDir, jobId, jobrec, format=''):
     """ update the XML with the SURLs """
 
-    xml = ""
+    lines = []
 
-    # read back the SURL dictionary
+    # the SURL registry of the job (in memory, picks up the SURLs added by other processes)
     from SiteMover import SiteMover
-    sitemover = SiteMover()
-    surlDictionary = sitemover.getSURLDictionary(workDir, jobId)
+    surlDictionary = SiteMover.getSURLRegistry(workDir, jobId).surls
 
     # get the experiment object
     thisExperiment = getExperiment(experiment)
@@ -3014,6 +2987,9 @@ def updateXMLWithSURLs(experiment, node_xml, workDir, jobId, jobrec, format=''):
                 metadata_attr_name = "surl"
             re_tobeset = re.compile('\<metadata att\_name\=\"%s\" att\_value\=\"([a-zA-Z0-9-]+)\-surltobeset\"\/\>' % (metadata_attr_name))
         for line in node_xml_list:
+            if "surltobeset" not in line:
+                lines.append(line)
+                continue
             tobeset = re_tobeset.search(line)
             if tobeset:
                 # extract the guid and surl
@@ -3026,18 +3002,16 @@ def updateXMLWithSURLs(experiment, node_xml, workDir, jobId, jobrec, format=''):
                     tolog("!!WARNING!!2996!! Encountered a missing guid in the surl dictionary - did the corresponding transfer fail? guid = %s, %s" % (guid, e))
                     # add the 'surltobeset' line when job recovery is used
                     if jobrec:
-                        xml += line + "\n"
+                        lines.append(line)
                 else:
                     # replace the guid and the "surltobeset"-string with the surl
                     if surl and surl != "":
-                        xml += line.replace(guid + "-surltobeset", surl) + "\n"
+                        lines.append(line.replace(guid + "-surltobeset", surl))
                     else:
                         tolog("!!WARNING!!2996!! Could not extract guid %s from xml line: %s" % (guid, line))
             # fail safe in case something went wrong above, remove the guid+surltobeset line
-            elif "surltobeset" in line:
-                tolog("Failed to remove surltobeset from line: %s" % (line))
             else:
-                xml += line + "\n"
+                tolog("Failed to remove surltobeset from line: %s" % (line))
 
     else:
         tolog("!!WARNING!!2997!! Encountered an empty SURL dictionary")
@@ -3046,9 +3020,14 @@ def updateXMLWithSURLs(experiment, node_xml, workDir, jobId, jobrec, format=''):
         for line in node_xml_list:
             if not jobrec:
                 if not "surltobeset" in line:
-                    xml += line + "\n"
+                    lines.append(line)
             else:
-                xml += line + "\n"
+                lines.append(line)
+
+    # every line ends with a newline
+    xml = "\n".join(lines)
+    if lines:
+        xml += "\n"
 
     if xml == "\n":
         xml = ""
@@ -4100,7 +4079,7 @@ def moveToExternal(workdir, recoveryDir):
 
             moveDic = {"workdir" : _job.workdir, "datadir" : _job.datadir, "logfile" : logfile, "logfile_copied" : logfile_copied,
                        "logfile_registered" : logfile_registered, "metadata1" : metadatafile1,
-                       "metadata2" : metadatafile2, "surlDictionary" : surlDictionary }
+                       "metadata2" : metadatafile2, "surlDictionary" : surlDictionary, "surlJournal" : surlDictionary + ".journal" }
             tolog("Using moveDic: %s" % str(moveDic))
             failures = 0
             successes = 0
@@ -1,5 +1,9 @@
 #!/usr/bin/python -u
 
+# start the import profiler (if requested) before the pilot modules are loaded
+import ImportProfiler
+ImportProfiler.enable()
+
 import commands
 import getopt
 import os
@@ -28,11 +32,7 @@ from WatchDog import WatchDog
 from Monitor import Monitor
 import subprocess
 import DeferredStageout
-
-try:
-    from rucio.client import Client
-except Exception, e:
-    print "!!WARNING!!0000!! Exception caught:", e
+import ResourceSampler
 
 # Initialize the configuration singleton
 import environment
@@ -48,7 +48,7 @@ def usage():
         -l <wrapperflag> -i <pilotreleaseflag> -o <countrygroup> -v <workingGroup> -A <allowOtherCountry>
         -B <allowSingleUser> -C <timefloor> -D <useCoPilot> -E <stageoutretry> -F <experiment> -G <getJobMaxTime>
         -H <cache> -I <schedconfigURL> -N <yodaNodes> -Q <yodaQueue> -M <use_newmover> -O <panda_proxy_url>
-        -P <panda_proxy_port> -R <resourceType> -S <harvesterMode> -T <maxtime> -K <taskID>
+        -P <panda_proxy_port> -R <resourceType> -S <harvesterMode> -T <maxtime> -K <taskID> [--profile-imports]
     where:
                <sitename> is the name of the site that this job is landed,like BNL_ATLAS_1
                <workdir> is the pathname to the work directory of this job on the site
@@ -92,6 +92,8 @@ def usage():
                <resourceType> MCORE, SCORE
                <harvesterMode> True if Harvester is launching the pilot, False otherwise
                <taskID> taskID, will only download jobs from this task.
+               --profile-imports writes the cumulative import time per module of the pilot and the payload
+               subprocesses to the log (same as PILOT_PROFILE_IMPORTS=1)
     """
     #  <testlevel> 0: no test, 1: simulate put error, 2: ...
     print usage.__doc__
@@ -664,7 +666,7 @@ def runJobRecovery(thisSite, _psport, extradir):
 
         try:
             lostPandaIDs = RecoverLostHPCEventJobs(_dir, thisSite, _psport)
-        except:
+        except Exception, e:
             pUtil.tolog("!!WARNING!!1999!! Failed during search for lost HPCEvent jobs: %s" % str(e))
         else:
             pUtil.tolog("Recovered/Updated lost HPCEvent jobs(%s)" % (lostPandaIDs))
@@ -1841,7 +1843,7 @@ def diskCleanup(wntmpdir, _uflag):
 
     for _dir in dirs:
         pUtil.tolog("Cleaning %s" % (_dir))
-        cleaner = Cleaner(limit = env['cleanupLimit'], path = _dir, uflag = _uflag)
+        cleaner = Cleaner(limit = env['cleanupLimit'], path = _dir, uflag = _uflag, time_budget = env['cleanupTimeBudget'])
         _ec = cleaner.cleanup()
         del cleaner
 
@@ -2729,6 +2731,9 @@ def runMain(runpars):
         env['workerNode'] = Node.Node()
         env['workerNode'].setNodeName(getProperNodeName(os.uname()[1]))
 
+        # keep sampling the worker node resources in the background, Node.collectWNInfo() reads the latest sample
+        ResourceSampler.start(interval=env['resourceSamplerInterval'])
+
         # collect WN info .........................................................................................
 
         # do not include the basename in the path since it has not been created yet
@@ -2868,6 +2873,8 @@ def runMain(runpars):
             else:
                 env['isJobDownloaded'] = True
                 pUtil.tolog("Using job definition id: %s" % (env['job'].jobDefinitionID))
+                # the sampled node statistics reported with the job metrics belong to this job only
+                ResourceSampler.resetStatistics()
                 env['job'].timeGetJob = int(round(tp_1[4] - tp_0[4]))
 
             # verify any contradicting job definition parameters here
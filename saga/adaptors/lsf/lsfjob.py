@@ -8,10 +8,10 @@ __license__   = "MIT"
 """
 
 import radical.utils.which
-import radical.utils.threads as sut
 
 import saga.url as surl
 import saga.utils.pty_shell
+import saga.utils.job.bulk_monitor as sbm
 
 import saga.adaptors.base
 import saga.adaptors.cpi.job
@@ -21,7 +21,6 @@ from saga.job.constants import *
 import re
 import os 
 import time
-import threading
 
 from cgi  import parse_qs
 
@@ -29,62 +28,11 @@ SYNC_CALL = saga.adaptors.cpi.decorators.SYNC_CALL
 ASYNC_CALL = saga.adaptors.cpi.decorators.ASYNC_CALL
 
 SYNC_WAIT_UPDATE_INTERVAL = 1  # seconds
-MONITOR_UPDATE_INTERVAL = 3  # seconds
+MONITOR_UPDATE_INTERVAL = 3  # seconds, interval after a job changed its state
+MONITOR_MAX_INTERVAL = 60  # seconds, max. interval between two bulk bjobs calls
 
-
-# --------------------------------------------------------------------
-#
-class _job_state_monitor(threading.Thread):
-    """ thread that periodically monitors job states
-    """
-    def __init__(self, job_service):
-
-        self.logger = job_service._logger
-        self.js = job_service
-        self._stop = sut.Event()
-
-        super(_job_state_monitor, self).__init__()
-        self.setDaemon(True)
-
-    def stop(self):
-        self._stop.set()
-
-
-    def stopped(self):
-        return self._stop.isSet()
-
-    def run(self):
-        while self.stopped() is False:
-            try:
-                # do bulk updates here! we don't want to pull information
-                # job by job. that would be too inefficient!
-                jobs = self.js.jobs
-                job_keys = jobs.keys()
-
-                for job in job_keys:
-                    # if the job hasn't been started, we can't update its
-                    # state. we can tell if a job has been started if it
-                    # has a job id
-                    if  jobs[job].get ('job_id', None) is not None:
-                        # we only need to monitor jobs that are not in a
-                        # terminal state, so we can skip the ones that are 
-                        # either done, failed or canceled
-                        state = jobs[job]['state']
-                        if (state != saga.job.DONE) and (state != saga.job.FAILED) and (state != saga.job.CANCELED):
-
-                            job_info = self.js._job_get_info(job)
-                            self.logger.info("Job monitoring thread updating Job %s (state: %s)" % (job, job_info['state']))
-
-                            if job_info['state'] != jobs[job]['state']:
-                                # fire job state callback if 'state' has changed
-                                job._api()._attributes_i_set('state', job_info['state'], job._api()._UP, True)
-
-                            # update job info
-                            self.js.jobs[job] = job_info
-
-                time.sleep(MONITOR_UPDATE_INTERVAL)
-            except Exception as e:
-                self.logger.warning("Exception caught in job monitoring thread: %s" % e)
+# the fields requested from 'bjobs -o' for bulk state updates
+BJOBS_FIELDS = 'jobid stat exec_host exit_code submit_time start_time finish_time delimiter=","'
 
 
 # --------------------------------------------------------------------
@@ -115,6 +63,31 @@ def _lsf_to_saga_jobstate(lsfjs):
         return saga.job.UNKNOWN
 
 
+# --------------------------------------------------------------------
+#
+def _parse_bjobs_output(out):
+    """ parses the output of "bjobs -noheader -o '<BJOBS_FIELDS>' <pid> ..."
+        into a dict {pid: job info} and a list of pids LSF doesn't know
+    """
+    records   = dict()
+    not_found = re.findall(r'Job <(.*?)> is not found', out)
+
+    for line in out.split('\n'):
+        fields = line.strip().split(',')
+        if len(fields) != 7 or not fields[0].isdigit():
+            continue
+        info = {'state'      : _lsf_to_saga_jobstate(fields[1]),
+                'exec_hosts' : fields[2],
+                'create_time': fields[4],
+                'start_time' : fields[5],
+                'end_time'   : fields[6]}
+        if fields[3] not in ['-', '']:
+            info['returncode'] = int(fields[3])
+        records[fields[0]] = info
+
+    return records, not_found
+
+
 # --------------------------------------------------------------------
 #
 def _lsfcript_generator(url, logger, jd, ppn, lsf_version, queue=None, ):
@@ -365,6 +338,14 @@ class LSFJobService (saga.adaptors.cpi.job.Service):
             self.mt.stop()
             self.mt.join(10)  # don't block forever on join()
 
+            if  self.mt.isAlive() and self.shell :
+                # the monitoring thread may still be using the shell, so it
+                # must not go back to the pool
+                self._logger.warning("Job monitoring thread did not stop, closing its shell.")
+                shell      = self.shell
+                self.shell = None
+                shell.finalize(kill_pty=True)
+
         self._logger.info("Job monitoring thread stopped.")
 
         self.finalize(True)
@@ -376,7 +357,11 @@ class LSFJobService (saga.adaptors.cpi.job.Service):
 
         if  kill_shell :
             if  self.shell :
-                self.shell.finalize (True)
+                # return the shell to the pool, for the next job service --
+                # only once, it may be handed out again right away
+                shell      = self.shell
+                self.shell = None
+                self.session._shell_pool.put (shell)
 
 
     # ----------------------------------------------------------------
@@ -393,7 +378,9 @@ class LSFJobService (saga.adaptors.cpi.job.Service):
         self.jobs    = dict()
 
         # the monitoring thread - one per service instance
-        self.mt = _job_state_monitor(job_service=self)
+        self.mt = sbm.BulkJobMonitor(job_service=self,
+                                     min_interval=MONITOR_UPDATE_INTERVAL,
+                                     max_interval=MONITOR_MAX_INTERVAL)
         self.mt.start()
 
         rm_scheme = rm_url.scheme
@@ -425,7 +412,8 @@ class LSFJobService (saga.adaptors.cpi.job.Service):
                           'bsub':     None,
                           'bkill':    None}
 
-        self.shell = saga.utils.pty_shell.PTYShell(pty_url, self.session)
+        # get a (possibly warm) shell from the session's shell pool
+        self.shell = self.session._shell_pool.get(pty_url, self.session)
 
       # self.shell.set_initialize_hook(self.initialize)
       # self.shell.set_finalize_hook(self.finalize)
@@ -437,15 +425,22 @@ class LSFJobService (saga.adaptors.cpi.job.Service):
     # ----------------------------------------------------------------
     #
     def initialize(self):
-        # check if all required lsf tools are available
+        # check if all required lsf tools are available -- all probes are
+        # pipelined into one shell roundtrip
+        probes = list()
         for cmd in self._commands.keys():
-            ret, out, _ = self.shell.run_sync("which %s " % cmd)
+            probes.append("which %s " % cmd)
+            probes.append("%s -V" % cmd)
+        results = dict(zip(probes, self.shell.run_pipelined(probes)))
+
+        for cmd in self._commands.keys():
+            ret, out, _ = results["which %s " % cmd]
             if ret != 0:
                 message = "Couldn't find LSF tools: %s" % out
                 log_error_and_raise(message, saga.NoSuccess, self._logger)
             else:
                 path = out.strip()  # strip removes newline
-                ret, out, _ = self.shell.run_sync("%s -V" % cmd)
+                ret, out, _ = results["%s -V" % cmd]
                 if ret != 0:
                     message = "Couldn't find LSF tools: %s" % out
                     log_error_and_raise(message, saga.NoSuccess, self._logger)
@@ -568,6 +563,9 @@ class LSFJobService (saga.adaptors.cpi.job.Service):
             #self.jobs[job_obj]['state'] = saga.job.PENDING
             #job_obj._api()._attributes_i_set('state', self.jobs[job_obj]['state'], job_obj._api()._UP, True)
 
+            # a new job is watched -- poll fast again
+            self.mt.wake()
+
             # return the job id
             return job_id
 
@@ -679,6 +677,61 @@ class LSFJobService (saga.adaptors.cpi.job.Service):
         # return the new job info dict
         return curr_info
 
+    # ----------------------------------------------------------------
+    #
+    def _bulk_update(self):
+        """ refresh the info of all submitted, non-final jobs with a single
+            bjobs call, fire the state callback for jobs whose state changed
+            and return the number of those jobs
+        """
+        pids = dict()
+        for job_obj, job_info in self.jobs.items():
+            # if the job hasn't been started, we can't update its state. we
+            # can tell if a job has been started if it has a job id
+            if  job_info.get('job_id', None) is not None \
+            and job_info['state'] not in sbm.FINAL_STATES \
+            and job_info['gone'] is not True:
+                pids[self._adaptor.parse_id(job_info['job_id'])[1]] = job_obj
+
+        if not pids:
+            return 0
+
+        ret, out, _ = self.shell.run_sync("%s -noheader -o '%s' %s" \
+            % (self._commands['bjobs']['path'], BJOBS_FIELDS, ' '.join(pids.keys())))
+        records, not_found = _parse_bjobs_output(out)
+
+        if ret != 0 and not records and not not_found:
+            # something went wrong, keep the old info and retry next cycle
+            self._logger.warning("Error retrieving job info via 'bjobs': %s" % out)
+            return 0
+
+        changed = 0
+        for pid, job_obj in pids.iteritems():
+            if pid in records:
+                new_info = records[pid]
+            elif pid in not_found:
+                # the job has disappeared: this can either mean DONE, or FAILED
+                self._logger.warning("Previously running job %s has disappeared. This probably means that the backend doesn't store informations about finished jobs. Setting state to 'DONE'." % pid)
+                if self.jobs[job_obj]['state'] in [saga.job.RUNNING, saga.job.PENDING]:
+                    new_info = {'gone': True, 'state': saga.job.DONE}
+                else:
+                    new_info = {'gone': True, 'state': saga.job.FAILED}
+            else:
+                continue
+
+            changed += sbm.apply_bulk_info(self.jobs, job_obj, new_info,
+                                           self._job_state_changed)
+
+        return changed
+
+    # ----------------------------------------------------------------
+    #
+    def _job_state_changed(self, job_obj, job_info):
+        """ fire the job state callback
+        """
+        self._logger.info("Job monitoring thread updating Job %s (state: %s)" % (job_obj, job_info['state']))
+        job_obj._api()._attributes_i_set('state', job_info['state'], job_obj._api()._UP, True)
+
     # ----------------------------------------------------------------
     #
     def _job_get_state(self, job_obj):
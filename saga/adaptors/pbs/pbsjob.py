@@ -7,10 +7,8 @@ __license__   = "MIT"
 """ PBS job adaptor implementation
 """
 
-import threading
-
 import saga.url             as surl
-import saga.utils.pty_shell as sups
+import saga.utils.job.bulk_monitor as sbm
 import saga.adaptors.base
 import saga.adaptors.cpi.job
 
@@ -19,7 +17,6 @@ from saga.job.constants import *
 import re
 import os 
 import time
-import threading
 
 from cgi  import parse_qs
 
@@ -27,67 +24,8 @@ SYNC_CALL  = saga.adaptors.cpi.decorators.SYNC_CALL
 ASYNC_CALL = saga.adaptors.cpi.decorators.ASYNC_CALL
 
 SYNC_WAIT_UPDATE_INTERVAL =  1  # seconds
-MONITOR_UPDATE_INTERVAL   = 60  # seconds
-
-
-# --------------------------------------------------------------------
-#
-class _job_state_monitor(threading.Thread):
-    """ thread that periodically monitors job states
-    """
-    def __init__(self, job_service):
-
-        self.logger = job_service._logger
-        self.js = job_service
-        self._stop = threading.Event()
-
-        super(_job_state_monitor, self).__init__()
-        self.setDaemon(True)
-
-    def stop(self):
-        self._stop.set()
-
-
-    def stopped(self):
-        return self._stop.isSet()
-
-    def run(self):
-
-        while self.stopped() is False:
-
-            try:
-                # FIXME: do bulk updates here! we don't want to pull information
-                # job by job. that would be too inefficient!
-                jobs = self.js.jobs
-
-                for job_id in jobs.keys() :
-
-                    job_info = jobs[job_id]
-
-                    # we only need to monitor jobs that are not in a
-                    # terminal state, so we can skip the ones that are 
-                    # either done, failed or canceled
-                    if  job_info['state'] not in [saga.job.DONE, saga.job.FAILED, saga.job.CANCELED] :
-
-                        new_job_info = self.js._job_get_info(job_id)
-                        self.logger.info ("Job monitoring thread updating Job %s (state: %s)" \
-                                       % (job_id, new_job_info['state']))
-
-                        # fire job state callback if 'state' has changed
-                        if  new_job_info['state'] != job_info['state']:
-                            job_obj = job_info['obj']
-                            job_obj._attributes_i_set('state', new_job_info['state'], job_obj._UP, True)
-
-                        # update job info
-                        jobs[job_id] = new_job_info
-
-            except Exception as e:
-                import traceback
-                traceback.print_exc ()
-                self.logger.warning("Exception caught in job monitoring thread: %s" % e)
-
-            finally :
-                time.sleep (MONITOR_UPDATE_INTERVAL)
+MONITOR_UPDATE_INTERVAL   = 60  # seconds, max. interval between two bulk qstat calls
+MONITOR_MIN_INTERVAL      = 10  # seconds, interval after a job changed its state
 
 
 # --------------------------------------------------------------------
@@ -128,6 +66,86 @@ def _pbs_to_saga_jobstate(pbsjs):
         return saga.job.UNKNOWN
 
 
+# --------------------------------------------------------------------
+#
+def _parse_qstat_xml(out):
+    """ parses the XML output of Torque's 'qstat -f -x <pid> ...' into a dict
+        {pid: {attribute: value}}
+    """
+    import xml.etree.ElementTree as ET
+
+    records = dict()
+
+    # the shell may add some noise around the document
+    start = out.find('<Data>')
+    end   = out.rfind('</Data>')
+    if start < 0 or end < 0:
+        return records
+
+    root = ET.fromstring(out[start:end + len('</Data>')])
+    for job in root.findall('Job'):
+        job_id = job.findtext('Job_Id')
+        if not job_id:
+            continue
+        attrs = dict()
+        for child in job:
+            if child.text is not None:
+                attrs[child.tag] = child.text.strip()
+        records[job_id.strip().split('.')[0]] = attrs
+
+    return records
+
+
+# --------------------------------------------------------------------
+#
+def _parse_qstat_full(out):
+    """ parses the text output of 'qstat -f <pid> ...' (one 'Job Id:' block
+        per job) into a dict {pid: {attribute: value}}
+    """
+    records = dict()
+    attrs   = None
+    key     = None
+
+    for line in out.split('\n'):
+        if line.startswith('Job Id:'):
+            attrs = dict()
+            key   = None
+            records[line.split(':', 1)[1].strip().split('.')[0]] = attrs
+        elif attrs is None or not line.strip():
+            continue
+        elif line.startswith('\t') and key is not None:
+            # long values are wrapped onto tab-indented continuation lines
+            attrs[key] += line.strip()
+        elif ' = ' in line:
+            key, val   = line.split(' = ', 1)
+            key        = key.strip()
+            attrs[key] = val.strip()
+
+    return records
+
+
+# --------------------------------------------------------------------
+#
+def _pbs_job_info(attrs):
+    """ translates qstat attributes into (partial) saga job info
+    """
+    info = dict()
+    for key, val in attrs.iteritems():
+        if key == 'job_state':
+            info['state'] = _pbs_to_saga_jobstate(val)
+        elif key == 'exec_host':
+            info['exec_hosts'] = val.split('+')  # format i73/7+i73/6+...
+        elif key in ['exit_status','Exit_status']:
+            info['returncode'] = int(val)
+        elif key == 'ctime':
+            info['create_time'] = val
+        elif key in ['start_time','stime']:
+            info['start_time'] = val
+        elif key in ['comp_time','mtime']:
+            info['end_time'] = val
+    return info
+
+
 # --------------------------------------------------------------------
 #
 def _pbscript_generator(url, logger, jd, ppn, pbs_version, is_cray=False, queue=None, ):
@@ -437,6 +455,14 @@ class PBSJobService (saga.adaptors.cpi.job.Service):
             self.mt.stop()
             self.mt.join(10)  # don't block forever on join()
 
+            if  self.mt.isAlive() and self.shell :
+                # the monitoring thread may still be using the shell, so it
+                # must not go back to the pool
+                self._logger.warning("Job monitoring thread did not stop, closing its shell.")
+                shell      = self.shell
+                self.shell = None
+                shell.finalize(kill_pty=True)
+
         self._logger.info("Job monitoring thread stopped.")
 
         self.finalize(True)
@@ -448,7 +474,11 @@ class PBSJobService (saga.adaptors.cpi.job.Service):
 
         if  kill_shell :
             if  self.shell :
-                self.shell.finalize (True)
+                # return the shell to the pool, for the next job service --
+                # only once, it may be handed out again right away
+                shell      = self.shell
+                self.shell = None
+                self.session._shell_pool.put (shell)
 
 
     # ----------------------------------------------------------------
@@ -466,7 +496,9 @@ class PBSJobService (saga.adaptors.cpi.job.Service):
         self.jobs    = dict()
 
         # the monitoring thread - one per service instance
-        self.mt = _job_state_monitor(job_service=self)
+        self.mt = sbm.BulkJobMonitor(job_service=self,
+                                     min_interval=MONITOR_MIN_INTERVAL,
+                                     max_interval=MONITOR_UPDATE_INTERVAL)
         self.mt.start()
 
         rm_scheme = rm_url.scheme
@@ -502,7 +534,8 @@ class PBSJobService (saga.adaptors.cpi.job.Service):
                           'qsub':     None,
                           'qdel':     None}
 
-        self.shell = sups.PTYShell(pty_url, self.session)
+        # get a (possibly warm) shell from the session's shell pool
+        self.shell = self.session._shell_pool.get(pty_url, self.session)
 
       # self.shell.set_initialize_hook(self.initialize)
       # self.shell.set_finalize_hook(self.finalize)
@@ -514,9 +547,17 @@ class PBSJobService (saga.adaptors.cpi.job.Service):
     # ----------------------------------------------------------------
     #
     def initialize(self):
-        # check if all required pbs tools are available
+        # check if all required pbs tools are available -- all probes are
+        # pipelined into one shell roundtrip
+        probes = list()
         for cmd in self._commands.keys():
-            ret, out, _ = self.shell.run_sync("which %s " % cmd)
+            probes.append("which %s " % cmd)
+            if cmd != 'qdel':  # qdel doesn't support --version!
+                probes.append("%s --version" % cmd)
+        results = dict(zip(probes, self.shell.run_pipelined(probes)))
+
+        for cmd in self._commands.keys():
+            ret, out, _ = results["which %s " % cmd]
             if ret != 0:
                 message = "Error finding PBS tools: %s" % out
                 log_error_and_raise(message, saga.NoSuccess, self._logger)
@@ -526,7 +567,7 @@ class PBSJobService (saga.adaptors.cpi.job.Service):
                     self._commands[cmd] = {"path":    path,
                                            "version": "?"}
                 else:
-                    ret, out, _ = self.shell.run_sync("%s --version" % cmd)
+                    ret, out, _ = results["%s --version" % cmd]
                     if ret != 0:
                         message = "Error finding PBS tools: %s" % out
                         log_error_and_raise(message, saga.NoSuccess,
@@ -685,6 +726,9 @@ class PBSJobService (saga.adaptors.cpi.job.Service):
             # set status to 'pending' and manually trigger callback
             job_obj._attributes_i_set('state', state, job_obj._UP, True)
 
+            # a new job is watched -- poll fast again
+            self.mt.wake()
+
             # return the job id
             return job_id
 
@@ -837,6 +881,65 @@ grep -E -i '(job_state)|(exec_host)|(exit_status)|(ctime)|(start_time)\
         # return the new job info dict
         return curr_info
 
+    # ----------------------------------------------------------------
+    #
+    def _bulk_update(self):
+        """ refresh the info of all non-final jobs with a single qstat call,
+            fire the state callback for jobs whose state changed and return
+            the number of those jobs
+        """
+        pids = dict()
+        for job_id, job_info in self.jobs.items():
+            if  job_info['state'] not in sbm.FINAL_STATES \
+            and job_info['gone'] is not True:
+                pids[self._adaptor.parse_id(job_id)[1]] = job_id
+
+        if not pids:
+            return 0
+
+        if 'PBSPro_1' in self._commands['qstat']['version']:
+            ret, out, _ = self.shell.run_sync("%s -fx %s" \
+                % (self._commands['qstat']['path'], ' '.join(pids.keys())))
+            records = _parse_qstat_full(out)
+        else:
+            ret, out, _ = self.shell.run_sync("%s -f -x %s" \
+                % (self._commands['qstat']['path'], ' '.join(pids.keys())))
+            records = _parse_qstat_xml(out)
+
+        if ret != 0 and not records and "Unknown Job Id" not in out:
+            # something went wrong, keep the old info and retry next cycle
+            self._logger.warning("Error retrieving job info via 'qstat': %s" % out)
+            return 0
+
+        changed = 0
+        for pid, job_id in pids.iteritems():
+            if pid in records:
+                new_info = _pbs_job_info(records[pid])
+            elif "Unknown Job Id" in out:
+                # the job has disappeared: this can either mean DONE, or FAILED
+                self._logger.warning("Previously running job %s has disappeared. This probably means that the backend doesn't store informations about finished jobs. Setting state to 'DONE'." % job_id)
+                if self.jobs[job_id]['state'] in [saga.job.RUNNING, saga.job.PENDING]:
+                    new_info = {'gone': True, 'state': saga.job.DONE}
+                else:
+                    new_info = {'gone': True, 'state': saga.job.FAILED}
+            else:
+                continue
+
+            changed += sbm.apply_bulk_info(self.jobs, job_id, new_info,
+                                           self._job_state_changed)
+
+        return changed
+
+    # ----------------------------------------------------------------
+    #
+    def _job_state_changed(self, job_id, job_info):
+        """ fire the job state callback
+        """
+        self._logger.info ("Job monitoring thread updating Job %s (state: %s)" \
+                        % (job_id, job_info['state']))
+        job_obj = job_info['obj']
+        job_obj._attributes_i_set('state', job_info['state'], job_obj._UP, True)
+
     # ----------------------------------------------------------------
     #
     def _job_get_state(self, job_id):
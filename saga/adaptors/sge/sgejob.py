@@ -9,6 +9,7 @@ __license__   = "MIT"
 """
 
 import saga.utils.pty_shell
+import saga.utils.job.bulk_monitor as sbm
 
 import saga.url as surl
 import saga.adaptors.base
@@ -19,6 +20,7 @@ from saga.job.constants import *
 import os
 import re
 import time
+import threading
 from cgi import parse_qs
 from StringIO import StringIO
 from datetime import datetime
@@ -28,6 +30,39 @@ ASYNC_CALL = saga.adaptors.cpi.decorators.ASYNC_CALL
 
 _QSTAT_JOB_STATE_RE = re.compile(r"^([^ ]+) ([0-9]{2}/[0-9]{2}/[0-9]{4} [0-9]{2}:[0-9]{2}:[0-9]{2}) (.+)$")
 
+BULK_MIN_INTERVAL =  2  # seconds, max. age of cached job states after a state change
+BULK_MAX_INTERVAL = 30  # seconds, max. age of cached job states while nothing changes
+
+
+# --------------------------------------------------------------------
+#
+def _parse_qstat_xml(out):
+    """ parses the output of 'qstat -xml' into a dict
+        {pid: {'state':..., 'start_time':..., 'queue':...}}
+    """
+    import xml.etree.ElementTree as ET
+
+    records = dict()
+
+    # the shell may add some noise around the document
+    start = out.find('<job_info')
+    end   = out.rfind('</job_info>')
+    if start < 0 or end < 0:
+        return records
+
+    root = ET.fromstring(out[start:end + len('</job_info>')])
+    for job in root.getiterator('job_list'):
+        pid = job.findtext('JB_job_number')
+        if not pid:
+            continue
+        records[pid.strip()] = {
+            'state'      : (job.findtext('state') or '').strip(),
+            'start_time' : (job.findtext('JAT_start_time') or '').strip() or None,
+            'queue'      : (job.findtext('queue_name') or '').strip() or None,
+        }
+
+    return records
+
 class SgeKeyValueParser(object):
     """
     Parser for SGE commands returning lines with key-value pairs.
@@ -281,6 +316,11 @@ class SGEJobService (saga.adaptors.cpi.job.Service):
         self.accounting = False
         self.temp_path = "$HOME/.saga/adaptors/sge_job"
 
+        # job states are refreshed for all jobs at once, and cached for an
+        # adaptive interval
+        self._bulk_interval = sbm.AdaptiveInterval(BULK_MIN_INTERVAL, BULK_MAX_INTERVAL)
+        self._bulk_lock     = threading.Lock()
+
 
         rm_scheme = rm_url.scheme
         pty_url   = surl.Url (rm_url)
@@ -313,7 +353,8 @@ class SGEJobService (saga.adaptors.cpi.job.Service):
                           'qconf': None,
                           'qacct': None}
 
-        self.shell = saga.utils.pty_shell.PTYShell(pty_url, self.session)
+        # get a (possibly warm) shell from the session's shell pool
+        self.shell = self.session._shell_pool.get(pty_url, self.session)
 
       # self.shell.set_initialize_hook(self.initialize)
       # self.shell.set_finalize_hook(self.finalize)
@@ -327,21 +368,32 @@ class SGEJobService (saga.adaptors.cpi.job.Service):
     #
     def close (self) :
         if  self.shell :
-            self.shell.finalize (True)
+            # return the shell to the pool, for the next job service --
+            # only once, it may be handed out again right away
+            shell      = self.shell
+            self.shell = None
+            self.session._shell_pool.put (shell)
 
     # ----------------------------------------------------------------
     #
     def initialize(self):
-        # check if all required sge tools are available
+        # check if all required sge tools are available -- all probes are
+        # pipelined into one shell roundtrip
+        probes = list()
         for cmd in self._commands.keys():
-            ret, out, _ = self.shell.run_sync("which %s " % cmd)
+            probes.append("which %s " % cmd)
+            probes.append("%s -help" % cmd)
+        results = dict(zip(probes, self.shell.run_pipelined(probes)))
+
+        for cmd in self._commands.keys():
+            ret, out, _ = results["which %s " % cmd]
             if ret != 0:
                 message = "Error finding SGE tools: %s" % out
                 log_error_and_raise(message, saga.NoSuccess, self._logger)
             else:
                 path = out.strip()  # strip removes newline
 
-                ret, out, _ = self.shell.run_sync("%s -help" % cmd)
+                ret, out, _ = results["%s -help" % cmd]
                 if ret != 0:
                     # fix for a bug in certain qstat versions that return
                     # '1' after a successfull qstat -help:
@@ -437,7 +489,11 @@ class SGEJobService (saga.adaptors.cpi.job.Service):
     def finalize(self, kill_shell=False):
         if  kill_shell :
             if  self.shell :
-                self.shell.finalize (True)
+                # return the shell to the pool, for the next job service --
+                # only once, it may be handed out again right away
+                shell      = self.shell
+                self.shell = None
+                self.session._shell_pool.put (shell)
 
     # ----------------------------------------------------------------
     #
@@ -834,6 +890,9 @@ class SGEJobService (saga.adaptors.cpi.job.Service):
             'gone':         False
         }
 
+        # a new job is watched -- poll fast again
+        self._bulk_interval.reset()
+
         return job_id
 
     # ----------------------------------------------------------------
@@ -956,6 +1015,53 @@ class SGEJobService (saga.adaptors.cpi.job.Service):
         self.jobs[job_id] = curr_info
         return curr_info
 
+    # ----------------------------------------------------------------
+    #
+    def _bulk_update(self):
+        """ refresh the state of all non-final jobs with a single 'qstat -xml'
+            call, return the number of jobs whose state changed. Jobs which
+            have left the queue are looked up one by one (job info file or
+            accounting) as before.
+        """
+        pids = dict()
+        for job_id, job_info in self.jobs.items():
+            if  job_info['state'] not in sbm.FINAL_STATES \
+            and job_info['gone'] is not True:
+                pids[self._adaptor.parse_id(job_id)[1]] = job_id
+
+        if not pids:
+            return 0
+
+        ret, out, _ = self.shell.run_sync("%s -xml" % self._commands['qstat']['path'])
+        if ret != 0:
+            self._logger.warning("Error retrieving job states via 'qstat -xml': %s" % out)
+            return 0
+        records = _parse_qstat_xml(out)
+
+        changed = 0
+        for pid, job_id in pids.iteritems():
+            record = records.get(pid)
+            if record is None or (self.accounting and record['state'] == "Eqw"):
+                # finished (or broken) job: fall back to the per-job lookup
+                try:
+                    new_info = self._retrieve_job(job_id)
+                except saga.NoSuccess:
+                    new_info = {'gone': True}
+            else:
+                new_info = {'state': self.__sge_to_saga_jobstate(record['state'])}
+                if record['start_time'] and record['state'] in ["r", "t", "s", "S", "T", "d", "E"]:
+                    try:
+                        dt = datetime.strptime(record['start_time'], "%Y-%m-%dT%H:%M:%S")
+                        new_info['start_time'] = dt.strftime("%a %b %d %H:%M:%S %Y")
+                    except ValueError:
+                        pass
+                if record['queue'] and "@" in record['queue']:
+                    new_info['exec_hosts'] = record['queue'].split("@")[1]
+
+            changed += sbm.apply_bulk_info(self.jobs, job_id, new_info)
+
+        return changed
+
     # ----------------------------------------------------------------
     #
     def _job_get_state(self, job_id):
@@ -967,9 +1073,11 @@ class SGEJobService (saga.adaptors.cpi.job.Service):
         or self.jobs[job_id]['state'] == saga.job.DONE:
             return self.jobs[job_id]['state']
 
-        # check if we can / should update
+        # check if we can / should update -- all jobs at once
         if (self.jobs[job_id]['gone'] is not True):
-            self.jobs[job_id] = self._job_get_info(job_id=job_id)
+            with self._bulk_lock:
+                if self._bulk_interval.due():
+                    self._bulk_interval.update(self._bulk_update())
 
         return self.jobs[job_id]['state']
 
@@ -10,6 +10,7 @@ __license__   = "MIT"
 #      attributes required for SLURM in a job description
 
 import saga.utils.pty_shell
+import saga.utils.job.bulk_monitor as sbm
 
 import saga.url as surl
 import saga.adaptors.base
@@ -21,10 +22,49 @@ import time
 import textwrap
 import string
 import tempfile
+import threading
 
 SYNC_CALL  = saga.adaptors.cpi.decorators.SYNC_CALL
 ASYNC_CALL = saga.adaptors.cpi.decorators.ASYNC_CALL
 
+BULK_MIN_INTERVAL =  2  # seconds, max. age of cached job states after a state change
+BULK_MAX_INTERVAL = 30  # seconds, max. age of cached job states while nothing changes
+
+
+# --------------------------------------------------------------------
+#
+def _parse_squeue_output(out):
+    """ parses the output of 'squeue -h -o "%i|%T|%N" -j <pid>,...' into a
+        dict {pid: (slurm state, node list)}
+    """
+    records = dict()
+    for line in out.split('\n'):
+        fields = line.strip().split('|')
+        if len(fields) != 3 or not fields[0]:
+            continue
+        records[fields[0]] = (fields[1], fields[2])
+    return records
+
+
+# --------------------------------------------------------------------
+#
+def _parse_sacct_output(out):
+    """ parses the output of 'sacct --format=JobID,State --parsable2
+        --noheader --jobs=<pid>,...' into a dict {pid: slurm state}
+    """
+    # output will look like:
+    # 500723|COMPLETED
+    # 500723.batch|COMPLETED
+    # 500682|CANCELLED by 900369
+    records = dict()
+    for line in out.split('\n'):
+        fields = line.strip().split('|', 1)
+        if len(fields) != 2 or '.' in fields[0] or not fields[1]:
+            continue
+        records[fields[0]] = fields[1].split()[0].strip()
+    return records
+
+
 # --------------------------------------------------------------------
 #
 def log_error_and_raise(message, exception, logger):
@@ -285,6 +325,12 @@ class SLURMJobService (saga.adaptors.cpi.job.Service) :
         self.session = session
 
         self.jobs = {}
+
+        # job states are refreshed for all jobs at once, and cached for an
+        # adaptive interval
+        self._bulk_interval = sbm.AdaptiveInterval(BULK_MIN_INTERVAL, BULK_MAX_INTERVAL)
+        self._bulk_lock     = threading.Lock()
+
         self._open ()
 
         return self.get_api ()
@@ -294,7 +340,11 @@ class SLURMJobService (saga.adaptors.cpi.job.Service) :
     #
     def close (self) :
         if  self.shell :
-            self.shell.finalize (True)
+            # return the shell to the pool, for the next job service --
+            # only once, it may be handed out again right away
+            shell      = self.shell
+            self.shell = None
+            self.session._shell_pool.put (shell)
 
 
     # # ----------------------------------------------------------------
@@ -354,15 +404,17 @@ class SLURMJobService (saga.adaptors.cpi.job.Service) :
 
         # establish shell connection
         self._logger.debug("Opening shell of type: %s" % shell_url)
-        self.shell = saga.utils.pty_shell.PTYShell (shell_url, 
-                                                    self.session, 
-                                                    self._logger)
+        # get a (possibly warm) shell from the session's shell pool
+        self.shell = self.session._shell_pool.get (shell_url, 
+                                                   self.session, 
+                                                   self._logger)
 
         # verify our SLURM environment contains the commands we need for this
         # adaptor to work properly
         self._logger.debug("Verifying existence of remote SLURM tools.")
-        for cmd in self._commands.keys():
-            ret, out, _ = self.shell.run_sync("which %s " % cmd)
+        probes  = ["which %s " % cmd for cmd in self._commands.keys()]
+        results = self.shell.run_pipelined(probes)
+        for cmd, (ret, out, _) in zip(self._commands.keys(), results):
             if ret != 0:
                 message = "Error finding SLURM tool %s on remote server %s!\n" \
                           "Locations searched:\n%s\n" \
@@ -616,8 +668,67 @@ class SLURMJobService (saga.adaptors.cpi.job.Service) :
                 'gone': False
             }
 
+        # a new job is watched -- poll fast again
+        self._bulk_interval.reset()
+
         return self.job_id
 
+    # ----------------------------------------------------------------
+    #
+    def _bulk_update (self) :
+        """ refresh the state of all non-final jobs with a single squeue call
+            (and a single sacct call for jobs squeue doesn't know anymore),
+            return the number of jobs whose state changed
+        """
+        pids = dict()
+        for job_id, job_info in self.jobs.items():
+            if  job_info['state'] not in sbm.FINAL_STATES \
+            and job_info['gone'] is not True:
+                pids[self._adaptor.parse_id(job_id)[1]] = job_id
+
+        if not pids:
+            return 0
+
+        ret, out, _ = self.shell.run_sync('squeue -h -o "%%i|%%T|%%N" -j %s' \
+                                          % ','.join(pids.keys()))
+        records = _parse_squeue_output(out)
+
+        # jobs which left the queue: look at the slurm accounting history
+        missing = [pid for pid in pids if pid not in records]
+        if missing:
+            ret, out, _ = self.shell.run_sync(
+                "sacct --format=JobID,State --parsable2 --noheader --jobs=%s" \
+                % ','.join(missing))
+            for pid, slurm_state in _parse_sacct_output(out).iteritems():
+                records[pid] = (slurm_state, None)
+
+        changed = 0
+        for pid, job_id in pids.iteritems():
+            if pid not in records:
+                continue
+            slurm_state, exec_hosts = records[pid]
+            new_info = {'state': self._slurm_to_saga_jobstate(slurm_state)}
+            if exec_hosts and not exec_hosts.startswith('('):
+                new_info['exec_hosts'] = exec_hosts
+            changed += sbm.apply_bulk_info(self.jobs, job_id, new_info)
+
+        return changed
+
+    # ----------------------------------------------------------------
+    #
+    def _bulk_job_state (self, job_id) :
+        """ return the (cached) state of a job we submitted, or None if we
+            don't know the job
+        """
+        if job_id not in self.jobs:
+            return None
+
+        with self._bulk_lock:
+            if self._bulk_interval.due():
+                self._bulk_interval.update(self._bulk_update())
+
+        return self.jobs[job_id]['state']
+
     # ----------------  
     # FROM STAMPEDE'S SQUEUE MAN PAGE
     # 
@@ -994,6 +1105,11 @@ class SLURMJob (saga.adaptors.cpi.job.Job):
             or self._state == saga.job.DONE:
             return self._state
 
+        # jobs submitted through this service are refreshed in bulk
+        state = self.js._bulk_job_state(job_id)
+        if state is not None and state != saga.job.UNKNOWN:
+            return state
+
         rm, pid = self._adaptor.parse_id (job_id)
 
         try:
@@ -0,0 +1,306 @@
+
+__author__    = "Andre Merzky, Ole Weidner"
+__copyright__ = "Copyright 2012-2013, The SAGA Project"
+__license__   = "MIT"
+
+
+''' Provides the adaptor meta data the engine needs to route API calls (adaptor
+    name, version, URL schemas and cpi classes) without importing the adaptor
+    modules.
+
+    The meta data are read from the module level ``_ADAPTOR_INFO`` dict in the
+    adaptor's source file, which is parsed (not executed) with the ``ast``
+    module.  Only literal values and references to other module level literals
+    (like ``_ADAPTOR_NAME`` and ``_ADAPTOR_SCHEMAS``) are resolved.  Results are
+    cached in a json file, and a cache entry is invalidated as soon as the
+    mtime or size of the adaptor source file changes.
+
+    If the meta data of a module cannot be determined, `get_adaptor_info()`
+    returns `None` for that module, and the engine loads it eagerly.
+'''
+
+import os
+import ast
+import json
+import imp
+import threading
+
+
+# the _ADAPTOR_INFO keys the engine needs for registration
+_INFO_KEYS = ['name', 'version', 'schemas', 'cpis']
+
+# bump this if the cached format changes
+_CACHE_VERSION = 1
+
+_cache_lock = threading.Lock ()
+
+# the saga package this engine belongs to
+_SAGA_ROOT  = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+
+
+# ------------------------------------------------------------------------------
+#
+def _find_source (module_name) :
+    """ Locate the source file of a dotted module name, without importing the
+        module or any of its parent packages.
+    """
+
+    path = None
+    for elem in module_name.split ('.') :
+        handle, pathname, descr = imp.find_module (elem, path)
+        if  handle :
+            handle.close ()
+        if  descr[2] == imp.PKG_DIRECTORY :
+            path     = [pathname]
+            pathname = os.path.join (pathname, '__init__.py')
+
+    if  not pathname.endswith ('.py') :
+        # compiled only, or extension module
+        return None
+
+    return os.path.abspath (pathname)
+
+
+# ------------------------------------------------------------------------------
+#
+class _Unresolved (Exception) :
+    pass
+
+
+def _eval_node (node, env) :
+    """ evaluate a literal ast node, resolving names from env """
+
+    if  isinstance (node, ast.Str) :
+        return node.s
+
+    if  isinstance (node, ast.Num) :
+        return node.n
+
+    if  isinstance (node, (ast.List, ast.Tuple)) :
+        return [_eval_node (elt, env) for elt in node.elts]
+
+    if  isinstance (node, ast.Dict) :
+        return dict ([(_eval_node (k, env), _eval_node (v, env)) \
+                      for k, v in zip (node.keys, node.values)])
+
+    if  isinstance (node, ast.Name) :
+        if  node.id in env :
+            return env[node.id]
+        if  node.id in ['True', 'False', 'None'] :
+            return {'True' : True, 'False' : False, 'None' : None}[node.id]
+
+    raise _Unresolved (ast.dump (node))
+
+
+def _eval_info (node, env) :
+    """ evaluate only the _ADAPTOR_INFO keys needed for registration -- other
+        entries (like capabilities) may reference non-literal values
+    """
+
+    if  not isinstance (node, ast.Dict) :
+        raise _Unresolved ('_ADAPTOR_INFO is not a dict')
+
+    info = dict ()
+    for k, v in zip (node.keys, node.values) :
+        key = _eval_node (k, env)
+        if  key in _INFO_KEYS :
+            info[key] = _eval_node (v, env)
+
+    return info
+
+
+def parse_adaptor_info (source) :
+    """ Parse adaptor source code and return the registration relevant parts
+        of its _ADAPTOR_INFO dict, or None if they can't be determined
+        statically.
+    """
+
+    tree = ast.parse (source)
+    env  = dict ()
+    info = None
+
+    for stmt in tree.body :
+
+        if  not isinstance (stmt, ast.Assign)      or \
+            len (stmt.targets) != 1                 or \
+            not isinstance (stmt.targets[0], ast.Name) :
+            continue
+
+        name = stmt.targets[0].id
+
+        try :
+            if  name == '_ADAPTOR_INFO' :
+                info = _eval_info (stmt.value, env)
+            else :
+                env[name] = _eval_node (stmt.value, env)
+
+        except _Unresolved :
+            # a later re-assignment may still resolve this name
+            if  name in env :
+                del env[name]
+            if  name == '_ADAPTOR_INFO' :
+                info = None
+
+    if  not info :
+        return None
+
+    for key in _INFO_KEYS :
+        if  not key in info :
+            return None
+
+    for cpi in info['cpis'] :
+        if  not isinstance (cpi, dict) or \
+            not 'type'  in cpi          or \
+            not 'class' in cpi             :
+            return None
+
+    return info
+
+
+# ------------------------------------------------------------------------------
+#
+def _read_cache (cache_file) :
+
+    try :
+        with open (cache_file) as handle :
+            cache = json.load (handle)
+        if  cache.get ('version') == _CACHE_VERSION :
+            return cache.get ('modules', {})
+    except Exception :
+        pass
+
+    return dict ()
+
+
+def _write_cache (cache_file, modules) :
+
+    # write to a temp file and rename, so that concurrent processes never see
+    # a partial cache
+    try :
+        cache_dir = os.path.dirname (cache_file)
+        if  cache_dir and not os.path.isdir (cache_dir) :
+            os.makedirs (cache_dir)
+
+        tmp_file = "%s.%s.tmp" % (cache_file, os.getpid ())
+        with open (tmp_file, 'w') as handle :
+            json.dump ({'version' : _CACHE_VERSION, 'modules' : modules}, handle)
+        os.rename (tmp_file, cache_file)
+
+    except Exception :
+        # the cache is an optimization only
+        pass
+
+
+# ------------------------------------------------------------------------------
+#
+def get_adaptor_info (module_names, cache_file=None, logger=None) :
+    """ Return a dict {module_name : info} with the registration meta data of
+        the given adaptor modules, where info is None for modules which need to
+        be imported to find out.  If cache_file is given, meta data are cached
+        there and only re-parsed for modules whose source changed.
+    """
+
+    with _cache_lock :
+
+        cache   = dict ()
+        changed = False
+        ret     = dict ()
+
+        if  cache_file :
+            cache = _read_cache (cache_file)
+
+        for module_name in module_names :
+
+            info = None
+
+            try :
+                entry  = cache.get (module_name)
+                source = None
+
+                # for adaptors shipped with this saga package, check the cached
+                # source path first, to avoid searching sys.path on every
+                # engine startup
+                if  entry and entry['stamp'][0].startswith (_SAGA_ROOT + os.sep) \
+                          and os.path.exists (entry['stamp'][0]) :
+                    source = entry['stamp'][0]
+                else :
+                    source = _find_source (module_name)
+
+                if  not source :
+                    ret[module_name] = None
+                    continue
+
+                st    = os.stat (source)
+                stamp = [source, st.st_mtime, st.st_size]
+
+                if  entry and entry.get ('stamp') == stamp :
+                    info = entry.get ('info')
+
+                else :
+                    with open (source) as handle :
+                        info = parse_adaptor_info (handle.read ())
+                    cache[module_name] = {'stamp' : stamp, 'info' : info}
+                    changed = True
+
+            except Exception as e :
+                if  logger :
+                    logger.debug ("no static meta data for adaptor %s: %s" % (module_name, e))
+                info = None
+
+            ret[module_name] = info
+
+        if  cache_file and changed :
+            _write_cache (cache_file, cache)
+
+        return ret
+
+
+# ------------------------------------------------------------------------------
+#
+if __name__ == '__main__' :
+
+    # startup benchmark: python -m saga.engine.adaptor_cache [iterations]
+    #
+    # Times 'import saga' plus engine creation in fresh interpreters, with
+    # eager adaptor loading, and with lazy loading on a cold and a warm meta
+    # data cache.
+
+    import sys
+    import shutil
+    import tempfile
+    import subprocess
+
+    iterations = 5
+    if  len (sys.argv) > 1 :
+        iterations = int (sys.argv[1])
+
+    probe = "import time; start = time.time (); import saga; " \
+            "saga.engine.engine.Engine (); print time.time () - start"
+
+    def startup (lazy, cache_file, cold) :
+
+        env = dict (os.environ)
+        env['SAGA_LAZY_ADAPTORS'] = str(lazy)
+        env['SAGA_ADAPTOR_CACHE'] = cache_file
+
+        times = list()
+        for i in range (iterations) :
+            if  cold and os.path.exists (cache_file) :
+                os.remove (cache_file)
+            out = subprocess.check_output ([sys.executable, '-c', probe], env=env)
+            times.append (float (out.strip ().split ()[-1]))
+
+        return min (times), sum (times) / len (times)
+
+    tmp_dir    = tempfile.mkdtemp ()
+    cache_file = os.path.join (tmp_dir, 'adaptor_registry.json')
+
+    try :
+        for name, lazy, cold in [('eager loading',          False, True ),
+                                 ('lazy loading, no cache', True,  True ),
+                                 ('lazy loading, cached',   True,  False)] :
+            t_min, t_avg = startup (lazy, cache_file, cold)
+            print "%-24s : min %.3fs  avg %.3fs  (%d runs)" % (name, t_min, t_avg, iterations)
+    finally :
+        shutil.rmtree (tmp_dir)
+
@@ -6,11 +6,13 @@ __license__   = "MIT"
 
 """ Provides the SAGA runtime. """
 
+import os
 import re
 import sys
 import pprint
 import string
 import inspect
+import threading
 
 import radical.utils         as ru
 import radical.utils.config  as ruc
@@ -19,6 +21,7 @@ import radical.utils.logger  as rul
 import saga.exceptions      as se
 
 import saga.engine.registry  # adaptors to load
+import saga.engine.adaptor_cache
 
 
 ############# These are all supported options for saga.engine ####################
@@ -33,6 +36,23 @@ _config_options = [
     'documentation' : 'load adaptors which are marked as beta (i.e. not released).',
     'env_variable'  : None
     },
+    { 
+    'category'      : 'saga.engine',
+    'name'          : 'lazy_adaptors', 
+    'type'          : bool, 
+    'default'       : True,
+    'valid_options' : [True, False],
+    'documentation' : 'register adaptors from their static meta data, and import an adaptor module only when it is first used.',
+    'env_variable'  : 'SAGA_LAZY_ADAPTORS'
+    },
+    { 
+    'category'      : 'saga.engine',
+    'name'          : 'adaptor_cache', 
+    'type'          : str, 
+    'default'       : '~/.saga/adaptor_registry.json',
+    'documentation' : 'cache file for adaptor meta data used by lazy adaptor loading (empty: no cache).',
+    'env_variable'  : 'SAGA_ADAPTOR_CACHE'
+    },
     # FIXME: is there a better place to register util level options?
     { 
     'category'      : 'saga.utils.pty',
@@ -86,7 +106,7 @@ class Engine(ruc.Configurable):
         loading and management, and which binds adaptor instances to
         API object instances.   The Engine singleton is implicitly
         instantiated as soon as SAGA is imported into Python.  It
-        will, on creation, load all available adaptors.  Adaptors
+        will, on creation, register all available adaptors.  Adaptors
         modules MUST provide an 'Adaptor' class, which will register
         the adaptor in the engine with information like these
         (simplified)::
@@ -157,6 +177,16 @@ class Engine(ruc.Configurable):
                   else :
                       # successfully bound to adaptor
                       return
+
+        With the 'lazy_adaptors' option (default), adaptor modules are not
+        imported on engine creation: the registry is filled from the static
+        '_ADAPTOR_INFO' meta data of the adaptor sources (see
+        saga.engine.adaptor_cache), with placeholder entries which have no
+        'cpi_class' and 'adaptor_instance' yet.  An adaptor module is imported
+        and instantiated on the first lookup of one of its cpi types and
+        schemas, and its placeholders are then replaced by the actual entries
+        (or removed if the adaptor fails to load).  Context adaptors are
+        always loaded eagerly, as any session needs them.
     """
 
     __metaclass__ = ru.Singleton
@@ -170,6 +200,11 @@ class Engine(ruc.Configurable):
         # Engine manages cpis from adaptors
         self._adaptor_registry = {}
 
+        # adaptor modules which are registered but not yet imported, and
+        # the lock serializing their on-demand loading
+        self._lazy_modules     = set()
+        self._load_lock        = threading.RLock ()
+
 
         # set the configuration options for this object
         ruc.Configurable.__init__       (self, 'saga')
@@ -190,19 +225,17 @@ class Engine(ruc.Configurable):
     #-----------------------------------------------------------------
     # 
     def _load_adaptors (self, inject_registry=None):
-        """ Try to load all adaptors that are registered in 
+        """ Try to register all adaptors that are registered in 
             saga.engine.registry.py. This method is called from the
             constructor.  As Engine is a singleton, this method is
             called once after the module is first loaded in any python
-            application.
+            application.  Adaptors with static meta data are only imported
+            on first use if 'lazy_adaptors' is enabled, all others are
+            loaded right away.
 
             :param inject_registry: Inject a fake registry. *For unit tests only*.
         """
 
-        # get the engine config options
-        global_config = ruc.getConfig('saga')
-
-
         # get the list of adaptors to load
         registry = saga.engine.registry.adaptor_registry
 
@@ -211,267 +244,414 @@ class Engine(ruc.Configurable):
         # so, we reset cpi infos from the earlier singleton creation.
         if inject_registry != None :
             self._adaptor_registry = {}
+            self._lazy_modules     = set()
             registry               = inject_registry
 
 
-        # attempt to load all registered modules
+        # check which adaptors can be registered without importing them
+        lazy_info = dict()
+        if  self._cfg['lazy_adaptors'].get_value () :
+
+            cache_file = self._cfg['adaptor_cache'].get_value ()
+            if  cache_file :
+                cache_file = os.path.expanduser (cache_file)
+
+            lazy_info = saga.engine.adaptor_cache.get_adaptor_info (registry,
+                            cache_file=cache_file, logger=self._logger)
+
+
+        # attempt to register all registered modules
         for module_name in registry:
 
-            self._logger.info ("Loading  adaptor %s"  %  module_name)
+            info = lazy_info.get (module_name)
 
+            if  info and not self._is_context_adaptor (info) :
 
-            # first, import the module
-            adaptor_module = None
-            try :
-                adaptor_module = __import__ (module_name, fromlist=['Adaptor'])
+                # beta adaptors would be skipped on loading anyway
+                if  not self._cfg['load_beta_adaptors'].get_value () and \
+                    ('alpha' in info['version'].lower() or \
+                     'beta'  in info['version'].lower()    ) :
+                    self._logger.warn ("Skipping adaptor %s: beta versions are disabled (%s)" \
+                                    % (module_name, info['version']))
+                    continue
+
+                self._register_lazy (module_name, info)
+
+            else :
+                self._load_adaptor (module_name)
 
-            except Exception as e:
-                self._logger.warn ("Skipping adaptor %s 1: module loading failed: %s" % (module_name, e))
-                continue # skip to next adaptor
 
+    #-----------------------------------------------------------------
+    # 
+    def _is_context_adaptor (self, adaptor_info) :
 
-            # we expect the module to have an 'Adaptor' class
-            # implemented, which, on calling 'register()', returns
-            # a info dict for all implemented adaptor classes.
-            adaptor_instance = None
-            adaptor_info     = None
+        for cpi_info in adaptor_info['cpis'] :
+            if  cpi_info['type'] == 'saga.Context' :
+                return True
 
-            try: 
-                adaptor_instance = adaptor_module.Adaptor ()
-                adaptor_info     = adaptor_instance.register ()
+        return False
 
-            except se.SagaException as e:
-                self._logger.warn ("Skipping adaptor %s: loading failed: '%s'" % (module_name, e))
-                continue # skip to next adaptor
 
-            except Exception as e:
-                self._logger.warn ("Skipping adaptor %s: loading failed: '%s'" % (module_name, e))
-                continue # skip to next adaptor
+    #-----------------------------------------------------------------
+    # 
+    def _register_info (self, cpi_type, adaptor_schema, info) :
+        """ Add a registry entry.  If a placeholder for the same module and cpi
+            class exists, the entry replaces it in place, so that the adaptor
+            order for a schema does not depend on the order adaptors are loaded
+            in.  Returns False if the entry was registered before.
+        """
 
+        # make sure we can register that cpi type
+        if not cpi_type in self._adaptor_registry :
+            self._adaptor_registry[cpi_type] = {}
 
-            # the adaptor must also provide a sanity_check() method, which sould
-            # be used to confirm that the adaptor can function properly in the
-            # current runtime environment (e.g., that all pre-requisites and
-            # system dependencies are met).
-            try: 
-                adaptor_instance.sanity_check ()
+        # make sure we can register that schema
+        if not adaptor_schema in self._adaptor_registry[cpi_type] :
+            self._adaptor_registry[cpi_type][adaptor_schema] = []
 
-            except Exception as e:
-                self._logger.warn ("Skipping adaptor %s: failed self test: %s" % (module_name, e))
-                continue # skip to next adaptor
+        infos = self._adaptor_registry[cpi_type][adaptor_schema]
 
+        if  info in infos :
+            return False
 
-            # check if we have a valid adaptor_info
-            if adaptor_info is None :
-                self._logger.warning ("Skipping adaptor %s: adaptor meta data are invalid" \
-                                   % module_name)
-                continue  # skip to next adaptor
+        for idx, old_info in enumerate (infos) :
+            if  old_info['cpi_class']   is None                and \
+                old_info['module_name'] == info['module_name'] and \
+                old_info['cpi_cname']   == info['cpi_cname']       :
+                infos[idx] = info
+                return True
 
+        infos.append (info)
+        return True
 
-            if  not 'name'    in adaptor_info or \
-                not 'cpis'    in adaptor_info or \
-                not 'version' in adaptor_info or \
-                not 'schemas' in adaptor_info    :
-                self._logger.warning ("Skipping adaptor %s: adaptor meta data are incomplete" \
-                                   % module_name)
-                continue  # skip to next adaptor
 
+    #-----------------------------------------------------------------
+    # 
+    def _register_lazy (self, module_name, adaptor_info) :
+        """ Register placeholders for all cpis and schemas of an adaptor which
+            is not imported yet.
+        """
 
-            adaptor_name    = adaptor_info['name']
-            adaptor_version = adaptor_info['version']
-            adaptor_schemas = adaptor_info['schemas']
-            adaptor_enabled = True   # default unless disabled by 'enabled' option or version filer
+        self._logger.info ("Register adaptor %s (not loaded)" % module_name)
 
-            # disable adaptors in 'alpha' or 'beta' versions -- unless
-            # the 'load_beta_adaptors' config option is set to True
-            if not self._cfg['load_beta_adaptors'].get_value () :
+        self._lazy_modules.add (module_name)
 
-                if 'alpha' in adaptor_version.lower() or \
-                   'beta'  in adaptor_version.lower()    :
+        for cpi_info in adaptor_info['cpis'] :
+            for adaptor_schema in adaptor_info['schemas'] :
 
-                    self._logger.warn ("Skipping adaptor %s: beta versions are disabled (%s)" \
-                                    % (module_name, adaptor_version))
-                    continue  # skip to next adaptor
+                info = {'cpi_cname'        : str(cpi_info['class']),
+                        'cpi_class'        : None,
+                        'adaptor_name'     : str(adaptor_info['name']),
+                        'adaptor_instance' : None,
+                        'module_name'      : module_name}
 
+                self._register_info (str(cpi_info['type']), 
+                                     str(adaptor_schema).lower (), info)
 
-            # get the 'enabled' option in the adaptor's config
-            # section (saga.cpi.base ensures that the option exists,
-            # if it is initialized correctly in the adaptor class.
-            adaptor_config  = None
-            adaptor_enabled = False
 
-            try :
-                adaptor_config  = global_config.get_category (adaptor_name)
-                adaptor_enabled = adaptor_config['enabled'].get_value ()
+    #-----------------------------------------------------------------
+    # 
+    def _load_lazy (self, module_names) :
+        """ Import and register all given adaptor modules which are registered
+            but not loaded yet, and drop all placeholders which could not be
+            replaced by actual adaptor entries.
+        """
 
-            except se.SagaException as e:
-                self._logger.warn ("Skipping adaptor %s: initialization failed: %s" % (module_name, e))
-                continue # skip to next adaptor
-            except Exception as e:
-                self._logger.warn ("Skipping adaptor %s: initialization failed: %s" % (module_name, e))
-                continue # skip to next adaptor
+        with self._load_lock :
 
+            for module_name in module_names :
 
-            # only load adaptor if it is not disabled via config files
-            if adaptor_enabled == False :
-                self._logger.info ("Skipping adaptor %s: 'enabled' set to False" \
-                                % (module_name))
-                continue # skip to next adaptor
+                if  not module_name in self._lazy_modules :
+                    continue
+
+                self._lazy_modules.discard (module_name)
+                self._load_adaptor (module_name)
+
+                for cpi_type in self._adaptor_registry.keys () :
+                    for schema in self._adaptor_registry[cpi_type].keys () :
+                        infos = self._adaptor_registry[cpi_type][schema]
+                        infos[:] = [info for info in infos \
+                                    if not (info['cpi_class']   is None and \
+                                            info['module_name'] == module_name)]
+                        if  not infos :
+                            del (self._adaptor_registry[cpi_type][schema])
+                    if  not self._adaptor_registry[cpi_type] :
+                        del (self._adaptor_registry[cpi_type])
+
+
+    #-----------------------------------------------------------------
+    # 
+    def _resolve (self, ctype, schema) :
+        """ make sure all adaptors registered for ctype and schema are loaded
+        """
 
+        if  not self._lazy_modules :
+            return
 
-            # check if the adaptor has anything to register
-            if 0 == len (adaptor_info['cpis']) :
-                self._logger.warn ("Skipping adaptor %s: does not register any cpis" \
+        if  not ctype in self._adaptor_registry or \
+            not schema in self._adaptor_registry[ctype] :
+            return
+
+        self._load_lazy ([info['module_name'] \
+                          for info in self._adaptor_registry[ctype][schema] \
+                          if info['cpi_class'] is None])
+
+
+    #-----------------------------------------------------------------
+    # 
+    def _load_adaptor (self, module_name) :
+        """ Import, instantiate, check and register one adaptor module. """
+
+        # get the engine config options
+        global_config = ruc.getConfig('saga')
+
+        self._logger.info ("Loading  adaptor %s"  %  module_name)
+
+
+        # first, import the module
+        adaptor_module = None
+        try :
+            adaptor_module = __import__ (module_name, fromlist=['Adaptor'])
+
+        except Exception as e:
+            self._logger.warn ("Skipping adaptor %s 1: module loading failed: %s" % (module_name, e))
+            return # skip to next adaptor
+
+
+        # we expect the module to have an 'Adaptor' class
+        # implemented, which, on calling 'register()', returns
+        # a info dict for all implemented adaptor classes.
+        adaptor_instance = None
+        adaptor_info     = None
+
+        try: 
+            adaptor_instance = adaptor_module.Adaptor ()
+            adaptor_info     = adaptor_instance.register ()
+
+        except se.SagaException as e:
+            self._logger.warn ("Skipping adaptor %s: loading failed: '%s'" % (module_name, e))
+            return # skip to next adaptor
+
+        except Exception as e:
+            self._logger.warn ("Skipping adaptor %s: loading failed: '%s'" % (module_name, e))
+            return # skip to next adaptor
+
+
+        # the adaptor must also provide a sanity_check() method, which sould
+        # be used to confirm that the adaptor can function properly in the
+        # current runtime environment (e.g., that all pre-requisites and
+        # system dependencies are met).
+        try: 
+            adaptor_instance.sanity_check ()
+
+        except Exception as e:
+            self._logger.warn ("Skipping adaptor %s: failed self test: %s" % (module_name, e))
+            return # skip to next adaptor
+
+
+        # check if we have a valid adaptor_info
+        if adaptor_info is None :
+            self._logger.warning ("Skipping adaptor %s: adaptor meta data are invalid" \
+                               % module_name)
+            return  # skip to next adaptor
+
+
+        if  not 'name'    in adaptor_info or \
+            not 'cpis'    in adaptor_info or \
+            not 'version' in adaptor_info or \
+            not 'schemas' in adaptor_info    :
+            self._logger.warning ("Skipping adaptor %s: adaptor meta data are incomplete" \
+                               % module_name)
+            return  # skip to next adaptor
+
+
+        adaptor_name    = adaptor_info['name']
+        adaptor_version = adaptor_info['version']
+        adaptor_schemas = adaptor_info['schemas']
+        adaptor_enabled = True   # default unless disabled by 'enabled' option or version filer
+
+        # disable adaptors in 'alpha' or 'beta' versions -- unless
+        # the 'load_beta_adaptors' config option is set to True
+        if not self._cfg['load_beta_adaptors'].get_value () :
+
+            if 'alpha' in adaptor_version.lower() or \
+               'beta'  in adaptor_version.lower()    :
+
+                self._logger.warn ("Skipping adaptor %s: beta versions are disabled (%s)" \
+                                % (module_name, adaptor_version))
+                return  # skip to next adaptor
+
+
+        # get the 'enabled' option in the adaptor's config
+        # section (saga.cpi.base ensures that the option exists,
+        # if it is initialized correctly in the adaptor class.
+        adaptor_config  = None
+        adaptor_enabled = False
+
+        try :
+            adaptor_config  = global_config.get_category (adaptor_name)
+            adaptor_enabled = adaptor_config['enabled'].get_value ()
+
+        except se.SagaException as e:
+            self._logger.warn ("Skipping adaptor %s: initialization failed: %s" % (module_name, e))
+            return # skip to next adaptor
+        except Exception as e:
+            self._logger.warn ("Skipping adaptor %s: initialization failed: %s" % (module_name, e))
+            return # skip to next adaptor
+
+
+        # only load adaptor if it is not disabled via config files
+        if adaptor_enabled == False :
+            self._logger.info ("Skipping adaptor %s: 'enabled' set to False" \
+                            % (module_name))
+            return # skip to next adaptor
+
+
+        # check if the adaptor has anything to register
+        if 0 == len (adaptor_info['cpis']) :
+            self._logger.warn ("Skipping adaptor %s: does not register any cpis" \
+                            % (module_name))
+            return # skip to next adaptor
+
+
+        # we got an enabled adaptor with valid info - yay!  We can
+        # now register all adaptor classes (cpi implementations).
+        for cpi_info in adaptor_info['cpis'] :
+
+            # check cpi information details for completeness
+            if  not 'type'    in cpi_info or \
+                not 'class'   in cpi_info    :
+                self._logger.info ("Skipping adaptor %s cpi: cpi info detail is incomplete" \
                                 % (module_name))
-                continue # skip to next adaptor
-
-
-            # we got an enabled adaptor with valid info - yay!  We can
-            # now register all adaptor classes (cpi implementations).
-            for cpi_info in adaptor_info['cpis'] :
-
-                # check cpi information details for completeness
-                if  not 'type'    in cpi_info or \
-                    not 'class'   in cpi_info    :
-                    self._logger.info ("Skipping adaptor %s cpi: cpi info detail is incomplete" \
-                                    % (module_name))
-                    continue # skip to next cpi info
-
-
-                # adaptor classes are registered for specific API types.
-                cpi_type  = cpi_info['type']
-                cpi_cname = cpi_info['class']
-                cpi_class = None
-
-                try :
-                    cpi_class = getattr (adaptor_module, cpi_cname)
-
-                except Exception as e:
-                    # this exception likely means that the adaptor does
-                    # not call the saga.adaptors.Base initializer (correctly)
-                    self._logger.warning ("Skipping adaptor %s: adaptor class invalid %s: %s" \
-                                       % (module_name, cpi_info['class'], str(e)))
-                    continue # skip to next adaptor
-
-                # make sure the cpi class is a valid cpi for the given type.
-                # We walk through the list of known modules, and try to find
-                # a modules which could have that class.  We do the following
-                # tests:
-                #
-                #   cpi_class: ShellJobService
-                #   cpi_type:  saga.job.Service
-                #   modules:   saga.adaptors.cpi.job
-                #   modules:   saga.adaptors.cpi.job.service
-                #   classes:   saga.adaptors.cpi.job.Service
-                #   classes:   saga.adaptors.cpi.job.service.Service
-                #
-                #   cpi_class: X509Context
-                #   cpi_type:  saga.Context
-                #   modules:   saga.adaptors.cpi.context
-                #   classes:   saga.adaptors.cpi.context.Context
-                #
-                # So, we add a 'adaptors.cpi' after the 'saga' namespace
-                # element, then append the rest of the given namespace.  If that
-                # gives a module which has the requested class, fine -- if not,
-                # we add a lower cased version of the class name as last
-                # namespace element, and check again.
-
-                # ->   saga .  job .  Service 
-                # <- ['saga', 'job', 'Service']
-                cpi_type_nselems = cpi_type.split ('.')
-
-                if  len(cpi_type_nselems) < 2 or \
-                    len(cpi_type_nselems) > 3    :
-                    self._logger.warn ("Skipping adaptor %s: cpi type not valid: '%s'" \
-                                     % (module_name, cpi_type))
-                    continue # skip to next cpi info
-
-                if cpi_type_nselems[0] != 'saga' :
-                    self._logger.warn ("Skipping adaptor %s: cpi namespace not valid: '%s'" \
-                                     % (module_name, cpi_type))
-                    continue # skip to next cpi info
-
-                # -> ['saga',                    'job', 'Service'] 
-                # <- ['saga', 'adaptors', 'cpi', 'job', 'Service']
-                cpi_type_nselems.insert (1, 'adaptors')
-                cpi_type_nselems.insert (2, 'cpi')
-
-                # -> ['saga', 'adaptors', 'cpi', 'job',  'Service']
-                # <- ['saga', 'adaptors', 'cpi', 'job'], 'Service'
-                cpi_type_cname = cpi_type_nselems.pop ()
-
-                # -> ['saga', 'adaptors', 'cpi', 'job'], 'Service'
-                # <-  'saga.adaptors.cpi.job
-                # <-  'saga.adaptors.cpi.job.service
-                cpi_type_modname_1 = '.'.join (cpi_type_nselems)
-                cpi_type_modname_2 = '.'.join (cpi_type_nselems + [cpi_type_cname.lower()])
-
-                # does either module exist?
-                cpi_type_modname = None
-                if  cpi_type_modname_1 in sys.modules :
-                    cpi_type_modname = cpi_type_modname_1 
-
-                if  cpi_type_modname_2 in sys.modules :
-                    cpi_type_modname = cpi_type_modname_2 
-
-                if  not cpi_type_modname :
-                    self._logger.warn ("Skipping adaptor %s: cpi type not known: '%s'" \
-                                     % (module_name, cpi_type))
-                    continue # skip to next cpi info
-
-                # so, make sure the given cpi is actually
-                # implemented by the adaptor class
-                cpi_ok = False
-                for name, cpi_obj in inspect.getmembers (sys.modules[cpi_type_modname]) :
-                    if  name == cpi_type_cname      and \
-                        inspect.isclass (cpi_obj)       :
-                        if  issubclass (cpi_class, cpi_obj) :
-                            cpi_ok = True
-
-                if not cpi_ok :
-                    self._logger.warn ("Skipping adaptor %s: doesn't implement cpi '%s (%s)'" \
-                                     % (module_name, cpi_class, cpi_type))
-                    continue # skip to next cpi info
-
-
-                # finally, register the cpi for all its schemas!
-                registered_schemas = list()
-                for adaptor_schema in adaptor_schemas:
-
-                    adaptor_schema = adaptor_schema.lower ()
-
-                    # make sure we can register that cpi type
-                    if not cpi_type in self._adaptor_registry :
-                        self._adaptor_registry[cpi_type] = {}
-
-                    # make sure we can register that schema
-                    if not adaptor_schema in self._adaptor_registry[cpi_type] :
-                        self._adaptor_registry[cpi_type][adaptor_schema] = []
-
-                    # we register the cpi class, so that we can create
-                    # instances as needed, and the adaptor instance,
-                    # as that is passed to the cpi class c'tor later
-                    # on (the adaptor instance is used to share state
-                    # between cpi instances, amongst others)
-                    info = {'cpi_cname'        : cpi_cname, 
-                            'cpi_class'        : cpi_class, 
-                            'adaptor_name'     : adaptor_name,
-                            'adaptor_instance' : adaptor_instance}
-
-                    # make sure this tuple was not registered, yet
-                    if info in self._adaptor_registry[cpi_type][adaptor_schema] :
-
-                        self._logger.warn ("Skipping adaptor %s: already registered '%s - %s'" \
-                                         % (module_name, cpi_class, adaptor_instance))
-                        continue  # skip to next cpi info
-
-                    self._adaptor_registry[cpi_type][adaptor_schema].append(info)
-                    registered_schemas.append(str("%s://" % adaptor_schema))
-
-                self._logger.info("Register adaptor %s for %s API with URL scheme(s) %s" %
-                                      (module_name,
-                                       cpi_type,
-                                       registered_schemas))
+                continue # skip to next cpi info
+
+
+            # adaptor classes are registered for specific API types.
+            cpi_type  = cpi_info['type']
+            cpi_cname = cpi_info['class']
+            cpi_class = None
+
+            try :
+                cpi_class = getattr (adaptor_module, cpi_cname)
+
+            except Exception as e:
+                # this exception likely means that the adaptor does
+                # not call the saga.adaptors.Base initializer (correctly)
+                self._logger.warning ("Skipping adaptor %s: adaptor class invalid %s: %s" \
+                                   % (module_name, cpi_info['class'], str(e)))
+                return # skip to next adaptor
+
+            # make sure the cpi class is a valid cpi for the given type.
+            # We walk through the list of known modules, and try to find
+            # a modules which could have that class.  We do the following
+            # tests:
+            #
+            #   cpi_class: ShellJobService
+            #   cpi_type:  saga.job.Service
+            #   modules:   saga.adaptors.cpi.job
+            #   modules:   saga.adaptors.cpi.job.service
+            #   classes:   saga.adaptors.cpi.job.Service
+            #   classes:   saga.adaptors.cpi.job.service.Service
+            #
+            #   cpi_class: X509Context
+            #   cpi_type:  saga.Context
+            #   modules:   saga.adaptors.cpi.context
+            #   classes:   saga.adaptors.cpi.context.Context
+            #
+            # So, we add a 'adaptors.cpi' after the 'saga' namespace
+            # element, then append the rest of the given namespace.  If that
+            # gives a module which has the requested class, fine -- if not,
+            # we add a lower cased version of the class name as last
+            # namespace element, and check again.
+
+            # ->   saga .  job .  Service 
+            # <- ['saga', 'job', 'Service']
+            cpi_type_nselems = cpi_type.split ('.')
+
+            if  len(cpi_type_nselems) < 2 or \
+                len(cpi_type_nselems) > 3    :
+                self._logger.warn ("Skipping adaptor %s: cpi type not valid: '%s'" \
+                                 % (module_name, cpi_type))
+                continue # skip to next cpi info
+
+            if cpi_type_nselems[0] != 'saga' :
+                self._logger.warn ("Skipping adaptor %s: cpi namespace not valid: '%s'" \
+                                 % (module_name, cpi_type))
+                continue # skip to next cpi info
+
+            # -> ['saga',                    'job', 'Service'] 
+            # <- ['saga', 'adaptors', 'cpi', 'job', 'Service']
+            cpi_type_nselems.insert (1, 'adaptors')
+            cpi_type_nselems.insert (2, 'cpi')
+
+            # -> ['saga', 'adaptors', 'cpi', 'job',  'Service']
+            # <- ['saga', 'adaptors', 'cpi', 'job'], 'Service'
+            cpi_type_cname = cpi_type_nselems.pop ()
+
+            # -> ['saga', 'adaptors', 'cpi', 'job'], 'Service'
+            # <-  'saga.adaptors.cpi.job
+            # <-  'saga.adaptors.cpi.job.service
+            cpi_type_modname_1 = '.'.join (cpi_type_nselems)
+            cpi_type_modname_2 = '.'.join (cpi_type_nselems + [cpi_type_cname.lower()])
+
+            # does either module exist?
+            cpi_type_modname = None
+            if  cpi_type_modname_1 in sys.modules :
+                cpi_type_modname = cpi_type_modname_1 
+
+            if  cpi_type_modname_2 in sys.modules :
+                cpi_type_modname = cpi_type_modname_2 
+
+            if  not cpi_type_modname :
+                self._logger.warn ("Skipping adaptor %s: cpi type not known: '%s'" \
+                                 % (module_name, cpi_type))
+                continue # skip to next cpi info
+
+            # so, make sure the given cpi is actually
+            # implemented by the adaptor class
+            cpi_ok = False
+            for name, cpi_obj in inspect.getmembers (sys.modules[cpi_type_modname]) :
+                if  name == cpi_type_cname      and \
+                    inspect.isclass (cpi_obj)       :
+                    if  issubclass (cpi_class, cpi_obj) :
+                        cpi_ok = True
+
+            if not cpi_ok :
+                self._logger.warn ("Skipping adaptor %s: doesn't implement cpi '%s (%s)'" \
+                                 % (module_name, cpi_class, cpi_type))
+                continue # skip to next cpi info
+
+
+            # finally, register the cpi for all its schemas!
+            registered_schemas = list()
+            for adaptor_schema in adaptor_schemas:
+
+                adaptor_schema = adaptor_schema.lower ()
+
+                # we register the cpi class, so that we can create
+                # instances as needed, and the adaptor instance,
+                # as that is passed to the cpi class c'tor later
+                # on (the adaptor instance is used to share state
+                # between cpi instances, amongst others)
+                info = {'cpi_cname'        : cpi_cname, 
+                        'cpi_class'        : cpi_class, 
+                        'adaptor_name'     : adaptor_name,
+                        'adaptor_instance' : adaptor_instance,
+                        'module_name'      : module_name}
+
+                # make sure this tuple was not registered, yet
+                if not self._register_info (cpi_type, adaptor_schema, info) :
+
+                    self._logger.warn ("Skipping adaptor %s: already registered '%s - %s'" \
+                                     % (module_name, cpi_class, adaptor_instance))
+                    continue  # skip to next cpi info
+
+                registered_schemas.append(str("%s://" % adaptor_schema))
+
+            self._logger.info("Register adaptor %s for %s API with URL scheme(s) %s" %
+                                  (module_name,
+                                   cpi_type,
+                                   registered_schemas))
 
 
 
@@ -486,6 +666,8 @@ class Engine(ruc.Configurable):
             name)
         '''
 
+        self._resolve (ctype, schema.lower ())
+
         if not ctype in self._adaptor_registry :
             return []
 
@@ -510,6 +692,14 @@ class Engine(ruc.Configurable):
             interact with other adaptors.
         '''
 
+        if  self._lazy_modules :
+            self._load_lazy ([info['module_name'] \
+                              for ctype  in self._adaptor_registry.values () \
+                              for infos  in ctype.values () \
+                              for info   in infos \
+                              if  info['cpi_class']    is None and \
+                                  info['adaptor_name'] == adaptor_name])
+
         for ctype in self._adaptor_registry.keys () :
             for schema in self._adaptor_registry[ctype].keys () :
                 for info in self._adaptor_registry[ctype][schema] :
@@ -534,6 +724,8 @@ class Engine(ruc.Configurable):
         adaptor.
         '''
 
+        self._resolve (ctype, schema)
+
         if not ctype in self._adaptor_registry:
             error_msg = "No adaptor found for '%s' and URL scheme %s://" \
                                   % (ctype, schema)
@@ -598,6 +790,9 @@ class Engine(ruc.Configurable):
     #-----------------------------------------------------------------
     # 
     def loaded_adaptors (self):
+
+        # this exposes the full registry, so load all pending adaptors first
+        self._load_lazy (list(self._lazy_modules))
         return self._adaptor_registry
 
 
@@ -605,6 +800,7 @@ class Engine(ruc.Configurable):
     # 
     def _dump (self) :
         import pprint
+        self._load_lazy (list(self._lazy_modules))
         pprint.pprint (self._adaptor_registry)
 
 
@@ -14,6 +14,8 @@ import saga.engine.engine
 import saga.context
 import saga.base
 
+import saga.utils.pty_shell_pool as supsp
+
 
 
 # ------------------------------------------------------------------------------
@@ -112,6 +114,12 @@ class _DefaultSession (object) :
                 max_obj_age   = config['connection_pool_ttl'].get_value ()
                 )
 
+        # warm command shells, shared by the job services of this session
+        self._shell_pool = supsp.PTYShellPool (
+                max_idle      = config['connection_pool_size'].get_value (),
+                max_idle_time = config['connection_pool_ttl'].get_value ()
+                )
+
         _engine = saga.engine.engine.Engine ()
 
         if not 'saga.Context' in _engine._adaptor_registry :
@@ -213,12 +221,14 @@ class Session (saga.base.SimpleBase) :
         # shared list of the default session singleton.  Otherwise, we create
         # a private list which is not populated.
 
-        # a session also has a lease manager, for adaptors in this session to use.
+        # a session also has a lease manager and a shell pool, for adaptors in
+        # this session to use.
 
         if  default :
             default_session     = _DefaultSession ()
             self.contexts       = default_session.contexts 
             self._lease_manager = default_session._lease_manager
+            self._shell_pool    = default_session._shell_pool
         else :
             self.contexts       = _ContextList (session=self)
 
@@ -232,6 +242,10 @@ class Session (saga.base.SimpleBase) :
                     max_pool_wait = config['connection_pool_wait'].get_value (),
                     max_obj_age   = config['connection_pool_ttl'].get_value ()
                     )
+            self._shell_pool    = supsp.PTYShellPool (
+                    max_idle      = config['connection_pool_size'].get_value (),
+                    max_idle_time = config['connection_pool_ttl'].get_value ()
+                    )
 
 
 
@@ -0,0 +1,147 @@
+
+__author__    = "Andre Merzky, Ole Weidner"
+__copyright__ = "Copyright 2012-2013, The SAGA Project"
+__license__   = "MIT"
+
+
+''' Provides helpers for job adaptors which refresh the state of all their
+    jobs with a single bulk query to the batch system, instead of running one
+    query per job.
+
+    A job service using these helpers implements `_bulk_update()`, which
+    queries all non-final jobs at once, updates `self.jobs` and returns the
+    number of jobs whose state changed (state callbacks should only be fired
+    for those).  The `BulkJobMonitor` thread calls it periodically, and
+    adaptors without monitoring thread can use an `AdaptiveInterval` to decide
+    when a cached bulk result has become stale.
+'''
+
+import time
+import threading
+
+from saga.job.constants import DONE, FAILED, CANCELED
+
+
+FINAL_STATES = [DONE, FAILED, CANCELED]
+
+
+# --------------------------------------------------------------------
+#
+class AdaptiveInterval(object):
+    """ A poll interval which grows while nothing changes and snaps back to
+        its minimum as soon as a job changes state
+    """
+
+    def __init__(self, min_interval, max_interval, factor=2.0):
+
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max(min_interval, max_interval))
+        self.factor       = factor
+        self._interval    = self.min_interval
+        self._last        = None
+        self._lock        = threading.Lock()
+
+    def get(self):
+        return self._interval
+
+    def reset(self):
+        """ go back to fast polling, e.g. after a new job was submitted
+        """
+        with self._lock:
+            self._interval = self.min_interval
+
+    def update(self, changed):
+        """ record a poll cycle which saw 'changed' state changes
+        """
+        with self._lock:
+            self._last = time.time()
+            if  changed:
+                self._interval = self.min_interval
+            else:
+                self._interval = min(self._interval * self.factor, self.max_interval)
+
+    def due(self):
+        """ is a new bulk query needed (for adaptors which poll on demand)?
+        """
+        return self._last is None or time.time() - self._last >= self._interval
+
+
+# --------------------------------------------------------------------
+#
+class BulkJobMonitor(threading.Thread):
+    """ thread that periodically refreshes all job states of a job service
+        with one bulk query per cycle
+    """
+
+    def __init__(self, job_service, min_interval, max_interval, factor=2.0):
+
+        self.logger   = job_service._logger
+        self.js       = job_service
+        self.interval = AdaptiveInterval(min_interval, max_interval, factor)
+        self._stop    = threading.Event()
+        self._wakeup  = threading.Event()
+
+        super(BulkJobMonitor, self).__init__()
+        self.setDaemon(True)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def stopped(self):
+        return self._stop.isSet()
+
+    def wake(self):
+        """ poll soon and fast again, e.g. after a job was submitted
+        """
+        self.interval.reset()
+        self._wakeup.set()
+
+    def run(self):
+
+        while self.stopped() is False:
+
+            self._wakeup.wait(self.interval.get())
+            self._wakeup.clear()
+
+            if  self.stopped():
+                break
+
+            try:
+                changed = self.js._bulk_update()
+                self.interval.update(changed)
+                self.logger.debug("Job monitoring thread: %s job state changes, next poll in %ss" \
+                               % (changed, self.interval.get()))
+
+            except Exception as e:
+                import traceback
+                traceback.print_exc ()
+                self.logger.warning("Exception caught in job monitoring thread: %s" % e)
+                self.interval.update(0)
+
+
+# --------------------------------------------------------------------
+#
+def apply_bulk_info(jobs, key, new_info, on_change=None):
+    """ merge new job info into jobs[key], call on_change(key, new_info) only
+        if the state changed, and return 1 on a state change, 0 otherwise
+    """
+
+    prev_info = jobs.get(key)
+    if  prev_info is None:
+        return 0
+
+    curr_info = dict(prev_info)
+    for k, v in new_info.iteritems():
+        if  v is not None:
+            curr_info[k] = v
+
+    jobs[key] = curr_info
+
+    if  curr_info.get('state') != prev_info.get('state'):
+        if  on_change:
+            on_change(key, curr_info)
+        return 1
+
+    return 0
+
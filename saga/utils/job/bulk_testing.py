@@ -0,0 +1,90 @@
+
+__author__    = "Andre Merzky, Ole Weidner"
+__copyright__ = "Copyright 2012-2013, The SAGA Project"
+__license__   = "MIT"
+
+
+''' Fakes for testing the bulk state updates of the job adaptors (see
+    `bulk_monitor`) against recorded batch system output, without a batch
+    system and without a shell.
+'''
+
+import re
+import logging
+import threading
+
+import saga.utils.job.bulk_monitor as sbm
+
+
+# --------------------------------------------------------------------
+#
+class FakeShell(object):
+    """ replays recorded (ret, out, err) tuples and remembers the commands
+    """
+
+    def __init__(self, responses):
+
+        self.responses = list(responses)
+        self.commands  = list()
+
+    def run_sync(self, command):
+
+        self.commands.append(command)
+        if  not self.responses:
+            raise AssertionError("unexpected command: %s" % command)
+        return self.responses.pop(0)
+
+
+# --------------------------------------------------------------------
+#
+class FakeAdaptor(object):
+    """ splits '[rm]-[pid]' job ids like the job adaptors do
+    """
+
+    id_re = re.compile('^\[(.*)\]-\[(.*?)\]$')
+
+    def parse_id(self, id):
+        match = self.id_re.match(id)
+        return (match.group(1), match.group(2))
+
+
+# --------------------------------------------------------------------
+#
+class FakeJob(object):
+    """ records the states set by the state callbacks
+    """
+
+    _UP = True
+
+    def __init__(self):
+        self.states = list()
+
+    def _api(self):
+        return self
+
+    def _attributes_i_set(self, key, val, flow, force):
+        self.states.append(val)
+
+
+# --------------------------------------------------------------------
+#
+def make_service(cls, responses, jobs, **attributes):
+    """ create a job service of class cls without connecting anywhere: the
+        shell replays responses, self.jobs is set to jobs
+    """
+
+    # the fake service has no monitoring thread, session and shell pool to
+    # clean up
+    fake = type(cls.__name__, (cls,), {'__del__' : lambda self: None})
+
+    js = fake.__new__(fake)
+    js.shell          = FakeShell(responses)
+    js.jobs           = jobs
+    js._adaptor       = FakeAdaptor()
+    js._logger        = logging.getLogger('saga.test')
+    js._bulk_interval = sbm.AdaptiveInterval(60, 60)
+    js._bulk_lock     = threading.Lock()
+    for key, val in attributes.iteritems():
+        setattr(js, key, val)
+    return js
+
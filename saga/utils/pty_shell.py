@@ -25,6 +25,10 @@ import pty_exceptions               as ptye
 #
 _PTY_TIMEOUT = 2.0
 
+# max length of a pipelined command line -- the pty line discipline truncates
+# canonical input lines at 4096 characters
+_PIPE_MAX_LINE = 4000
+
 # ------------------------------------------------------------------------------
 #
 # iomode flags
@@ -179,6 +183,9 @@ class PTYShell (object) :
     # unique ID per connection, for debugging
     _pty_id = 0
 
+    # unique ID per pipelined command batch, for output sentinels
+    _pipe_id = 0
+
     # ----------------------------------------------------------------
     #
     def __init__ (self, url, session=None, logger=None, init=None, opts={}, posix=True) :
@@ -743,6 +750,145 @@ class PTYShell (object) :
                 raise ptye.translate_exception (e)
 
 
+    # ----------------------------------------------------------------
+    #
+    def run_pipelined (self, commands, iomode=None) :
+        """
+        Run a list of shell commands with as few prompt roundtrips as possible,
+        and report exit code, stdout and stderr for each of them (a list of
+        tuples, as returned by :func:`run_sync`).
+
+        :type  commands: list of strings
+        :param commands: shell commands to run, in order.
+
+        :type  iomode:  enum
+        :param iomode:  Defines how stdout and stderr are captured (see
+                        :func:`run_sync`), for all commands.
+
+        The commands are joined into one command line, where each command is
+        followed by a sentinel which reports its exit code, and the combined
+        output is split on those sentinels.  Commands are thus all run, in
+        order, independent of the exit codes of the previous commands -- just
+        as a series of :func:`run_sync` calls would do.  Command lines are
+        capped at `_PIPE_MAX_LINE` characters (the pty's canonical input
+        limit), so long command lists take more than one roundtrip.
+
+        The same restrictions as for :func:`run_sync` apply, and additionally
+        the commands must be single-line, and must not end in comments.
+        """
+
+        with self.pty_shell.rlock :
+
+            self._trace ("run pipelined : %s" % commands)
+
+            if not self.pty_shell.alive (recover=True) :
+                raise se.IncorrectState ("Can't run command -- shell died:\n%s" \
+                                      % self.pty_shell.autopsy ())
+
+            try :
+
+                _err = "/tmp/saga-python.ssh-job.stderr.$$"
+
+                redir = ""
+                if  iomode == IGNORE   : redir = " 1>>/dev/null 2>>/dev/null"
+                if  iomode == MERGED   : redir = " 2>&1"
+                if  iomode == SEPARATE : redir = " 2>%s" % _err
+                if  iomode == STDOUT   : redir = " 2>/dev/null"
+                if  iomode == STDERR   : redir = " 2>%s 1>/dev/null" % _err
+
+                PTYShell._pipe_id += 1
+                token = "SAGA-PIPE-%d-%d" % (os.getpid (), PTYShell._pipe_id)
+
+                # one shell statement per command, which prints a sentinel with
+                # the command's exit code (and, if needed, its stderr)
+                stmts = list()
+                for idx, command in enumerate (commands) :
+
+                    command = command.strip ()
+
+                    if  not command :
+                        command = ':'
+
+                    if  command.endswith ('&') :
+                        raise se.BadParameter ("run_pipelined can only run foreground jobs ('%s')" \
+                                            % command)
+
+                    if  '\n' in command :
+                        raise se.BadParameter ("run_pipelined can only run single-line commands ('%s')" \
+                                            % command)
+
+                    stmt = "%s%s ; printf '\\n%s-R-%d-%%d-\\n' $?" % (command, redir, token, idx)
+
+                    if  iomode in [SEPARATE, STDERR] :
+                        stmt += " ; cat %s ; printf '\\n%s-E-%d-\\n'" % (_err, token, idx)
+
+                    stmts.append (stmt)
+
+                # pack statements into as few command lines as possible
+                lines = list()
+                line  = ""
+                for stmt in stmts :
+                    if  line and len (line) + len (stmt) + 3 > _PIPE_MAX_LINE :
+                        lines.append (line)
+                        line = ""
+                    if  line : line += " ; %s" % stmt
+                    else     : line  = " %s"   % stmt
+                if  line :
+                    lines.append (line)
+
+                txt = ""
+                for line in lines :
+
+                    self.logger.debug    ('run_pipelined: %s' % line)
+                    self.pty_shell.write ("%s\n" % line)
+
+                    fret, match = self.pty_shell.find ([self.prompt], timeout=-1.0)  # blocks
+
+                    if  fret == None :
+                        # not find prompt after blocking?  BAD!  Restart the shell
+                        self.finalize (kill_pty=True)
+                        raise se.IncorrectState ("run_pipelined failed, no prompt (%s)" % line)
+
+                    _, out = self._eval_prompt (match)
+                    txt   += out
+
+                # demultiplex the output
+                sentinel = re.compile ("\n%s-([RE])-(\d+)-(?:(\d+)-)?\n" % re.escape (token))
+
+                results = [[None, None, None] for command in commands]
+                start   = 0
+                for m in sentinel.finditer (txt) :
+
+                    data  = txt[start:m.start ()]
+                    start = m.end ()
+                    idx   = int (m.group (2))
+
+                    if  m.group (1) == 'R' :
+                        results[idx][0] = int (m.group (3))
+                        if  iomode in [None, MERGED, STDOUT, SEPARATE] :
+                            results[idx][1] = data
+                    else :
+                        results[idx][2] = data
+
+                ret = list()
+                for idx, result in enumerate (results) :
+
+                    if  result[0] is None :
+                        raise se.IncorrectState ("run_pipelined failed, no exit code (%s)" \
+                                              % commands[idx])
+
+                    if  iomode in [SEPARATE, STDERR] and result[2] is None :
+                        raise se.IncorrectState ("run_pipelined failed, no stderr (%s)" \
+                                              % commands[idx])
+
+                    ret.append (tuple (result))
+
+                return ret
+
+            except Exception as e :
+                raise ptye.translate_exception (e)
+
+
     # ----------------------------------------------------------------
     #
     def run_async (self, command) :
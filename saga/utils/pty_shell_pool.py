@@ -0,0 +1,265 @@
+
+__author__    = "Andre Merzky, Ole Weidner"
+__copyright__ = "Copyright 2012-2013, The SAGA Project"
+__license__   = "MIT"
+
+
+''' Provides a pool of warm :class:`PTYShell` instances.
+
+    Starting a shell costs a process spawn, prompt negotiation and, for remote
+    shells, an ssh connection (or at least a channel on the ssh master).  Job
+    services get their command shell from the pool of their session, and
+    return it on close, so that the next job service for the same resource
+    manager starts with a warm shell.
+
+    Shells are keyed by URL schema, user, host and port, plus shell options --
+    the URL path and query do not matter for the shell.  A shell is exclusively
+    owned between `get()` and `put()`.  Pooled shells are health checked before
+    they are handed out again: the shell process must be alive, and shells
+    which idled for more than `probe_after` seconds must also run a no-op
+    command successfully.  Shells idling for more than `max_idle_time` seconds
+    are closed.
+'''
+
+import time
+import threading
+
+import radical.utils.logger as rul
+
+import saga.url             as surl
+
+
+# ------------------------------------------------------------------------------
+#
+class PTYShellPool (object) :
+
+    # --------------------------------------------------------------------------
+    #
+    def __init__ (self, max_idle=10, max_idle_time=10*60, probe_after=60) :
+
+        self.max_idle      = max_idle       # max idle shells per key
+        self.max_idle_time = max_idle_time  # close shells idle for longer
+        self.probe_after   = probe_after    # run a no-op on shells idle for longer
+
+        self._idle   = dict ()   # key -> [(shell, t_released), ...]
+        self._keys   = dict ()   # id(shell) -> key
+        self._lock   = threading.Lock ()
+        self._logger = rul.getLogger ('saga', 'PTYShellPool')
+
+
+    # --------------------------------------------------------------------------
+    #
+    def _key (self, url, opts, posix) :
+
+        url = surl.Url (url)
+        return "%s://%s@%s:%s %s %s" % (url.schema, url.username, url.host,
+                                        url.port, sorted (opts.items ()), posix)
+
+
+    # --------------------------------------------------------------------------
+    #
+    def _healthy (self, shell, idle) :
+
+        try :
+            if  not shell.alive (recover=False) :
+                return False
+
+            if  idle > self.probe_after :
+                ret, _, _ = shell.run_sync (" true", iomode=None)
+                if  ret != 0 :
+                    return False
+
+            return True
+
+        except Exception as e :
+            self._logger.debug ("pooled shell failed health check: %s" % e)
+            return False
+
+
+    # --------------------------------------------------------------------------
+    #
+    def _close (self, shell) :
+
+        try :
+            shell.finalize (kill_pty=True)
+        except Exception :
+            pass
+
+
+    # --------------------------------------------------------------------------
+    #
+    def get (self, url, session, logger=None, opts={}, posix=True) :
+        """
+        Return a healthy pooled shell for the given URL, or a new one.
+        """
+
+        import saga.utils.pty_shell as sups
+
+        key = self._key (url, opts, posix)
+        now = time.time ()
+
+        while True :
+
+            with self._lock :
+
+                if  not self._idle.get (key) :
+                    break
+
+                shell, t_released = self._idle[key].pop ()
+
+            # check health outside of the lock, it may take a roundtrip
+            idle = now - t_released
+
+            if  idle > self.max_idle_time or \
+                not self._healthy (shell, idle) :
+                self._logger.debug ("close stale pooled shell for %s" % key)
+                with self._lock :
+                    self._keys.pop (id(shell), None)
+                self._close (shell)
+                continue
+
+            if  logger :
+                shell.logger = logger
+
+            self._logger.debug ("reuse pooled shell for %s (idle %.1fs)" % (key, idle))
+            return shell
+
+        shell = sups.PTYShell (url, session, logger, opts=opts, posix=posix)
+
+        with self._lock :
+            self._keys[id(shell)] = key
+
+        return shell
+
+
+    # --------------------------------------------------------------------------
+    #
+    def put (self, shell) :
+        """
+        Return a shell to the pool.  Dead shells, shells not created by this
+        pool, and shells exceeding the per key idle limit are closed.  Putting
+        a shell which is already pooled is a no-op.
+        """
+
+        if  not shell :
+            return
+
+        with self._lock :
+            key = self._keys.get (id(shell))
+
+        try :
+            alive = shell.alive (recover=False)
+        except Exception :
+            alive = False
+
+        with self._lock :
+
+            if  key and alive :
+
+                idle = self._idle.setdefault (key, list())
+
+                # services may release their shell more than once
+                if  shell in [s for (s, t) in idle] :
+                    return
+
+                # drop shells which idled for too long anyway
+                now  = time.time ()
+                keep = [(s, t) for (s, t) in idle if now - t <= self.max_idle_time]
+                for (s, t) in idle :
+                    if  (s, t) not in keep :
+                        self._keys.pop (id(s), None)
+                        self._close (s)
+                idle[:] = keep
+
+                if  len (idle) < self.max_idle :
+                    idle.append ((shell, now))
+                    return
+
+            self._keys.pop (id(shell), None)
+
+        self._close (shell)
+
+
+    # --------------------------------------------------------------------------
+    #
+    def close (self) :
+        """
+        Close all idle shells.
+        """
+
+        with self._lock :
+            shells = [s for idle in self._idle.values () for (s, t) in idle]
+            self._idle = dict ()
+            for shell in shells :
+                self._keys.pop (id(shell), None)
+
+        for shell in shells :
+            self._close (shell)
+
+
+# ------------------------------------------------------------------------------
+#
+if __name__ == '__main__' :
+
+    # benchmark on a local fork:// shell:
+    #
+    #   python -m saga.utils.pty_shell_pool [njobs]
+    #
+    # compares shell startup with and without pool, and bulk job submission and
+    # status queries with one run_sync() per command vs. run_pipelined().
+
+    import sys
+    import saga
+    import saga.utils.pty_shell as sups
+
+    njobs = 200
+    if  len (sys.argv) > 1 :
+        njobs = int (sys.argv[1])
+
+    session = saga.Session ()
+    url     = 'fork://localhost'
+
+    def timed (name, n, func) :
+        start = time.time ()
+        ret   = func ()
+        t     = time.time () - start
+        print "%-36s : %7.3fs  %8.1f ops/s  %7.2fms/op" % (name, t, n / t, 1000.0 * t / n)
+        return ret
+
+    # shell startup
+    nshells = 10
+    def fresh () :
+        for i in range (nshells) :
+            sups.PTYShell (url, session).finalize (kill_pty=True)
+
+    pool = PTYShellPool ()
+    pool.put (pool.get (url, session))
+    def pooled () :
+        for i in range (nshells) :
+            pool.put (pool.get (url, session))
+
+    timed ("shell startup, new shell",    nshells, fresh)
+    timed ("shell startup, pooled shell", nshells, pooled)
+
+    shell  = pool.get (url, session)
+    submit = ["nohup sleep 1 >/dev/null 2>&1 & echo $!"] * njobs
+
+    def serial_submit () :
+        return [shell.run_sync (cmd)[1].strip () for cmd in submit]
+
+    def pipelined_submit () :
+        return [out.strip () for (_, out, _) in shell.run_pipelined (submit)]
+
+    pids   = timed ("submit %d jobs, run_sync"      % njobs, njobs, serial_submit)
+    pids  += timed ("submit %d jobs, run_pipelined" % njobs, njobs, pipelined_submit)
+
+    query  = ["kill -0 %s" % pid for pid in pids[:njobs]]
+
+    timed ("query %d states, run_sync"      % njobs, njobs,
+           lambda : [shell.run_sync (cmd)[0] for cmd in query])
+    timed ("query %d states, run_pipelined" % njobs, njobs,
+           lambda : [ret for (ret, _, _) in shell.run_pipelined (query)])
+
+    pool.put (shell)
+    pool.close ()
+
@@ -0,0 +1,392 @@
+
+__author__    = "Andre Merzky, Ole Weidner"
+__copyright__ = "Copyright 2012-2013, The SAGA Project"
+__license__   = "MIT"
+
+
+''' Tests of the bulk state updates of the job adaptors (see
+    :mod:`saga.utils.job.bulk_monitor`) against recorded batch system output,
+    with the fakes of :mod:`saga.utils.job.bulk_testing`:
+
+        python -m saga.utils.test_bulk_update
+'''
+
+import unittest
+
+import saga
+import saga.utils.job.bulk_testing  as sbt
+
+import saga.adaptors.pbs.pbsjob     as pbsjob
+import saga.adaptors.lsf.lsfjob     as lsfjob
+import saga.adaptors.sge.sgejob     as sgejob
+import saga.adaptors.slurm.slurm_job as slurm_job
+
+
+# ------------------------------------------------------------------------------
+#
+BJOBS_OUTPUT = """\
+2001,RUN,node01,-,Oct 13 14:17,Oct 13 14:18,-
+2002,DONE,node02,-,Oct 13 14:17,Oct 13 14:18,Oct 13 14:27 L
+2003,EXIT,node03,127,Oct 13 14:17,Oct 13 14:19,Oct 13 14:19 L
+2004,PEND,-,-,Oct 13 14:20,-,-
+Job <2005> is not found
+"""
+
+
+# ------------------------------------------------------------------------------
+#
+class LSFBulkUpdateTest (unittest.TestCase) :
+
+    def service (self, responses, states) :
+        jobs = dict()
+        for pid, state in states.iteritems () :
+            job_obj = sbt.FakeJob ()
+            job_obj.pid = pid
+            jobs[job_obj] = {'state' : state, 'gone' : False,
+                             'job_id' : '[lsf+ssh://host]-[%s]' % pid if pid else None}
+        commands = {'bjobs' : {'path' : '/usr/bin/bjobs', 'version' : '9.1'}}
+        return sbt.make_service (lsfjob.LSFJobService, responses, jobs, _commands=commands)
+
+    def job (self, js, pid) :
+        return [job_info for job_obj, job_info in js.jobs.items () if job_obj.pid == pid][0]
+
+    def test_parse_bjobs_output (self) :
+        records, not_found = lsfjob._parse_bjobs_output (BJOBS_OUTPUT)
+        self.assertEqual (sorted (records.keys ()), ['2001', '2002', '2003', '2004'])
+        self.assertEqual (not_found, ['2005'])
+        self.assertEqual (records['2001']['state'], saga.job.RUNNING)
+        self.assertFalse ('returncode' in records['2001'])
+        self.assertEqual (records['2003']['state'], saga.job.FAILED)
+        self.assertEqual (records['2003']['returncode'], 127)
+        self.assertEqual (records['2004']['state'], saga.job.PENDING)
+
+    def test_bulk_update (self) :
+        js = self.service ([(255, BJOBS_OUTPUT, '')],
+                           {'2001' : saga.job.PENDING, '2002' : saga.job.RUNNING,
+                            '2003' : saga.job.RUNNING, '2004' : saga.job.PENDING,
+                            '2005' : saga.job.RUNNING, '1000' : saga.job.DONE,
+                            None   : saga.job.NEW})
+        self.assertEqual (js._bulk_update (), 4)
+
+        # one bjobs call for all submitted, non-final jobs
+        self.assertEqual (len (js.shell.commands), 1)
+        command = js.shell.commands[0]
+        self.assertTrue  (command.startswith ("/usr/bin/bjobs -noheader -o '%s' " % lsfjob.BJOBS_FIELDS))
+        self.assertEqual (sorted (command.split ("' ")[1].split ()), ['2001', '2002', '2003', '2004', '2005'])
+
+        self.assertEqual (self.job (js, '2001')['state'], saga.job.RUNNING)
+        self.assertEqual (self.job (js, '2002')['state'], saga.job.DONE)
+        self.assertEqual (self.job (js, '2003')['returncode'], 127)
+        self.assertEqual (self.job (js, '2004')['state'], saga.job.PENDING)
+        self.assertEqual ((self.job (js, '2005')['state'], self.job (js, '2005')['gone']), (saga.job.DONE, True))
+
+        # callbacks only for the jobs which changed state
+        for job_obj in js.jobs :
+            expected = {'2001' : [saga.job.RUNNING], '2002' : [saga.job.DONE],
+                        '2003' : [saga.job.FAILED],  '2005' : [saga.job.DONE]}.get (job_obj.pid, [])
+            self.assertEqual (job_obj.states, expected)
+
+    def test_bulk_update_error (self) :
+        js = self.service ([(255, "LSF is down. Please wait ...", '')], {'2001' : saga.job.RUNNING})
+        self.assertEqual (js._bulk_update (), 0)
+        self.assertEqual (self.job (js, '2001')['state'], saga.job.RUNNING)
+
+
+# ------------------------------------------------------------------------------
+#
+QSTAT_TORQUE_XML = """\
+<Data><Job><Job_Id>1234.pbs.example.org</Job_Id><Job_Name>saga-job</Job_Name>\
+<Job_Owner>user@login1.example.org</Job_Owner><job_state>R</job_state>\
+<queue>batch</queue><ctime>1476363430</ctime><exec_host>node01/1+node01/0</exec_host>\
+<start_time>1476363440</start_time></Job>\
+<Job><Job_Id>1235.pbs.example.org</Job_Id><Job_Name>saga-job</Job_Name>\
+<job_state>C</job_state><queue>batch</queue><ctime>1476363431</ctime>\
+<exec_host>node02/0</exec_host><exit_status>0</exit_status>\
+<start_time>1476363441</start_time><comp_time>1476363501</comp_time></Job></Data>
+"""
+
+QSTAT_PBSPRO_FULL = """\
+Job Id: 4711.pbspro-server
+    Job_Name = saga-job
+    Job_Owner = user@login1
+    job_state = F
+    queue = workq
+    exec_host = node12/0*8+node13/0*8
+    Exit_status = 1
+    ctime = Thu Oct 13 14:17:10 2016
+    stime = Thu Oct 13 14:17:12 2016
+    mtime = Thu Oct 13 14:27:45 2016
+    Variable_List = PBS_O_HOME=/home/user,PBS_O_LANG=en_US.UTF-8,
+\tPBS_O_LOGNAME=user
+
+Job Id: 4712.pbspro-server
+    Job_Name = saga-job
+    job_state = Q
+    queue = workq
+    ctime = Thu Oct 13 14:17:11 2016
+
+"""
+
+
+# ------------------------------------------------------------------------------
+#
+class PBSBulkUpdateTest (unittest.TestCase) :
+
+    def service (self, version, responses, states) :
+        jobs = dict()
+        for pid, state in states.iteritems () :
+            jobs['[pbs+ssh://host]-[%s]' % pid] = {'state' : state, 'gone' : False, 'obj' : sbt.FakeJob ()}
+        commands = {'qstat' : {'path' : '/usr/bin/qstat', 'version' : version}}
+        return sbt.make_service (pbsjob.PBSJobService, responses, jobs, _commands=commands)
+
+    def test_parse_qstat_xml (self) :
+        records = pbsjob._parse_qstat_xml ("some shell noise\n" + QSTAT_TORQUE_XML)
+        self.assertEqual (sorted (records.keys ()), ['1234', '1235'])
+        self.assertEqual (records['1234']['job_state'], 'R')
+        self.assertEqual (records['1235']['exit_status'], '0')
+        self.assertEqual (pbsjob._parse_qstat_xml ("qstat: command not found"), {})
+
+    def test_parse_qstat_full (self) :
+        records = pbsjob._parse_qstat_full (QSTAT_PBSPRO_FULL)
+        self.assertEqual (sorted (records.keys ()), ['4711', '4712'])
+        self.assertEqual (records['4711']['exec_host'], 'node12/0*8+node13/0*8')
+        self.assertEqual (records['4711']['Variable_List'],
+                          'PBS_O_HOME=/home/user,PBS_O_LANG=en_US.UTF-8,PBS_O_LOGNAME=user')
+        self.assertEqual (records['4712']['job_state'], 'Q')
+
+    def test_pbs_job_info (self) :
+        info = pbsjob._pbs_job_info (pbsjob._parse_qstat_xml (QSTAT_TORQUE_XML)['1235'])
+        self.assertEqual (info['state'], saga.job.DONE)
+        self.assertEqual (info['returncode'], 0)
+        self.assertEqual (info['exec_hosts'], ['node02/0'])
+        self.assertEqual (info['end_time'], '1476363501')
+        info = pbsjob._pbs_job_info (pbsjob._parse_qstat_full (QSTAT_PBSPRO_FULL)['4711'])
+        self.assertEqual (info['state'], saga.job.DONE)
+        self.assertEqual (info['returncode'], 1)
+        self.assertEqual (info['start_time'], 'Thu Oct 13 14:17:12 2016')
+
+    def test_bulk_update_torque (self) :
+        js = self.service ('Torque 4.2.10', [(0, QSTAT_TORQUE_XML, '')],
+                           {'1234' : saga.job.PENDING, '1235' : saga.job.RUNNING, '1000' : saga.job.DONE})
+        self.assertEqual (js._bulk_update (), 2)
+
+        # one qstat for all non-final jobs
+        self.assertEqual (len (js.shell.commands), 1)
+        self.assertTrue  (js.shell.commands[0].startswith ('/usr/bin/qstat -f -x '))
+        self.assertEqual (sorted (js.shell.commands[0].split ()[3:]), ['1234', '1235'])
+
+        job = js.jobs['[pbs+ssh://host]-[1235]']
+        self.assertEqual (job['state'], saga.job.DONE)
+        self.assertEqual (job['returncode'], 0)
+        self.assertEqual (job['obj'].states, [saga.job.DONE])
+        self.assertEqual (js.jobs['[pbs+ssh://host]-[1234]']['obj'].states, [saga.job.RUNNING])
+
+        # nothing changed: no callbacks
+        js.shell.responses.append ((0, QSTAT_TORQUE_XML, ''))
+        self.assertEqual (js._bulk_update (), 0)
+        self.assertEqual (js.jobs['[pbs+ssh://host]-[1234]']['obj'].states, [saga.job.RUNNING])
+
+    def test_bulk_update_pbspro (self) :
+        js = self.service ('PBSPro_13.1.0', [(0, QSTAT_PBSPRO_FULL, '')],
+                           {'4711' : saga.job.RUNNING, '4712' : saga.job.PENDING})
+        self.assertEqual (js._bulk_update (), 1)
+        self.assertTrue  (js.shell.commands[0].startswith ('/usr/bin/qstat -fx '))
+        self.assertEqual (js.jobs['[pbs+ssh://host]-[4711]']['state'], saga.job.DONE)
+        self.assertEqual (js.jobs['[pbs+ssh://host]-[4711]']['returncode'], 1)
+        self.assertEqual (js.jobs['[pbs+ssh://host]-[4712]']['obj'].states, [])
+
+    def test_bulk_update_gone (self) :
+        out = QSTAT_TORQUE_XML[:QSTAT_TORQUE_XML.index ('<Job><Job_Id>1235')] + "</Data>\n" \
+            + "qstat: Unknown Job Id 1236.pbs.example.org\n"
+        js  = self.service ('Torque 4.2.10', [(153, out, '')],
+                            {'1234' : saga.job.RUNNING, '1236' : saga.job.RUNNING})
+        self.assertEqual (js._bulk_update (), 1)
+        job = js.jobs['[pbs+ssh://host]-[1236]']
+        self.assertEqual ((job['state'], job['gone']), (saga.job.DONE, True))
+
+        # gone jobs are not queried anymore
+        js.shell.responses.append ((0, QSTAT_TORQUE_XML, ''))
+        js._bulk_update ()
+        self.assertEqual (js.shell.commands[1].split ()[3:], ['1234'])
+
+    def test_bulk_update_error (self) :
+        js = self.service ('Torque 4.2.10', [(1, "qstat: cannot connect to server", '')],
+                           {'1234' : saga.job.RUNNING})
+        self.assertEqual (js._bulk_update (), 0)
+        self.assertEqual (js.jobs['[pbs+ssh://host]-[1234]']['state'], saga.job.RUNNING)
+
+
+# ------------------------------------------------------------------------------
+#
+QSTAT_XML = """\
+<?xml version='1.0'?>
+<job_info  xmlns:xsd="http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qstat/qstat.xsd">
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>5001</JB_job_number>
+      <JAT_prio>0.55500</JAT_prio>
+      <JB_name>saga-job</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>r</state>
+      <JAT_start_time>2016-10-13T14:17:12</JAT_start_time>
+      <queue_name>all.q@node01.example.org</queue_name>
+      <slots>1</slots>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>5002</JB_job_number>
+      <JAT_prio>0.00000</JAT_prio>
+      <JB_name>saga-job</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>qw</state>
+      <JB_submission_time>2016-10-13T14:17:10</JB_submission_time>
+      <queue_name></queue_name>
+      <slots>1</slots>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>5003</JB_job_number>
+      <JB_name>saga-job</JB_name>
+      <state>Eqw</state>
+      <queue_name></queue_name>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+
+# ------------------------------------------------------------------------------
+#
+class SGEBulkUpdateTest (unittest.TestCase) :
+
+    def service (self, responses, states, accounting=False) :
+        jobs = dict()
+        for pid, state in states.iteritems () :
+            jobs['[sge+ssh://host]-[%s]' % pid] = {'state' : state, 'gone' : False}
+        commands = {'qstat' : {'path' : '/usr/bin/qstat', 'version' : 'GE 6.2u5'}}
+        js = sbt.make_service (sgejob.SGEJobService, responses, jobs, _commands=commands, accounting=accounting)
+
+        # finished jobs are looked up one by one
+        js.retrieved = list()
+        def retrieve (job_id) :
+            js.retrieved.append (job_id)
+            return {'state' : saga.job.DONE, 'returncode' : 0}
+        js._retrieve_job = retrieve
+        return js
+
+    def test_parse_qstat_xml (self) :
+        records = sgejob._parse_qstat_xml ("noise\n" + QSTAT_XML)
+        self.assertEqual (sorted (records.keys ()), ['5001', '5002', '5003'])
+        self.assertEqual (records['5001'], {'state' : 'r', 'start_time' : '2016-10-13T14:17:12',
+                                            'queue' : 'all.q@node01.example.org'})
+        self.assertEqual (records['5002'], {'state' : 'qw', 'start_time' : None, 'queue' : None})
+        self.assertEqual (sgejob._parse_qstat_xml ("error: commlib error"), {})
+
+    def test_bulk_update (self) :
+        js = self.service ([(0, QSTAT_XML, '')],
+                           {'5001' : saga.job.PENDING, '5002' : saga.job.PENDING,
+                            '5003' : saga.job.PENDING, '5004' : saga.job.RUNNING,
+                            '1000' : saga.job.DONE})
+        self.assertEqual (js._bulk_update (), 3)
+        self.assertEqual (js.shell.commands, ['/usr/bin/qstat -xml'])
+
+        job = lambda pid : js.jobs['[sge+ssh://host]-[%s]' % pid]
+        self.assertEqual (job ('5001')['state'], saga.job.RUNNING)
+        self.assertEqual (job ('5001')['start_time'], 'Thu Oct 13 14:17:12 2016')
+        self.assertEqual (job ('5001')['exec_hosts'], 'node01.example.org')
+        self.assertEqual (job ('5002')['state'], saga.job.PENDING)
+        self.assertEqual (job ('5003')['state'], saga.job.FAILED)
+
+        # a job which left the queue
+        self.assertEqual (js.retrieved, ['[sge+ssh://host]-[5004]'])
+        self.assertEqual (job ('5004')['state'], saga.job.DONE)
+
+    def test_bulk_update_accounting (self) :
+        # with accounting, the reason of an Eqw job is looked up
+        js = self.service ([(0, QSTAT_XML, '')], {'5003' : saga.job.PENDING}, accounting=True)
+        js._bulk_update ()
+        self.assertEqual (js.retrieved, ['[sge+ssh://host]-[5003]'])
+
+    def test_bulk_update_error (self) :
+        js = self.service ([(1, "error: commlib error: got select error (Connection refused)", '')],
+                           {'5001' : saga.job.RUNNING})
+        self.assertEqual (js._bulk_update (), 0)
+        self.assertEqual (js.jobs['[sge+ssh://host]-[5001]']['state'], saga.job.RUNNING)
+        self.assertEqual (js.retrieved, [])
+
+
+# ------------------------------------------------------------------------------
+#
+SQUEUE_OUTPUT = """\
+3001|RUNNING|nid00[012-015]
+3002|PENDING|
+3005|COMPLETING|nid00020
+"""
+
+SACCT_OUTPUT = """\
+3003|COMPLETED
+3003.batch|COMPLETED
+3003.0|COMPLETED
+3004|CANCELLED by 900369
+3004.batch|CANCELLED
+"""
+
+
+# ------------------------------------------------------------------------------
+#
+class SLURMBulkUpdateTest (unittest.TestCase) :
+
+    def service (self, responses, states) :
+        jobs = dict()
+        for pid, state in states.iteritems () :
+            jobs['[slurm+ssh://host]-[%s]' % pid] = {'state' : state, 'gone' : False}
+        return sbt.make_service (slurm_job.SLURMJobService, responses, jobs)
+
+    def test_parse_squeue_output (self) :
+        records = slurm_job._parse_squeue_output (SQUEUE_OUTPUT + "slurm_load_jobs error: Invalid job id specified\n")
+        self.assertEqual (records, {'3001' : ('RUNNING', 'nid00[012-015]'),
+                                    '3002' : ('PENDING', ''),
+                                    '3005' : ('COMPLETING', 'nid00020')})
+
+    def test_parse_sacct_output (self) :
+        self.assertEqual (slurm_job._parse_sacct_output (SACCT_OUTPUT), {'3003' : 'COMPLETED', '3004' : 'CANCELLED'})
+
+    def test_bulk_update (self) :
+        js = self.service ([(0, SQUEUE_OUTPUT, ''), (0, SACCT_OUTPUT, '')],
+                           {'3001' : saga.job.PENDING, '3002' : saga.job.PENDING,
+                            '3003' : saga.job.RUNNING, '3004' : saga.job.RUNNING,
+                            '3005' : saga.job.RUNNING, '1000' : saga.job.DONE})
+        self.assertEqual (js._bulk_update (), 3)
+
+        # one squeue for all non-final jobs, one sacct for those which left the queue
+        self.assertEqual (len (js.shell.commands), 2)
+        squeue, sacct = js.shell.commands
+        self.assertTrue  (squeue.startswith ('squeue -h -o "%i|%T|%N" -j '))
+        self.assertEqual (sorted (squeue.split ()[-1].split (',')), ['3001', '3002', '3003', '3004', '3005'])
+        self.assertEqual (sorted (sacct.split ('--jobs=')[1].split (',')), ['3003', '3004'])
+
+        job = lambda pid : js.jobs['[slurm+ssh://host]-[%s]' % pid]
+        self.assertEqual (job ('3001')['state'], saga.job.RUNNING)
+        self.assertEqual (job ('3001')['exec_hosts'], 'nid00[012-015]')
+        self.assertEqual (job ('3002')['state'], saga.job.PENDING)
+        self.assertFalse ('exec_hosts' in job ('3002'))
+        self.assertEqual (job ('3003')['state'], saga.job.DONE)
+        self.assertEqual (job ('3004')['state'], saga.job.CANCELED)
+        self.assertEqual (job ('3005')['state'], saga.job.RUNNING)
+
+    def test_bulk_job_state (self) :
+        js = self.service ([(0, SQUEUE_OUTPUT, '')], {'3001' : saga.job.PENDING, '3005' : saga.job.RUNNING})
+
+        # the first query refreshes all jobs, the second is served from the cache
+        self.assertEqual (js._bulk_job_state ('[slurm+ssh://host]-[3001]'), saga.job.RUNNING)
+        self.assertEqual (js._bulk_job_state ('[slurm+ssh://host]-[3005]'), saga.job.RUNNING)
+        self.assertEqual (len (js.shell.commands), 1)
+        self.assertEqual (js._bulk_job_state ('[slurm+ssh://host]-[4000]'), None)
+
+
+# ------------------------------------------------------------------------------
+#
+if __name__ == '__main__' :
+
+    unittest.main ()
+
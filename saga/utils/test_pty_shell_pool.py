@@ -0,0 +1,202 @@
+
+__author__    = "Andre Merzky, Ole Weidner"
+__copyright__ = "Copyright 2012-2013, The SAGA Project"
+__license__   = "MIT"
+
+
+''' Tests for pipelined command execution in :class:`PTYShell`, and for the
+    way the job services return their shell to the :class:`PTYShellPool`.
+
+    The tests run on a local fork:// shell:
+
+        python -m saga.utils.test_pty_shell_pool
+'''
+
+import unittest
+
+import saga
+import saga.utils.pty_shell         as sups
+import saga.utils.pty_shell_pool    as supp
+import saga.utils.job.bulk_testing  as sbt
+
+import saga.adaptors.pbs.pbsjob     as pbsjob
+import saga.adaptors.lsf.lsfjob     as lsfjob
+import saga.adaptors.sge.sgejob     as sgejob
+import saga.adaptors.slurm.slurm_job as slurm_job
+
+
+URL = 'fork://localhost'
+
+SERVICES = [pbsjob.PBSJobService,
+            lsfjob.LSFJobService,
+            sgejob.SGEJobService,
+            slurm_job.SLURMJobService]
+
+
+# ------------------------------------------------------------------------------
+#
+class FakeSession (object) :
+
+    def __init__ (self, pool) :
+        self._shell_pool = pool
+
+
+# ------------------------------------------------------------------------------
+#
+class RecordingPool (object) :
+
+    def __init__ (self) :
+        self.puts = list()
+
+    def put (self, shell) :
+        self.puts.append (shell)
+
+
+# ------------------------------------------------------------------------------
+#
+class FakeMonitor (object) :
+    """ a monitoring thread which does not stop
+    """
+
+    def stop (self) :
+        pass
+
+    def join (self, timeout=None) :
+        pass
+
+    def isAlive (self) :
+        return True
+
+
+# ------------------------------------------------------------------------------
+#
+class ClosableShell (object) :
+
+    def __init__ (self) :
+        self.finalized = False
+
+    def finalize (self, kill_pty=False) :
+        self.finalized = True
+
+
+# ------------------------------------------------------------------------------
+#
+class PipelinedTest (unittest.TestCase) :
+
+    @classmethod
+    def setUpClass (cls) :
+        cls.session = saga.Session ()
+        cls.shell   = sups.PTYShell (URL, cls.session)
+
+    @classmethod
+    def tearDownClass (cls) :
+        cls.shell.finalize (kill_pty=True)
+
+    def test_outputs_in_command_order (self) :
+
+        commands = ["echo out-%d ; (exit %d)" % (i, i % 7)
+                    for i in range (20)]
+        results  = self.shell.run_pipelined (commands)
+
+        self.assertEqual (len (results), len (commands))
+        for i, (ret, out, err) in enumerate (results) :
+            self.assertEqual (ret, i % 7)
+            self.assertEqual (out.strip (), "out-%d" % i)
+
+    def test_separate_stderr (self) :
+
+        commands = ["sh -c 'echo out-%d ; echo err-%d 1>&2 ; exit %d'" % (i, i, i % 3)
+                    for i in range (10)]
+        results  = self.shell.run_pipelined (commands, iomode=sups.SEPARATE)
+
+        for i, (ret, out, err) in enumerate (results) :
+            self.assertEqual (ret, i % 3)
+            self.assertEqual (out.strip (), "out-%d" % i)
+            self.assertEqual (err.strip (), "err-%d" % i)
+
+    def test_multiple_command_lines (self) :
+
+        # more than _PIPE_MAX_LINE characters of commands need more than one
+        # command line, the outputs must still line up with the commands
+        commands = ["echo %s-%d" % ('x' * 50, i) for i in range (300)]
+        self.assertTrue (sum ([len (c) for c in commands]) > sups._PIPE_MAX_LINE)
+
+        results  = self.shell.run_pipelined (commands)
+        expected = [self.shell.run_sync (c) for c in commands[:5]]
+
+        self.assertEqual (len (results), len (commands))
+        for i, (ret, out, err) in enumerate (results) :
+            self.assertEqual (ret, 0)
+            self.assertEqual (out.strip (), "%s-%d" % ('x' * 50, i))
+        for i, (ret, out, err) in enumerate (expected) :
+            self.assertEqual ((ret, out.strip ()), (results[i][0], results[i][1].strip ()))
+
+
+# ------------------------------------------------------------------------------
+#
+class ShellReleaseTest (unittest.TestCase) :
+
+    def make_service (self, cls, pool, shell, mt=None) :
+        return sbt.make_service (cls, [], {}, session=FakeSession (pool),
+                                 shell=shell, mt=mt)
+
+    def test_released_once (self) :
+
+        for cls in SERVICES :
+            pool  = RecordingPool ()
+            shell = ClosableShell ()
+            js    = self.make_service (cls, pool, shell)
+
+            # close() followed by finalize() (the SLURM service has none),
+            # as __del__ would do
+            js.close ()
+            if  hasattr (js, 'finalize') :
+                js.finalize (True)
+            js.close ()
+
+            self.assertEqual (pool.puts, [shell], cls.__name__)
+            self.assertEqual (js.shell, None)
+
+    def test_busy_monitor_shell_not_pooled (self) :
+
+        for cls in [pbsjob.PBSJobService, lsfjob.LSFJobService] :
+            pool  = RecordingPool ()
+            shell = ClosableShell ()
+            js    = self.make_service (cls, pool, shell, mt=FakeMonitor ())
+
+            js.close ()
+
+            self.assertEqual (pool.puts, [])
+            self.assertTrue  (shell.finalized)
+
+    def test_no_shared_shell (self) :
+
+        session = saga.Session ()
+        pool    = supp.PTYShellPool ()
+
+        try :
+            a  = pool.get (URL, session)
+            js = self.make_service (pbsjob.PBSJobService, pool, a)
+
+            js.close ()
+            b = pool.get (URL, session)
+            self.assertTrue (a is b)
+
+            # a stale release must not hand b out a second time
+            js.finalize (True)
+            c = pool.get (URL, session)
+            self.assertFalse (c is b)
+
+            pool.put (b)
+            pool.put (c)
+
+        finally :
+            pool.close ()
+
+
+# ------------------------------------------------------------------------------
+#
+if __name__ == '__main__' :
+
+    unittest.main ()
+
@@ -22,6 +22,7 @@ from PilotErrors import PilotErrors
 from pUtil import tolog, readpar, getSiteInformation, extractFilePaths, getExperiment
 from FileStateClient import updateFileState
 from SiteInformation import SiteInformation
+import CopytoolSetupCache
 
 class xrdcpSiteMover(SiteMover.SiteMover):
     """ SiteMover that uses xrdcp for both get and put """
@@ -118,7 +119,7 @@ class xrdcpSiteMover(SiteMover.SiteMover):
         # get the experiment object
         thisExperiment = getExperiment(experiment)
 
-        status, output = thisExperiment.verifyProxy(envsetup=_setupStr)
+        status, output = CopytoolSetupCache.verifyProxy(thisExperiment, _setupStr)
         return status, output
 
     def verifySetup(self, _setupStr, experiment, proxycheck=False):
@@ -133,7 +134,8 @@ class xrdcpSiteMover(SiteMover.SiteMover):
             command = command + ";"
         command += " which " + self.copyCommand
         self.log("Execute command:  %s" % command)
-        status, output = commands.getstatusoutput(command)
+        # probed once per process for a given setup, copy command and proxy
+        status, output = CopytoolSetupCache.probeSetup(_setupStr, self.copyCommand)
         self.log("Status: %s, Output: %s" % (status, output))
         if status != 0:
             self.log(self.copyCommand +" is not found in envsetup: " + _setupStr)
@@ -286,7 +288,8 @@ class xrdcpSiteMover(SiteMover.SiteMover):
         outputRet["report"]['relativeStart'] = time()
         outputRet["report"]['transferStart'] = time()
         try:
-            timerCommand = TimerCommand(_cmd_str)
+            _cmd, _env = CopytoolSetupCache.splitCommand(_cmd_str, self._setup, self.copyCommand)
+            timerCommand = TimerCommand(_cmd, env=_env)
             s, o = timerCommand.run(timeout=self.timeout)
         except Exception, e:
             tolog("!!WARNING!!2990!! Exception caught by stageInFile(): %s" % (str(e)))
@@ -546,7 +549,7 @@ class xrdcpSiteMover(SiteMover.SiteMover):
 
         command = "%s xrdcp -h" % (self._setup)
         tolog("Execute command(%s) to decide whether -adler or --cksum adler32 to be used." % command)
-        status_local, output_local = commands.getstatusoutput(command)
+        status_local, output_local = CopytoolSetupCache.getstatusoutput(command, self._setup, self.copyCommand)
         tolog("status: %s, output: %s" % (status_local, output_local))
         checksum_option = ""
         if "-adler" in output_local:
@@ -571,7 +574,8 @@ class xrdcpSiteMover(SiteMover.SiteMover):
         outputRet["report"]['relativeStart'] = time()
         outputRet["report"]['transferStart'] =  time()
         try:
-            timerCommand = TimerCommand(_cmd_str)
+            _cmd, _env = CopytoolSetupCache.splitCommand(_cmd_str, self._setup, self.copyCommand)
+            timerCommand = TimerCommand(_cmd, env=_env)
             ec, o = timerCommand.run(timeout=self.timeout)
         except Exception, e:
             tolog("!!WARNING!!2999!! xrdcp threw an exception: %s" % (o))
@@ -609,7 +613,7 @@ class xrdcpSiteMover(SiteMover.SiteMover):
         cmd = "%s xrdadler32 %s" % (self._setup, full_surl)
         tolog("Executing command: %s" % (cmd))
         try:
-            ec, output = commands.getstatusoutput(cmd)
+            ec, output = CopytoolSetupCache.getstatusoutput(cmd, self._setup, self.copyCommand)
         except Exception, e:
             tolog("Warning: (Exception caught) xrdadler32 failed: %s" % (e))
             output = None